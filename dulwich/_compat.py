@@ -136,6 +136,35 @@ except ImportError:
                 return
 
 
+try:
+    from heapq import merge
+except ImportError:
+    # Implementation of merge from Python 2.6 heapq module:
+    # Copyright (c) 2001-2010 Python Software Foundation; All Rights Reserved
+    # Licensed under the Python Software Foundation License.
+    from heapq import heapify, heappop, heapreplace
+    def merge(*iterables):
+        h = []
+        for itnum, it in enumerate(map(iter, iterables)):
+            try:
+                next = it.next
+                h.append([next(), itnum, next])
+            except StopIteration:
+                pass
+        heapify(h)
+        while 1:
+            try:
+                while 1:
+                    v, itnum, next = s = h[0]
+                    yield v
+                    s[0] = next()
+                    heapreplace(h, s)
+            except StopIteration:
+                heappop(h)
+            except IndexError:
+                return
+
+
 try:
     all = all
 except NameError:
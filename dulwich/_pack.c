@@ -222,6 +222,328 @@ static PyObject *py_bisect_find_sha(PyObject *self, PyObject *args)
 }
 
 
+/* Size of the blocks of the base buffer that are indexed. */
+#define DELTA_BLOCK_SIZE 16
+/* Maximum number of base offsets remembered for identical blocks. */
+#define DELTA_MAX_BLOCK_OFFSETS 64
+
+struct delta_index_entry {
+	uint32_t offset;
+	int32_t next;
+};
+
+typedef struct {
+	PyObject_HEAD
+	PyObject *base;
+	uint32_t hash_mask;
+	int32_t *buckets;
+	struct delta_index_entry *entries;
+} DeltaIndexObject;
+
+static uint32_t delta_block_hash(const uint8_t *block)
+{
+	uint32_t hash = 2166136261U;
+	int i;
+	for (i = 0; i < DELTA_BLOCK_SIZE; i++) {
+		hash ^= block[i];
+		hash *= 16777619U;
+	}
+	return hash;
+}
+
+static void delta_index_dealloc(DeltaIndexObject *self)
+{
+	Py_XDECREF(self->base);
+	PyMem_Free(self->buckets);
+	PyMem_Free(self->entries);
+	self->ob_type->tp_free((PyObject *)self);
+}
+
+static PyObject *delta_index_new(PyTypeObject *type, PyObject *args,
+				 PyObject *kwargs)
+{
+	DeltaIndexObject *self;
+	PyObject *py_base;
+	const uint8_t *base;
+	Py_ssize_t base_len, num_blocks, i, num_entries = 0;
+	int32_t *tails;
+	uint32_t hash_size = 16;
+	char *kwnames[] = { "base_buf", NULL };
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwnames, &py_base))
+		return NULL;
+
+	py_base = py_chunked_as_string(py_base);
+	if (py_base == NULL)
+		return NULL;
+
+	self = (DeltaIndexObject *)type->tp_alloc(type, 0);
+	if (self == NULL) {
+		Py_DECREF(py_base);
+		return NULL;
+	}
+	self->base = py_base;
+
+	base = (const uint8_t *)PyString_AS_STRING(py_base);
+	base_len = PyString_GET_SIZE(py_base);
+	num_blocks = base_len / DELTA_BLOCK_SIZE;
+	while (hash_size < num_blocks)
+		hash_size <<= 1;
+	self->hash_mask = hash_size - 1;
+
+	self->buckets = PyMem_Malloc(hash_size * sizeof(int32_t));
+	self->entries = PyMem_Malloc(
+		(num_blocks ? num_blocks : 1) * sizeof(struct delta_index_entry));
+	tails = PyMem_Malloc(hash_size * sizeof(int32_t));
+	if (self->buckets == NULL || self->entries == NULL || tails == NULL) {
+		PyMem_Free(tails);
+		Py_DECREF(self);
+		return PyErr_NoMemory();
+	}
+	for (i = 0; i < hash_size; i++)
+		self->buckets[i] = tails[i] = -1;
+
+	/* Entries are appended to the end of each chain, so that candidates
+	 * are tried in order of increasing offset like the Python
+	 * implementation does. */
+	for (i = 0; i < num_blocks; i++) {
+		const uint8_t *block = base + i * DELTA_BLOCK_SIZE;
+		uint32_t bucket = delta_block_hash(block) & self->hash_mask;
+		int32_t e;
+		int same = 0;
+		for (e = self->buckets[bucket]; e != -1; e = self->entries[e].next) {
+			if (!memcmp(base + self->entries[e].offset, block,
+				    DELTA_BLOCK_SIZE))
+				same++;
+		}
+		if (same >= DELTA_MAX_BLOCK_OFFSETS)
+			continue;
+		self->entries[num_entries].offset = i * DELTA_BLOCK_SIZE;
+		self->entries[num_entries].next = -1;
+		if (tails[bucket] == -1)
+			self->buckets[bucket] = num_entries;
+		else
+			self->entries[tails[bucket]].next = num_entries;
+		tails[bucket] = num_entries;
+		num_entries++;
+	}
+	PyMem_Free(tails);
+
+	return (PyObject *)self;
+}
+
+static Py_ssize_t delta_index_len(DeltaIndexObject *self)
+{
+	return PyString_GET_SIZE(self->base);
+}
+
+struct delta_buffer {
+	uint8_t *data;
+	size_t len;
+	size_t size;
+};
+
+static int delta_buffer_grow(struct delta_buffer *buf, size_t extra)
+{
+	uint8_t *data;
+	size_t size = buf->size;
+	if (buf->len + extra <= size)
+		return 0;
+	while (buf->len + extra > size)
+		size = size * 2 + 64;
+	data = PyMem_Realloc(buf->data, size);
+	if (data == NULL)
+		return -1;
+	buf->data = data;
+	buf->size = size;
+	return 0;
+}
+
+static int delta_write_size(struct delta_buffer *buf, size_t size)
+{
+	if (delta_buffer_grow(buf, 10) < 0)
+		return -1;
+	while (size >= 0x80) {
+		buf->data[buf->len++] = (size & 0x7f) | 0x80;
+		size >>= 7;
+	}
+	buf->data[buf->len++] = size;
+	return 0;
+}
+
+static int delta_write_insert(struct delta_buffer *buf, const uint8_t *data,
+			      size_t len)
+{
+	while (len > 0) {
+		size_t size = len > 127 ? 127 : len;
+		if (delta_buffer_grow(buf, size + 1) < 0)
+			return -1;
+		buf->data[buf->len++] = size;
+		memcpy(buf->data + buf->len, data, size);
+		buf->len += size;
+		data += size;
+		len -= size;
+	}
+	return 0;
+}
+
+static int delta_write_copy(struct delta_buffer *buf, size_t offset,
+			    size_t len)
+{
+	while (len > 0) {
+		size_t size = len > 0x10000 ? 0x10000 : len;
+		uint8_t op = 0x80;
+		size_t op_pos;
+		int i;
+		if (delta_buffer_grow(buf, 7) < 0)
+			return -1;
+		op_pos = buf->len++;
+		for (i = 0; i < 4; i++) {
+			if (offset & (0xffUL << (i * 8))) {
+				buf->data[buf->len++] = (offset >> (i * 8)) & 0xff;
+				op |= 1 << i;
+			}
+		}
+		for (i = 0; i < 2; i++) {
+			if (size & (0xffUL << (i * 8))) {
+				buf->data[buf->len++] = (size >> (i * 8)) & 0xff;
+				op |= 1 << (4 + i);
+			}
+		}
+		buf->data[op_pos] = op;
+		offset += size;
+		len -= size;
+	}
+	return 0;
+}
+
+static PyObject *delta_index_delta_against(DeltaIndexObject *self,
+					   PyObject *args)
+{
+	PyObject *py_target, *ret;
+	const uint8_t *base, *target;
+	size_t base_len, target_len, i = 0, insert_start = 0;
+	struct delta_buffer buf = { NULL, 0, 0 };
+
+	if (!PyArg_ParseTuple(args, "O", &py_target))
+		return NULL;
+
+	py_target = py_chunked_as_string(py_target);
+	if (py_target == NULL)
+		return NULL;
+
+	base = (const uint8_t *)PyString_AS_STRING(self->base);
+	base_len = PyString_GET_SIZE(self->base);
+	target = (const uint8_t *)PyString_AS_STRING(py_target);
+	target_len = PyString_GET_SIZE(py_target);
+
+	if (delta_write_size(&buf, base_len) < 0 ||
+	    delta_write_size(&buf, target_len) < 0)
+		goto nomem;
+
+	while (i + DELTA_BLOCK_SIZE <= target_len) {
+		uint32_t bucket = delta_block_hash(target + i) & self->hash_mask;
+		size_t best_offset = 0, best_len = 0;
+		int32_t e;
+		for (e = self->buckets[bucket]; e != -1; e = self->entries[e].next) {
+			size_t offset = self->entries[e].offset, len;
+			if (memcmp(base + offset, target + i, DELTA_BLOCK_SIZE))
+				continue;
+			len = DELTA_BLOCK_SIZE;
+			while (offset + len < base_len && i + len < target_len &&
+			       base[offset + len] == target[i + len])
+				len++;
+			if (len > best_len) {
+				best_offset = offset;
+				best_len = len;
+			}
+		}
+		if (best_len == 0) {
+			i++;
+			continue;
+		}
+		/* Extend the match backwards over data we would otherwise
+		 * insert. */
+		while (best_offset > 0 && i > insert_start &&
+		       base[best_offset - 1] == target[i - 1]) {
+			best_offset--;
+			best_len++;
+			i--;
+		}
+		if (delta_write_insert(&buf, target + insert_start,
+				       i - insert_start) < 0 ||
+		    delta_write_copy(&buf, best_offset, best_len) < 0)
+			goto nomem;
+		i += best_len;
+		insert_start = i;
+	}
+	if (delta_write_insert(&buf, target + insert_start,
+			       target_len - insert_start) < 0)
+		goto nomem;
+
+	Py_DECREF(py_target);
+	ret = PyString_FromStringAndSize((char *)buf.data, buf.len);
+	PyMem_Free(buf.data);
+	return ret;
+
+nomem:
+	Py_DECREF(py_target);
+	PyMem_Free(buf.data);
+	return PyErr_NoMemory();
+}
+
+static PyMethodDef delta_index_methods[] = {
+	{ "delta_against", (PyCFunction)delta_index_delta_against,
+	  METH_VARARGS, NULL },
+	{ NULL, NULL, 0, NULL }
+};
+
+static PySequenceMethods delta_index_as_sequence = {
+	(lenfunc)delta_index_len,	/* sq_length */
+};
+
+static PyTypeObject DeltaIndexType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"dulwich._pack.DeltaIndex",	/* tp_name */
+	sizeof(DeltaIndexObject),	/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)delta_index_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	&delta_index_as_sequence,	/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"Index over a base buffer for creating deltas against it.",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	delta_index_methods,		/* tp_methods */
+	0,				/* tp_members */
+	0,				/* tp_getset */
+	0,				/* tp_base */
+	0,				/* tp_dict */
+	0,				/* tp_descr_get */
+	0,				/* tp_descr_set */
+	0,				/* tp_dictoffset */
+	0,				/* tp_init */
+	0,				/* tp_alloc */
+	delta_index_new,		/* tp_new */
+};
+
 static PyMethodDef py_pack_methods[] = {
 	{ "apply_delta", (PyCFunction)py_apply_delta, METH_VARARGS, NULL },
 	{ "bisect_find_sha", (PyCFunction)py_bisect_find_sha, METH_VARARGS, NULL },
@@ -232,7 +554,13 @@ void init_pack(void)
 {
 	PyObject *m;
 
+	if (PyType_Ready(&DeltaIndexType) < 0)
+		return;
+
 	m = Py_InitModule3("_pack", py_pack_methods, NULL);
 	if (m == NULL)
 		return;
+
+	Py_INCREF(&DeltaIndexType);
+	PyModule_AddObject(m, "DeltaIndex", (PyObject *)&DeltaIndexType);
 }
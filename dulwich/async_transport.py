@@ -0,0 +1,787 @@
+# async_transport.py -- Event loop based git protocol transports
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Event loop based transports for the git protocol.
+
+All socket I/O is done by an asyncore event loop running in a single thread,
+so that many mostly idle connections can be kept open by one process.
+
+The server parses the pkt-lines it receives in the loop thread, and only
+hands a connection to a bounded pool of worker threads once a complete round
+of them has arrived: the command, and for upload-pack the wants and each
+batch of haves. The workers open the repository, advertise the refs, look up
+the haves and eventually generate and send the pack, so that connections
+that are waiting for the client don't use a thread and the loop never waits
+for a repository. Other commands are handled by the usual blocking handlers
+on a worker; they only block on the buffers of their connection, never on a
+socket.
+"""
+
+import asyncore
+from collections import (
+    deque,
+    )
+import errno
+import os
+import Queue
+import select
+import socket
+import sys
+import thread
+import threading
+import time
+
+from dulwich.client import (
+    TCPGitClient,
+    )
+from dulwich.errors import (
+    GitProtocolError,
+    )
+from dulwich import log_utils
+from dulwich.protocol import (
+    PktLineParser,
+    Protocol,
+    ReceivableProtocol,
+    TCP_GIT_PORT,
+    )
+from dulwich.server import (
+    DEFAULT_HANDLERS,
+    ProtocolGraphWalker,
+    UploadPackHandler,
+    )
+
+logger = log_utils.getLogger(__name__)
+
+_RECV_SIZE = 65536
+
+
+if getattr(asyncore, 'file_dispatcher', None) is not None:
+
+    class _Waker(asyncore.file_dispatcher):
+        """Pipe that is used to wake up the event loop from other threads."""
+
+        def __init__(self, map):
+            read_fd, self._write_fd = os.pipe()
+            asyncore.file_dispatcher.__init__(self, read_fd, map=map)
+            os.close(read_fd)
+
+        def writable(self):
+            return False
+
+        def handle_read(self):
+            try:
+                self.recv(4096)
+            except (OSError, socket.error):
+                pass
+
+        def wake(self):
+            if self._write_fd is None:
+                return
+            try:
+                os.write(self._write_fd, 'x')
+            except OSError:
+                pass
+
+        def close(self):
+            asyncore.file_dispatcher.close(self)
+            if self._write_fd is not None:
+                os.close(self._write_fd)
+                self._write_fd = None
+
+else:
+    _Waker = None
+
+
+class EventLoop(object):
+    """An asyncore event loop, usually running in a thread of its own.
+
+    Dispatchers in the loop must only be created, used and closed from the
+    loop thread; other threads can use call_soon and call to run code there.
+    """
+
+    def __init__(self, poll_interval=0.5):
+        """Create a new EventLoop.
+
+        :param poll_interval: Maximum time in seconds to wait for events
+            before checking for timeouts
+        """
+        self.map = {}
+        self.poll_interval = poll_interval
+        self._calls = deque()
+        self._thread_ident = None
+        self._running = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+        if _Waker is not None:
+            self._waker = _Waker(self.map)
+        else:
+            # Without a waker, calls from other threads are picked up after
+            # at most a poll interval.
+            self._waker = None
+        self._use_poll = getattr(select, 'poll', None) is not None
+
+    def in_loop(self):
+        """Check whether this is called from the loop thread."""
+        return thread.get_ident() == self._thread_ident
+
+    def wake(self):
+        """Wake up the event loop, e.g. because there is data to write."""
+        if self._waker is not None:
+            self._waker.wake()
+
+    def call_soon(self, func, *args):
+        """Run a function in the loop thread, without waiting for it."""
+        self._calls.append((func, args))
+        self.wake()
+
+    def call(self, func, *args):
+        """Run a function in the loop thread and return its result.
+
+        If the loop is not running or this is called from the loop thread,
+        the function is run directly.
+        """
+        if not self._running or self.in_loop():
+            return func(*args)
+        result = []
+        done = threading.Event()
+        def run():
+            try:
+                result.append((True, func(*args)))
+            except:
+                result.append((False, sys.exc_info()))
+            done.set()
+        self.call_soon(run)
+        done.wait()
+        succeeded, value = result[0]
+        if not succeeded:
+            raise value[0], value[1], value[2]
+        return value
+
+    def _run_calls(self):
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except:
+                logger.exception('Exception in event loop call')
+
+    def _check_timeouts(self):
+        now = time.time()
+        for dispatcher in self.map.values():
+            check_timeout = getattr(dispatcher, 'check_timeout', None)
+            if check_timeout is not None:
+                check_timeout(now)
+
+    def run(self):
+        """Run the event loop until stop is called.
+
+        All dispatchers in the loop are closed once it stops.
+        """
+        self._running = True
+        self._stopped.clear()
+        self._run()
+
+    def _run(self):
+        self._thread_ident = thread.get_ident()
+        try:
+            while self._running:
+                asyncore.loop(self.poll_interval, self._use_poll, self.map,
+                              count=1)
+                self._run_calls()
+                self._check_timeouts()
+        finally:
+            self._run_calls()
+            asyncore.close_all(self.map)
+            self._thread_ident = None
+            self._stopped.set()
+
+    def start(self):
+        """Run the event loop in a new daemon thread.
+
+        :return: The thread running the loop
+        """
+        self._running = True
+        self._stopped.clear()
+        loop_thread = threading.Thread(target=self._run)
+        loop_thread.setDaemon(True)
+        loop_thread.start()
+        return loop_thread
+
+    def stop(self):
+        """Stop the event loop and wait for it to finish."""
+        self._running = False
+        self.wake()
+        if not self.in_loop():
+            self._stopped.wait()
+
+
+class AsyncChannel(asyncore.dispatcher):
+    """A connection in an EventLoop that can be used from other threads.
+
+    The event loop reads from and writes to the socket; read, read_some and
+    write can be called from another thread, and only block on the buffers
+    of the channel. The channel is closed when the other side closes the
+    connection, when it has been waiting for input for longer than its timeout
+    or after close_when_done once all buffered data has been sent.
+    """
+
+    # Number of bytes to buffer in either direction before reading from the
+    # socket is paused or writers block.
+    max_buffer_size = 1024 * 1024
+
+    def __init__(self, loop, sock, timeout=None):
+        """Create a new AsyncChannel; this must be called in the loop thread.
+
+        :param loop: EventLoop to add the channel to
+        :param sock: A connected socket
+        :param timeout: Optional number of seconds after which to close the
+            connection if no data arrives while waiting for input
+        """
+        asyncore.dispatcher.__init__(self, sock, map=loop.map)
+        self.loop = loop
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._in = deque()
+        self._in_len = 0
+        self._out = deque()
+        self._out_len = 0
+        self._eof = False
+        self._closed = False
+        self._close_when_done = False
+        self._last_received = time.time()
+        self._waiting_since = None
+
+    # Methods called in the loop thread
+
+    def readable(self):
+        return not self._eof and self._in_len < self.max_buffer_size
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_read(self):
+        data = self.recv(_RECV_SIZE)
+        if not data:
+            return
+        self._last_received = time.time()
+        self._cond.acquire()
+        try:
+            self._in.append(data)
+            self._in_len += len(data)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self.data_received(data)
+
+    def data_received(self, data):
+        """Called in the loop thread with data received from the socket."""
+
+    def handle_write(self):
+        data = self._out[0]
+        sent = self.send(data)
+        if not sent:
+            return
+        self._cond.acquire()
+        try:
+            if sent < len(data):
+                self._out[0] = data[sent:]
+            else:
+                self._out.popleft()
+            self._out_len -= sent
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if self._close_when_done and not self._out:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logger.exception('Exception happened on connection')
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._cond.acquire()
+        try:
+            self._eof = True
+            self._closed = True
+            self._out.clear()
+            self._out_len = 0
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def check_timeout(self, now):
+        """Close the channel if it has been waiting for input for too long."""
+        if self.timeout is None or self._waiting_since is None:
+            return
+        if now - max(self._waiting_since, self._last_received) > self.timeout:
+            logger.info('Closing connection after timeout')
+            self.close()
+
+    def _close_if_done(self):
+        if self._out:
+            self._close_when_done = True
+        else:
+            self.close()
+
+    # Methods called from other threads
+
+    def _take(self, size):
+        chunks = []
+        taken = 0
+        while self._in and taken < size:
+            chunk = self._in.popleft()
+            needed = size - taken
+            if len(chunk) > needed:
+                self._in.appendleft(chunk[needed:])
+                chunk = chunk[:needed]
+            chunks.append(chunk)
+            taken += len(chunk)
+        self._in_len -= taken
+        return ''.join(chunks)
+
+    def _wait_for_input(self):
+        # Called with the lock held.
+        if self._in_len or self._eof:
+            return
+        self._waiting_since = time.time()
+        try:
+            while not self._in_len and not self._eof:
+                self._cond.wait()
+        finally:
+            self._waiting_since = None
+
+    def read_some(self, size):
+        """Read at most size bytes, blocking until at least one is available.
+
+        :return: The data read, or an empty string at the end of the stream
+        """
+        self._cond.acquire()
+        try:
+            self._wait_for_input()
+            was_full = self._in_len >= self.max_buffer_size
+            data = self._take(size)
+        finally:
+            self._cond.release()
+        if was_full:
+            # Reading from the socket may have been paused.
+            self.loop.wake()
+        return data
+
+    def read(self, size=-1):
+        """Read size bytes, blocking until they are available.
+
+        :param size: Number of bytes to read; if negative, read until the end
+            of the stream
+        :return: The data read, which is shorter than size only at the end
+            of the stream
+        """
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            if remaining < 0:
+                data = self.read_some(_RECV_SIZE)
+            else:
+                data = self.read_some(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            if remaining > 0:
+                remaining -= len(data)
+        return ''.join(chunks)
+
+    def has_input(self):
+        """Check whether read_some would return without blocking."""
+        return bool(self._in_len) or self._eof
+
+    def write(self, data):
+        """Queue data to be sent, blocking while the send buffer is full.
+
+        Writes from the loop thread never block.
+
+        :raise socket.error: if the channel has been closed
+        """
+        if not data:
+            return
+        in_loop = self.loop.in_loop()
+        self._cond.acquire()
+        try:
+            while (not self._closed and not in_loop and
+                   self._out_len >= self.max_buffer_size):
+                self._cond.wait()
+            if self._closed:
+                raise socket.error(errno.EPIPE, 'Connection closed')
+            self._out.append(data)
+            self._out_len += len(data)
+        finally:
+            self._cond.release()
+        self.loop.wake()
+
+    def close_when_done(self):
+        """Close the channel once all buffered data has been sent."""
+        self.loop.call_soon(self._close_if_done)
+
+
+class WorkerPool(object):
+    """A fixed number of threads that run queued tasks.
+
+    Tasks wait in the queue until a worker is available, so at most as many
+    tasks run at the same time as there are workers.
+    """
+
+    def __init__(self, workers=10):
+        """Create a new WorkerPool and start its threads.
+
+        :param workers: Number of worker threads
+        """
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self._threads.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except:
+                logger.exception('Exception in worker task')
+
+    def submit(self, func, *args):
+        """Queue a function to be run by a worker."""
+        self._tasks.put((func, args))
+
+    def close(self):
+        """Stop the workers once the tasks queued so far have run."""
+        for worker in self._threads:
+            self._tasks.put(None)
+        self._threads = []
+
+
+def _is_flush(pkt):
+    return pkt is None
+
+
+def _ends_haves(pkt):
+    return pkt is None or pkt.rstrip('\n') == 'done'
+
+
+class _CommonRevisionsWalker(object):
+    """Graph walker that returns revisions that were already negotiated."""
+
+    def __init__(self, common):
+        self._common = iter(common)
+
+    def next(self):
+        for sha in self._common:
+            return sha
+        return None
+
+    def ack(self, have_ref):
+        pass
+
+
+class _GitServerChannel(AsyncChannel):
+    """Server connection of an AsyncTCPGitServer.
+
+    The pkt-lines from the client are parsed in the loop thread as they
+    arrive. Once a complete round of them is buffered, it is processed by a
+    worker, so that reading them never blocks and the loop thread never
+    accesses the repository.
+    """
+
+    def __init__(self, server, sock):
+        AsyncChannel.__init__(self, server.loop, sock,
+                              timeout=server.connection_timeout)
+        self._server = server
+        self._parser = PktLineParser(self._pkt_received)
+        # Number of parsed pkt-lines that have not been processed yet
+        self._unprocessed = 0
+        # Called on a worker with the number of lines once a round has arrived
+        self._round_handler = self._command_received
+        # Function that checks whether a pkt-line ends a round, or None if
+        # every pkt-line does
+        self._round_end = None
+        # Whether a worker is processing a round
+        self._busy = False
+        # Pkt-lines that arrived while a worker was processing a round
+        self._deferred = []
+        # The timeout applies to waiting for the command and negotiation as
+        # well.
+        self._waiting_since = time.time()
+
+    def data_received(self, data):
+        if self._parser is not None:
+            self._parser.parse(data)
+
+    def _pkt_received(self, pkt):
+        if self._parser is None:
+            return
+        if self._busy:
+            # The next round handler is only known once the worker is done.
+            self._deferred.append(pkt)
+            return
+        self._unprocessed += 1
+        if self._round_end is not None and not self._round_end(pkt):
+            return
+        lines = self._unprocessed
+        self._unprocessed = 0
+        self._busy = True
+        # The client is waiting for the server now, not the other way round.
+        self._waiting_since = None
+        self._server.worker_pool.submit(self._process_round,
+                                        self._round_handler, lines)
+
+    def _process_round(self, round_handler, lines):
+        # Called on a worker.
+        try:
+            round_handler(lines)
+        except:
+            logger.exception('Exception happened during processing of '
+                             'request')
+            self._stop_parsing()
+            self.close_when_done()
+        self.loop.call_soon(self._round_done)
+
+    def _round_done(self):
+        self._busy = False
+        if self._parser is None:
+            return
+        self._waiting_since = time.time()
+        deferred = self._deferred
+        self._deferred = []
+        for pkt in deferred:
+            self._pkt_received(pkt)
+
+    def _stop_parsing(self):
+        self._parser = None
+        self._waiting_since = None
+
+    # Round handlers, called on a worker
+
+    def _command_received(self, lines):
+        # The command is still in the buffer, so it is parsed as usual.
+        proto = ReceivableProtocol(self.read_some, self.write)
+        command, args = proto.read_cmd()
+        logger.info('Handling %s request, args=%s', command, args)
+        cls = self._server.handlers.get(command, None)
+        if not callable(cls):
+            raise GitProtocolError('Invalid service %s' % command)
+        if isinstance(cls, type) and issubclass(cls, UploadPackHandler):
+            self._start_upload_pack(cls(self._server.backend, args, proto))
+        else:
+            self._stop_parsing()
+            self._handle(command, cls(self._server.backend, args, proto))
+
+    def _start_upload_pack(self, handler):
+        self._handler = handler
+        repo = handler.repo
+        self._heads = repo.get_refs()
+        if not self._heads:
+            # The repo is empty, so short-circuit the whole process.
+            handler.proto.write_pkt_line(None)
+            self._finish_negotiation()
+            return
+        self._walker = ProtocolGraphWalker(handler, repo.object_store,
+                                           repo.get_peeled)
+        self._walker.send_refs(self._heads)
+        handler.stats.start_phase('negotiate')
+        self._round_handler = self._wants_received
+        self._round_end = _is_flush
+
+    def _wants_received(self, lines):
+        self._wants = self._walker.read_wants(self._heads)
+        if not self._wants:
+            self._finish_negotiation()
+            return
+        self._common = []
+        self._round_handler = self._haves_received
+        self._round_end = _ends_haves
+
+    def _haves_received(self, lines):
+        store = self._handler.repo.object_store
+        for i in range(lines):
+            done, have = self._walker.handle_line(
+                self._handler.proto.read_pkt_line())
+            if have is not None and have in store:
+                self._common.append(have)
+                self._walker.ack(have)
+            if done:
+                self._stop_parsing()
+                self._send_pack()
+                return
+
+    def _finish_negotiation(self):
+        self._stop_parsing()
+        self._handler.stats.end_phase('negotiate')
+        self.close_when_done()
+
+    def _send_pack(self):
+        handler = self._handler
+        try:
+            objects_iter = handler.repo.fetch_objects(
+                lambda heads: self._wants,
+                _CommonRevisionsWalker(self._common), handler.progress,
+                get_tagged=handler.get_tagged)
+            handler.stats.end_phase('negotiate')
+            handler.send_pack(objects_iter)
+            logger.info('Handled git-upload-pack request: %s', handler.stats)
+        except:
+            logger.exception('Exception happened during processing of '
+                             'request')
+        self.close_when_done()
+
+    def _handle(self, command, handler):
+        try:
+            handler.handle()
+            if getattr(handler, 'stats', None) is not None:
+                logger.info('Handled %s request: %s', command, handler.stats)
+        except:
+            logger.exception('Exception happened during processing of '
+                             'request')
+        self.close_when_done()
+
+
+class AsyncTCPGitServer(asyncore.dispatcher):
+    """Git server for the git:// protocol that uses an EventLoop.
+
+    Connections are handled by the event loop until they have something for
+    a worker to do. For upload-pack, which is used for fetching, a worker
+    advertises the refs and processes each round of negotiation once it has
+    arrived, and finally generates and sends the pack. Other commands are
+    handled by a worker once the command has arrived.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 connection_timeout=None, loop=None, workers=10):
+        """Create a new AsyncTCPGitServer.
+
+        :param backend: Backend to serve repositories from
+        :param listen_addr: Address to listen on
+        :param port: Port to listen on
+        :param handlers: Optional dict of command names to handler classes,
+            in addition to the default handlers
+        :param connection_timeout: Optional number of seconds after which to
+            close connections that are waiting for input
+        :param loop: EventLoop to use; by default a new one is created, which
+            is run by serve_forever
+        :param workers: Number of worker threads, and thus the maximum number
+            of connections whose requests are processed at the same time
+        """
+        self.handlers = dict(DEFAULT_HANDLERS)
+        if handlers is not None:
+            self.handlers.update(handlers)
+        self.backend = backend
+        self.connection_timeout = connection_timeout
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+        self.worker_pool = WorkerPool(workers)
+        logger.info('Listening for TCP connections on %s:%d', listen_addr, port)
+        loop.call(self._listen, listen_addr, port)
+
+    def _listen(self, listen_addr, port):
+        asyncore.dispatcher.__init__(self, map=self.loop.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((listen_addr, port))
+        self.listen(socket.SOMAXCONN)
+        self.server_address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, client_address = pair
+        logger.info('Handling request from %s', client_address)
+        _GitServerChannel(self, sock)
+
+    def handle_error(self):
+        logger.exception('Exception happened in server')
+
+    def serve_forever(self):
+        """Run the event loop until shutdown is called."""
+        self.loop.run()
+
+    serve = serve_forever
+
+    def shutdown(self):
+        """Stop the event loop and the workers, closing all connections."""
+        self.loop.stop()
+        self.worker_pool.close()
+
+    def server_close(self):
+        self.loop.call(self.close)
+        self.worker_pool.close()
+
+
+class AsyncTCPGitClient(TCPGitClient):
+    """A Git Client that works over TCP directly (i.e. git://), doing its
+    socket I/O in an EventLoop.
+
+    A single event loop can be shared by many clients that are used from
+    different threads. A client that starts its own loop stops it in close.
+    """
+
+    def __init__(self, host, port=None, loop=None, *args, **kwargs):
+        """Create a new AsyncTCPGitClient.
+
+        :param host: Host to connect to
+        :param port: Port to connect to
+        :param loop: Running EventLoop to use; by default a new one is started
+            and stopped by close
+        :see: GitClient.__init__ for the other parameters
+        """
+        TCPGitClient.__init__(self, host, port, *args, **kwargs)
+        if loop is None:
+            loop = EventLoop()
+            self._loop_thread = loop.start()
+        else:
+            self._loop_thread = None
+        self._loop = loop
+
+    def close(self):
+        """Stop the event loop of this client, if it started one.
+
+        Connections of the client are closed once their loop stops.
+        """
+        if self._loop_thread is None:
+            return
+        self._loop.stop()
+        self._loop_thread.join()
+        self._loop_thread = None
+
+    def _connect(self, cmd, path):
+        s = self._connect_socket()
+        channel = self._loop.call(AsyncChannel, self._loop, s,
+                                  self._timeout)
+        proto = Protocol(channel.read, channel.write,
+                         report_activity=self._report_activity)
+        if path.startswith("/~"):
+            path = path[1:]
+        proto.send_cmd('git-%s' % cmd, path, 'host=%s' % self._host)
+        return proto, channel.has_input
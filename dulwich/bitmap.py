@@ -0,0 +1,478 @@
+# bitmap.py -- Reachability bitmap indexes for packs
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reachability bitmap indexes for packs.
+
+A pack bitmap index (a .bitmap file next to the .idx file of a pack) stores,
+for a selection of commits in the pack, the set of objects in the pack that
+are reachable from that commit. Each set is a bitmap in which bit i
+corresponds to the i-th object in the pack, in pack (offset) order. The
+bitmaps are compressed using EWAH, as described in "Sorting improves
+word-aligned bitmap indexes" (Lemire, Kaser and Aouiche, 2010).
+
+Bitmaps are represented as Python longs, so set operations are cheap.
+"""
+
+import binascii
+import stat
+import struct
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    Blob,
+    Commit,
+    S_ISGITLINK,
+    Tag,
+    Tree,
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    DeltaChainIterator,
+    SHA1Writer,
+    )
+from dulwich._compat import (
+    make_sha,
+    )
+
+BITMAP_SIGNATURE = 'BITM'
+BITMAP_OPT_FULL_DAG = 1
+BITMAP_OPT_HASH_CACHE = 4
+
+_EWAH_ALL_ONES = (1 << 64) - 1
+_EWAH_MAX_RUNNING_LENGTH = (1 << 32) - 1
+_EWAH_MAX_LITERAL_WORDS = (1 << 31) - 1
+
+# Type bitmaps, in the order they appear in the file.
+_TYPE_NUMS = (Commit.type_num, Tree.type_num, Blob.type_num, Tag.type_num)
+
+
+def bits_to_bytes(bits, num_bytes=0):
+    """Convert a bitmap to a little-endian byte string.
+
+    :param bits: Bitmap as a long
+    :param num_bytes: Minimum length of the result
+    :return: String in which bit i is bit (i % 8) of byte (i / 8)
+    """
+    if bits:
+        hex = '%x' % bits
+        data = binascii.unhexlify('0' * (len(hex) % 2) + hex)[::-1]
+    else:
+        data = ''
+    return data + '\0' * (num_bytes - len(data))
+
+
+def bytes_to_bits(data):
+    """Convert a little-endian byte string to a bitmap.
+
+    :param data: String in which bit i is bit (i % 8) of byte (i / 8)
+    :return: Bitmap as a long
+    """
+    data = str(data).rstrip('\0')
+    if not data:
+        return 0L
+    return long(binascii.hexlify(data[::-1]), 16)
+
+
+def iter_bit_positions(bits):
+    """Iterate over the positions of the bits that are set in a bitmap.
+
+    :param bits: Bitmap as a long
+    :return: Iterator over the bit positions, in ascending order
+    """
+    for i, byte in enumerate(bytearray(bits_to_bytes(bits))):
+        if not byte:
+            continue
+        for j in range(8):
+            if byte & (1 << j):
+                yield i * 8 + j
+
+
+def _bit_size(data):
+    """Return the number of bits up to the highest bit set in a string."""
+    data = data.rstrip('\0')
+    if not data:
+        return 0
+    size = 8 * (len(data) - 1)
+    last = ord(data[-1])
+    while last:
+        last >>= 1
+        size += 1
+    return size
+
+
+def read_ewah(data, offset=0):
+    """Read an EWAH compressed bitmap.
+
+    :param data: Buffer to read from
+    :param offset: Offset of the bitmap in data
+    :return: Tuple with the bitmap as a long and the offset just past it
+    """
+    bit_size, num_words = struct.unpack_from('>LL', data, offset)
+    offset += 8
+    words = struct.unpack_from('>%dQ' % num_words, data, offset)
+    offset += 8 * num_words + 4  # Skip the position of the last RLW.
+    out = []
+    i = 0
+    while i < num_words:
+        rlw = words[i]
+        running_length = (rlw >> 1) & _EWAH_MAX_RUNNING_LENGTH
+        num_literals = rlw >> 33
+        if rlw & 1:
+            out.append('\xff' * (8 * running_length))
+        else:
+            out.append('\0' * (8 * running_length))
+        i += 1
+        out.append(struct.pack('<%dQ' % num_literals,
+                               *words[i:i+num_literals]))
+        i += num_literals
+    return bytes_to_bits(''.join(out)), offset
+
+
+def write_ewah(bits):
+    """Serialize a bitmap using EWAH compression.
+
+    :param bits: Bitmap as a long
+    :return: String with the serialized bitmap
+    """
+    data = bits_to_bytes(bits)
+    data += '\0' * (-len(data) % 8)
+    words = struct.unpack('<%dQ' % (len(data) // 8), data)
+    out = []
+    rlw_pos = 0
+    i = 0
+    while True:
+        running_bit = 0
+        running_length = 0
+        if i < len(words) and words[i] in (0, _EWAH_ALL_ONES):
+            running_bit = words[i] & 1
+            while (i < len(words) and words[i] == words[i - running_length]
+                   and running_length < _EWAH_MAX_RUNNING_LENGTH):
+                running_length += 1
+                i += 1
+        literals_start = i
+        while (i < len(words) and words[i] not in (0, _EWAH_ALL_ONES) and
+               i - literals_start < _EWAH_MAX_LITERAL_WORDS):
+            i += 1
+        rlw_pos = len(out)
+        out.append(running_bit | (running_length << 1) |
+                   ((i - literals_start) << 33))
+        out.extend(words[literals_start:i])
+        if i >= len(words):
+            break
+    return (struct.pack('>LL', _bit_size(data), len(out)) +
+            struct.pack('>%dQ' % len(out), *out) +
+            struct.pack('>L', rlw_pos))
+
+
+def load_pack_bitmap(path, pack_index):
+    """Load a pack bitmap index by path.
+
+    :param path: Path to the .bitmap file
+    :param pack_index: PackIndex of the pack the bitmap index is for
+    :return: A PackBitmapIndex loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return PackBitmapIndex(path, pack_index, contents=f.read())
+    finally:
+        f.close()
+
+
+class PackBitmapIndex(object):
+    """A pack bitmap index (version 1)."""
+
+    def __init__(self, filename, pack_index, contents):
+        self._filename = filename
+        self._contents = contents
+        if contents[:4] != BITMAP_SIGNATURE:
+            raise AssertionError('Not a pack bitmap index file')
+        (self.version, self.flags, num_entries) = struct.unpack_from(
+            '>HHL', contents, 4)
+        if self.version != 1:
+            raise AssertionError(
+                'Unknown pack bitmap index version %d' % self.version)
+        if not self.flags & BITMAP_OPT_FULL_DAG:
+            raise AssertionError('Unsupported pack bitmap index options')
+        self.pack_checksum = contents[12:32]
+        offset = 32
+        self._type_bitmaps = {}
+        for type_num in _TYPE_NUMS:
+            self._type_bitmaps[type_num], offset = read_ewah(contents, offset)
+        self._index_order = []
+        self._pack_order = []
+        self._positions = {}
+        for sha, pack_offset, crc32 in pack_index.iterentries():
+            self._index_order.append(sha)
+            self._pack_order.append((pack_offset, sha))
+        self._index_order.sort()
+        self._pack_order.sort()
+        self._pack_order = [sha for (pack_offset, sha) in self._pack_order]
+        for i, sha in enumerate(self._pack_order):
+            self._positions[sha] = i
+        # Entries are (commit SHA, XOR offset, offset of the EWAH bitmap).
+        self._entries = []
+        self._entry_indexes = {}
+        for i in range(num_entries):
+            commit_pos, xor_offset, entry_flags = struct.unpack_from(
+                '>LBB', contents, offset)
+            sha = self._index_order[commit_pos]
+            self._entries.append((sha, xor_offset, offset + 6))
+            self._entry_indexes[sha] = i
+            offset += 6
+            bit_size, num_words = struct.unpack_from('>LL', contents, offset)
+            offset += 12 + 8 * num_words
+        self._bitmaps = {}
+
+    def __len__(self):
+        """Return the number of commits with a bitmap."""
+        return len(self._entries)
+
+    def __contains__(self, sha):
+        """Check whether there is a bitmap for a commit."""
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return sha in self._entry_indexes
+
+    @property
+    def num_objects(self):
+        """The number of objects in the pack."""
+        return len(self._pack_order)
+
+    def object_position(self, sha):
+        """Return the position of an object in pack order.
+
+        :param sha: SHA1 of the object, as hex or binary string
+        :raise KeyError: if the object is not in the pack
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._positions[sha]
+
+    def object_sha(self, position):
+        """Return the binary SHA1 of the object at a position in pack order.
+        """
+        return self._pack_order[position]
+
+    def type_bitmap(self, type_num):
+        """Return the bitmap of the objects of a particular type."""
+        return self._type_bitmaps[type_num]
+
+    def _get_entry_bitmap(self, i):
+        sha, xor_offset, offset = self._entries[i]
+        try:
+            return self._bitmaps[sha]
+        except KeyError:
+            bits = read_ewah(self._contents, offset)[0]
+            if xor_offset:
+                bits ^= self._get_entry_bitmap(i - xor_offset)
+            self._bitmaps[sha] = bits
+            return bits
+
+    def get_commit_bitmap(self, sha):
+        """Return the bitmap of the objects reachable from a commit.
+
+        :param sha: SHA1 of the commit, as hex or binary string
+        :raise KeyError: if there is no bitmap for the commit
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._get_entry_bitmap(self._entry_indexes[sha])
+
+    def iter_shas(self, bits):
+        """Iterate over the hex SHA1s of the objects in a bitmap."""
+        for i in iter_bit_positions(bits):
+            yield sha_to_hex(self._pack_order[i])
+
+    def reachable(self, shas, get_object):
+        """Compute the bitmap of the objects reachable from a set of objects.
+
+        :param shas: Iterable over SHA1s to start from
+        :param get_object: Function to retrieve an object by hex SHA1
+        :return: Bitmap as a long
+        :raise KeyError: if a reachable object is not in the pack
+        """
+        return reachable_bitmap(shas, self._positions, self.num_objects,
+                                get_object, self._get_commit_bitmap_or_none)
+
+    def _get_commit_bitmap_or_none(self, sha):
+        i = self._entry_indexes.get(sha)
+        if i is None:
+            return None
+        return self._get_entry_bitmap(i)
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this bitmap index.
+
+        :return: This is a 20-byte binary digest
+        """
+        return make_sha(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this bitmap index.
+
+        :return: 20-byte binary digest
+        """
+        return self._contents[-20:]
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+
+def reachable_bitmap(shas, positions, num_objects, get_object,
+                     get_commit_bitmap):
+    """Compute the bitmap of the objects reachable from a set of objects.
+
+    Commits are walked until a commit with a bitmap is found. After that,
+    the trees of the walked commits are walked, skipping trees and blobs
+    that are already known to be reachable.
+
+    :param shas: Iterable over SHA1s to start from
+    :param positions: Dictionary mapping binary SHA1s to positions in pack
+        order
+    :param num_objects: Number of objects in the pack
+    :param get_object: Function to retrieve an object by hex SHA1
+    :param get_commit_bitmap: Function that returns the bitmap for a commit
+        by binary SHA1, or None
+    :return: Bitmap as a long
+    :raise KeyError: if a reachable object is not in the pack
+    """
+    bits = 0L
+    todo = [(len(sha) == 40 and sha or sha_to_hex(sha)) for sha in shas]
+    walked = set()
+    walked_positions = []
+    trees = []
+    while todo:
+        sha = todo.pop()
+        if sha in walked:
+            continue
+        walked.add(sha)
+        bin_sha = hex_to_sha(sha)
+        commit_bits = get_commit_bitmap(bin_sha)
+        if commit_bits is not None:
+            bits |= commit_bits
+            continue
+        obj = get_object(sha)
+        if isinstance(obj, Commit):
+            todo.extend(obj.parents)
+            trees.append(obj.tree)
+        elif isinstance(obj, Tag):
+            todo.append(obj.object[1])
+        else:
+            trees.append(sha)
+            continue
+        walked_positions.append(positions[bin_sha])
+
+    present = bytearray(bits_to_bytes(bits, (num_objects + 7) // 8))
+    for pos in walked_positions:
+        present[pos >> 3] |= 1 << (pos & 7)
+    while trees:
+        sha = trees.pop()
+        pos = positions[hex_to_sha(sha)]
+        if present[pos >> 3] & (1 << (pos & 7)):
+            continue
+        present[pos >> 3] |= 1 << (pos & 7)
+        obj = get_object(sha)
+        if isinstance(obj, Tree):
+            for name, mode, entry_sha in obj.iteritems():
+                if S_ISGITLINK(mode):
+                    continue
+                if stat.S_ISDIR(mode):
+                    trees.append(entry_sha)
+                else:
+                    pos = positions[hex_to_sha(entry_sha)]
+                    present[pos >> 3] |= 1 << (pos & 7)
+        elif isinstance(obj, Tag):
+            trees.append(obj.object[1])
+    return bytes_to_bits(present)
+
+
+def write_pack_bitmap(f, pack, commits, get_object=None):
+    """Write a pack bitmap index.
+
+    All objects reachable from the selected commits must be in the pack.
+
+    :param f: File-like object to write to
+    :param pack: Pack to write the bitmap index for
+    :param commits: Iterable over SHA1s of the commits to store bitmaps for
+    :param get_object: Function to retrieve an object by hex SHA1; defaults
+        to retrieving objects from the pack
+    :return: The SHA of the written bitmap index
+    :raise KeyError: if an object reachable from one of the commits is not
+        in the pack
+    """
+    if get_object is None:
+        get_object = pack.__getitem__
+    pack_order = []
+    index_order = []
+    type_positions = dict((type_num, []) for type_num in _TYPE_NUMS)
+    pack.begin_use()
+    try:
+        pack_checksum = pack.index.get_pack_checksum()
+        for sha, offset, crc32 in pack.index.iterentries():
+            pack_order.append((offset, sha))
+            index_order.append(sha)
+        pack_order.sort()
+        index_order.sort()
+        positions = dict((sha, i)
+                         for (i, (offset, sha)) in enumerate(pack_order))
+        for unpacked in DeltaChainIterator.for_pack_data(pack.data):
+            type_positions[unpacked.obj_type_num].append(
+                positions[unpacked.sha()])
+    finally:
+        pack.end_use()
+    index_positions = dict((sha, i) for (i, sha) in enumerate(index_order))
+    num_objects = len(pack_order)
+
+    # Compute bitmaps for older commits first, so they can be reused for
+    # the bitmaps of their descendants.
+    commits = [get_object(len(sha) == 40 and sha or sha_to_hex(sha))
+               for sha in commits]
+    commits.sort(key=lambda c: c.commit_time)
+    bitmaps = {}
+    for commit in commits:
+        bin_sha = hex_to_sha(commit.id)
+        if bin_sha in bitmaps:
+            continue
+        bitmaps[bin_sha] = reachable_bitmap([commit.id], positions,
+            num_objects, get_object, bitmaps.get)
+
+    f = SHA1Writer(f)
+    f.write(BITMAP_SIGNATURE)
+    f.write(struct.pack('>HHL', 1, BITMAP_OPT_FULL_DAG, len(bitmaps)))
+    f.write(pack_checksum)
+    for type_num in _TYPE_NUMS:
+        present = bytearray((num_objects + 7) // 8)
+        for pos in type_positions[type_num]:
+            present[pos >> 3] |= 1 << (pos & 7)
+        f.write(write_ewah(bytes_to_bits(present)))
+    for commit in commits:
+        bin_sha = hex_to_sha(commit.id)
+        bits = bitmaps.pop(bin_sha, None)
+        if bits is None:
+            continue
+        f.write(struct.pack('>LBB', index_positions[bin_sha], 0, 0))
+        f.write(write_ewah(bits))
+    return f.write_sha()
@@ -22,13 +22,23 @@
 __docformat__ = 'restructuredText'
 
 from cStringIO import StringIO
+import httplib
+import itertools
+import os
+import Queue
 import select
 import socket
 import subprocess
+import sys
+import threading
+import time
+import urllib
 import urllib2
 import urlparse
+import zlib
 
 from dulwich.errors import (
+    FetchTimeout,
     GitProtocolError,
     NotGitRepository,
     SendPackError,
@@ -37,11 +47,18 @@ from dulwich.errors import (
 from dulwich.protocol import (
     PktLineParser,
     Protocol,
+    SideBandReader,
     TCP_GIT_PORT,
     ZERO_SHA,
+    ProtocolStats,
     extract_capabilities,
+    report_reads,
+    )
+from dulwich.file import (
+    GitFile,
     )
 from dulwich.pack import (
+    generate_pack_chunks,
     write_pack_objects,
     )
 
@@ -60,6 +77,16 @@ COMMON_CAPABILITIES = ['ofs-delta', 'side-band-64k']
 FETCH_CAPABILITIES = ['multi_ack', 'multi_ack_detailed'] + COMMON_CAPABILITIES
 SEND_CAPABILITIES = ['report-status'] + COMMON_CAPABILITIES
 
+# Size of the chunks fetch_pack passes pack data on in.
+_PACK_BUFSIZE = 65536
+
+# Request bodies larger than this are sent using chunked transfer encoding,
+# like git's http.postBuffer setting.
+DEFAULT_HTTP_POST_BUFFER = 1024 * 1024
+
+# Maximum number of connections HttpConnectionPool opens to a single host.
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 6
+
 
 class ReportStatusParser(object):
     """Handle status as reported by servers with the 'report-status' capability.
@@ -127,22 +154,38 @@ class GitClient(object):
 
     """
 
-    def __init__(self, thin_packs=True, report_activity=None):
+    def __init__(self, thin_packs=True, report_activity=None, stats=None,
+                 timeout=None):
         """Create a new GitClient instance.
 
         :param thin_packs: Whether or not thin packs should be retrieved
         :param report_activity: Optional callback for reporting transport
             activity.
+        :param stats: Optional ProtocolStats instance to record traffic and
+            phase timings in; a new one is created if not specified.
+        :param timeout: Optional timeout in seconds for connecting to the
+            server and for each read from it. Reads that time out raise
+            socket.timeout, or urllib2.URLError for HTTP requests.
         """
-        self._report_activity = report_activity
+        if stats is None:
+            stats = ProtocolStats()
+        self.stats = stats
+        self._timeout = timeout
+        self._activity_callback = report_activity
         self._fetch_capabilities = list(FETCH_CAPABILITIES)
         self._send_capabilities = list(SEND_CAPABILITIES)
         if thin_packs:
             self._fetch_capabilities.append('thin-pack')
 
+    def _report_activity(self, nbytes, direction):
+        self.stats.report_activity(nbytes, direction)
+        if self._activity_callback is not None:
+            self._activity_callback(nbytes, direction)
+
     def _read_refs(self, proto):
         server_capabilities = None
         refs = {}
+        self.stats.start_phase('advertise')
         # Receive refs from server
         for pkt in proto.read_pkt_seq():
             (sha, ref) = pkt.rstrip('\n').split(' ', 1)
@@ -151,6 +194,7 @@ class GitClient(object):
             if server_capabilities is None:
                 (ref, server_capabilities) = extract_capabilities(ref)
             refs[ref] = sha
+        self.stats.end_phase('advertise')
         return refs, server_capabilities
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
@@ -171,6 +215,8 @@ class GitClient(object):
     def fetch(self, path, target, determine_wants=None, progress=None):
         """Fetch into a target repository.
 
+        The pack is indexed as it is received, and completed if it is thin.
+
         :param path: Path to fetch from
         :param target: Target repository to fetch into
         :param determine_wants: Optional function to determine what refs
@@ -180,15 +226,16 @@ class GitClient(object):
         """
         if determine_wants is None:
             determine_wants = target.object_store.determine_wants_all
-        f, commit = target.object_store.add_pack()
-        try:
-            return self.fetch_pack(path, determine_wants,
-                target.get_graph_walker(), f.write, progress)
-        finally:
-            commit()
+        def add_pack(read_all, read_some):
+            pack = target.object_store.add_thin_pack(read_all, read_some)
+            if pack is not None:
+                self.stats.add_count('objects', len(pack))
+            return pack
+        return self._fetch_pack(path, determine_wants,
+            target.get_graph_walker(), add_pack, progress)
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress):
+                   progress=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
@@ -196,7 +243,26 @@ class GitClient(object):
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
         """
-        raise NotImplementedError(self.fetch_pack)
+        def copy_pack(read_all, read_some):
+            while True:
+                data = read_some(_PACK_BUFSIZE)
+                if not data:
+                    break
+                pack_data(data)
+        return self._fetch_pack(path, determine_wants, graph_walker,
+                                copy_pack, progress)
+
+    def _fetch_pack(self, path, determine_wants, graph_walker, handle_pack,
+                    progress=None):
+        """Retrieve a pack from a git smart server.
+
+        :param determine_wants: Callback that returns list of commits to fetch
+        :param graph_walker: Object with next() and ack().
+        :param handle_pack: Function that is called with read_all and
+            read_some functions for the pack stream, and reads the pack
+        :param progress: Callback for progress reports (strings)
+        """
+        raise NotImplementedError(self._fetch_pack)
 
     def _parse_status_report(self, proto):
         unpack = proto.read_pkt_line().strip()
@@ -325,6 +391,8 @@ class GitClient(object):
             whether there is extra graph data to read on proto
         """
         assert isinstance(wants, list) and type(wants[0]) == str
+        self.stats.start_phase('negotiate')
+        self.stats.add_count('wants', len(wants))
         proto.write_pkt_line('want %s %s\n' % (
             wants[0], ' '.join(capabilities)))
         for want in wants[1:]:
@@ -333,6 +401,7 @@ class GitClient(object):
         have = graph_walker.next()
         while have:
             proto.write_pkt_line('have %s\n' % have)
+            self.stats.add_count('haves')
             if can_read():
                 pkt = proto.read_pkt_line()
                 parts = pkt.rstrip('\n').split(' ')
@@ -350,13 +419,14 @@ class GitClient(object):
         proto.write_pkt_line('done\n')
 
     def _handle_upload_pack_tail(self, proto, capabilities, graph_walker,
-                                 pack_data, progress):
+                                 handle_pack, progress):
         """Handle the tail of a 'git-upload-pack' request.
 
         :param proto: Protocol object to read from
         :param capabilities: List of negotiated capabilities
         :param graph_walker: GraphWalker instance to call .ack() on
-        :param pack_data: Function to call with pack data
+        :param handle_pack: Function to call with read_all and read_some
+            functions for the pack data
         :param progress: Optional progress reporting function
         """
         pkt = proto.read_pkt_line()
@@ -368,15 +438,21 @@ class GitClient(object):
                     'ready', 'continue', 'common'):
                 break
             pkt = proto.read_pkt_line()
+        self.stats.end_phase('negotiate')
+        self.stats.start_phase('receiving')
         if "side-band-64k" in capabilities:
-            self._read_side_band64k_data(proto, {1: pack_data, 2: progress})
+            reader = SideBandReader(proto, {2: progress})
+            handle_pack(reader.read, reader.read_some)
+            # Handle any progress messages that follow the pack.
+            reader.read_all_data()
             # wait for EOF before returning
             data = proto.read()
             if data:
                 raise Exception('Unexpected response %r' % data)
         else:
-            # FIXME: Buffering?
-            pack_data(self.read())
+            read = report_reads(proto.read, proto.report_activity)
+            handle_pack(read, read)
+        self.stats.end_phase('receiving')
 
 
 
@@ -425,20 +501,18 @@ class TraditionalGitClient(GitClient):
             return new_refs
         objects = generate_pack_contents(have, want)
         if len(objects) > 0:
-            entries, sha = write_pack_objects(proto.write_file(), objects)
+            self.stats.add_count('objects', len(objects))
+            self.stats.start_phase('writing')
+            try:
+                entries, sha = write_pack_objects(proto.write_file(), objects)
+            finally:
+                self.stats.end_phase('writing')
         self._handle_receive_pack_tail(proto, negotiated_capabilities,
             progress)
         return new_refs
 
-    def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
-        """Retrieve a pack from a git smart server.
-
-        :param determine_wants: Callback that returns list of commits to fetch
-        :param graph_walker: Object with next() and ack().
-        :param pack_data: Callback called for each bit of data in the pack
-        :param progress: Callback for progress reports (strings)
-        """
+    def _fetch_pack(self, path, determine_wants, graph_walker, handle_pack,
+                    progress=None):
         proto, can_read = self._connect('upload-pack', path)
         (refs, server_capabilities) = self._read_refs(proto)
         negotiated_capabilities = list(self._fetch_capabilities)
@@ -449,7 +523,7 @@ class TraditionalGitClient(GitClient):
         self._handle_upload_pack_head(proto, negotiated_capabilities,
             graph_walker, wants, can_read)
         self._handle_upload_pack_tail(proto, negotiated_capabilities,
-            graph_walker, pack_data, progress)
+            graph_walker, handle_pack, progress)
         return refs
 
 
@@ -463,7 +537,8 @@ class TCPGitClient(TraditionalGitClient):
         self._port = port
         GitClient.__init__(self, *args, **kwargs)
 
-    def _connect(self, cmd, path):
+    def _connect_socket(self):
+        """Open a socket connected to the server."""
         sockaddrs = socket.getaddrinfo(self._host, self._port,
             socket.AF_UNSPEC, socket.SOCK_STREAM)
         s = None
@@ -471,6 +546,8 @@ class TCPGitClient(TraditionalGitClient):
         for (family, socktype, proto, canonname, sockaddr) in sockaddrs:
             s = socket.socket(family, socktype, proto)
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self._timeout is not None:
+                s.settimeout(self._timeout)
             try:
                 s.connect(sockaddr)
                 break
@@ -480,6 +557,10 @@ class TCPGitClient(TraditionalGitClient):
                 s = None
         if s is None:
             raise err
+        return s
+
+    def _connect(self, cmd, path):
+        s = self._connect_socket()
         # -1 means system default buffering
         rfile = s.makefile('rb', -1)
         # 0 means unbuffered
@@ -493,12 +574,40 @@ class TCPGitClient(TraditionalGitClient):
 
 
 class SubprocessWrapper(object):
-    """A socket-like object that talks to a subprocess via pipes."""
+    """A socket-like object that talks to a subprocess via pipes.
+
+    :ivar timeout: Optional timeout in seconds for each read; if no data
+        arrives in time, the subprocess is killed and socket.timeout is
+        raised. This is not supported on Windows. It must be set before the
+        first read.
+    """
 
-    def __init__(self, proc):
+    def __init__(self, proc, timeout=None):
         self.proc = proc
-        self.read = proc.stdout.read
         self.write = proc.stdin.write
+        self.timeout = timeout
+
+    def read(self, size=-1):
+        if self.timeout is None or subprocess.mswindows:
+            return self.proc.stdout.read(size)
+        # Read from the file descriptor, so that no data is buffered where
+        # select can't see it.
+        fileno = self.proc.stdout.fileno()
+        chunks = []
+        while size != 0:
+            if not select.select([fileno], [], [], self.timeout)[0]:
+                self.proc.kill()
+                raise socket.timeout('timed out')
+            if size < 0:
+                data = os.read(fileno, _PACK_BUFSIZE)
+            else:
+                data = os.read(fileno, size)
+            if not data:
+                break
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
 
     def can_read(self):
         if subprocess.mswindows:
@@ -527,7 +636,8 @@ class SubprocessGitClient(TraditionalGitClient):
         argv = ['git', service, path]
         p = SubprocessWrapper(
             subprocess.Popen(argv, bufsize=0, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE))
+                             stdout=subprocess.PIPE),
+            timeout=self._timeout)
         return Protocol(p.read, p.write,
                         report_activity=self._report_activity), p.can_read
 
@@ -568,69 +678,549 @@ class SSHGitClient(TraditionalGitClient):
         con = get_ssh_vendor().connect_ssh(
             self.host, ["%s '%s'" % (self._get_cmd_path(cmd), path)],
             port=self.port, username=self.username)
+        if self._timeout is not None and isinstance(con, SubprocessWrapper):
+            con.timeout = self._timeout
         return (Protocol(con.read, con.write, report_activity=self._report_activity),
                 con.can_read)
 
 
+class _PooledResponse(object):
+    """HTTP response whose connection is returned to its pool once read."""
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def _release(self, reusable):
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        self._pool._release_connection(self._key, conn, reusable)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release(True)
+        return data
+
+    def recv(self, amt):
+        return self.read(amt)
+
+    def close(self):
+        """Finish with this response.
+
+        The connection is kept for reuse if no more than a small amount of
+        data was left unread; otherwise it is closed.
+        """
+        if self._conn is None:
+            return
+        reusable = False
+        try:
+            if not self._response.isclosed():
+                # Usually only the end of a chunked body is left.
+                self._response.read(_PACK_BUFSIZE)
+            reusable = self._response.isclosed()
+        except (socket.error, httplib.HTTPException):
+            pass
+        self._response.close()
+        self._release(reusable)
+
+
+def _send_chunked(conn, method, selector, headers, chunks):
+    """Send a request with a body in chunked transfer encoding.
+
+    :param conn: httplib.HTTPConnection to send the request over
+    :param method: HTTP method
+    :param selector: Path and query of the URL to request
+    :param headers: Dictionary with request headers
+    :param chunks: Iterator over the chunks of the request body
+    """
+    conn.putrequest(method, selector)
+    for name, value in headers.iteritems():
+        conn.putheader(name, value)
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    for chunk in chunks:
+        conn.send('%x\r\n' % len(chunk))
+        conn.send(chunk)
+        conn.send('\r\n')
+    conn.send('0\r\n\r\n')
+
+
+class _ChunkedRequest(urllib2.Request):
+    """A POST request whose body is sent in chunked transfer encoding.
+
+    The request goes through the usual urllib2 handlers, so that proxies,
+    authentication and redirects are handled as for other requests, but only
+    the handlers of HttpGitClient can send its body. Other handlers would
+    send an empty body, so has_data and get_data raise an error unless one
+    of those handlers has accepted the request. Since the body is generated
+    while it is sent, the request can only be sent once.
+    """
+
+    def __init__(self, url, chunks, headers={}):
+        urllib2.Request.__init__(self, url, headers=headers)
+        self._chunks = chunks
+        self._accepted = False
+
+    def get_method(self):
+        return 'POST'
+
+    def accept(self):
+        """Mark the request as being handled by a handler that can send it."""
+        self._accepted = True
+
+    def _check_accepted(self):
+        if not self._accepted:
+            raise urllib2.URLError(
+                'chunked request body can only be sent by the handlers of '
+                'HttpGitClient')
+
+    def has_data(self):
+        self._check_accepted()
+        return False
+
+    def get_data(self):
+        self._check_accepted()
+        return None
+
+    def take_chunks(self):
+        """Get the chunks of the body, which may only be done once.
+
+        :raise urllib2.URLError: if the body has been sent before, e.g.
+            because the server asked for authentication
+        """
+        chunks = self._chunks
+        if chunks is None:
+            raise urllib2.URLError(
+                'chunked request body can not be sent again')
+        self._chunks = None
+        return chunks
+
+
+class HttpConnectionPool(object):
+    """Pool of persistent HTTP connections.
+
+    Connections are kept open once the response to a request has been read,
+    so that later requests to the same host can reuse them. The pool is safe
+    to use from multiple threads.
+    """
+
+    def __init__(self, max_connections_per_host=None, timeout=None):
+        """Create a new HttpConnectionPool.
+
+        :param max_connections_per_host: Maximum number of connections to
+            open to a single host; requests wait for a connection to become
+            available once this many are in use
+        :param timeout: Optional socket timeout for new connections
+        """
+        if max_connections_per_host is None:
+            max_connections_per_host = DEFAULT_MAX_CONNECTIONS_PER_HOST
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        # (scheme, host) -> idle connections, most recently used last
+        self._idle = {}
+        # (scheme, host) -> number of open connections, idle or not
+        self._counts = {}
+
+    def _new_connection(self, key):
+        scheme, host = key
+        if scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        if self.timeout is None:
+            return conn_class(host)
+        return conn_class(host, timeout=self.timeout)
+
+    def _get_connection(self, key, reuse=True):
+        """Get a connection to a host, waiting if too many are in use.
+
+        :param key: Tuple with scheme and host
+        :param reuse: Whether an idle connection may be returned
+        :return: Tuple with connection and whether it was used before
+        """
+        self._lock.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                if idle and reuse:
+                    return idle.pop(), True
+                count = self._counts.get(key, 0)
+                if count < self.max_connections_per_host:
+                    self._counts[key] = count + 1
+                    break
+                if idle:
+                    # Make room for the new connection.
+                    idle.pop(0).close()
+                    break
+                self._released.wait()
+        finally:
+            self._lock.release()
+        return self._new_connection(key), False
+
+    def _release_connection(self, key, conn, reusable):
+        self._lock.acquire()
+        try:
+            if reusable:
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                conn.close()
+                self._counts[key] -= 1
+            self._released.notify()
+        finally:
+            self._lock.release()
+
+    def request(self, scheme, host, method, selector, headers, body=None):
+        """Send a request over a pooled connection.
+
+        If a reused connection turns out to have been closed by the server,
+        the request is retried once on a new connection.
+
+        :param scheme: URL scheme, 'http' or 'https'
+        :param host: Host to connect to, optionally including a port
+        :param method: HTTP method
+        :param selector: Path and query of the URL to request
+        :param headers: Dictionary with request headers
+        :param body: Optional request body, as a string
+        :return: Response object; its connection is returned to the pool once
+            the response has been read completely or closed
+        """
+        key = (scheme, host)
+        conn, reused = self._get_connection(key)
+        while True:
+            try:
+                conn.request(method, selector, body, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                self._release_connection(key, conn, False)
+                if not reused:
+                    raise
+                conn, reused = self._get_connection(key, reuse=False)
+                continue
+            return _PooledResponse(self, key, conn, response)
+
+    def request_chunked(self, scheme, host, method, selector, headers,
+                        chunks):
+        """Send a request with a body in chunked transfer encoding.
+
+        Since the body can not be sent again, this always uses a new
+        connection; the connection is pooled for reuse afterwards.
+
+        :param chunks: Iterator over the chunks of the request body
+        :return: Response object, as for request
+        """
+        key = (scheme, host)
+        conn, reused = self._get_connection(key, reuse=False)
+        try:
+            _send_chunked(conn, method, selector, headers, chunks)
+            response = conn.getresponse()
+        except:
+            self._release_connection(key, conn, False)
+            raise
+        return _PooledResponse(self, key, conn, response)
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.iteritems():
+                for conn in idle:
+                    conn.close()
+                self._counts[key] -= len(idle)
+            self._idle = {}
+            self._released.notifyAll()
+        finally:
+            self._lock.release()
+
+
+def _wrap_pooled_response(response, url):
+    """Wrap a pooled response in the same way urllib2 wraps responses.
+
+    The body of redirects and errors is read straight away, so that their
+    connection goes back to the pool even if the caller does not close them.
+
+    :param response: Response returned by HttpConnectionPool
+    :param url: URL that was requested
+    :return: urllib.addinfourl instance
+    """
+    if response.status >= 300:
+        fp = StringIO(response.read())
+        response.close()
+    else:
+        fp = socket._fileobject(response, close=True)
+    resp = urllib.addinfourl(fp, response.msg, url, response.status)
+    resp.msg = response.reason
+    return resp
+
+
+class _PooledHandlerMixin(object):
+    """Mixin for urllib2 handlers that send requests over pooled connections.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def _pooled_request(self, req):
+        if isinstance(req, _ChunkedRequest):
+            req.accept()
+        return self.do_request_(req)
+
+    def _pooled_open(self, scheme, http_class, req):
+        chunks = None
+        if isinstance(req, _ChunkedRequest):
+            chunks = req.take_chunks()
+        if getattr(req, '_tunnel_host', None):
+            # Requests tunneled through a proxy are not pooled.
+            if chunks is not None:
+                http_class = _chunked_connection_factory(http_class, chunks)
+            return self.do_open(http_class, req)
+        # Merge the headers in the same way as do_open, but don't ask the
+        # server to close the connection.
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        try:
+            if chunks is not None:
+                response = self._pool.request_chunked(scheme, req.get_host(),
+                    req.get_method(), req.get_selector(), headers, chunks)
+            else:
+                response = self._pool.request(scheme, req.get_host(),
+                    req.get_method(), req.get_selector(), headers, req.data)
+        except socket.error, e:
+            raise urllib2.URLError(e)
+        return _wrap_pooled_response(response, req.get_full_url())
+
+
+def _chunked_connection_factory(http_class, chunks):
+    """Make connections for do_open that send a chunked request body.
+
+    :param http_class: httplib connection class
+    :param chunks: Iterator over the chunks of the request body
+    :return: Function that creates connections like http_class
+    """
+    def connect(host, **kwargs):
+        conn = http_class(host, **kwargs)
+        conn.request = lambda method, selector, body, headers: (
+            _send_chunked(conn, method, selector, headers, chunks))
+        return conn
+    return connect
+
+
+class _PooledHTTPHandler(_PooledHandlerMixin, urllib2.HTTPHandler):
+
+    def http_request(self, req):
+        return self._pooled_request(req)
+
+    def http_open(self, req):
+        return self._pooled_open('http', httplib.HTTPConnection, req)
+
+
+if hasattr(urllib2, 'HTTPSHandler'):
+    class _PooledHTTPSHandler(_PooledHandlerMixin, urllib2.HTTPSHandler):
+
+        def https_request(self, req):
+            return self._pooled_request(req)
+
+        def https_open(self, req):
+            return self._pooled_open('https', httplib.HTTPSConnection, req)
+
+    _POOLED_HANDLERS = (_PooledHTTPHandler, _PooledHTTPSHandler)
+else:
+    _POOLED_HANDLERS = (_PooledHTTPHandler, )
+
+
+def _gzip_chunks(chunks):
+    """Compress a sequence of chunks in gzip format.
+
+    :param chunks: Iterable over strings
+    :return: Iterator over the compressed data
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _coalesce_chunks(chunks, size):
+    """Join small chunks together into chunks of at least a given size.
+
+    :param chunks: Iterator over strings
+    :param size: Minimum size of the chunks to generate; only the last chunk
+        may be smaller
+    :return: Iterator over strings
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield ''.join(pending)
+            pending = []
+            pending_size = 0
+    if pending_size:
+        yield ''.join(pending)
+
+
 class HttpGitClient(GitClient):
 
-    def __init__(self, base_url, dumb=None, *args, **kwargs):
+    def __init__(self, base_url, dumb=None, post_buffer=None,
+                 compress_requests=False, pool=None, *args, **kwargs):
+        """Create a new HttpGitClient instance.
+
+        :param base_url: Base URL of the repository
+        :param dumb: Whether to use the dumb HTTP protocol; None to detect it
+        :param post_buffer: Size of the largest request body to send in one
+            go; larger bodies are streamed using chunked transfer encoding
+            as they are generated
+        :param compress_requests: Whether to compress request bodies with
+            gzip
+        :param pool: HttpConnectionPool to send requests through; by default
+            each client has its own pool, so that connections are reused
+            across the requests it makes. The timeout of the client only
+            applies to its own pool.
+        """
+        GitClient.__init__(self, *args, **kwargs)
         self.base_url = base_url.rstrip("/") + "/"
         self.dumb = dumb
-        GitClient.__init__(self, *args, **kwargs)
+        if post_buffer is None:
+            post_buffer = DEFAULT_HTTP_POST_BUFFER
+        self.post_buffer = post_buffer
+        self.compress_requests = compress_requests
+        if pool is None:
+            pool = HttpConnectionPool(timeout=self._timeout)
+        self.pool = pool
+        self._opener = urllib2.build_opener(
+            *[cls(pool) for cls in _POOLED_HANDLERS])
 
     def _get_url(self, path):
         return urlparse.urljoin(self.base_url, path).rstrip("/") + "/"
 
+    def close(self):
+        """Close the idle connections of this client's pool."""
+        self.pool.close()
+
     def _perform(self, req):
         """Perform a HTTP request.
 
         This is provided so subclasses can provide their own version.
+        Chunked requests from _perform_chunked can only be sent through the
+        handlers of this client's opener; other openers raise
+        urllib2.URLError for them rather than send an empty body, so
+        overrides that use a different opener should also override
+        _perform_chunked.
 
         :param req: urllib2.Request instance
         :return: matching response
         """
-        return urllib2.urlopen(req)
+        return self._opener.open(req)
+
+    def _perform_chunked(self, url, headers, chunks):
+        """Perform a HTTP POST request with a chunked request body.
+
+        The request is performed with _perform, so it is subject to the same
+        proxy settings and handlers as other requests.
+
+        :param url: URL to post to
+        :param headers: Dictionary with request headers
+        :param chunks: Iterator over the chunks of the request body
+        :return: response, with the same interface as those returned by
+            _perform
+        """
+        return self._perform(_ChunkedRequest(url, chunks, headers=headers))
 
     def _discover_references(self, service, url):
         assert url[-1] == "/"
         url = urlparse.urljoin(url, "info/refs")
         headers = {}
-        if self.dumb != False:
+        if not self.dumb:
             url += "?service=%s" % service
             headers["Content-Type"] = "application/x-%s-request" % service
         req = urllib2.Request(url, headers=headers)
         resp = self._perform(req)
-        if resp.getcode() == 404:
-            raise NotGitRepository()
-        if resp.getcode() != 200:
-            raise GitProtocolError("unexpected http response %d" %
-                resp.getcode())
-        self.dumb = (not resp.info().gettype().startswith("application/x-git-"))
-        proto = Protocol(resp.read, None)
-        if not self.dumb:
-            # The first line should mention the service
-            pkts = list(proto.read_pkt_seq())
-            if pkts != [('# service=%s\n' % service)]:
-                raise GitProtocolError(
-                    "unexpected first line %r from smart server" % pkts)
-        return self._read_refs(proto)
+        try:
+            if resp.getcode() == 404:
+                raise NotGitRepository()
+            if resp.getcode() != 200:
+                raise GitProtocolError("unexpected http response %d" %
+                    resp.getcode())
+            self.dumb = (
+                not resp.info().gettype().startswith("application/x-git-"))
+            proto = Protocol(resp.read, None,
+                             report_activity=self._report_activity)
+            if not self.dumb:
+                # The first line should mention the service
+                pkts = list(proto.read_pkt_seq())
+                if pkts != [('# service=%s\n' % service)]:
+                    raise GitProtocolError(
+                        "unexpected first line %r from smart server" % pkts)
+            return self._read_refs(proto)
+        finally:
+            resp.close()
+
+    def _report_writes(self, chunks):
+        for chunk in chunks:
+            self._report_activity(len(chunk), 'write')
+            yield chunk
 
     def _smart_request(self, service, url, data):
+        """Send a request to a smart HTTP server.
+
+        Request bodies of up to post_buffer bytes are sent in one go; larger
+        ones are streamed to the server as they are generated.
+
+        :param service: Name of the service to invoke
+        :param url: Repository URL
+        :param data: Request body, either as a string or as an iterable over
+            its chunks
+        :return: response
+        """
         assert url[-1] == "/"
         url = urlparse.urljoin(url, service)
-        req = urllib2.Request(url,
-            headers={"Content-Type": "application/x-%s-request" % service},
-            data=data)
-        resp = self._perform(req)
-        if resp.getcode() == 404:
-            raise NotGitRepository()
-        if resp.getcode() != 200:
-            raise GitProtocolError("Invalid HTTP response from server: %d"
-                % resp.getcode())
-        if resp.info().gettype() != ("application/x-%s-result" % service):
-            raise GitProtocolError("Invalid content-type from server: %s"
-                % resp.info().gettype())
+        headers = {"Content-Type": "application/x-%s-request" % service}
+        if isinstance(data, str):
+            data = [data]
+        if self.compress_requests:
+            data = _gzip_chunks(data)
+            headers["Content-Encoding"] = "gzip"
+        chunks = self._report_writes(_coalesce_chunks(data, _PACK_BUFSIZE))
+        body = []
+        body_size = 0
+        for chunk in chunks:
+            body.append(chunk)
+            body_size += len(chunk)
+            if body_size > self.post_buffer:
+                resp = self._perform_chunked(url, headers,
+                    itertools.chain(body, chunks))
+                break
+        else:
+            req = urllib2.Request(url, headers=headers, data=''.join(body))
+            resp = self._perform(req)
+        try:
+            if resp.getcode() == 404:
+                raise NotGitRepository()
+            if resp.getcode() != 200:
+                raise GitProtocolError("Invalid HTTP response from server: %d"
+                    % resp.getcode())
+            if resp.info().gettype() != ("application/x-%s-result" % service):
+                raise GitProtocolError("Invalid content-type from server: %s"
+                    % resp.info().gettype())
+        except:
+            resp.close()
+            raise
         return resp
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
@@ -662,24 +1252,27 @@ class HttpGitClient(GitClient):
         if not want and old_refs == new_refs:
             return new_refs
         objects = generate_pack_contents(have, want)
+        data = [req_data.getvalue()]
         if len(objects) > 0:
-            entries, sha = write_pack_objects(req_proto.write_file(), objects)
-        resp = self._smart_request("git-receive-pack", url,
-            data=req_data.getvalue())
-        resp_proto = Protocol(resp.read, None)
-        self._handle_receive_pack_tail(resp_proto, negotiated_capabilities,
-            progress)
+            self.stats.add_count('objects', len(objects))
+            # The pack is generated while it is being sent.
+            data = itertools.chain(data, generate_pack_chunks(objects))
+        self.stats.start_phase('writing')
+        try:
+            resp = self._smart_request("git-receive-pack", url, data=data)
+        finally:
+            self.stats.end_phase('writing')
+        try:
+            resp_proto = Protocol(resp.read, None,
+                                  report_activity=self._report_activity)
+            self._handle_receive_pack_tail(resp_proto,
+                negotiated_capabilities, progress)
+        finally:
+            resp.close()
         return new_refs
 
-    def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress):
-        """Retrieve a pack from a git smart server.
-
-        :param determine_wants: Callback that returns list of commits to fetch
-        :param graph_walker: Object with next() and ack().
-        :param pack_data: Callback called for each bit of data in the pack
-        :param progress: Callback for progress reports (strings)
-        """
+    def _fetch_pack(self, path, determine_wants, graph_walker, handle_pack,
+                    progress=None):
         url = self._get_url(path)
         refs, server_capabilities = self._discover_references(
             "git-upload-pack", url)
@@ -696,38 +1289,229 @@ class HttpGitClient(GitClient):
             lambda: False)
         resp = self._smart_request("git-upload-pack", url,
             data=req_data.getvalue())
-        resp_proto = Protocol(resp.read, None)
-        self._handle_upload_pack_tail(resp_proto, negotiated_capabilities,
-            graph_walker, pack_data, progress)
+        try:
+            resp_proto = Protocol(resp.read, None,
+                                  report_activity=self._report_activity)
+            self._handle_upload_pack_tail(resp_proto,
+                negotiated_capabilities, graph_walker, handle_pack, progress)
+        finally:
+            resp.close()
         return refs
 
 
-def get_transport_and_path(uri):
+def get_transport_and_path(uri, **kwargs):
     """Obtain a git client from a URI or path.
 
     :param uri: URI or path
+    :param kwargs: Keyword arguments for the client, e.g. timeout
     :return: Tuple with client instance and relative path.
     """
     parsed = urlparse.urlparse(uri)
     if parsed.scheme == 'git':
-        return TCPGitClient(parsed.hostname, port=parsed.port), parsed.path
+        return (TCPGitClient(parsed.hostname, port=parsed.port, **kwargs),
+                parsed.path)
     elif parsed.scheme == 'git+ssh':
         return SSHGitClient(parsed.hostname, port=parsed.port,
-                            username=parsed.username), parsed.path
+                            username=parsed.username, **kwargs), parsed.path
     elif parsed.scheme in ('http', 'https'):
         return HttpGitClient(urlparse.urlunparse(
-            parsed.scheme, parsed.netloc, path='/'))
+            (parsed.scheme, parsed.netloc, '/', '', '', '')),
+            **kwargs), parsed.path
 
     if parsed.scheme and not parsed.netloc:
         # SSH with no user@, zero or one leading slash.
-        return SSHGitClient(parsed.scheme), parsed.path
+        return SSHGitClient(parsed.scheme, **kwargs), parsed.path
     elif parsed.scheme:
         raise ValueError('Unknown git protocol scheme: %s' % parsed.scheme)
     elif '@' in parsed.path and ':' in parsed.path:
         # SSH with user@host:foo.
         user_host, path = parsed.path.split(':')
         user, host = user_host.rsplit('@')
-        return SSHGitClient(host, username=user), path
+        return SSHGitClient(host, username=user, **kwargs), path
 
     # Otherwise, assume it's a local path.
-    return SubprocessGitClient(), uri
+    return SubprocessGitClient(**kwargs), uri
+
+
+class FetchResult(object):
+    """Result of fetching from a single remote with fetch_many.
+
+    :ivar url: URL that was fetched from
+    :ivar target: Repository that was fetched into
+    :ivar refs: Dictionary with the remote refs, or None if fetching failed
+    :ivar error: Exception raised by the last attempt, or None if it
+        succeeded
+    :ivar attempts: Number of attempts that were made
+    :ivar bytes_received: Number of bytes of pack data received, over all
+        attempts
+    :ivar num_objects: Number of objects in the pack that was added
+    :ivar elapsed: Time spent on fetching, in seconds
+    """
+
+    def __init__(self, url, target):
+        self.url = url
+        self.target = target
+        self.refs = None
+        self.error = None
+        self.attempts = 0
+        self.bytes_received = 0
+        self.num_objects = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        if self.error is not None:
+            status = 'failed: %s' % self.error
+        else:
+            status = '%d objects, %d bytes' % (self.num_objects,
+                                               self.bytes_received)
+        return '<%s for %s: %s>' % (self.__class__.__name__, self.url, status)
+
+
+def _is_timeout(e):
+    """Check whether an exception was caused by a socket timeout."""
+    if isinstance(e, urllib2.URLError):
+        e = e.reason
+    elif isinstance(e, GitProtocolError) and e.args:
+        # Protocol wraps socket errors.
+        e = e.args[0]
+    return isinstance(e, socket.timeout)
+
+
+def _fetch_one(result, get_transport, determine_wants, timeout, progress):
+    """Make a single attempt at fetching for a FetchResult.
+
+    FETCH_HEAD in the target repository is locked while fetching, and
+    written with the remote refs once the fetch succeeds.
+    """
+    url = result.url
+    target = result.target
+    if timeout is not None:
+        deadline = time.time() + timeout
+    else:
+        deadline = None
+
+    def check_deadline():
+        if deadline is not None and time.time() > deadline:
+            raise FetchTimeout(url)
+
+    def report_progress(data):
+        check_deadline()
+        if progress is not None:
+            progress(url, data)
+
+    def counting(read):
+        def read_counted(size):
+            check_deadline()
+            data = read(size)
+            result.bytes_received += len(data)
+            return data
+        return read_counted
+
+    packs = []
+    def handle_pack(read_all, read_some):
+        pack = target.object_store.add_thin_pack(counting(read_all),
+                                                 counting(read_some))
+        if pack is not None:
+            packs.append(pack)
+
+    if determine_wants is None:
+        determine_wants = target.object_store.determine_wants_all
+    f = GitFile(os.path.join(target.controldir(), 'FETCH_HEAD'), 'wb')
+    try:
+        client, path = get_transport(url)
+        try:
+            refs = client._fetch_pack(path, determine_wants,
+                target.get_graph_walker(), handle_pack, report_progress)
+        finally:
+            close = getattr(client, 'close', None)
+            if close is not None:
+                close()
+        for name in sorted(refs):
+            if not name.endswith('^{}'):
+                f.write("%s\t\t'%s' of %s\n" % (refs[name], name, url))
+    except:
+        f.abort()
+        if _is_timeout(sys.exc_info()[1]):
+            raise FetchTimeout(url)
+        raise
+    f.close()
+    result.refs = refs
+    result.num_objects = sum(len(pack) for pack in packs)
+
+
+def fetch_many(specs, concurrency=4, timeout=None, retries=0, progress=None,
+               determine_wants=None, get_transport=None):
+    """Fetch from many remotes in parallel.
+
+    Each remote is fetched into its own repository by a pool of worker
+    threads. Failures are recorded in the results rather than raised.
+    FETCH_HEAD in a target repository is locked while it is fetched into, so
+    a repository that is already being fetched into (by another process or
+    by a spec with the same target) can not be fetched into.
+
+    :param specs: Iterable over (url, target) tuples, where target is the
+        on-disk repository to fetch into
+    :param concurrency: Maximum number of fetches to run at the same time
+    :param timeout: Optional timeout in seconds for each attempt. Clients
+        returned by the default get_transport use it as the timeout for
+        connecting and for each read, and the total time of an attempt is
+        checked whenever data is received.
+    :param retries: Number of times to retry a failed fetch
+    :param progress: Optional function that is called with the URL and the
+        data of the progress messages of all remotes; calls are serialized
+    :param determine_wants: Optional function to determine what refs to
+        fetch; by default all refs are fetched
+    :param get_transport: Function that returns a client and path for a
+        URL; defaults to get_transport_and_path. Clients it returns should
+        have a timeout of their own if timeout is set, since a blocking read
+        can otherwise not be interrupted.
+    :return: List of FetchResult objects, in the same order as specs
+    """
+    if get_transport is None:
+        def get_transport(url):
+            return get_transport_and_path(url, timeout=timeout)
+    results = [FetchResult(url, target) for (url, target) in specs]
+    pending = Queue.Queue()
+    for result in results:
+        pending.put(result)
+
+    if progress is not None:
+        progress_lock = threading.Lock()
+        def shared_progress(url, data):
+            progress_lock.acquire()
+            try:
+                progress(url, data)
+            finally:
+                progress_lock.release()
+    else:
+        shared_progress = None
+
+    def worker():
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            while True:
+                result.attempts += 1
+                try:
+                    _fetch_one(result, get_transport, determine_wants,
+                               timeout, shared_progress)
+                except Exception, e:
+                    result.error = e
+                    if result.attempts > retries:
+                        break
+                else:
+                    result.error = None
+                    break
+            result.elapsed = time.time() - start
+
+    threads = []
+    for i in range(min(concurrency, len(results))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
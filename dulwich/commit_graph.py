@@ -0,0 +1,316 @@
+# commit_graph.py -- Commit graph files
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Commit graph files.
+
+A commit graph file (objects/info/commit-graph) stores the parents, root
+tree, commit time and generation number of a set of commits, so that the
+history can be walked without inflating and parsing commit objects.
+
+The generation number of a commit is one more than the maximum generation
+number of its parents; commits without parents have generation number 1.
+If commit A is an ancestor of commit B, A has a lower generation number
+than B.
+"""
+
+import struct
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+from dulwich._compat import (
+    make_sha,
+    )
+try:
+    from struct import unpack_from
+except ImportError:
+    from dulwich._compat import unpack_from
+
+COMMIT_GRAPH_FILENAME = 'commit-graph'
+
+_COMMIT_GRAPH_SIGNATURE = 'CGPH'
+_CHUNK_OID_FANOUT = 'OIDF'
+_CHUNK_OID_LOOKUP = 'OIDL'
+_CHUNK_COMMIT_DATA = 'CDAT'
+_CHUNK_EXTRA_EDGES = 'EDGE'
+
+_PARENT_NONE = 0x70000000
+_PARENT_EXTRA_EDGES = 0x80000000
+_PARENT_LAST_EDGE = 0x80000000
+_GENERATION_MAX = 0x3FFFFFFF
+
+
+def load_commit_graph(path):
+    """Load a commit graph file by path.
+
+    :param path: Path to the commit graph file
+    :return: A CommitGraph loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return CommitGraph(path, file=f)
+    finally:
+        f.close()
+
+
+class CommitGraph(object):
+    """A git commit graph file (version 1)."""
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != _COMMIT_GRAPH_SIGNATURE:
+            raise AssertionError('Not a commit graph file')
+        (self.version, hash_version, num_chunks,
+         num_base_graphs) = unpack_from('>BBBB', self._contents, 4)
+        if self.version != 1:
+            raise AssertionError(
+                'Unknown commit graph version %d' % self.version)
+        if hash_version != 1:
+            raise AssertionError(
+                'Unknown commit graph hash version %d' % hash_version)
+        if num_base_graphs != 0:
+            raise AssertionError('Split commit graphs are not supported')
+        self._chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = unpack_from('>4sQ', self._contents, 8 + i * 12)
+            self._chunks[chunk_id] = offset
+        for chunk_id in (_CHUNK_OID_FANOUT, _CHUNK_OID_LOOKUP,
+                         _CHUNK_COMMIT_DATA):
+            if chunk_id not in self._chunks:
+                raise AssertionError(
+                    'Missing %s chunk in commit graph' % chunk_id)
+        self._fan_out_table = list(unpack_from('>256L', self._contents,
+            self._chunks[_CHUNK_OID_FANOUT]))
+        self._name_table_offset = self._chunks[_CHUNK_OID_LOOKUP]
+        self._data_table_offset = self._chunks[_CHUNK_COMMIT_DATA]
+        self._edge_table_offset = self._chunks.get(_CHUNK_EXTRA_EDGES)
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of commits in this commit graph."""
+        return self._fan_out_table[-1]
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def __iter__(self):
+        """Iterate over the hex SHA1s of the commits in this graph."""
+        for i in xrange(len(self)):
+            yield sha_to_hex(self._unpack_name(i))
+
+    def _commit_position(self, sha):
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = None
+        if start < end:
+            i = bisect_find_sha(start, end - 1, sha, self._unpack_name)
+        if i is None:
+            raise KeyError(sha)
+        return i
+
+    def __contains__(self, sha):
+        try:
+            self._commit_position(sha)
+            return True
+        except KeyError:
+            return False
+
+    def _unpack_data(self, i):
+        return unpack_from('>20sLLLL', self._contents,
+                           self._data_table_offset + i * 36)
+
+    def _parent_positions(self, i):
+        (tree, parent1, parent2, gen_and_time_high,
+         time_low) = self._unpack_data(i)
+        if parent1 == _PARENT_NONE:
+            return []
+        if parent2 == _PARENT_NONE:
+            return [parent1]
+        if not parent2 & _PARENT_EXTRA_EDGES:
+            return [parent1, parent2]
+        ret = [parent1]
+        offset = (self._edge_table_offset +
+                  (parent2 & ~_PARENT_EXTRA_EDGES) * 4)
+        while True:
+            (edge,) = unpack_from('>L', self._contents, offset)
+            ret.append(edge & ~_PARENT_LAST_EDGE)
+            if edge & _PARENT_LAST_EDGE:
+                return ret
+            offset += 4
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        :param sha: SHA1 of the commit, as hex or binary string
+        :return: List of hex SHA1s of the parents
+        :raise KeyError: if the commit is not in this graph
+        """
+        return [sha_to_hex(self._unpack_name(p))
+                for p in self._parent_positions(self._commit_position(sha))]
+
+    def get_tree(self, sha):
+        """Return the hex SHA1 of the root tree of a commit."""
+        return sha_to_hex(self._unpack_data(self._commit_position(sha))[0])
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit, in seconds since the epoch."""
+        data = self._unpack_data(self._commit_position(sha))
+        return ((data[3] & 0x3) << 32) | data[4]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit."""
+        return self._unpack_data(self._commit_position(sha))[3] >> 2
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this commit graph.
+
+        :return: This is a 20-byte binary digest
+        """
+        return make_sha(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this commit graph.
+
+        :return: 20-byte binary digest
+        """
+        return str(self._contents[-20:])
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+
+def write_commit_graph(f, get_commit, commit_ids):
+    """Write a commit graph file.
+
+    The graph contains the given commits and all of their ancestors.
+
+    :param f: File-like object to write to
+    :param get_commit: Function to retrieve a Commit by hex SHA1
+    :param commit_ids: Iterable over hex SHA1s of commits
+    :return: The SHA of the written commit graph
+    """
+    commits = {}
+    todo = list(commit_ids)
+    while todo:
+        sha = todo.pop()
+        if sha in commits:
+            continue
+        commit = get_commit(sha)
+        commits[sha] = commit
+        todo.extend(commit.parents)
+
+    generations = {}
+    for sha in commits:
+        todo = [sha]
+        while todo:
+            current = todo[-1]
+            if current in generations:
+                todo.pop()
+                continue
+            parents = commits[current].parents
+            missing = [p for p in parents if p not in generations]
+            if missing:
+                todo.extend(missing)
+                continue
+            generations[current] = min(_GENERATION_MAX,
+                1 + max([0] + [generations[p] for p in parents]))
+            todo.pop()
+
+    shas = sorted(commits)
+    positions = dict((sha, i) for (i, sha) in enumerate(shas))
+    fan_out = [0] * 256
+    for sha in shas:
+        fan_out[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fan_out[i] += fan_out[i-1]
+    data = []
+    edges = []
+    for sha in shas:
+        commit = commits[sha]
+        parents = [positions[p] for p in commit.parents]
+        if not parents:
+            parent1, parent2 = _PARENT_NONE, _PARENT_NONE
+        elif len(parents) == 1:
+            parent1, parent2 = parents[0], _PARENT_NONE
+        elif len(parents) == 2:
+            parent1, parent2 = parents
+        else:
+            parent1 = parents[0]
+            parent2 = _PARENT_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(parents[-1] | _PARENT_LAST_EDGE)
+        commit_time = commit.commit_time
+        data.append(struct.pack('>20sLLLL', hex_to_sha(commit.tree),
+            parent1, parent2,
+            (generations[sha] << 2) | ((commit_time >> 32) & 0x3),
+            commit_time & 0xFFFFFFFF))
+
+    chunks = [
+        (_CHUNK_OID_FANOUT, [struct.pack('>256L', *fan_out)]),
+        (_CHUNK_OID_LOOKUP, [hex_to_sha(sha) for sha in shas]),
+        (_CHUNK_COMMIT_DATA, data),
+        ]
+    if edges:
+        chunks.append((_CHUNK_EXTRA_EDGES,
+                       [struct.pack('>%dL' % len(edges), *edges)]))
+
+    f = SHA1Writer(f)
+    f.write(_COMMIT_GRAPH_SIGNATURE)
+    f.write(struct.pack('>BBBB', 1, 1, len(chunks), 0))
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, chunk_data in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += sum(len(c) for c in chunk_data)
+    f.write(struct.pack('>4sQ', '\0\0\0\0', offset))
+    for chunk_id, chunk_data in chunks:
+        for chunk in chunk_data:
+            f.write(chunk)
+    return f.write_sha()
@@ -67,7 +67,7 @@ class TreeChange(namedtuple('TreeChange', ['type', 'old', 'new'])):
 
 def _tree_entries(path, tree):
     result = []
-    if not tree:
+    if tree is None:
         return result
     for entry in tree.iteritems(name_order=True):
         result.append(entry.in_path(path))
@@ -145,8 +145,13 @@ def walk_trees(store, tree1_id, tree2_id, prune_identical=False):
         if prune_identical and is_tree1 and is_tree2 and entry1 == entry2:
             continue
 
-        tree1 = is_tree1 and store[entry1.sha] or None
-        tree2 = is_tree2 and store[entry2.sha] or None
+        # Trees are not tested for truth, as their length would make them
+        # keep their parsed entries.
+        tree1 = tree2 = None
+        if is_tree1:
+            tree1 = store[entry1.sha]
+        if is_tree2:
+            tree2 = store[entry2.sha]
         path = entry1.path or entry2.path
         todo.extend(reversed(_merge_entries(path, tree1, tree2)))
         yield entry1, entry2
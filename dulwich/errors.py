@@ -138,6 +138,13 @@ class HangupException(GitProtocolError):
             "The remote server unexpectedly closed the connection.")
 
 
+class FetchTimeout(GitProtocolError):
+    """A fetch did not complete within its timeout."""
+
+    def __init__(self, url):
+        GitProtocolError.__init__(self, 'Fetch from %s timed out' % url)
+
+
 class UnexpectedCommandError(GitProtocolError):
     """Unexpected command received in a proto line."""
 
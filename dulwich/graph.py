@@ -0,0 +1,139 @@
+# graph.py -- Queries on the commit graph
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Ancestry queries on the commit graph.
+
+These only use the get_parents, get_commit_time and get_generation methods
+of the object store. When generation numbers are available (see
+dulwich.commit_graph), walks stop as soon as the generation numbers show
+that the answer can not change.
+"""
+
+import heapq
+
+# Commits without a known generation number are all descendants of commits
+# with one, since commit graphs contain all ancestors of their commits.
+_GENERATION_INFINITY = 0xFFFFFFFF
+
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+
+
+def is_ancestor(store, ancestor, descendant):
+    """Check whether a commit is an ancestor of another commit.
+
+    A commit is considered to be an ancestor of itself.
+
+    :param store: Object store to retrieve commit information from
+    :param ancestor: SHA1 of the possible ancestor
+    :param descendant: SHA1 of the possible descendant
+    :return: True if ancestor is reachable from descendant, False otherwise
+    """
+    if ancestor == descendant:
+        return True
+    min_generation = store.get_generation(ancestor)
+    todo = [descendant]
+    seen = set(todo)
+    while todo:
+        sha = todo.pop()
+        for parent in store.get_parents(sha):
+            if parent == ancestor:
+                return True
+            if parent in seen:
+                continue
+            seen.add(parent)
+            if min_generation is not None:
+                generation = store.get_generation(parent)
+                if generation is not None and generation <= min_generation:
+                    # The ancestors of this commit all have lower generation
+                    # numbers than the commit we're looking for.
+                    continue
+            todo.append(parent)
+    return False
+
+
+def _priority(store, sha):
+    generation = store.get_generation(sha)
+    if generation is None:
+        generation = _GENERATION_INFINITY
+    return (-generation, -store.get_commit_time(sha), sha)
+
+
+def _paint_down_to_common(store, a, b):
+    """Find the common ancestors of two commits that are not reachable from
+    other common ancestors found earlier.
+
+    Commits are processed newest first, by generation number if known and
+    by commit time otherwise, and are painted with the side(s) they are
+    reachable from. The walk stops once only commits reachable from a common
+    ancestor are left.
+    """
+    flags = {a: _PARENT1, b: _PARENT2}
+    queue = [_priority(store, a), _priority(store, b)]
+    heapq.heapify(queue)
+    # Commits are queued at most once; their flags are read when they are
+    # popped. nonstale counts the queued commits that are not stale.
+    queued = set([a, b])
+    nonstale = 2
+    results = []
+    while nonstale:
+        _, _, sha = heapq.heappop(queue)
+        queued.remove(sha)
+        commit_flags = flags[sha]
+        if not commit_flags & _STALE:
+            nonstale -= 1
+        if commit_flags == _PARENT1 | _PARENT2:
+            if sha not in results:
+                results.append(sha)
+            commit_flags |= _STALE
+            flags[sha] = commit_flags
+        for parent in store.get_parents(sha):
+            parent_flags = flags.get(parent, 0)
+            if parent_flags & commit_flags == commit_flags:
+                continue
+            new_flags = parent_flags | commit_flags
+            flags[parent] = new_flags
+            if parent in queued:
+                if not parent_flags & _STALE and new_flags & _STALE:
+                    nonstale -= 1
+            else:
+                queued.add(parent)
+                heapq.heappush(queue, _priority(store, parent))
+                if not new_flags & _STALE:
+                    nonstale += 1
+    return results
+
+
+def find_merge_base(store, a, b):
+    """Find the best common ancestors of two commits.
+
+    :param store: Object store to retrieve commit information from
+    :param a: SHA1 of the first commit
+    :param b: SHA1 of the second commit
+    :return: List of SHA1s of the common ancestors of a and b that are not
+        ancestors of other common ancestors; empty if there are none
+    """
+    if a == b:
+        return [a]
+    candidates = _paint_down_to_common(store, a, b)
+    if len(candidates) < 2:
+        return candidates
+    return [c for c in candidates
+            if not [o for o in candidates
+                    if o != c and is_ancestor(store, c, o)]]
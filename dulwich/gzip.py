@@ -77,7 +77,7 @@ class GzipConsumer(object):
                     raise IOError('invalid gzip data')
                 data = data[i:]
             except IndexError:
-                self.__data = data
+                self._data = data
                 return # need more data
             import zlib
             self._data = ''
@@ -25,7 +25,17 @@ import itertools
 import os
 import stat
 import tempfile
+import threading
 
+from dulwich.bitmap import (
+    load_pack_bitmap,
+    write_pack_bitmap,
+    )
+from dulwich.commit_graph import (
+    COMMIT_GRAPH_FILENAME,
+    load_commit_graph,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
@@ -34,6 +44,9 @@ from dulwich.errors import (
     NotTreeError,
     )
 from dulwich.file import GitFile
+from dulwich.lru_cache import (
+    LRUCache,
+    )
 from dulwich.objects import (
     Commit,
     ShaFile,
@@ -45,15 +58,22 @@ from dulwich.objects import (
     hex_to_filename,
     S_ISGITLINK,
     object_class,
+    read_loose_object_info,
     )
 from dulwich.pack import (
+    DELTA_TYPES,
+    DeltaBaseCache,
+    MULTI_PACK_INDEX_FILENAME,
     Pack,
     PackData,
+    deltify_pack_entries,
     iter_sha1,
+    load_multi_pack_index,
     write_pack_header,
     write_pack_index_v2,
     write_pack_object,
     write_pack_objects,
+    write_multi_pack_index,
     compute_file_sha,
     PackIndexer,
     PackStreamCopier,
@@ -107,6 +127,15 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_object_info(self, name):
+        """Obtain the type and size of an object.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and size of the object contents.
+        """
+        type_num, uncomp = self.get_raw(name)
+        return type_num, len(uncomp)
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
         type_num, uncomp = self.get_raw(sha)
@@ -194,7 +223,37 @@ class BaseObjectStore(object):
         :param heads: Local heads to start search with
         :return: GraphWalker object
         """
-        return ObjectStoreGraphWalker(heads, lambda sha: self[sha].parents)
+        return ObjectStoreGraphWalker(heads, self.get_parents)
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        :param sha: SHA1 of the commit
+        :return: List of SHA1s of the parents
+        :raise KeyError: if the commit is not present
+        """
+        return self[sha].parents
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :param sha: SHA1 of the commit
+        :return: Commit time, in seconds since the epoch
+        :raise KeyError: if the commit is not present
+        """
+        return self[sha].commit_time
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit, if known.
+
+        The generation number of a commit is one more than the maximum
+        generation number of its parents, so if a commit is an ancestor of
+        another commit, it has a lower generation number.
+
+        :param sha: SHA1 of the commit
+        :return: Generation number, or None if it is not known
+        """
+        return None
 
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
@@ -203,7 +262,24 @@ class BaseObjectStore(object):
         :param want: List of SHA1s of objects that should be sent
         :param progress: Optional progress reporting method
         """
-        return self.iter_shas(self.find_missing_objects(have, want, progress))
+        return ObjectStoreIterator(self,
+            self.find_missing_objects(have, want, progress), haves=have)
+
+    def iter_pack_records(self, object_ids, window=10, depth=50,
+                          thin_bases=()):
+        """Generate the entries of a pack containing a set of objects.
+
+        :param object_ids: Iterable over (sha, path) tuples of objects to pack
+        :param window: Sliding window size for searching for deltas; 0 to
+            disable delta compression
+        :param depth: Maximum delta chain depth
+        :param thin_bases: SHA1s of objects the receiver is known to have, and
+            which may be used as delta bases without being sent
+        :return: Iterator over records suitable for write_pack_data
+        """
+        return deltify_pack_entries(self.get_raw, object_ids, window,
+                                    depth=depth,
+                                    get_info=self.get_object_info)
 
     def peel_sha(self, sha):
         """Peel all tags from a SHA.
@@ -221,21 +297,265 @@ class BaseObjectStore(object):
         return obj
 
 
+class PackHandleCache(object):
+    """Limits the number of packs that have their files loaded.
+
+    Packs register themselves when they load their data or index. Once more
+    than max_open_packs packs are loaded, or their mapped indexes and data
+    take up more than max_mapped_size bytes, the least recently used packs
+    are released, which closes their files once no thread is using them
+    (see Pack.begin_use). They are loaded again when they are next used.
+
+    A single cache can be shared by the object stores of many repositories,
+    and used from several threads.
+    """
+
+    def __init__(self, max_open_packs=None, max_mapped_size=None):
+        """Create a new PackHandleCache.
+
+        :param max_open_packs: Maximum number of loaded packs, or None
+        :param max_mapped_size: Maximum number of bytes in loaded pack
+            indexes and mapped pack data, or None
+        """
+        self.max_open_packs = max_open_packs
+        self.max_mapped_size = max_mapped_size
+        self._lock = threading.Lock()
+        # Maps id(pack) to (last use, pack)
+        self._packs = {}
+        self._clock = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._packs)
+
+    def __contains__(self, pack):
+        return id(pack) in self._packs
+
+    def mapped_size(self):
+        """Return the number of bytes in the loaded indexes and data of the
+        packs."""
+        return sum(pack.mapped_size() for _, pack in self._packs.values())
+
+    def touch(self, pack):
+        """Mark a pack as recently used."""
+        key = id(pack)
+        self._lock.acquire()
+        try:
+            if key in self._packs:
+                self._clock += 1
+                self._packs[key] = (self._clock, pack)
+        finally:
+            self._lock.release()
+
+    def opened(self, pack):
+        """Register a pack that loaded its data or index.
+
+        Other packs are released if this takes the cache over its limits.
+        """
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._packs[id(pack)] = (self._clock, pack)
+            self._shrink(pack)
+        finally:
+            self._lock.release()
+
+    def forget(self, pack):
+        """Stop tracking a pack, e.g. because it was removed."""
+        self._lock.acquire()
+        try:
+            self._packs.pop(id(pack), None)
+        finally:
+            self._lock.release()
+
+    def _over_limits(self):
+        if (self.max_open_packs is not None and
+            len(self._packs) > self.max_open_packs):
+            return True
+        if (self.max_mapped_size is not None and
+            self.mapped_size() > self.max_mapped_size):
+            return True
+        return False
+
+    def _shrink(self, keep):
+        # Called with the lock held.
+        if not self._over_limits():
+            return
+        entries = sorted(self._packs.values())
+        for _, pack in entries:
+            if pack is keep:
+                continue
+            del self._packs[id(pack)]
+            pack.release()
+            self.evictions += 1
+            if not self._over_limits():
+                break
+
+
 class PackBasedObjectStore(BaseObjectStore):
 
+    # Number of SHAs that were not found in any pack to remember.
+    packed_miss_cache_size = 10000
+
     def __init__(self):
         self._pack_cache = None
+        self._packed_misses = LRUCache(self.packed_miss_cache_size)
+        self._packed_misses_lock = threading.Lock()
+        # Bumped whenever packs appear, so that lookups that were already
+        # running do not record misses for objects in the new packs.
+        self._packed_misses_generation = 0
+        # Resolved objects from all packs in this store
+        self.delta_base_cache = DeltaBaseCache()
 
     @property
     def alternates(self):
         return []
 
+    def _scan_packs(self, sha, packs):
+        """Find an object by looking in a number of packs.
+
+        Packs that have taken many misses skip most further misses using
+        their bloom filter; see Pack.find_offset. The pack the object is
+        found in is moved to the front of the pack cache, so
+        that packs are tried in most-recently-hit order.
+
+        :param sha: Binary SHA1 of the object
+        :param packs: Iterable over Pack objects to look in
+        :return: Tuple with Pack object and offset, or None if the object
+            is not in any of the packs.
+        """
+        for pack in packs:
+            offset = pack.find_offset(sha)
+            if offset is None:
+                continue
+            self._pack_hit(pack)
+            return pack, offset
+        return None
+
+    def _pack_hit(self, pack):
+        """Move a pack to the front of the pack cache."""
+        if pack.handle_cache is not None:
+            pack.handle_cache.touch(pack)
+        packs = self._pack_cache
+        if not packs or packs[0] is pack:
+            return
+        # The list is replaced rather than changed in place, as other threads
+        # may be iterating over it.
+        self._pack_cache = [pack] + [p for p in packs if p is not pack]
+
+    def _find_packed(self, sha):
+        """Find the pack containing an object.
+
+        :param sha: Binary SHA1 of the object
+        :return: Tuple with Pack object and offset, or None if the object
+            is not packed.
+        """
+        return self._scan_packs(sha, self.packs)
+
+    def _lookup_packed(self, sha):
+        """Find the pack containing an object, remembering misses.
+
+        :param sha: SHA1 of the object, as hex or binary string
+        :return: Tuple with Pack object and offset, or None if the object
+            is not packed.
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        # Reloads the packs and forgets the misses if the packs changed.
+        self.packs
+        self._packed_misses_lock.acquire()
+        try:
+            if sha in self._packed_misses:
+                return None
+            generation = self._packed_misses_generation
+        finally:
+            self._packed_misses_lock.release()
+        entry = self._find_packed(sha)
+        if entry is None:
+            self._packed_misses_lock.acquire()
+            try:
+                if generation == self._packed_misses_generation:
+                    self._packed_misses.add(sha, True)
+            finally:
+                self._packed_misses_lock.release()
+        return entry
+
     def contains_packed(self, sha):
         """Check if a particular object is present by SHA1 and is packed."""
-        for pack in self.packs:
-            if sha in pack:
-                return True
-        return False
+        return self._lookup_packed(sha) is not None
+
+    def _get_pack_bitmap(self):
+        """Return the pack bitmap index to use for reachability queries.
+
+        :return: A PackBitmapIndex, or None if there is none
+        """
+        return None
+
+    def find_missing_objects(self, haves, wants, progress=None,
+                             get_tagged=None):
+        """Find the missing objects required for a set of revisions.
+
+        If one of the packs has a bitmap index, and it covers all objects
+        reachable from the wants and haves, the missing objects are found
+        using bitmap operations rather than by walking the object graph.
+        The objects found this way are those not reachable from any of the
+        haves, and are yielded without paths.
+
+        :param haves: Iterable over SHAs already in common.
+        :param wants: Iterable over SHAs of objects to fetch.
+        :param progress: Simple progress function that will be called with
+            updated progress strings.
+        :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+            sha for including tags.
+        :return: Iterator over (sha, path) pairs.
+        """
+        bitmap = self._get_pack_bitmap()
+        if bitmap is not None:
+            haves = list(haves)
+            wants = list(wants)
+            try:
+                missing = self._find_missing_objects_bitmap(bitmap, haves,
+                                                            wants, get_tagged)
+            except KeyError:
+                pass
+            else:
+                if progress is not None:
+                    progress("counting objects: %d, done.\n" % len(missing))
+                return iter(missing)
+        return super(PackBasedObjectStore, self).find_missing_objects(
+            haves, wants, progress, get_tagged)
+
+    def _find_missing_objects_bitmap(self, bitmap, haves, wants, get_tagged):
+        """Find missing objects using a pack bitmap index.
+
+        :raise KeyError: if an object reachable from the wants or haves is
+            not covered by the bitmap index
+        """
+        have_bits = bitmap.reachable(haves, self.__getitem__)
+        want_bits = bitmap.reachable(wants, self.__getitem__)
+        missing = [(sha, None)
+                   for sha in bitmap.iter_shas(want_bits & ~have_bits)]
+        tagged = get_tagged and get_tagged() or {}
+        if tagged:
+            sent = set(sha for sha, path in missing)
+            for sha, tag_sha in tagged.iteritems():
+                if sha in sent and tag_sha not in sent:
+                    missing.append((tag_sha, None))
+                    sent.add(tag_sha)
+        return missing
+
+    def _get_packed_raw(self, sha):
+        """Obtain the raw text for an object from one of the packs.
+
+        :param sha: Binary SHA1 of the object
+        :return: tuple with numeric type and object contents.
+        :raise KeyError: if the object is not in any pack
+        """
+        entry = self._lookup_packed(sha)
+        if entry is None:
+            raise KeyError(sha)
+        pack, offset = entry
+        return pack.get_raw_at(offset)
 
     def _load_packs(self):
         raise NotImplementedError(self._load_packs)
@@ -248,15 +568,41 @@ class PackBasedObjectStore(BaseObjectStore):
         """Add a newly appeared pack to the cache by path.
 
         """
-        if self._pack_cache is not None:
-            self._pack_cache.append(pack)
+        packs = self._pack_cache
+        if packs is not None:
+            self._pack_cache = [pack] + packs
+        self._clear_packed_misses()
+
+    def _clear_packed_misses(self):
+        self._packed_misses_lock.acquire()
+        try:
+            self._packed_misses.clear()
+            self._packed_misses_generation += 1
+        finally:
+            self._packed_misses_lock.release()
 
     @property
     def packs(self):
         """List with pack objects."""
-        if self._pack_cache is None or self._pack_cache_stale():
-            self._pack_cache = self._load_packs()
-        return self._pack_cache
+        # close() may reset the cache from another thread at any time.
+        packs = self._pack_cache
+        if packs is None or self._pack_cache_stale():
+            packs = self._load_packs()
+            self._pack_cache = packs
+            self._clear_packed_misses()
+        return packs
+
+    def close(self):
+        """Release the loaded packs of this object store.
+
+        The packs are loaded again when they are next used.
+        """
+        packs = self._pack_cache
+        self._pack_cache = None
+        for pack in packs or []:
+            if pack.handle_cache is not None:
+                pack.handle_cache.forget(pack)
+            pack.release()
 
     def _iter_loose_objects(self):
         """Iterate over the SHAs of all loose objects."""
@@ -265,6 +611,18 @@ class PackBasedObjectStore(BaseObjectStore):
     def _get_loose_object(self, sha):
         raise NotImplementedError(self._get_loose_object)
 
+    def _get_loose_object_info(self, sha):
+        """Get the type and size of a loose object.
+
+        :param sha: Hex SHA1 of the object
+        :return: Tuple with type number and size, or None if there is no
+            such loose object
+        """
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return obj.type_num, obj.raw_length()
+
     def _remove_loose_object(self, sha):
         raise NotImplementedError(self._remove_loose_object)
 
@@ -304,11 +662,10 @@ class PackBasedObjectStore(BaseObjectStore):
             hexsha = None
         else:
             raise AssertionError("Invalid object name %r" % name)
-        for pack in self.packs:
-            try:
-                return pack.get_raw(sha)
-            except KeyError:
-                pass
+        try:
+            return self._get_packed_raw(sha)
+        except KeyError:
+            pass
         if hexsha is None:
             hexsha = sha_to_hex(name)
         ret = self._get_loose_object(hexsha)
@@ -321,6 +678,159 @@ class PackBasedObjectStore(BaseObjectStore):
                 pass
         raise KeyError(hexsha)
 
+    def get_object_info(self, name):
+        """Obtain the type and size of an object.
+
+        Only the object headers are read, so this is much cheaper than
+        get_raw for large or deltified objects.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and size of the object contents.
+        """
+        if len(name) == 40:
+            sha = hex_to_sha(name)
+            hexsha = name
+        elif len(name) == 20:
+            sha = name
+            hexsha = None
+        else:
+            raise AssertionError("Invalid object name %r" % name)
+        entry = self._lookup_packed(sha)
+        if entry is not None:
+            pack, offset = entry
+            return pack.get_object_info_at(offset)
+        if hexsha is None:
+            hexsha = sha_to_hex(name)
+        ret = self._get_loose_object_info(hexsha)
+        if ret is not None:
+            return ret
+        for alternate in self.alternates:
+            try:
+                return alternate.get_object_info(hexsha)
+            except KeyError:
+                pass
+        raise KeyError(hexsha)
+
+    def _get_raw_unresolved(self, sha):
+        """Find an object as it is stored in one of the packs.
+
+        :param sha: Binary SHA1 of the object
+        :return: An UnpackedObject, see Pack.get_raw_unresolved
+        :raise KeyError: if the object is not in any pack
+        """
+        entry = self._lookup_packed(sha)
+        if entry is None:
+            raise KeyError(sha)
+        return entry[0].get_raw_unresolved(sha)
+
+    def _get_object_header(self, sha):
+        """Find the type and delta base of an object as stored in a pack.
+
+        :param sha: Binary SHA1 of the object
+        :return: Tuple with type number and delta base, see
+            Pack.get_object_header
+        :raise KeyError: if the object is not in any pack
+        """
+        entry = self._lookup_packed(sha)
+        if entry is None:
+            raise KeyError(sha)
+        return entry[0].get_object_header(sha)
+
+    def iter_pack_records(self, object_ids, window=10, depth=50,
+                          thin_bases=()):
+        """Generate the entries of a pack containing a set of objects.
+
+        Objects that are stored as deltas in one of the packs are sent as the
+        same delta, without being searched for a new delta or recompressed, if
+        their delta base is sent as well or is one of thin_bases. Bases are
+        always written before the deltas against them. The remaining objects
+        are deltified as usual; if no delta is found for an object stored
+        in a pack, its compressed data is copied as well.
+
+        :param object_ids: Iterable over (sha, path) tuples of objects to pack
+        :param window: Sliding window size for searching for deltas; 0 to
+            disable delta compression
+        :param depth: Maximum delta chain depth
+        :param thin_bases: SHA1s of objects the receiver is known to have, and
+            which may be used as delta bases without being sent
+        :return: Iterator over records suitable for write_pack_data
+        """
+        object_ids = list(object_ids)
+        sending = set(hex_to_sha(sha) for sha, path in object_ids)
+        thin_bases = set(hex_to_sha(sha) for sha in thin_bases)
+        # Only the SHA1s of stored objects are kept here; their data is
+        # retrieved again when it is written.
+        reused = {}
+        stored = set()
+        full = []
+        for sha, path in object_ids:
+            bin_sha = hex_to_sha(sha)
+            try:
+                type_num, delta_base = self._get_object_header(bin_sha)
+            except KeyError:
+                full.append((sha, path))
+                continue
+            if type_num not in DELTA_TYPES:
+                stored.add(bin_sha)
+                full.append((sha, path))
+            elif delta_base in sending or delta_base in thin_bases:
+                reused[bin_sha] = (delta_base, path)
+            else:
+                full.append((sha, path))
+
+        def drop_reused(bin_sha):
+            path = reused.pop(bin_sha)[1]
+            full.append((sha_to_hex(bin_sha), path))
+
+        # Reused deltas may form chains that are too long or, with deltas
+        # from different packs, even circular. Break those up.
+        depths = {}
+        for bin_sha in list(reused):
+            chain = []
+            current = bin_sha
+            while current in reused and current not in depths:
+                if current in chain:
+                    drop_reused(current)
+                    depths[current] = 0
+                    break
+                chain.append(current)
+                current = reused[current][0]
+            base_depth = depths.get(current, 0)
+            for chain_sha in reversed(chain):
+                if chain_sha in depths:
+                    base_depth = depths[chain_sha]
+                    continue
+                base_depth += 1
+                if base_depth > depth:
+                    drop_reused(chain_sha)
+                    base_depth = 0
+                depths[chain_sha] = base_depth
+
+        pending = {}
+        for bin_sha, (delta_base, path) in reused.iteritems():
+            pending.setdefault(delta_base, []).append(bin_sha)
+
+        def iter_dependents(base):
+            todo = list(pending.pop(base, []))
+            while todo:
+                bin_sha = todo.pop()
+                yield self._get_raw_unresolved(bin_sha)
+                todo.extend(pending.pop(bin_sha, []))
+
+        for record in deltify_pack_entries(self.get_raw, full, window,
+                                           depth=depth,
+                                           get_info=self.get_object_info):
+            if record[2] is None and record[1] in stored:
+                stored.remove(record[1])
+                yield self._get_raw_unresolved(record[1])
+            else:
+                yield record
+            for dependent in iter_dependents(record[1]):
+                yield dependent
+        for base in thin_bases:
+            for dependent in iter_dependents(base):
+                yield dependent
+
     def add_objects(self, objects):
         """Add a set of objects to this object store.
 
@@ -338,6 +848,10 @@ class PackBasedObjectStore(BaseObjectStore):
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
+    # Number of bytes of object records to keep in memory while indexing a
+    # received pack, before moving them to temporary files.
+    pack_indexer_spill_threshold = 64 * 1024 * 1024
+
     def __init__(self, path):
         """Open an object store.
 
@@ -348,6 +862,15 @@ class DiskObjectStore(PackBasedObjectStore):
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
         self._alternates = None
+        self._midx = None
+        self._midx_packs = {}
+        self._midx_covered = set()
+        self._bitmap_pack = None
+        self._bitmap = None
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+        # Optional PackHandleCache for the packs in this store
+        self.pack_handle_cache = None
 
     @property
     def alternates(self):
@@ -355,9 +878,15 @@ class DiskObjectStore(PackBasedObjectStore):
             return self._alternates
         self._alternates = []
         for path in self._read_alternate_paths():
-            self._alternates.append(DiskObjectStore(path))
+            self._alternates.append(self._open_alternate(path))
         return self._alternates
 
+    def _open_alternate(self, path):
+        store = DiskObjectStore(path)
+        store.pack_handle_cache = self.pack_handle_cache
+        store.delta_base_cache = self.delta_base_cache
+        return store
+
     def _read_alternate_paths(self):
         try:
             f = GitFile(os.path.join(self.path, "info", "alternates"),
@@ -403,7 +932,7 @@ class DiskObjectStore(PackBasedObjectStore):
             f.write("%s\n" % path)
         finally:
             f.close()
-        self.alternates.append(DiskObjectStore(path))
+        self.alternates.append(self._open_alternate(path))
 
     def _load_packs(self):
         pack_files = []
@@ -417,11 +946,224 @@ class DiskObjectStore(PackBasedObjectStore):
                     pack_files.append((os.stat(filename).st_mtime, filename))
         except OSError, e:
             if e.errno == errno.ENOENT:
+                self.close()
                 return []
             raise
         pack_files.sort(reverse=True)
         suffix_len = len(".pack")
-        return [Pack(f[:-suffix_len]) for _, f in pack_files]
+        # Packs that are still there are kept, along with their caches.
+        old_packs = dict((p._basename, p) for p in self._pack_cache or [])
+        packs = []
+        for _, f in pack_files:
+            pack = old_packs.pop(f[:-suffix_len], None)
+            if pack is None:
+                pack = self._open_pack(f[:-suffix_len])
+            packs.append(pack)
+        for pack in old_packs.itervalues():
+            if pack.handle_cache is not None:
+                pack.handle_cache.forget(pack)
+            pack.release()
+        self._load_multi_pack_index(packs)
+        self._bitmap = None
+        self._bitmap_pack = None
+        self._commit_graph_loaded = False
+        for pack in packs:
+            if os.path.exists(pack._basename + '.bitmap'):
+                self._bitmap_pack = pack
+                break
+        return packs
+
+    def _get_pack_bitmap(self):
+        # Make sure the pack cache is up to date.
+        self.packs
+        pack = self._bitmap_pack
+        if pack is None:
+            return None
+        if self._bitmap is None:
+            pack.begin_use()
+            try:
+                bitmap = load_pack_bitmap(pack._basename + '.bitmap',
+                                          pack.index)
+                pack_checksum = pack.index.get_pack_checksum()
+            finally:
+                pack.end_use()
+            if bitmap.pack_checksum != pack_checksum:
+                # The bitmap index is for an older version of this pack.
+                self._bitmap_pack = None
+                return None
+            self._bitmap = bitmap
+        return self._bitmap
+
+    def _get_commit_graph(self):
+        """Return the commit graph of this store, or None if it has none.
+
+        The commit graph is reloaded when the packs are.
+        """
+        if not self._commit_graph_loaded:
+            if self._commit_graph is not None:
+                self._commit_graph.close()
+            self._commit_graph = None
+            try:
+                self._commit_graph = load_commit_graph(
+                    os.path.join(self.path, 'info', COMMIT_GRAPH_FILENAME))
+            except (OSError, IOError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def get_parents(self, sha):
+        graph = self._get_commit_graph()
+        if graph is not None:
+            try:
+                return graph.get_parents(sha)
+            except KeyError:
+                pass
+        return super(DiskObjectStore, self).get_parents(sha)
+
+    def get_commit_time(self, sha):
+        graph = self._get_commit_graph()
+        if graph is not None:
+            try:
+                return graph.get_commit_time(sha)
+            except KeyError:
+                pass
+        return super(DiskObjectStore, self).get_commit_time(sha)
+
+    def get_generation(self, sha):
+        graph = self._get_commit_graph()
+        if graph is not None:
+            try:
+                return graph.get_generation(sha)
+            except KeyError:
+                pass
+        return None
+
+    def write_commit_graph(self, commit_ids):
+        """Write a commit graph for a set of commits and their ancestors.
+
+        :param commit_ids: SHA1s of the commits, usually the tips of the
+            branches
+        :return: The SHA of the new commit graph
+        """
+        try:
+            os.mkdir(os.path.join(self.path, 'info'))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        f = GitFile(os.path.join(self.path, 'info', COMMIT_GRAPH_FILENAME),
+                    'wb')
+        try:
+            sha = write_commit_graph(f, self.__getitem__, commit_ids)
+        finally:
+            f.close()
+        self._commit_graph_loaded = False
+        return sha
+
+    def write_pack_bitmap(self, pack, commits):
+        """Write a bitmap index for a pack in this store.
+
+        :param pack: The Pack to write a bitmap index for; all objects
+            reachable from the selected commits must be in this pack.
+        :param commits: SHA1s of the commits to store bitmaps for, usually
+            the tips of the branches
+        :return: The SHA of the new bitmap index
+        """
+        f = GitFile(pack._basename + '.bitmap', 'wb')
+        try:
+            return write_pack_bitmap(f, pack, commits)
+        finally:
+            f.close()
+
+    def _load_multi_pack_index(self, packs):
+        """Load the multi-pack-index covering (some of) a set of packs.
+
+        Entries for packs that no longer exist are ignored.
+
+        :param packs: List of Pack objects in the pack directory
+        """
+        if self._midx is not None:
+            self._midx.close()
+        self._midx = None
+        self._midx_packs = {}
+        self._midx_covered = set()
+        try:
+            midx = load_multi_pack_index(
+                os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME))
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        packs_by_idx_name = dict(
+            (os.path.basename(pack._idx_path), pack) for pack in packs)
+        midx_packs = {}
+        for name in midx.pack_names:
+            if name in packs_by_idx_name:
+                midx_packs[name] = packs_by_idx_name[name]
+        self._midx_packs = midx_packs
+        self._midx_covered = set(id(pack) for pack in midx_packs.itervalues())
+        self._midx = midx
+
+    def _iter_uncovered_packs(self):
+        """Iterate over the packs not covered by the multi-pack-index."""
+        covered = self._midx_covered
+        for pack in self.packs:
+            if id(pack) not in covered:
+                yield pack
+
+    def _lookup_multi_pack_index(self, sha):
+        """Find an object using the multi-pack-index.
+
+        :param sha: Binary SHA1 of the object
+        :return: Tuple with Pack object and offset. The Pack object is None
+            if the pack the multi-pack-index records for the object is gone.
+        :raise KeyError: If the object is not in the multi-pack-index
+        """
+        if self._midx is None:
+            raise KeyError(sha)
+        name, offset = self._midx.object_entry(sha)
+        return self._midx_packs.get(name), offset
+
+    def _find_packed(self, sha):
+        try:
+            pack, offset = self._lookup_multi_pack_index(sha)
+        except KeyError:
+            return self._scan_packs(sha, self._iter_uncovered_packs())
+        if pack is None:
+            # The pack the multi-pack-index prefers is gone, but the object
+            # may still be in one of the other packs.
+            return self._scan_packs(sha, self.packs)
+        return pack, offset
+
+    def write_multi_pack_index(self):
+        """Write a multi-pack-index covering all packs in this store.
+
+        If an object is present in several packs, the most recently
+        modified pack is used.
+
+        :return: The SHA of the new multi-pack-index
+        """
+        packs = self.packs
+        f = GitFile(os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME),
+                    'wb')
+        for pack in packs:
+            pack.begin_use()
+        try:
+            sha = write_multi_pack_index(f, [
+                (os.path.basename(pack._idx_path), pack.index)
+                for pack in packs])
+        finally:
+            for pack in packs:
+                pack.end_use()
+            f.close()
+        self._load_multi_pack_index(packs)
+        return sha
+
+    def _open_pack(self, basename):
+        pack = Pack(basename)
+        pack.handle_cache = self.pack_handle_cache
+        pack.delta_base_cache = self.delta_base_cache
+        return pack
 
     def _pack_cache_stale(self):
         try:
@@ -451,6 +1193,19 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def _get_loose_object_info(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            f = GitFile(path, 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return read_loose_object_info(f)
+        finally:
+            f.close()
+
     def _remove_loose_object(self, sha):
         os.remove(self._get_shafile_path(sha))
 
@@ -499,7 +1254,7 @@ class DiskObjectStore(PackBasedObjectStore):
             index_file.abort()
 
         # Add the pack to the store and return it.
-        final_pack = Pack(pack_base_name)
+        final_pack = self._open_pack(pack_base_name)
         final_pack.check_length_and_checksum()
         self._add_known_pack(final_pack)
         return final_pack
@@ -516,18 +1271,32 @@ class DiskObjectStore(PackBasedObjectStore):
         :param read_some: Read function that returns at least one byte, but may
             not return the number of bytes requested.
         :return: A Pack object pointing at the now-completed thin pack in the
-            objects/pack directory.
+            objects/pack directory, or None if the stream was empty.
         """
         fd, path = tempfile.mkstemp(dir=self.path, prefix='tmp_pack_')
         f = os.fdopen(fd, 'w+b')
 
+        indexer = PackIndexer(f, resolve_ext_ref=self.get_raw,
+            spill_threshold=self.pack_indexer_spill_threshold,
+            spill_dir=self.path)
         try:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
-            copier = PackStreamCopier(read_all, read_some, f,
-                                      delta_iter=indexer)
-            copier.verify()
-            return self._complete_thin_pack(f, path, copier, indexer)
+            try:
+                copier = PackStreamCopier(read_all, read_some, f,
+                                          delta_iter=indexer)
+                copier.verify()
+                if not f.tell():
+                    f.close()
+                    os.remove(path)
+                    return None
+                return self._complete_thin_pack(f, path, copier, indexer)
+            except:
+                # Don't leave incomplete packs behind.
+                f.close()
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
         finally:
+            indexer.close()
             f.close()
 
     def move_in_pack(self, path):
@@ -549,7 +1318,7 @@ class DiskObjectStore(PackBasedObjectStore):
             f.close()
         p.close()
         os.rename(path, basename + ".pack")
-        final_pack = Pack(basename)
+        final_pack = self._open_pack(basename)
         self._add_known_pack(final_pack)
         return final_pack
 
@@ -687,15 +1456,20 @@ class ObjectIterator(object):
 class ObjectStoreIterator(ObjectIterator):
     """ObjectIterator that works on top of an ObjectStore."""
 
-    def __init__(self, store, sha_iter):
+    def __init__(self, store, sha_iter, haves=None):
         """Create a new ObjectIterator.
 
         :param store: Object store to retrieve from
         :param sha_iter: Iterator over (sha, path) tuples
+        :param haves: Optional SHA1s of objects the receiver has; these may
+            be used as delta bases when writing a thin pack.
         """
         self.store = store
         self.sha_iter = sha_iter
         self._shas = []
+        if haves is None:
+            haves = []
+        self.haves = haves
 
     def __iter__(self):
         """Yield tuple with next object and path."""
@@ -707,6 +1481,21 @@ class ObjectStoreIterator(ObjectIterator):
         for o, path in self:
             yield o
 
+    def iter_pack_records(self, window=10, depth=50, thin=False):
+        """Generate the entries of a pack containing these objects.
+
+        :param window: Sliding window size for searching for deltas
+        :param depth: Maximum delta chain depth
+        :param thin: Whether objects in haves may be used as delta bases
+        :return: Iterator over records suitable for write_pack_data
+        """
+        if thin:
+            thin_bases = self.haves
+        else:
+            thin_bases = ()
+        return self.store.iter_pack_records(self.itershas(), window=window,
+            depth=depth, thin_bases=thin_bases)
+
     def itershas(self):
         """Iterate over the SHAs."""
         for sha in self._shas:
@@ -736,8 +1525,14 @@ class ObjectStoreIterator(ObjectIterator):
         return self.store[key]
 
     def __len__(self):
-        """Return the number of objects."""
-        return len(list(self.itershas()))
+        """Return the number of objects.
+
+        :note: This only collects the SHA1s and paths of the objects; the
+            objects themselves are retrieved when iterating.
+        """
+        for sha in self.itershas():
+            pass
+        return len(self._shas)
 
 
 def tree_lookup_path(lookup_obj, root_sha, path):
@@ -158,6 +158,62 @@ def check_identity(identity, error_msg):
         raise ObjectFormatException(error_msg)
 
 
+def read_loose_object_info(f):
+    """Read the type and size of a loose object without inflating it.
+
+    Both legacy (zlib compressed with a text header) and new style (pack-like
+    binary header) loose objects are supported; only the header is read.
+
+    :param f: File-like object to read the object from
+    :return: Tuple with the type number and the size of the object
+    :raise ObjectFormatException: if the object header is invalid
+    """
+    bufsize = 64
+    magic = f.read(2)
+    if len(magic) < 2:
+        raise ObjectFormatException("invalid object header")
+    if ShaFile._is_legacy_object(magic):
+        decomp = zlib.decompressobj()
+        try:
+            header = decomp.decompress(magic)
+            while "\0" not in header:
+                extra = f.read(bufsize)
+                if not extra:
+                    raise ObjectFormatException(
+                        "Invalid object header, no \\0")
+                header += decomp.decompress(extra)
+        except zlib.error:
+            raise ObjectFormatException("invalid object header")
+        header = header[:header.find("\0")]
+        try:
+            type_name, size = header.split(" ", 1)
+            size = int(size)
+        except ValueError:
+            raise ObjectFormatException("invalid object header")
+        obj_class = object_class(type_name)
+        if not obj_class:
+            raise ObjectFormatException("Not a known type: %s" % type_name)
+    else:
+        byte = ord(magic[0])
+        obj_class = object_class((byte >> 4) & 7)
+        if not obj_class:
+            raise ObjectFormatException(
+                "Not a known type %d" % ((byte >> 4) & 7))
+        size = byte & 0x0f
+        shift = 4
+        extra = magic[1:]
+        while byte & 0x80:
+            if not extra:
+                extra = f.read(1)
+                if not extra:
+                    raise ObjectFormatException("invalid object header")
+            byte = ord(extra[0])
+            extra = extra[1:]
+            size += (byte & 0x7f) << shift
+            shift += 7
+    return obj_class.type_num, size
+
+
 class FixedSha(object):
     """SHA object that behaves like hashlib's but is given a fixed value."""
 
@@ -224,7 +280,9 @@ class ShaFile(object):
 
     def as_raw_chunks(self):
         if self._needs_parsing:
-            self._ensure_parsed()
+            # Objects created from raw chunks already have their text.
+            if self._file is not None or self._path is not None:
+                self._ensure_parsed()
         elif self._needs_serialization:
             self._chunked_text = self._serialize()
         return self._chunked_text
@@ -243,16 +301,14 @@ class ShaFile(object):
 
     def _ensure_parsed(self):
         if self._needs_parsing:
-            if not self._chunked_text:
-                if self._file is not None:
-                    self._parse_file(self._file)
-                    self._file = None
-                elif self._path is not None:
-                    self._parse_path()
-                else:
-                    raise AssertionError(
-                        "ShaFile needs either text or filename")
-            self._deserialize(self._chunked_text)
+            # Reading the file sets and parses the raw text.
+            if self._file is not None:
+                self._parse_file(self._file)
+                self._file = None
+            elif self._path is not None:
+                self._parse_path()
+            else:
+                self._deserialize(self._chunked_text)
             self._needs_parsing = False
 
     def set_raw_string(self, text):
@@ -267,6 +323,17 @@ class ShaFile(object):
         self._needs_parsing = False
         self._needs_serialization = False
 
+    def _set_raw_chunks_lazy(self, chunks):
+        """Set the raw text, but only parse it when its contents are used.
+
+        The chunks are kept as they are, so the raw text and SHA can be
+        retrieved without parsing or copying them.
+        """
+        self._chunked_text = chunks
+        self._sha = None
+        self._needs_parsing = True
+        self._needs_serialization = False
+
     @staticmethod
     def _parse_object_header(magic, f):
         """Parse a new style object, creating it but not reading the file."""
@@ -367,22 +434,28 @@ class ShaFile(object):
     def from_raw_string(type_num, string):
         """Creates an object of the indicated type from the raw string given.
 
+        The string is only parsed when the contents of the object are used.
+
         :param type_num: The numeric type of the object.
         :param string: The raw uncompressed contents.
         """
+        if type(string) != str:
+            raise TypeError(string)
         obj = object_class(type_num)()
-        obj.set_raw_string(string)
+        obj._set_raw_chunks_lazy([string])
         return obj
 
     @staticmethod
     def from_raw_chunks(type_num, chunks):
         """Creates an object of the indicated type from the raw chunks given.
 
+        The chunks are only parsed when the contents of the object are used.
+
         :param type_num: The numeric type of the object.
-        :param chunks: An iterable of the raw uncompressed contents.
+        :param chunks: A list of the raw uncompressed contents.
         """
         obj = object_class(type_num)()
-        obj.set_raw_chunks(chunks)
+        obj._set_raw_chunks_lazy(chunks)
         return obj
 
     @classmethod
@@ -691,6 +764,8 @@ class Tag(ShaFile):
 class TreeEntry(namedtuple('TreeEntry', ['path', 'mode', 'sha'])):
     """Named tuple encapsulating a single tree entry."""
 
+    __slots__ = ()
+
     def in_path(self, path):
         """Return a copy of this entry with the given path prepended."""
         return TreeEntry(posixpath.join(path, self.path), self.mode, self.sha)
@@ -768,7 +843,13 @@ def cmp_entry_name_order(entry1, entry2):
 
 
 class Tree(ShaFile):
-    """A Git tree object"""
+    """A Git tree object.
+
+    Parsed trees keep only their text. Iterating over the entries parses
+    them again every time, which saves memory when walking many trees but
+    costs time when the same tree is iterated over repeatedly; lookups and
+    changes parse the entries once and keep them.
+    """
 
     type_name = 'tree'
     type_num = 2
@@ -786,13 +867,29 @@ class Tree(ShaFile):
             raise NotTreeError(filename)
         return tree
 
-    def __contains__(self, name):
+    def _parse_entries(self):
+        """Parse the entries from the tree text.
+
+        :return: Dictionary mapping names to (mode, sha) tuples
+        """
+        try:
+            return dict([(n, (m, s)) for n, m, s in
+                         parse_tree(self._chunked_text[0])])
+        except ValueError, e:
+            raise ObjectFormatException(e)
+
+    def _get_entries(self):
+        """Get the entries dictionary, creating it if necessary."""
         self._ensure_parsed()
-        return name in self._entries
+        if self._entries is None:
+            self._entries = self._parse_entries()
+        return self._entries
+
+    def __contains__(self, name):
+        return name in self._get_entries()
 
     def __getitem__(self, name):
-        self._ensure_parsed()
-        return self._entries[name]
+        return self._get_entries()[name]
 
     def __setitem__(self, name, value):
         """Set a tree entry by name.
@@ -803,22 +900,18 @@ class Tree(ShaFile):
             a string.
         """
         mode, hexsha = value
-        self._ensure_parsed()
-        self._entries[name] = (mode, hexsha)
+        self._get_entries()[name] = (mode, hexsha)
         self._needs_serialization = True
 
     def __delitem__(self, name):
-        self._ensure_parsed()
-        del self._entries[name]
+        del self._get_entries()[name]
         self._needs_serialization = True
 
     def __len__(self):
-        self._ensure_parsed()
-        return len(self._entries)
+        return len(self._get_entries())
 
     def __iter__(self):
-        self._ensure_parsed()
-        return iter(self._entries)
+        return iter(self._get_entries())
 
     def add(self, name, mode, hexsha):
         """Add an entry to the tree.
@@ -832,8 +925,7 @@ class Tree(ShaFile):
             (name, mode) = (mode, name)
             warnings.warn("Please use Tree.add(name, mode, hexsha)",
                 category=DeprecationWarning, stacklevel=2)
-        self._ensure_parsed()
-        self._entries[name] = mode, hexsha
+        self._get_entries()[name] = mode, hexsha
         self._needs_serialization = True
 
     def entries(self):
@@ -855,11 +947,18 @@ class Tree(ShaFile):
     def iteritems(self, name_order=False):
         """Iterate over entries.
 
+        Unless the entries have already been parsed for lookups or changes,
+        they are parsed from the tree text for this iteration only and not
+        kept in memory.
+
         :param name_order: If True, iterate in name order instead of tree order.
         :return: Iterator over (name, mode, sha) tuples
         """
         self._ensure_parsed()
-        return sorted_tree_items(self._entries, name_order)
+        entries = self._entries
+        if entries is None:
+            entries = self._parse_entries()
+        return sorted_tree_items(entries, name_order)
 
     def items(self):
         """Return the sorted entries in this tree.
@@ -869,14 +968,13 @@ class Tree(ShaFile):
         return list(self.iteritems())
 
     def _deserialize(self, chunks):
-        """Grab the entries in the tree"""
-        try:
-            parsed_entries = parse_tree("".join(chunks))
-        except ValueError, e:
-            raise ObjectFormatException(e)
-        # TODO: list comprehension is for efficiency in the common (small) case;
-        # if memory efficiency in the large case is a concern, use a genexp.
-        self._entries = dict([(n, (m, s)) for n, m, s in parsed_entries])
+        """Grab the entries in the tree.
+
+        Only the tree text is kept; the entries are parsed from it when they
+        are used.
+        """
+        self._chunked_text = ["".join(chunks)]
+        self._entries = None
 
     def check(self):
         """Check this object for internal consistency.
@@ -889,8 +987,11 @@ class Tree(ShaFile):
                          stat.S_IFLNK, stat.S_IFDIR, S_IFGITLINK,
                          # TODO: optionally exclude as in git fsck --strict
                          stat.S_IFREG | 0664)
-        for name, mode, sha in parse_tree(''.join(self._chunked_text),
-                                          True):
+        try:
+            entries = list(parse_tree(''.join(self._chunked_text), True))
+        except ValueError, e:
+            raise ObjectFormatException(e)
+        for name, mode, sha in entries:
             check_hexsha(sha, 'invalid sha %s' % sha)
             if '/' in name or name in ('', '.', '..'):
                 raise ObjectFormatException('invalid name %s' % name)
@@ -42,7 +42,6 @@ from cStringIO import (
 from collections import (
     deque,
     )
-import difflib
 from itertools import (
     chain,
     imap,
@@ -61,6 +60,8 @@ try:
 except ImportError:
     from dulwich._compat import unpack_from
 import sys
+import tempfile
+import threading
 import warnings
 import zlib
 
@@ -74,6 +75,7 @@ from dulwich.lru_cache import (
     )
 from dulwich._compat import (
     make_sha,
+    merge,
     SEEK_CUR,
     SEEK_END,
     )
@@ -276,26 +278,56 @@ def load_pack_index(path):
         f.close()
 
 
-def _load_file_contents(f, size=None):
+def _mmap_file_contents(f, size=None):
+    """Map the contents of a file in memory, if possible.
+
+    :param f: File-like object
+    :param size: Number of bytes to map, or None for the whole file
+    :return: Tuple with mmap object and size, or (None, None) if the file
+        could not be mapped
+    """
     fileno = getattr(f, 'fileno', None)
+    if fileno is None or not has_mmap:
+        return None, None
+    fd = f.fileno()
+    if size is None:
+        size = os.fstat(fd).st_size
+    try:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ), size
+    except (mmap.error, ValueError):
+        # Perhaps a socket, or an empty file?
+        return None, None
+
+
+def _load_file_contents(f, size=None):
     # Attempt to use mmap if possible
-    if fileno is not None:
-        fd = f.fileno()
-        if size is None:
-            size = os.fstat(fd).st_size
-        if has_mmap:
-            try:
-                contents = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
-            except mmap.error:
-                # Perhaps a socket?
-                pass
-            else:
-                return contents, size
+    contents, mapped_size = _mmap_file_contents(f, size)
+    if contents is not None:
+        return contents, mapped_size
     contents = f.read()
     size = len(contents)
     return contents, size
 
 
+class _BufferReader(object):
+    """Reads from a string or mmap, starting at an offset.
+
+    Unlike reading from a file, this doesn't need a lock to protect the file
+    position, so several threads can read from the same buffer at once.
+    """
+
+    __slots__ = ('_buf', '_offset')
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+
+    def read(self, size):
+        start = self._offset
+        self._offset += size
+        return self._buf[start:self._offset]
+
+
 def load_pack_index_file(path, f):
     """Load an index file from a file-like object.
 
@@ -345,6 +377,11 @@ class PackIndex(object):
     packfile of that object if it has it.
     """
 
+    _sha_by_offset = None
+
+    def close(self):
+        """Close the files used by this index, if any."""
+
     def __eq__(self, other):
         if not isinstance(other, PackIndex):
             return False
@@ -399,6 +436,37 @@ class PackIndex(object):
         """
         raise NotImplementedError(self._object_index)
 
+    def object_crc32(self, sha):
+        """Return the CRC32 checksum of the packed data of an object.
+
+        :param sha: SHA1 of the object, as hex or binary string
+        :return: The CRC32 checksum, or None if the index does not store it
+        :raise KeyError: if the object is not in the index
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._object_crc32(sha)
+
+    def _object_crc32(self, sha):
+        """See object_crc32.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        raise NotImplementedError(self._object_crc32)
+
+    def object_sha1(self, offset):
+        """Return the SHA1 of the object at the given offset in the packfile.
+
+        :note: The first call builds a reverse index of the whole pack index.
+        :param offset: Offset of the object in the corresponding packfile
+        :return: 20-byte binary SHA1
+        :raise KeyError: if no object starts at the given offset
+        """
+        if self._sha_by_offset is None:
+            self._sha_by_offset = dict(
+                (offset, name) for (name, offset, crc32) in self.iterentries())
+        return self._sha_by_offset[offset]
+
     def objects_sha1(self):
         """Return the hex SHA1 over all the shas of all objects in this pack.
 
@@ -421,8 +489,10 @@ class MemoryPackIndex(PackIndex):
         :param pack_checksum: Optional pack checksum
         """
         self._by_sha = {}
+        self._crc32_by_sha = {}
         for name, idx, crc32 in entries:
             self._by_sha[name] = idx
+            self._crc32_by_sha[name] = crc32
         self._entries = entries
         self._pack_checksum = pack_checksum
 
@@ -433,7 +503,10 @@ class MemoryPackIndex(PackIndex):
         return len(self._entries)
 
     def _object_index(self, sha):
-        return self._by_sha[sha][0]
+        return self._by_sha[sha]
+
+    def _object_crc32(self, sha):
+        return self._crc32_by_sha[sha]
 
     def _itersha(self):
         return iter(self._by_sha)
@@ -556,10 +629,12 @@ class FilePackIndex(PackIndex):
         """
         return str(self._contents[-20:])
 
-    def _object_index(self, sha):
-        """See object_index.
+    def _object_position(self, sha):
+        """Find the position of an object in the index.
 
         :param sha: A *binary* SHA string. (20 characters long)_
+        :return: Position of the entry for the object
+        :raise KeyError: if the object is not in the index
         """
         assert len(sha) == 20
         idx = ord(sha[0])
@@ -571,7 +646,21 @@ class FilePackIndex(PackIndex):
         i = bisect_find_sha(start, end, sha, self._unpack_name)
         if i is None:
             raise KeyError(sha)
-        return self._unpack_offset(i)
+        return i
+
+    def _object_index(self, sha):
+        """See object_index.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        return self._unpack_offset(self._object_position(sha))
+
+    def _object_crc32(self, sha):
+        """See object_crc32.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        return self._unpack_crc32_checksum(self._object_position(sha))
 
 
 class PackIndex1(FilePackIndex):
@@ -631,6 +720,276 @@ class PackIndex2(FilePackIndex):
                           self._crc32_table_offset + i * 4)[0]
 
 
+class ShaBloomFilter(object):
+    """A bloom filter for binary SHA1s.
+
+    SHA1s are uniformly distributed, so rather than hashing the keys again
+    the filter uses the five 32-bit words of each SHA1 as its hash values.
+    With the default of 10 bits per entry, about 1% of the lookups for
+    SHAs that were not added give a false positive.
+    """
+
+    def __init__(self, capacity, bits_per_entry=10):
+        """Create a new, empty bloom filter.
+
+        :param capacity: Number of SHAs the filter is sized for
+        :param bits_per_entry: Number of bits to use per entry
+        """
+        self._num_bits = max(8, capacity * bits_per_entry)
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    @classmethod
+    def from_shas(cls, capacity, shas):
+        """Create a bloom filter containing a set of SHAs.
+
+        :param capacity: Number of SHAs the filter is sized for
+        :param shas: Iterator over binary SHA1s
+        """
+        ret = cls(capacity)
+        for sha in shas:
+            ret.add(sha)
+        return ret
+
+    def add(self, sha):
+        """Add a binary SHA1 to this filter."""
+        bits = self._bits
+        num_bits = self._num_bits
+        for h in struct.unpack('>5L', sha):
+            h %= num_bits
+            bits[h >> 3] |= 1 << (h & 7)
+
+    def __contains__(self, sha):
+        """Check whether a binary SHA1 may have been added to this filter.
+
+        :return: False if the SHA was definitely not added, True otherwise
+        """
+        bits = self._bits
+        num_bits = self._num_bits
+        for h in struct.unpack('>5L', sha):
+            h %= num_bits
+            if not bits[h >> 3] & (1 << (h & 7)):
+                return False
+        return True
+
+
+MULTI_PACK_INDEX_FILENAME = 'multi-pack-index'
+
+_MIDX_SIGNATURE = 'MIDX'
+_MIDX_CHUNK_PACKNAMES = 'PNAM'
+_MIDX_CHUNK_OID_FANOUT = 'OIDF'
+_MIDX_CHUNK_OID_LOOKUP = 'OIDL'
+_MIDX_CHUNK_OBJECT_OFFSETS = 'OOFF'
+_MIDX_CHUNK_LARGE_OFFSETS = 'LOFF'
+_MIDX_LARGE_OFFSET_FLAG = 0x80000000
+
+
+def load_multi_pack_index(path):
+    """Load a multi-pack-index file by path.
+
+    :param path: Path to the multi-pack-index file
+    :return: A MultiPackIndex loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return MultiPackIndex(path, file=f)
+    finally:
+        f.close()
+
+
+class MultiPackIndex(object):
+    """A git multi-pack-index file.
+
+    A multi-pack-index maps the SHAs of the objects in a set of packs to the
+    pack containing each object and its offset in that pack, so that
+    objects can be found with a single lookup rather than one per pack.
+    Packs are identified by the file names of their indexes.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != _MIDX_SIGNATURE:
+            raise AssertionError('Not a multi-pack-index file')
+        (self.version, oid_version, num_chunks, num_base_files,
+         num_packs) = unpack_from('>BBBBL', self._contents, 4)
+        if self.version != 1:
+            raise AssertionError(
+                'Unknown multi-pack-index version %d' % self.version)
+        if oid_version != 1:
+            raise AssertionError(
+                'Unknown multi-pack-index hash version %d' % oid_version)
+        self._chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = unpack_from('>4sQ', self._contents, 12 + i * 12)
+            self._chunks[chunk_id] = offset
+        for chunk_id in (_MIDX_CHUNK_PACKNAMES, _MIDX_CHUNK_OID_FANOUT,
+                         _MIDX_CHUNK_OID_LOOKUP, _MIDX_CHUNK_OBJECT_OFFSETS):
+            if chunk_id not in self._chunks:
+                raise AssertionError(
+                    'Missing %s chunk in multi-pack-index' % chunk_id)
+        names_offset = self._chunks[_MIDX_CHUNK_PACKNAMES]
+        names = str(self._contents[names_offset:self._chunks[
+            _MIDX_CHUNK_OID_FANOUT]]).split('\0')
+        self.pack_names = names[:num_packs]
+        fan_out_offset = self._chunks[_MIDX_CHUNK_OID_FANOUT]
+        self._fan_out_table = list(unpack_from('>256L', self._contents,
+                                               fan_out_offset))
+        self._name_table_offset = self._chunks[_MIDX_CHUNK_OID_LOOKUP]
+        self._offset_table_offset = self._chunks[_MIDX_CHUNK_OBJECT_OFFSETS]
+        self._large_offset_table_offset = self._chunks.get(
+            _MIDX_CHUNK_LARGE_OFFSETS)
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of objects in this multi-pack-index."""
+        return self._fan_out_table[-1]
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def _unpack_pack_and_offset(self, i):
+        pack_id, offset = unpack_from('>LL', self._contents,
+                                      self._offset_table_offset + i * 8)
+        if offset & _MIDX_LARGE_OFFSET_FLAG:
+            (offset,) = unpack_from('>Q', self._contents,
+                self._large_offset_table_offset +
+                (offset & ~_MIDX_LARGE_OFFSET_FLAG) * 8)
+        return self.pack_names[pack_id], offset
+
+    def iterentries(self):
+        """Iterate over the entries in this multi-pack-index.
+
+        :return: iterator over tuples with binary object name, pack index
+            file name and offset in that pack.
+        """
+        for i in xrange(len(self)):
+            pack_name, offset = self._unpack_pack_and_offset(i)
+            yield self._unpack_name(i), pack_name, offset
+
+    def object_entry(self, sha):
+        """Find the pack containing an object.
+
+        :param sha: SHA1 of the object, as hex or binary string
+        :return: Tuple with pack index file name and offset in that pack
+        :raise KeyError: if the object is not in this multi-pack-index
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = None
+        if start < end:
+            i = bisect_find_sha(start, end - 1, sha, self._unpack_name)
+        if i is None:
+            raise KeyError(sha)
+        return self._unpack_pack_and_offset(i)
+
+    def __contains__(self, sha):
+        try:
+            self.object_entry(sha)
+            return True
+        except KeyError:
+            return False
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this multi-pack-index.
+
+        :return: This is a 20-byte binary digest
+        """
+        return make_sha(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this multi-pack-index.
+
+        :return: 20-byte binary digest
+        """
+        return str(self._contents[-20:])
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+
+def write_multi_pack_index(f, packs):
+    """Write a multi-pack-index file.
+
+    :param f: File-like object to write to
+    :param packs: Sequence of (index file name, PackIndex) tuples. If an
+        object is present in several packs, the first pack it is found in
+        is recorded.
+    :return: The SHA of the written multi-pack-index
+    """
+    pack_names = sorted(name for name, index in packs)
+    pack_ids = dict((name, i) for (i, name) in enumerate(pack_names))
+    entries = {}
+    for name, index in packs:
+        pack_id = pack_ids[name]
+        for sha, offset, crc32 in index.iterentries():
+            if sha not in entries:
+                entries[sha] = (pack_id, offset)
+    entries = sorted(entries.iteritems())
+
+    names_chunk = ''.join(name + '\0' for name in pack_names)
+    names_chunk += '\0' * (-len(names_chunk) % 4)
+    fan_out_table = defaultdict(lambda: 0)
+    for sha, _ in entries:
+        fan_out_table[ord(sha[0])] += 1
+    fan_out = []
+    for i in range(0x100):
+        fan_out.append(struct.pack('>L', fan_out_table[i]))
+        fan_out_table[i+1] += fan_out_table[i]
+    offsets = []
+    large_offsets = []
+    for sha, (pack_id, offset) in entries:
+        if offset >= _MIDX_LARGE_OFFSET_FLAG:
+            offsets.append(struct.pack('>LL', pack_id,
+                len(large_offsets) | _MIDX_LARGE_OFFSET_FLAG))
+            large_offsets.append(struct.pack('>Q', offset))
+        else:
+            offsets.append(struct.pack('>LL', pack_id, offset))
+
+    chunks = [
+        (_MIDX_CHUNK_PACKNAMES, [names_chunk]),
+        (_MIDX_CHUNK_OID_FANOUT, fan_out),
+        (_MIDX_CHUNK_OID_LOOKUP, [sha for sha, _ in entries]),
+        (_MIDX_CHUNK_OBJECT_OFFSETS, offsets),
+        ]
+    if large_offsets:
+        chunks.append((_MIDX_CHUNK_LARGE_OFFSETS, large_offsets))
+
+    f = SHA1Writer(f)
+    f.write(_MIDX_SIGNATURE)
+    f.write(struct.pack('>BBBBL', 1, 1, len(chunks), 0, len(pack_names)))
+    offset = 12 + (len(chunks) + 1) * 12
+    for chunk_id, data in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += chunks_length(data)
+    f.write(struct.pack('>4sQ', '\0\0\0\0', offset))
+    for chunk_id, data in chunks:
+        for chunk in data:
+            f.write(chunk)
+    return f.write_sha()
+
+
 def read_pack_header(read):
     """Read the header of a pack file.
 
@@ -652,6 +1011,68 @@ def chunks_length(chunks):
     return sum(imap(len, chunks))
 
 
+def unpack_object_header(read_all, crc32=None):
+    """Read the header of a packed object.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param crc32: If not None, the CRC32 to update with the header data
+    :return: A tuple of (type_num, size, delta_base, crc32). size is the
+        size of the data as stored, i.e. of the delta for delta types.
+        delta_base is the relative offset of the base for OFS_DELTA, its SHA
+        for REF_DELTA, and None otherwise.
+    """
+    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+    type_num = (bytes[0] >> 4) & 0x07
+    size = bytes[0] & 0x0f
+    for i, byte in enumerate(bytes[1:]):
+        size += (byte & 0x7f) << ((i * 7) + 4)
+
+    if type_num == OFS_DELTA:
+        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+        assert not (bytes[-1] & 0x80)
+        delta_base_offset = bytes[0] & 0x7f
+        for byte in bytes[1:]:
+            delta_base_offset += 1
+            delta_base_offset <<= 7
+            delta_base_offset += (byte & 0x7f)
+        delta_base = delta_base_offset
+    elif type_num == REF_DELTA:
+        delta_base = read_all(20)
+        if crc32 is not None:
+            crc32 = binascii.crc32(delta_base, crc32)
+    else:
+        delta_base = None
+    return type_num, size, delta_base, crc32
+
+
+def read_delta_sizes(read_some, bufsize=64):
+    """Read the source and target size from the start of a compressed delta.
+
+    Only as much of the delta is inflated as is needed for its header.
+
+    :param read_some: Read function for the compressed delta data
+    :param bufsize: Number of bytes to read at a time
+    :return: Tuple with the size of the delta base and of the result
+    """
+    decomp = zlib.decompressobj()
+    header = ''
+    pending = ''
+    # Each size takes at most 10 bytes.
+    while len(header) < 20:
+        if not pending:
+            pending = read_some(bufsize)
+            if not pending:
+                break
+        header += decomp.decompress(pending, 20 - len(header))
+        pending = decomp.unconsumed_tail
+        if decomp.unused_data:
+            break
+    src_size, index = _delta_header_size(header, 0)
+    dest_size, index = _delta_header_size(header, index)
+    return src_size, dest_size
+
+
 def unpack_object(read_all, read_some=None, compute_crc32=False,
                   include_comp=False, zlib_bufsize=_ZLIB_BUFSIZE):
     """Unpack a Git object.
@@ -683,31 +1104,8 @@ def unpack_object(read_all, read_some=None, compute_crc32=False,
     else:
         crc32 = None
 
-    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-    type_num = (bytes[0] >> 4) & 0x07
-    size = bytes[0] & 0x0f
-    for i, byte in enumerate(bytes[1:]):
-        size += (byte & 0x7f) << ((i * 7) + 4)
-
-    raw_base = len(bytes)
-    if type_num == OFS_DELTA:
-        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-        raw_base += len(bytes)
-        assert not (bytes[-1] & 0x80)
-        delta_base_offset = bytes[0] & 0x7f
-        for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        delta_base = delta_base_offset
-    elif type_num == REF_DELTA:
-        delta_base = read_all(20)
-        if compute_crc32:
-            crc32 = binascii.crc32(delta_base, crc32)
-        raw_base += 20
-    else:
-        delta_base = None
-
+    type_num, size, delta_base, crc32 = unpack_object_header(read_all,
+                                                              crc32=crc32)
     unpacked = UnpackedObject(type_num, delta_base, size, crc32)
     unused = read_zlib_chunks(read_some, unpacked, buffer_size=zlib_bufsize,
                               include_comp=include_comp)
@@ -721,6 +1119,85 @@ def _compute_object_size((num, obj)):
     return chunks_length(obj)
 
 
+# Default byte budget of a DeltaBaseCache, as for core.deltaBaseCacheLimit
+# in git.
+DEFAULT_DELTA_BASE_CACHE_LIMIT = 96 * 1024 * 1024
+
+
+class DeltaBaseCache(object):
+    """Cache of resolved objects from packs, keyed by pack and offset.
+
+    A single cache can be shared by all packs of an object store, so that
+    the memory used for delta bases has one bound no matter how many packs
+    there are. Like core.deltaBaseCacheLimit in git, max_size is the total
+    number of bytes of cached objects; objects that take up most of the
+    budget by themselves are not cached at all.
+    """
+
+    def __init__(self, max_size=DEFAULT_DELTA_BASE_CACHE_LIMIT):
+        """Create a new DeltaBaseCache.
+
+        :param max_size: Maximum number of bytes of objects to cache
+        """
+        self._lock = threading.Lock()
+        self._cache = LRUSizeCache(max_size, compute_size=_compute_object_size)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return self._cache._max_size
+
+    def resize(self, max_size):
+        """Change the byte budget of the cache."""
+        self._lock.acquire()
+        try:
+            self._cache.resize(max_size)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def size(self):
+        """Return the number of bytes of the cached objects."""
+        return self._cache._value_size
+
+    def get(self, pack_key, offset):
+        """Look up an object.
+
+        :param pack_key: Key identifying the pack
+        :param offset: Offset of the object in the pack
+        :return: Tuple with type number and list of chunks, or None
+        """
+        self._lock.acquire()
+        try:
+            ret = self._cache.get((pack_key, offset))
+            if ret is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return ret
+        finally:
+            self._lock.release()
+
+    def add(self, pack_key, offset, type_num, chunks):
+        """Add a resolved object to the cache."""
+        self._lock.acquire()
+        try:
+            self._cache.add((pack_key, offset), (type_num, chunks))
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all objects from the cache."""
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
 class PackStreamReader(object):
     """Class to read a pack stream.
 
@@ -927,6 +1404,25 @@ def compute_file_sha(f, start_ofs=0, end_ofs=0, buffer_size=1<<16):
     return sha
 
 
+class DeltaChainStats(object):
+    """Statistics about the delta chain of a resolved object.
+
+    :ivar depth: Number of deltas that were applied
+    :ivar base_cached: Whether the chain ended at a cached object rather than
+        at one that is not a delta
+    :ivar cached: Number of resolved objects that were added to the cache
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.base_cached = False
+        self.cached = 0
+
+    def __repr__(self):
+        return '%s(depth=%d, base_cached=%r, cached=%d)' % (
+            self.__class__.__name__, self.depth, self.base_cached, self.cached)
+
+
 class PackData(object):
     """The data contained in a packfile.
 
@@ -945,16 +1441,22 @@ class PackData(object):
     For the complete objects the data is stored as zlib deflated data.
     The size in the header is the uncompressed object size, so to uncompress
     you need to just keep feeding data to zlib until you get an object back,
-    or it errors on bad data. This is done here by just giving the complete
-    buffer from the start of the deflated object on. This is bad, but until I
-    get mmap sorted out it will have to do.
+    or it errors on bad data. If possible the pack file is mmapped, and
+    objects are inflated straight from the map without seeking in the file.
 
     Currently there are no integrity checks done. Also no attempt is made to
     try and detect the delta case, or a request for an object at the wrong
     position.  It will all just throw a zlib or KeyError.
     """
 
-    def __init__(self, filename, file=None, size=None):
+    # Every this many deltas down from a resolved object, the intermediate
+    # result is cached as well.
+    chain_cache_interval = 8
+
+    # Whether to read objects from a memory map of the pack file.
+    use_mmap = has_mmap
+
+    def __init__(self, filename, file=None, size=None, delta_base_cache=None):
         """Create a PackData object representing the pack in the given filename.
 
         The file must exist and stay readable until the object is disposed of. It
@@ -962,7 +1464,14 @@ class PackData(object):
 
         Currently there is a restriction on the size of the pack as the python
         mmap implementation is flawed.
-        """
+
+        Looking up objects by offset is safe to do from several threads at
+        once; iterating over the objects in the pack is not.
+
+        :param delta_base_cache: Optional DeltaBaseCache to keep resolved
+            objects in, e.g. shared with other packs. By default the pack
+            gets a cache of its own.
+        """
         self._filename = filename
         self._size = size
         self._header_size = 12
@@ -971,9 +1480,21 @@ class PackData(object):
         else:
             self._file = file
         (version, self._num_objects) = read_pack_header(self._file.read)
-        self._offset_cache = LRUSizeCache(1024*1024*20,
-            compute_size=_compute_object_size)
+        if delta_base_cache is None:
+            delta_base_cache = DeltaBaseCache(1024*1024*20)
+        self.delta_base_cache = delta_base_cache
+        if file is None:
+            # Pack files are named after their contents, so cached objects
+            # stay valid when the pack is opened again.
+            self._cache_key = os.path.abspath(filename)
+        else:
+            self._cache_key = object()
+        # Protects the file position.
+        self._lock = threading.Lock()
         self.pack = None
+        self._contents = None
+        if self.use_mmap:
+            self._contents = _mmap_file_contents(self._file)[0]
 
     @classmethod
     def from_file(cls, file, size):
@@ -984,8 +1505,21 @@ class PackData(object):
         return cls(filename=path)
 
     def close(self):
+        if self._contents is not None:
+            self._contents.close()
+            self._contents = None
         self._file.close()
 
+    def _reader_at(self, offset):
+        """Get a reader for the mapped pack data, starting at an offset.
+
+        :return: A _BufferReader, or None if the data at offset is not mapped
+        """
+        contents = self._contents
+        if contents is None or offset >= len(contents):
+            return None
+        return _BufferReader(contents, offset)
+
     def _get_size(self):
         if self._size is not None:
             return self._size
@@ -1007,48 +1541,94 @@ class PackData(object):
         """
         return compute_file_sha(self._file, end_ofs=-20).digest()
 
-    def get_ref(self, sha):
-        """Get the object for a ref SHA, only looking in this pack."""
-        # TODO: cache these results
+    def _ref_offset(self, sha):
         if self.pack is None:
             raise KeyError(sha)
         offset = self.pack.index.object_index(sha)
         if not offset:
             raise KeyError(sha)
+        return offset
+
+    def get_ref(self, sha):
+        """Get the object for a ref SHA, only looking in this pack."""
+        offset = self._ref_offset(sha)
         type, obj = self.get_object_at(offset)
         return offset, type, obj
 
-    def resolve_object(self, offset, type, obj, get_ref=None):
+    def _get_base(self, offset):
+        """Get the object at an offset, from the cache if possible.
+
+        :return: Tuple with type number, object and whether it was cached
+        """
+        cached = self.delta_base_cache.get(self._cache_key, offset)
+        if cached is not None:
+            return cached[0], cached[1], True
+        unpacked = self.get_unpacked_object_at(offset)
+        return unpacked.pack_type_num, unpacked._obj(), False
+
+    def resolve_object(self, offset, type, obj, get_ref=None, stats=None):
         """Resolve an object, possibly resolving deltas when necessary.
 
+        The delta chain is followed down to the first base that is either not
+        a delta or in the delta base cache, and the deltas are then applied
+        on the way back up, without recursion. The resolved object is cached,
+        along with every chain_cache_interval'th base on the way, so that
+        other objects in the same chain don't have to be resolved from the
+        bottom again.
+
+        :param offset: Offset of the object in this pack, or None
+        :param type: Type number of the object as stored in the pack
+        :param obj: The object as returned by get_object_at
+        :param get_ref: Optional function to look up the base of a REF_DELTA
+            by SHA, returning a tuple with offset, type number and object.
+            By default bases are looked up in this pack.
+        :param stats: Optional DeltaChainStats to record the chain in
         :return: Tuple with object type and contents.
         """
+        if stats is not None:
+            stats.depth = 0
+            stats.base_cached = False
+            stats.cached = 0
         if type not in DELTA_TYPES:
             return type, obj
 
-        if get_ref is None:
-            get_ref = self.get_ref
-        if type == OFS_DELTA:
-            (delta_offset, delta) = obj
-            # TODO: clean up asserts and replace with nicer error messages
-            assert isinstance(offset, int)
-            assert isinstance(delta_offset, int)
-            base_offset = offset-delta_offset
-            type, base_obj = self.get_object_at(base_offset)
-            assert isinstance(type, int)
-        elif type == REF_DELTA:
-            (basename, delta) = obj
-            assert isinstance(basename, str) and len(basename) == 20
-            base_offset, type, base_obj = get_ref(basename)
-            assert isinstance(type, int)
-        type, base_chunks = self.resolve_object(base_offset, type, base_obj)
-        chunks = apply_delta(base_chunks, delta)
-        # TODO(dborowitz): This can result in poor performance if large base
-        # objects are separated from deltas in the pack. We should reorganize
-        # so that we apply deltas to all objects in a chain one after the other
-        # to optimize cache performance.
-        if offset is not None:
-            self._offset_cache[offset] = type, chunks
+        base_cached = False
+        chain = []
+        while type in DELTA_TYPES:
+            if type == OFS_DELTA:
+                (delta_offset, delta) = obj
+                if offset is None:
+                    raise ValueError('OFS_DELTA without an offset')
+                chain.append((offset, delta))
+                offset -= delta_offset
+                type, obj, base_cached = self._get_base(offset)
+            elif type == REF_DELTA:
+                (basename, delta) = obj
+                assert isinstance(basename, str) and len(basename) == 20
+                chain.append((offset, delta))
+                if get_ref is None:
+                    offset = self._ref_offset(basename)
+                    type, obj, base_cached = self._get_base(offset)
+                else:
+                    offset, type, obj = get_ref(basename)
+                    base_cached = False
+            else:
+                raise AssertionError('unknown type %r' % type)
+
+        chunks = obj
+        interval = self.chain_cache_interval
+        cached = 0
+        for i in xrange(len(chain) - 1, -1, -1):
+            delta_offset, delta = chain[i]
+            chunks = apply_delta(chunks, delta)
+            if delta_offset is not None and i % interval == 0:
+                self.delta_base_cache.add(self._cache_key, delta_offset, type,
+                                          chunks)
+                cached += 1
+        if stats is not None:
+            stats.depth = len(chain)
+            stats.base_cached = base_cached
+            stats.cached = cached
         return type, chunks
 
     def iterobjects(self, progress=None, compute_crc32=True):
@@ -1144,8 +1724,12 @@ class PackData(object):
 
     def get_stored_checksum(self):
         """Return the expected checksum stored in this pack."""
-        self._file.seek(-20, SEEK_END)
-        return self._file.read(20)
+        self._lock.acquire()
+        try:
+            self._file.seek(-20, SEEK_END)
+            return self._file.read(20)
+        finally:
+            self._lock.release()
 
     def check(self):
         """Check the consistency of this pack."""
@@ -1161,14 +1745,290 @@ class PackData(object):
         and then the packfile can be asked directly for that object using this
         function.
         """
-        if offset in self._offset_cache:
-            return self._offset_cache[offset]
+        cached = self.delta_base_cache.get(self._cache_key, offset)
+        if cached is not None:
+            return cached
+        unpacked = self.get_unpacked_object_at(offset)
+        return (unpacked.pack_type_num, unpacked._obj())
+
+    def get_object_header_at(self, offset):
+        """Get the type and delta base of the object at an offset.
+
+        Only the object header is read; the data is not inflated.
+
+        :param offset: Offset of the object in the packfile
+        :return: Tuple with the type number as stored and the delta base,
+            see unpack_object_header
+        """
+        reader = self._reader_at(offset)
+        if reader is not None:
+            return unpack_object_header(reader.read)[0:3:2]
+        self._lock.acquire()
+        try:
+            self._file.seek(offset)
+            return unpack_object_header(self._file.read)[0:3:2]
+        finally:
+            self._lock.release()
+
+    def get_object_info_at(self, offset):
+        """Get the type and size of the object at an offset.
+
+        Only the object headers are read: for deltas the result size is taken
+        from the start of the delta and the chain is followed just to find
+        the type of its base.
+
+        :param offset: Offset of the object in the packfile
+        :return: Tuple with the type number and the size of the object
+        """
+        size = None
+        while True:
+            reader = self._reader_at(offset)
+            if reader is None:
+                self._lock.acquire()
+            try:
+                if reader is None:
+                    self._file.seek(offset)
+                    read = self._file.read
+                else:
+                    read = reader.read
+                type_num, raw_size, delta_base, _ = unpack_object_header(read)
+                if size is None:
+                    if type_num in DELTA_TYPES:
+                        size = read_delta_sizes(read)[1]
+                    else:
+                        size = raw_size
+            finally:
+                if reader is None:
+                    self._lock.release()
+            if type_num == OFS_DELTA:
+                offset -= delta_base
+            elif type_num == REF_DELTA:
+                offset = self._ref_offset(delta_base)
+            else:
+                return type_num, size
+
+    def get_unpacked_object_at(self, offset, include_comp=False,
+                               compute_crc32=False):
+        """Given an offset in to the packfile return the UnpackedObject there.
+
+        Unlike get_object_at, deltas are not resolved and the cache is not
+        consulted.
+
+        :param offset: Offset of the object in the packfile
+        :param include_comp: If True, include compressed data in the result.
+        :param compute_crc32: If True, compute the CRC32 of the packed data.
+        :return: An UnpackedObject with offset, pack_type_num, delta_base,
+            decomp_chunks and (for non-delta types) obj_chunks set.
+        """
         assert isinstance(offset, long) or isinstance(offset, int),\
                 'offset was %r' % offset
         assert offset >= self._header_size
+        reader = self._reader_at(offset)
+        if reader is not None:
+            unpacked, _ = unpack_object(reader.read,
+                                        include_comp=include_comp,
+                                        compute_crc32=compute_crc32)
+        else:
+            self._lock.acquire()
+            try:
+                self._file.seek(offset)
+                unpacked, _ = unpack_object(self._file.read,
+                                            include_comp=include_comp,
+                                            compute_crc32=compute_crc32)
+            finally:
+                self._lock.release()
+        unpacked.offset = offset
+        return unpacked
+
+
+# Number of bytes of records read at a time from a spilled _RecordTable.
+_RECORD_BLOCK_SIZE = 64 * 1024
+
+
+class _RecordTable(object):
+    """Growable table of fixed-size records.
+
+    Records are packed into a single buffer rather than kept as Python
+    objects, and the buffer can be moved to a temporary file to bound memory
+    usage.
+    """
+
+    # Default number of bytes of records sorted in memory at a time once the
+    # table is spilled.
+    sort_run_size = 16 * 1024 * 1024
+
+    def __init__(self, fmt, sort_run_size=None):
+        """Create a new _RecordTable.
+
+        :param fmt: struct format of the records
+        :param sort_run_size: Number of bytes of records to sort in memory at
+            a time once the records are in a temporary file
+        """
+        self._fmt = fmt
+        self._record_size = struct.calcsize(fmt)
+        self._buf = bytearray()
+        self._file = None
+        self._dir = None
+        self._count = 0
+        if sort_run_size is not None:
+            self.sort_run_size = sort_run_size
+
+    def __len__(self):
+        return self._count
+
+    def memory_usage(self):
+        """Return the number of bytes of record data kept in memory."""
+        return len(self._buf)
+
+    def is_spilled(self):
+        return self._file is not None
+
+    def spill(self, dir=None):
+        """Move the records to a temporary file.
+
+        :param dir: Directory to create the temporary file in
+        """
+        if self._file is not None:
+            return
+        self._dir = dir
+        self._file = tempfile.TemporaryFile(dir=dir)
+        self._file.write(str(self._buf))
+        self._buf = bytearray()
+
+    def append(self, *values):
+        """Append a record.
+
+        :return: The index of the new record
+        """
+        data = struct.pack(self._fmt, *values)
+        if self._file is None:
+            self._buf.extend(data)
+        else:
+            self._file.seek(0, SEEK_END)
+            self._file.write(data)
+        self._count += 1
+        return self._count - 1
+
+    def __getitem__(self, i):
+        offset = i * self._record_size
+        if self._file is None:
+            return unpack_from(self._fmt, self._buf, offset)
         self._file.seek(offset)
-        unpacked, _ = unpack_object(self._file.read)
-        return (unpacked.pack_type_num, unpacked._obj())
+        return struct.unpack(self._fmt, self._file.read(self._record_size))
+
+    def __setitem__(self, i, values):
+        data = struct.pack(self._fmt, *values)
+        offset = i * self._record_size
+        if self._file is None:
+            self._buf[offset:offset+self._record_size] = data
+        else:
+            self._file.seek(offset)
+            self._file.write(data)
+
+    def _iter_file_records(self, f, start, stop):
+        """Iterate over records in a file, reading them in blocks.
+
+        :param f: File to read the records from
+        :param start: Index of the first record
+        :param stop: Index after the last record
+        """
+        fmt = self._fmt
+        size = self._record_size
+        block_records = max(1, _RECORD_BLOCK_SIZE // size)
+        while start < stop:
+            n = min(block_records, stop - start)
+            # Other readers of the file may have moved its position.
+            f.seek(start * size)
+            data = f.read(n * size)
+            for i in xrange(n):
+                yield unpack_from(fmt, data, i * size)
+            start += n
+
+    def __iter__(self):
+        """Iterate over the records in order.
+
+        :note: Once spilled, records are read ahead in blocks, so changes to
+            records that have already been read may not be seen.
+        """
+        if self._file is not None:
+            return self._iter_file_records(self._file, 0, self._count)
+        return (self[i] for i in xrange(self._count))
+
+    def _write_records(self, f, records):
+        """Write records to a file, in blocks."""
+        fmt = self._fmt
+        block_records = max(1, _RECORD_BLOCK_SIZE // self._record_size)
+        block = []
+        for record in records:
+            block.append(struct.pack(fmt, *record))
+            if len(block) >= block_records:
+                f.write(''.join(block))
+                block = []
+        f.write(''.join(block))
+
+    def _write_sorted_run(self, f, start, stop):
+        """Sort a run of records and write it to the same place in a file."""
+        records = list(self._iter_file_records(self._file, start, stop))
+        records.sort()
+        f.seek(start * self._record_size)
+        self._write_records(f, records)
+
+    def sort(self):
+        """Sort the records.
+
+        Once spilled, runs of at most sort_run_size bytes of records are
+        sorted in memory and written to another temporary file, and then
+        merged back into the table.
+        """
+        if self._file is None:
+            records = list(self)
+            records.sort()
+            fmt = self._fmt
+            self._buf = bytearray(''.join(
+              [struct.pack(fmt, *record) for record in records]))
+            return
+        run_records = max(1, self.sort_run_size // self._record_size)
+        runs = tempfile.TemporaryFile(dir=self._dir)
+        try:
+            bounds = []
+            for start in xrange(0, self._count, run_records):
+                stop = min(start + run_records, self._count)
+                self._write_sorted_run(runs, start, stop)
+                bounds.append((start, stop))
+            merged = merge(*[self._iter_file_records(runs, start, stop)
+                             for start, stop in bounds])
+            self._file.seek(0)
+            self._write_records(self._file, merged)
+        finally:
+            runs.close()
+
+    def bisect_left(self, key, field=0):
+        """Find the first record whose given field is not less than key.
+
+        :note: The records must be sorted on the given field.
+        """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][field] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Records for the objects in a pack: offset, pack type number, and the
+# indexes of the first and last OFS_DELTA objects based on it and of the next
+# OFS_DELTA object with the same base (-1 if none).
+_OBJECT_RECORD = '>QBlll'
+# Records for REF_DELTA objects: base SHA, object index, and whether the
+# delta has been resolved.
+_REF_RECORD = '>20slB'
 
 
 class DeltaChainIterator(object):
@@ -1178,6 +2038,10 @@ class DeltaChainIterator(object):
     regardless of how many objects reference it as a delta base. As a result,
     memory usage is proportional to the length of the longest delta chain.
 
+    The objects and delta bases recorded while reading the pack are kept in
+    compact fixed-size records, which are moved to temporary files once they
+    use more than spill_threshold bytes of memory.
+
     Subclasses can override _result to define the result type of the iterator.
     By default, results are UnpackedObjects with the following members set:
 
@@ -1195,66 +2059,166 @@ class DeltaChainIterator(object):
     _compute_crc32 = False
     _include_comp = False
 
-    def __init__(self, file_obj, resolve_ext_ref=None):
+    def __init__(self, file_obj, resolve_ext_ref=None, spill_threshold=None,
+                 spill_dir=None):
+        """Create a new DeltaChainIterator.
+
+        :param file_obj: File object to read the pack data from
+        :param resolve_ext_ref: Optional function to retrieve (type_num,
+            chunks) of objects outside the pack by binary SHA1
+        :param spill_threshold: Optional number of bytes of recorded data to
+            keep in memory before moving it to temporary files
+        :param spill_dir: Directory to create temporary files in
+        """
         self._file = file_obj
         self._resolve_ext_ref = resolve_ext_ref
-        self._pending_ofs = defaultdict(list)
-        self._pending_ref = defaultdict(list)
-        self._full_ofs = []
-        self._shas = {}
+        self._spill_threshold = spill_threshold
+        self._spill_dir = spill_dir
+        self._objects = _RecordTable(_OBJECT_RECORD,
+                                     sort_run_size=spill_threshold)
+        self._refs = _RecordTable(_REF_RECORD, sort_run_size=spill_threshold)
+        self._refs_sorted = False
+        self._num_unresolved_ofs = 0
         self._ext_refs = []
 
     @classmethod
-    def for_pack_data(cls, pack_data, resolve_ext_ref=None):
-        walker = cls(None, resolve_ext_ref=resolve_ext_ref)
+    def for_pack_data(cls, pack_data, resolve_ext_ref=None,
+                      spill_threshold=None, spill_dir=None):
+        walker = cls(None, resolve_ext_ref=resolve_ext_ref,
+                     spill_threshold=spill_threshold, spill_dir=spill_dir)
         walker.set_pack_data(pack_data)
         for unpacked in pack_data._iter_unpacked():
             walker.record(unpacked)
         return walker
 
     def record(self, unpacked):
+        """Record an object read from the pack.
+
+        Objects must be recorded in the order in which they appear in the pack.
+        """
         type_num = unpacked.pack_type_num
         offset = unpacked.offset
+        index = self._objects.append(offset, type_num, -1, -1, -1)
         if type_num == OFS_DELTA:
-            base_offset = offset - unpacked.delta_base
-            self._pending_ofs[base_offset].append(offset)
+            base_index = self._find_offset(offset - unpacked.delta_base)
+            if base_index is None:
+                self._num_unresolved_ofs += 1
+            else:
+                self._add_ofs_child(base_index, index)
         elif type_num == REF_DELTA:
-            self._pending_ref[unpacked.delta_base].append(offset)
+            self._refs.append(unpacked.delta_base, index, 0)
+            self._refs_sorted = False
+        if (self._spill_threshold is not None and
+            self.memory_usage() > self._spill_threshold):
+            self._objects.spill(self._spill_dir)
+            self._refs.spill(self._spill_dir)
+
+    def memory_usage(self):
+        """Return the number of bytes used in memory for recorded objects."""
+        return self._objects.memory_usage() + self._refs.memory_usage()
+
+    def is_spilled(self):
+        """Check whether recorded objects have been moved to temporary files."""
+        return self._objects.is_spilled()
+
+    def close(self):
+        """Remove any temporary files used for recorded objects."""
+        self._objects.close()
+        self._refs.close()
+
+    def _find_offset(self, offset):
+        objects = self._objects
+        i = objects.bisect_left(offset)
+        if i < len(objects) and objects[i][0] == offset:
+            return i
+        return None
+
+    def _add_ofs_child(self, base_index, index):
+        objects = self._objects
+        base_offset, base_type, first, last, base_next = objects[base_index]
+        if first == -1:
+            first = index
         else:
-            self._full_ofs.append((offset, type_num))
+            last_record = list(objects[last])
+            last_record[4] = index
+            objects[last] = last_record
+        objects[base_index] = (base_offset, base_type, first, index, base_next)
+
+    def _iter_ofs_children(self, index):
+        objects = self._objects
+        child = objects[index][2]
+        while child != -1:
+            yield child
+            child = objects[child][4]
+
+    def _sort_refs(self):
+        if not self._refs_sorted:
+            self._refs.sort()
+            self._refs_sorted = True
+
+    def _pop_ref_children(self, base_sha):
+        """Mark the deltas based on an object as resolved.
+
+        :param base_sha: Binary SHA1 of the base object
+        :return: List of indexes of the REF_DELTA objects based on it
+        """
+        refs = self._refs
+        ret = []
+        i = refs.bisect_left(base_sha)
+        while i < len(refs):
+            sha, index, resolved = refs[i]
+            if sha != base_sha:
+                break
+            if not resolved:
+                refs[i] = (sha, index, 1)
+                ret.append(index)
+            i += 1
+        return ret
+
+    def _iter_pending_ref_shas(self):
+        refs = self._refs
+        last_sha = None
+        for i, (sha, index, resolved) in enumerate(refs):
+            # The record may have been resolved after it was read ahead.
+            if not resolved and sha != last_sha and not refs[i][2]:
+                last_sha = sha
+                yield sha
 
     def set_pack_data(self, pack_data):
         self._file = pack_data._file
 
     def _walk_all_chains(self):
-        for offset, type_num in self._full_ofs:
-            for result in self._follow_chain(offset, type_num, None):
-                yield result
+        self._sort_refs()
+        for index, record in enumerate(self._objects):
+            type_num = record[1]
+            if type_num not in DELTA_TYPES:
+                for result in self._follow_chain(index, type_num, None):
+                    yield result
         for result in self._walk_ref_chains():
             yield result
-        assert not self._pending_ofs
+        assert not self._num_unresolved_ofs
 
     def _ensure_no_pending(self):
-        if self._pending_ref:
-            raise KeyError([sha_to_hex(s) for s in self._pending_ref])
+        pending = list(self._iter_pending_ref_shas())
+        if pending:
+            raise KeyError([sha_to_hex(s) for s in pending])
 
     def _walk_ref_chains(self):
         if not self._resolve_ext_ref:
             self._ensure_no_pending()
             return
 
-        for base_sha, pending in sorted(self._pending_ref.iteritems()):
+        for base_sha in self._iter_pending_ref_shas():
             try:
                 type_num, chunks = self._resolve_ext_ref(base_sha)
             except KeyError:
                 # Not an external ref, but may depend on one. Either it will get
-                # popped via a _follow_chain call, or we will raise an error
+                # resolved via a _follow_chain call, or we will raise an error
                 # below.
                 continue
             self._ext_refs.append(base_sha)
-            self._pending_ref.pop(base_sha)
-            for new_offset in pending:
-                for result in self._follow_chain(new_offset, type_num, chunks):
+            for index in self._pop_ref_children(base_sha):
+                for result in self._follow_chain(index, type_num, chunks):
                     yield result
 
         self._ensure_no_pending()
@@ -1277,17 +2241,18 @@ class DeltaChainIterator(object):
                                               unpacked.decomp_chunks)
         return unpacked
 
-    def _follow_chain(self, offset, obj_type_num, base_chunks):
+    def _follow_chain(self, index, obj_type_num, base_chunks):
         # Unlike PackData.get_object_at, there is no need to cache offsets as
         # this approach by design inflates each object exactly once.
+        offset = self._objects[index][0]
         unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
         yield self._result(unpacked)
 
-        pending = chain(self._pending_ofs.pop(unpacked.offset, []),
-                        self._pending_ref.pop(unpacked.sha(), []))
-        for new_offset in pending:
+        pending = chain(self._iter_ofs_children(index),
+                        self._pop_ref_children(unpacked.sha()))
+        for new_index in pending:
             for new_result in self._follow_chain(
-              new_offset, unpacked.obj_type_num, unpacked.obj_chunks):
+              new_index, unpacked.obj_type_num, unpacked.obj_chunks):
                 yield new_result
 
     def __iter__(self):
@@ -1412,9 +2377,23 @@ def write_pack_object(f, type, object, sha=None):
     else:
         delta_base = None
     header = pack_object_header(type, delta_base, len(object))
-    comp_data = zlib.compress(object)
-    crc32 = 0
-    for data in (header, comp_data):
+    return _write_pack_entry(f, header, [zlib.compress(object)], sha=sha)
+
+
+def _write_pack_entry(f, header, comp_chunks, sha=None):
+    """Write an already compressed pack entry to a file.
+
+    :param f: File to write to
+    :param header: Pack object header, as created by pack_object_header
+    :param comp_chunks: Compressed object data chunks
+    :param sha: Optional SHA object to update with the written data
+    :return: CRC32 checksum of the written data
+    """
+    crc32 = binascii.crc32(header)
+    f.write(header)
+    if sha is not None:
+        sha.update(header)
+    for data in comp_chunks:
         f.write(data)
         if sha is not None:
             sha.update(data)
@@ -1455,14 +2434,25 @@ def write_pack_header(f, num_objects):
     f.write(struct.pack('>L', num_objects))  # Number of objects in pack
 
 
-def deltify_pack_objects(objects, window=10):
+def deltify_pack_objects(objects, window=10, depth=50):
     """Generate deltas for pack objects.
 
-    :param objects: Objects to deltify
-    :param window: Window size
+    Objects are sorted by type, path and decreasing size, then each object is
+    compared against the previous ``window`` objects of the same type. A delta
+    is only used if it is considerably smaller than the full text, and delta
+    chains are never allowed to grow beyond ``depth``.
+
+    :param objects: Iterable of (object, path) tuples to deltify
+    :param window: Window size; 0 to disable delta compression
+    :param depth: Maximum delta chain depth
     :return: Iterator over type_num, object id, delta_base, content
         delta_base is None for full text entries
     """
+    if not window:
+        for o, path in objects:
+            yield o.type_num, o.sha().digest(), None, o.as_raw_string()
+        return
+
     # Build a list of objects ordered by the magic Linus heuristic
     # This helps us find good objects to diff against us
     magic = []
@@ -1470,58 +2460,220 @@ def deltify_pack_objects(objects, window=10):
         magic.append((obj.type_num, path, -obj.raw_length(), obj))
     magic.sort()
 
+    for record in _deltify_sorted(
+        ((type_num, o.sha().digest(), o.as_raw_string())
+         for type_num, path, neg_length, o in magic), window, depth):
+        yield record
+
+
+def deltify_pack_entries(get_raw, object_ids, window=10, depth=50,
+                         get_info=None):
+    """Generate deltas for objects that are retrieved as they are needed.
+
+    This works like deltify_pack_objects, but only keeps the type, path and
+    size of each object in memory to sort them. Objects are then retrieved
+    again one at a time as they are deltified.
+
+    :param get_raw: Function to retrieve a (type_num, raw string) tuple for
+        an object by hex SHA1
+    :param object_ids: Iterable of (sha, path) tuples to deltify
+    :param window: Window size; 0 to disable delta compression
+    :param depth: Maximum delta chain depth
+    :param get_info: Optional function to retrieve a (type_num, size) tuple
+        for an object by hex SHA1, used to sort the objects without
+        retrieving their contents
+    :return: Iterator over type_num, object id, delta_base, content
+        delta_base is None for full text entries
+    """
+    if not window:
+        for sha, path in object_ids:
+            type_num, raw = get_raw(sha)
+            yield type_num, hex_to_sha(sha), None, raw
+        return
+
+    if get_info is None:
+        def get_info(sha):
+            type_num, raw = get_raw(sha)
+            return type_num, len(raw)
+    magic = []
+    for sha, path in object_ids:
+        type_num, size = get_info(sha)
+        magic.append((type_num, path, -size, sha))
+    magic.sort()
+
+    for record in _deltify_sorted(
+        ((type_num, hex_to_sha(sha), get_raw(sha)[1])
+         for type_num, path, neg_length, sha in magic), window, depth):
+        yield record
+
+
+def _deltify_sorted(objects, window, depth):
+    """Generate deltas for objects in the order in which they are given.
+
+    :param objects: Iterable of (type_num, binary sha, raw string) tuples
+    :param window: Window size
+    :param depth: Maximum delta chain depth
+    :return: Iterator over type_num, object id, delta_base, content
+    """
+    # Entries are [type_num, sha, raw, chain depth, DeltaIndex or None]
     possible_bases = deque()
 
-    for type_num, path, neg_length, o in magic:
-        raw = o.as_raw_string()
+    for type_num, sha, raw in objects:
         winner = raw
         winner_base = None
+        winner_depth = 0
         for base in possible_bases:
-            if base.type_num != type_num:
+            base_type_num, base_sha, base_raw, base_depth, base_index = base
+            if base_type_num != type_num or base_depth >= depth:
                 continue
-            delta = create_delta(base.as_raw_string(), raw)
-            if len(delta) < len(winner):
-                winner_base = base.sha().digest()
+            max_size = _max_delta_size(len(raw), base_depth, depth)
+            if winner_base is not None:
+                max_size = min(max_size, len(winner) - 1)
+            if not _worth_deltifying(len(base_raw), len(raw), max_size):
+                continue
+            if base_index is None:
+                base_index = base[4] = DeltaIndex(base_raw)
+            delta = base_index.delta_against(raw)
+            if len(delta) <= max_size:
+                winner_base = base_sha
                 winner = delta
-        yield type_num, o.sha().digest(), winner_base, winner
-        possible_bases.appendleft(o)
+                winner_depth = base_depth + 1
+        yield type_num, sha, winner_base, winner
+        possible_bases.appendleft([type_num, sha, raw, winner_depth, None])
         while len(possible_bases) > window:
             possible_bases.pop()
 
 
-def write_pack_objects(f, objects, window=10, num_objects=None):
+def _max_delta_size(target_size, base_depth, max_depth):
+    """Determine the largest delta worth storing for a target.
+
+    Like git, deltas have to be less than about half the size of the full
+    text, and bases deep in a delta chain need to produce even smaller deltas
+    to be chosen.
+    """
+    return (target_size // 2 - 20) * (max_depth - base_depth) // max_depth
+
+
+def _worth_deltifying(base_size, target_size, max_size):
+    """Check whether it is worth computing a delta between two objects."""
+    if max_size <= 0:
+        return False
+    if base_size < target_size and target_size - base_size >= max_size:
+        # The delta would have to insert too much data.
+        return False
+    if target_size < base_size // 32:
+        return False
+    return True
+
+
+def write_pack_objects(f, objects, window=10, num_objects=None, depth=50,
+                       thin=False):
     """Write a new pack data file.
 
+    If objects provides an iter_pack_records method (like
+    ObjectStoreIterator), it is used to generate the pack entries. This allows
+    object stores to reuse deltas that they have already stored.
+
     :param f: File to write to
     :param objects: Iterable of (object, path) tuples to write.
         Should provide __len__
-    :param window: Sliding window size for searching for deltas; currently
-                   unimplemented
+    :param window: Sliding window size for searching for deltas; 0 to
+        disable delta compression
     :param num_objects: Number of objects (do not use, deprecated)
+    :param depth: Maximum delta chain depth
+    :param thin: Whether deltas against objects the receiver is known to have
+        may be included, creating a thin pack
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     if num_objects is None:
         num_objects = len(objects)
-    # FIXME: pack_contents = deltify_pack_objects(objects, window)
-    pack_contents = (
-        (o.type_num, o.sha().digest(), None, o.as_raw_string())
-        for (o, path) in objects)
+    pack_contents = generate_pack_records(objects, window, depth, thin)
     return write_pack_data(f, num_objects, pack_contents)
 
 
+def generate_pack_records(objects, window=10, depth=50, thin=False):
+    """Generate the records of a pack containing a set of objects.
+
+    See write_pack_objects for a description of the arguments.
+
+    :return: Iterator over records, as taken by write_pack_data
+    """
+    iter_pack_records = getattr(objects, 'iter_pack_records', None)
+    if iter_pack_records is not None:
+        return iter_pack_records(window=window, depth=depth, thin=thin)
+    return deltify_pack_objects(objects, window, depth=depth)
+
+
+def generate_pack_chunks(objects, window=10, depth=50, thin=False):
+    """Generate the data of a new pack as it is written.
+
+    This works like write_pack_objects, but the pack is generated one object
+    at a time, so that it can be streamed without keeping it in memory.
+
+    :param objects: Iterable of (object, path) tuples to write.
+        Should provide __len__
+    :param window: Sliding window size for searching for deltas; 0 to
+        disable delta compression
+    :param depth: Maximum delta chain depth
+    :param thin: Whether deltas against objects the receiver is known to have
+        may be included, creating a thin pack
+    :return: Iterator over chunks of pack data
+    """
+    buf = StringIO()
+    f = SHA1Writer(buf)
+    write_pack_header(f, len(objects))
+    entries = {}
+    for _ in _write_pack_records(
+            f, generate_pack_records(objects, window, depth, thin), entries):
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    f.write_sha()
+    yield buf.getvalue()
+
+
 def write_pack_data(f, num_records, records):
     """Write a new pack data file.
 
+    Records with a delta base that was written earlier in the same pack are
+    written as OFS_DELTA entries, other deltas as REF_DELTA entries.
+
+    Records can also be UnpackedObjects with comp_chunks set, as returned by
+    Pack.get_raw_unresolved. Their compressed data is copied verbatim. They
+    must have a known SHA and a delta_base that is None or a binary SHA.
+
     :param f: File to write to
     :param num_records: Number of records
-    :param records: Iterator over type_num, object_id, delta_base, raw
+    :param records: Iterator over type_num, object_id, delta_base, raw tuples
+        or UnpackedObjects
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     # Write the pack
     entries = {}
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+    for _ in _write_pack_records(f, records, entries):
+        pass
+    return entries, f.write_sha()
+
+
+def _write_pack_records(f, records, entries):
+    """Write the records of a pack, yielding after each one.
+
+    :param f: SHA1Writer to write to, positioned after the pack header
+    :param records: Iterator over records, as for write_pack_data
+    :param entries: Dict to add id -> (offset, crc32 checksum) to for each
+        record written
+    :return: Iterator that yields None after writing each record
+    """
+    for record in records:
+        offset = f.offset()
+        if isinstance(record, UnpackedObject):
+            entries[record.sha()] = (offset, _write_unpacked(f, record,
+                                                             offset, entries))
+            yield
+            continue
+        type_num, object_id, delta_base, raw = record
         if delta_base is not None:
             try:
                 base_offset, base_crc32 = entries[delta_base]
@@ -1530,11 +2682,34 @@ def write_pack_data(f, num_records, records):
                 raw = (delta_base, raw)
             else:
                 type_num = OFS_DELTA
-                raw = (base_offset, raw)
-        offset = f.offset()
+                raw = (offset - base_offset, raw)
         crc32 = write_pack_object(f, type_num, raw)
         entries[object_id] = (offset, crc32)
-    return entries, f.write_sha()
+        yield
+
+
+def _write_unpacked(f, unpacked, offset, entries):
+    """Write an UnpackedObject with compressed data as part of a pack.
+
+    :param f: File to write to
+    :param unpacked: UnpackedObject with comp_chunks set
+    :param offset: Offset the object is written at
+    :param entries: Dict mapping id -> (offset, crc32) of written objects
+    :return: CRC32 checksum of the written data
+    """
+    type_num = unpacked.pack_type_num
+    delta_base = unpacked.delta_base
+    if type_num in DELTA_TYPES:
+        assert len(delta_base) == 20
+        try:
+            base_offset, base_crc32 = entries[delta_base]
+        except KeyError:
+            type_num = REF_DELTA
+        else:
+            type_num = OFS_DELTA
+            delta_base = offset - base_offset
+    header = pack_object_header(type_num, delta_base, unpacked.decomp_len)
+    return _write_pack_entry(f, header, unpacked.comp_chunks)
 
 
 def write_pack_index_v1(f, entries, pack_checksum):
@@ -1561,64 +2736,174 @@ def write_pack_index_v1(f, entries, pack_checksum):
     return f.write_sha()
 
 
+# Size of the blocks of the base buffer that are indexed by DeltaIndex.
+_DELTA_BLOCK_SIZE = 16
+
+# Maximum number of base offsets that are remembered for identical blocks.
+_DELTA_MAX_BLOCK_OFFSETS = 64
+
+
+def _encode_delta_size(size):
+    """Encode a size for a delta header."""
+    ret = ''
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret += chr(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret += chr(c)
+    return ret
+
+
+def _delta_copy_op(offset, length):
+    """Create a delta copy instruction.
+
+    :param offset: Offset in the base buffer
+    :param length: Number of bytes to copy, at most 0x10000
+    """
+    scratch = ''
+    op = 0x80
+    for i in range(4):
+        if offset & 0xff << i*8:
+            scratch += chr((offset >> i*8) & 0xff)
+            op |= 1 << i
+    for i in range(2):
+        if length & 0xff << i*8:
+            scratch += chr((length >> i*8) & 0xff)
+            op |= 1 << (4+i)
+    return chr(op) + scratch
+
+
+def _match_length(a, a_start, b, b_start):
+    """Determine the length of the common prefix of a[a_start:], b[b_start:]."""
+    length = 0
+    limit = min(len(a) - a_start, len(b) - b_start)
+    step = 64
+    while length < limit:
+        step = min(step, limit - length)
+        if (a[a_start+length:a_start+length+step] ==
+            b[b_start+length:b_start+length+step]):
+            length += step
+            step *= 2
+        elif step > 1:
+            step //= 2
+        else:
+            break
+    return length
+
+
+class DeltaIndex(object):
+    """Index over a base buffer for creating deltas against it.
+
+    Building the index is linear in the size of the base buffer, so when
+    creating deltas for several targets against the same base it should be
+    built once and reused. This is the equivalent of git's
+    create_delta_index.
+    """
+
+    def __init__(self, base_buf):
+        """Create a new DeltaIndex.
+
+        :param base_buf: Base buffer, as a string or list of chunks
+        """
+        if type(base_buf) != str:
+            base_buf = ''.join(base_buf)
+        self._base_buf = base_buf
+        self._blocks = {}
+        for offset in xrange(0, len(base_buf) - _DELTA_BLOCK_SIZE + 1,
+                             _DELTA_BLOCK_SIZE):
+            block = base_buf[offset:offset+_DELTA_BLOCK_SIZE]
+            offsets = self._blocks.setdefault(block, [])
+            if len(offsets) < _DELTA_MAX_BLOCK_OFFSETS:
+                offsets.append(offset)
+
+    def __len__(self):
+        """Return the size of the indexed base buffer."""
+        return len(self._base_buf)
+
+    def delta_against(self, target_buf):
+        """Create a delta that transforms the base buffer into target_buf.
+
+        :param target_buf: Target buffer, as a string or list of chunks
+        :return: Delta as a string
+        """
+        if type(target_buf) != str:
+            target_buf = ''.join(target_buf)
+        base_buf = self._base_buf
+        blocks = self._blocks
+        out = [_encode_delta_size(len(base_buf)),
+               _encode_delta_size(len(target_buf))]
+
+        def write_insert(start, end):
+            while start < end:
+                size = min(end - start, 127)
+                out.append(chr(size))
+                out.append(target_buf[start:start+size])
+                start += size
+
+        insert_start = 0
+        i = 0
+        end = len(target_buf) - _DELTA_BLOCK_SIZE
+        while i <= end:
+            offsets = blocks.get(target_buf[i:i+_DELTA_BLOCK_SIZE])
+            if offsets is None:
+                i += 1
+                continue
+            best_offset = None
+            best_length = 0
+            for offset in offsets:
+                length = _DELTA_BLOCK_SIZE + _match_length(
+                    base_buf, offset + _DELTA_BLOCK_SIZE,
+                    target_buf, i + _DELTA_BLOCK_SIZE)
+                if length > best_length:
+                    best_offset = offset
+                    best_length = length
+            # Extend the match backwards over data we would otherwise insert.
+            while (best_offset > 0 and i > insert_start and
+                   base_buf[best_offset-1] == target_buf[i-1]):
+                best_offset -= 1
+                best_length += 1
+                i -= 1
+            write_insert(insert_start, i)
+            while best_length > 0:
+                length = min(best_length, 0x10000)
+                out.append(_delta_copy_op(best_offset, length))
+                best_offset += length
+                best_length -= length
+                i += length
+            insert_start = i
+        write_insert(insert_start, len(target_buf))
+        return ''.join(out)
+
+
 def create_delta(base_buf, target_buf):
-    """Use python difflib to work out how to transform base_buf to target_buf.
+    """Create a delta that transforms base_buf into target_buf.
 
     :param base_buf: Base buffer
     :param target_buf: Target buffer
+    :return: Delta as a string
     """
     assert isinstance(base_buf, str)
     assert isinstance(target_buf, str)
-    out_buf = ''
-    # write delta header
-    def encode_size(size):
-        ret = ''
-        c = size & 0x7f
-        size >>= 7
-        while size:
-            ret += chr(c | 0x80)
-            c = size & 0x7f
-            size >>= 7
-        ret += chr(c)
-        return ret
-    out_buf += encode_size(len(base_buf))
-    out_buf += encode_size(len(target_buf))
-    # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
-        # Git patch opcodes don't care about deletes!
-        #if opcode == 'replace' or opcode == 'delete':
-        #    pass
-        if opcode == 'equal':
-            # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
-            scratch = ''
-            op = 0x80
-            o = i1
-            for i in range(4):
-                if o & 0xff << i*8:
-                    scratch += chr((o >> i*8) & 0xff)
-                    op |= 1 << i
-            s = i2 - i1
-            for i in range(2):
-                if s & 0xff << i*8:
-                    scratch += chr((s >> i*8) & 0xff)
-                    op |= 1 << (4+i)
-            out_buf += chr(op)
-            out_buf += scratch
-        if opcode == 'replace' or opcode == 'insert':
-            # If we are replacing a range or adding one, then we just
-            # output it to the stream (prefixed by its size)
-            s = j2 - j1
-            o = j1
-            while s > 127:
-                out_buf += chr(127)
-                out_buf += target_buf[o:o+127]
-                s -= 127
-                o += 127
-            out_buf += chr(s)
-            out_buf += target_buf[o:o+s]
-    return out_buf
+    return DeltaIndex(base_buf).delta_against(target_buf)
+
+
+def _delta_header_size(delta, index):
+    """Decode one of the sizes at the start of a delta.
+
+    :return: Tuple with the size and the index just after it
+    """
+    size = 0
+    i = 0
+    while True:
+        cmd = ord(delta[index])
+        index += 1
+        size |= (cmd & ~0x80) << i
+        i += 7
+        if not cmd & 0x80:
+            break
+    return size, index
 
 
 def apply_delta(src_buf, delta):
@@ -1634,19 +2919,8 @@ def apply_delta(src_buf, delta):
     out = []
     index = 0
     delta_length = len(delta)
-    def get_delta_header_size(delta, index):
-        size = 0
-        i = 0
-        while delta:
-            cmd = ord(delta[index])
-            index += 1
-            size |= (cmd & ~0x80) << i
-            i += 7
-            if not cmd & 0x80:
-                break
-        return size, index
-    src_size, index = get_delta_header_size(delta, index)
-    dest_size, index = get_delta_header_size(delta, index)
+    src_size, index = _delta_header_size(delta, index)
+    dest_size, index = _delta_header_size(delta, index)
     assert src_size == len(src_buf), '%d vs %d' % (src_size, len(src_buf))
     while index < delta_length:
         cmd = ord(delta[index])
@@ -1718,13 +2992,54 @@ def write_pack_index_v2(f, entries, pack_checksum):
     return f.write_sha()
 
 
+class _PackUseIterator(object):
+    """Iterator that ends a use of a pack once it is exhausted or dropped."""
+
+    def __init__(self, pack, iterable):
+        self._pack = pack
+        self._iter = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iter.next()
+        except:
+            self._end_use()
+            raise
+
+    def _end_use(self):
+        pack = self._pack
+        if pack is not None:
+            self._pack = None
+            pack.end_use()
+
+    __del__ = _end_use
+
+
 class Pack(object):
     """A Git pack object."""
 
+    # Number of lookups for objects that are not in the pack after which
+    # find_offset builds a bloom filter to rule out further misses.
+    bloom_filter_threshold = 32
+
     def __init__(self, basename):
         self._basename = basename
         self._data = None
         self._idx = None
+        # Number of begin_use calls without a matching end_use, and released
+        # data and index objects that are closed once it drops to zero
+        self._users = 0
+        self._closing = []
+        self._use_lock = threading.Lock()
+        self._bloom_filter = None
+        self._misses = 0
+        # Optional PackHandleCache that limits the number of open packs.
+        self.handle_cache = None
+        # Optional DeltaBaseCache to share with other packs.
+        self.delta_base_cache = None
         self._idx_path = self._basename + '.idx'
         self._data_path = self._basename + '.pack'
         self._data_load = lambda: PackData(self._data_path)
@@ -1754,11 +3069,17 @@ class Pack(object):
     @property
     def data(self):
         """The pack data object being used."""
-        if self._data is None:
-            self._data = self._data_load()
-            self._data.pack = self
+        data = self._data
+        if data is None:
+            data = self._data_load()
+            data.pack = self
+            if self.delta_base_cache is not None:
+                data.delta_base_cache = self.delta_base_cache
+            self._data = data
             self.check_length_and_checksum()
-        return self._data
+            if self.handle_cache is not None:
+                self.handle_cache.opened(self)
+        return data
 
     @property
     def index(self):
@@ -1766,9 +3087,117 @@ class Pack(object):
 
         :note: This may be an in-memory index
         """
-        if self._idx is None:
-            self._idx = self._idx_load()
-        return self._idx
+        idx = self._idx
+        if idx is None:
+            idx = self._idx_load()
+            self._idx = idx
+            if self.handle_cache is not None:
+                self.handle_cache.opened(self)
+        return idx
+
+    def is_open(self):
+        """Check whether the pack data or index of this pack are loaded."""
+        return self._data is not None or self._idx is not None
+
+    def mapped_size(self):
+        """Return the number of bytes of this pack that are held in memory.
+
+        This is the size of the loaded index, which is usually mmapped, plus
+        that of the mmapped pack data.
+        """
+        size = getattr(self._idx, '_size', None) or 0
+        if self._data is not None and self._data._contents is not None:
+            size += len(self._data._contents)
+        return size
+
+    def begin_use(self):
+        """Mark the pack as in use, e.g. by a reader in another thread.
+
+        While the pack is in use, release does not close the files of the
+        data and index it drops. Code that uses data or index directly
+        rather than through the methods of the pack should call this first,
+        and end_use once it is done.
+        """
+        self._use_lock.acquire()
+        try:
+            self._users += 1
+        finally:
+            self._use_lock.release()
+
+    def end_use(self):
+        """Mark the end of a use started with begin_use.
+
+        Files dropped by release while the pack was in use are closed once
+        the last use ends.
+        """
+        self._use_lock.acquire()
+        try:
+            self._users -= 1
+            closing = []
+            if not self._users:
+                closing, self._closing = self._closing, []
+        finally:
+            self._use_lock.release()
+        for f in closing:
+            f.close()
+
+    def release(self):
+        """Drop the loaded pack data and index, and close their files.
+
+        They are loaded again when they are next used. If the pack is in use
+        (see begin_use), the files are only closed once the last use ends,
+        so it is safe to release a pack that is in use by another thread.
+        """
+        self._use_lock.acquire()
+        try:
+            closing = [f for f in (self._data, self._idx) if f is not None]
+            self._data = None
+            self._idx = None
+            if self._users:
+                self._closing.extend(closing)
+                closing = []
+        finally:
+            self._use_lock.release()
+        for f in closing:
+            f.close()
+
+    @property
+    def bloom_filter(self):
+        """A ShaBloomFilter for the binary SHAs of the objects in this pack.
+
+        The filter is built from the index when it is first used, which
+        requires reading all SHAs in the index.
+        """
+        if self._bloom_filter is None:
+            self._bloom_filter = ShaBloomFilter.from_shas(
+                len(self.index), self.index._itersha())
+        return self._bloom_filter
+
+    def find_offset(self, sha):
+        """Find the offset of an object in this pack.
+
+        Lookups are answered by the index. Once the pack has seen
+        bloom_filter_threshold lookups for objects it does not contain, its
+        bloom filter is built and used to skip the index for most misses.
+
+        :param sha: Binary SHA1 of the object
+        :return: Offset of the object, or None if it is not in this pack
+        """
+        bloom_filter = self._bloom_filter
+        if bloom_filter is not None and sha not in bloom_filter:
+            return None
+        self.begin_use()
+        try:
+            try:
+                return self.index.object_index(sha)
+            except KeyError:
+                if bloom_filter is None:
+                    self._misses += 1
+                    if self._misses >= self.bloom_filter_threshold:
+                        self.bloom_filter
+                return None
+        finally:
+            self.end_use()
 
     def close(self):
         if self._data is not None:
@@ -1814,28 +3243,192 @@ class Pack(object):
 
     def __contains__(self, sha1):
         """Check whether this pack contains a particular SHA1."""
+        self.begin_use()
         try:
-            self.index.object_index(sha1)
-            return True
-        except KeyError:
-            return False
+            try:
+                self.index.object_index(sha1)
+                return True
+            except KeyError:
+                return False
+        finally:
+            self.end_use()
 
     def get_raw(self, sha1):
-        offset = self.index.object_index(sha1)
-        obj_type, obj = self.data.get_object_at(offset)
-        if type(offset) is long:
-          offset = int(offset)
-        type_num, chunks = self.data.resolve_object(offset, obj_type, obj)
+        self.begin_use()
+        try:
+            return self.get_raw_at(self.index.object_index(sha1))
+        finally:
+            self.end_use()
+
+    def get_raw_at(self, offset):
+        """Retrieve the raw text of the object at an offset in this pack.
+
+        :param offset: Offset of the object in the pack data
+        :return: Tuple with numeric type and object contents
+        """
+        self.begin_use()
+        try:
+            data = self.data
+            obj_type, obj = data.get_object_at(offset)
+            if type(offset) is long:
+              offset = int(offset)
+            type_num, chunks = data.resolve_object(offset, obj_type, obj)
+        finally:
+            self.end_use()
         return type_num, ''.join(chunks)
 
+    def get_object_info_at(self, offset):
+        """Get the type and size of the object at an offset in this pack.
+
+        :param offset: Offset of the object in the pack data
+        :return: Tuple with numeric type and size of the object
+        """
+        self.begin_use()
+        try:
+            return self.data.get_object_info_at(offset)
+        finally:
+            self.end_use()
+
+    def get_object_info(self, sha1):
+        """Get the type and size of an object without inflating it.
+
+        :param sha1: SHA1 of the object, binary or hex
+        :return: Tuple with numeric type and size of the object
+        """
+        self.begin_use()
+        try:
+            return self.get_object_info_at(self.index.object_index(sha1))
+        finally:
+            self.end_use()
+
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
         return ShaFile.from_raw_string(type, uncomp)
 
+    def get_unpacked_object(self, sha1, include_comp=False):
+        """Retrieve the specified SHA1 as stored in the pack.
+
+        Deltas are not resolved. OFS_DELTA entries are converted to REF_DELTA
+        entries referring to the SHA1 of their base, so the result does not
+        depend on the layout of this pack.
+
+        :param sha1: SHA1 of the object, as hex or binary string
+        :param include_comp: If True, include compressed data in the result.
+        :return: An UnpackedObject
+        :raise KeyError: if the object is not in this pack
+        """
+        self.begin_use()
+        try:
+            offset = self.index.object_index(sha1)
+            unpacked = self.data.get_unpacked_object_at(
+                offset, include_comp=include_comp)
+            if len(sha1) == 40:
+                sha1 = hex_to_sha(sha1)
+            unpacked._sha = sha1
+            self._convert_ofs_delta(unpacked)
+        finally:
+            self.end_use()
+        return unpacked
+
+    def get_object_header(self, sha1):
+        """Get the type and delta base of an object as stored in the pack.
+
+        Unlike get_raw_unresolved, only the object header is read.
+
+        :param sha1: SHA1 of the object, as hex or binary string
+        :return: Tuple with the type number as stored and the delta base
+            (None or a binary SHA, see get_unpacked_object)
+        :raise KeyError: if the object is not in this pack
+        """
+        self.begin_use()
+        try:
+            offset = self.index.object_index(sha1)
+            type_num, delta_base = self.data.get_object_header_at(offset)
+            if type_num == OFS_DELTA:
+                type_num = REF_DELTA
+                delta_base = self.index.object_sha1(offset - delta_base)
+        finally:
+            self.end_use()
+        return type_num, delta_base
+
+    def _convert_ofs_delta(self, unpacked):
+        if unpacked.pack_type_num == OFS_DELTA:
+            unpacked.pack_type_num = REF_DELTA
+            unpacked.delta_base = self.index.object_sha1(
+                unpacked.offset - unpacked.delta_base)
+
+    def _check_crc32(self, unpacked, expected):
+        """Check the CRC32 of an unpacked object against the index.
+
+        :raise ChecksumMismatch: if the CRC32 does not match
+        """
+        if expected is not None and unpacked.crc32 != expected:
+            raise ChecksumMismatch('%08x' % expected, '%08x' % unpacked.crc32,
+                                   'CRC32 of %s' % sha_to_hex(unpacked.sha()))
+
+    def get_raw_unresolved(self, sha1):
+        """Retrieve the compressed data of an object as stored in the pack.
+
+        The CRC32 of the packed data is verified against the index, if the
+        index stores it, so corrupt data is not propagated to other packs.
+
+        :param sha1: SHA1 of the object, as hex or binary string
+        :return: An UnpackedObject with pack_type_num, delta_base (None or a
+            binary SHA, see get_unpacked_object), decomp_len, comp_chunks and
+            crc32 set; the crc32 covers the data as it is stored in this pack.
+        :raise KeyError: if the object is not in this pack
+        :raise ChecksumMismatch: if the CRC32 does not match the index
+        """
+        self.begin_use()
+        try:
+            offset = self.index.object_index(sha1)
+            unpacked = self.data.get_unpacked_object_at(
+                offset, include_comp=True, compute_crc32=True)
+            if len(sha1) == 40:
+                sha1 = hex_to_sha(sha1)
+            unpacked._sha = sha1
+            self._check_crc32(unpacked, self.index.object_crc32(sha1))
+            self._convert_ofs_delta(unpacked)
+        finally:
+            self.end_use()
+        return unpacked
+
+    def iter_raw_entries(self):
+        """Iterate over the compressed data of all objects in this pack.
+
+        Objects are yielded in the order they are stored in, so the bases of
+        OFS_DELTA entries always come before the deltas. See
+        get_raw_unresolved for details on the yielded objects.
+
+        :return: Iterator over UnpackedObjects
+        """
+        self.begin_use()
+        try:
+            entries = sorted((offset, sha, crc32) for (sha, offset, crc32)
+                             in self.index.iterentries())
+        finally:
+            self.end_use()
+        for offset, sha, crc32 in entries:
+            self.begin_use()
+            try:
+                unpacked = self.data.get_unpacked_object_at(
+                    offset, include_comp=True, compute_crc32=True)
+                unpacked._sha = sha
+                self._check_crc32(unpacked, crc32)
+                self._convert_ofs_delta(unpacked)
+            finally:
+                self.end_use()
+            yield unpacked
+
     def iterobjects(self):
         """Iterate over the objects in this pack."""
-        return iter(PackInflater.for_pack_data(self.data))
+        self.begin_use()
+        try:
+            return _PackUseIterator(self, PackInflater.for_pack_data(self.data))
+        except:
+            self.end_use()
+            raise
 
     def pack_tuples(self):
         """Provide an iterable for use with write_pack_objects.
@@ -1854,6 +3447,10 @@ class Pack(object):
             def __iter__(self):
                 return ((o, None) for o in self.pack.iterobjects())
 
+            def iter_pack_records(self, window=10, depth=50, thin=False):
+                # Copy the compressed entries, including any deltas.
+                return self.pack.iter_raw_entries()
+
         return PackTupleIterable(self)
 
     def keep(self, msg=None):
@@ -1874,7 +3471,8 @@ class Pack(object):
         return keepfile_name
 
 
+_DeltaIndex_py = DeltaIndex
 try:
-    from dulwich._pack import apply_delta, bisect_find_sha
+    from dulwich._pack import apply_delta, bisect_find_sha, DeltaIndex
 except ImportError:
     pass
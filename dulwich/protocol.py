@@ -21,6 +21,7 @@
 
 from cStringIO import StringIO
 import socket
+import time
 
 from dulwich.errors import (
     HangupException,
@@ -65,6 +66,139 @@ def pkt_line(data):
     return '%04x%s' % (len(data) + 4, data)
 
 
+class ProtocolStats(object):
+    """Timing, traffic and object statistics for a protocol session.
+
+    The report_activity method can be passed as the report_activity callback
+    of a Protocol to count the bytes read and written. Phases are timed with
+    start_phase and end_phase; the time spent in a phase that is started
+    while another one is running is only counted for the inner phase. The
+    phases used by dulwich are 'advertise', 'negotiate', 'counting',
+    'compressing', 'writing', 'receiving' and 'indexing'.
+
+    :ivar bytes_read: Number of bytes read
+    :ivar bytes_written: Number of bytes written
+    :ivar timings: Dictionary mapping phase names to the total time spent in
+        them, in seconds
+    :ivar counts: Dictionary mapping names of counters, such as 'objects', to
+        their values
+    """
+
+    def __init__(self, phase_callback=None):
+        """Create a new ProtocolStats instance.
+
+        :param phase_callback: Optional function that is called with the name
+            of a phase and the time spent in it whenever a phase ends
+        """
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.timings = {}
+        self.counts = {}
+        self.phase_callback = phase_callback
+        # Running phases, as [name, start time, time spent in inner phases]
+        self._running = []
+
+    def report_activity(self, nbytes, direction):
+        """Count bytes read or written.
+
+        :param nbytes: Number of bytes
+        :param direction: 'read' or 'write'
+        """
+        if direction == 'read':
+            self.bytes_read += nbytes
+        else:
+            self.bytes_written += nbytes
+
+    def add_count(self, name, count=1):
+        """Increase a counter.
+
+        :param name: Name of the counter
+        :param count: Amount to increase it with
+        """
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def _add_inner_time(self, elapsed):
+        if self._running:
+            self._running[-1][2] += elapsed
+
+    def _add_timing(self, name, elapsed):
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+        if self.phase_callback is not None:
+            self.phase_callback(name, elapsed)
+
+    def start_phase(self, name):
+        """Start timing a phase.
+
+        :param name: Name of the phase
+        """
+        self._running.append([name, time.time(), 0.0])
+
+    def end_phase(self, name):
+        """Stop timing a phase.
+
+        Ending a phase that is not running does nothing.
+
+        :param name: Name of the phase
+        """
+        for i in range(len(self._running) - 1, -1, -1):
+            if self._running[i][0] == name:
+                break
+        else:
+            return
+        name, start, inner = self._running.pop(i)
+        total = time.time() - start
+        # Phases started within this one that were not ended are dropped.
+        del self._running[i:]
+        self._add_inner_time(total)
+        self._add_timing(name, total - inner)
+
+    def timed_iter(self, name, iterable):
+        """Time how long it takes to generate the items of an iterable.
+
+        :param name: Name of the phase to count the time as
+        :param iterable: Iterable to time
+        :return: Iterator over the items of iterable
+        """
+        it = iter(iterable)
+        elapsed = 0.0
+        while True:
+            start = time.time()
+            try:
+                item = it.next()
+            except StopIteration:
+                break
+            spent = time.time() - start
+            elapsed += spent
+            self._add_inner_time(spent)
+            yield item
+        self._add_timing(name, elapsed)
+
+    def __str__(self):
+        parts = ['read %d bytes, wrote %d bytes' % (self.bytes_read,
+                                                     self.bytes_written)]
+        for name, elapsed in sorted(self.timings.iteritems()):
+            parts.append('%s %.3fs' % (name, elapsed))
+        for name, count in sorted(self.counts.iteritems()):
+            parts.append('%d %s' % (count, name))
+        return ', '.join(parts)
+
+
+def report_reads(read, report_activity):
+    """Wrap a read function so that it reports the amount of data read.
+
+    :param read: Read function to wrap
+    :param report_activity: Activity callback, as taken by Protocol, or None
+    :return: Read function
+    """
+    if report_activity is None:
+        return read
+    def reporting_read(size):
+        data = read(size)
+        report_activity(len(data), 'read')
+        return data
+    return reporting_read
+
+
 class Protocol(object):
     """Class for interacting with a remote git process over the wire.
 
@@ -175,6 +309,8 @@ class Protocol(object):
             def write(self, data):
                 self._proto.write(data)
                 self._offset += len(data)
+                if self._proto.report_activity:
+                    self._proto.report_activity(len(data), 'write')
 
             def tell(self):
                 return self._offset
@@ -365,47 +501,78 @@ def ack_type(capabilities):
     return SINGLE_ACK
 
 
-class BufferedPktLineWriter(object):
-    """Writer that wraps its data in pkt-lines and has an independent buffer.
+class BufferedWriter(object):
+    """Writer that collects data into chunks of a fixed size.
 
-    Consecutive calls to write() wrap the data in a pkt-line and then buffers it
-    until enough lines have been written such that their total length (including
-    length prefix) reach the buffer size.
+    Consecutive calls to write() are buffered until the total length of the
+    data reaches the buffer size; the write callback is then called with
+    chunks of exactly that size. This is used to fill side-band frames rather
+    than sending a small frame for every write.
     """
 
     def __init__(self, write, bufsize=65515):
-        """Initialize the BufferedPktLineWriter.
+        """Initialize the BufferedWriter.
 
         :param write: A write callback for the underlying writer.
-        :param bufsize: The internal buffer size, including length prefixes.
+        :param bufsize: The size of the chunks passed to the write callback.
         """
         self._write = write
         self._bufsize = bufsize
-        self._wbuf = StringIO()
+        self._wbuf = []
         self._buflen = 0
+        self.bytes_written = 0
+        self.chunks_written = 0
+
+    def _write_chunk(self, chunk):
+        self._write(chunk)
+        self.bytes_written += len(chunk)
+        self.chunks_written += 1
 
     def write(self, data):
-        """Write data, wrapping it in a pkt-line."""
-        line = pkt_line(data)
-        line_len = len(line)
-        over = self._buflen + line_len - self._bufsize
-        if over >= 0:
-            start = line_len - over
-            self._wbuf.write(line[:start])
-            self.flush()
+        """Write data."""
+        self._wbuf.append(data)
+        self._buflen += len(data)
+        if self._buflen < self._bufsize:
+            return
+        bufsize = self._bufsize
+        buf = ''.join(self._wbuf)
+        end = len(buf) - (len(buf) % bufsize)
+        for start in xrange(0, end, bufsize):
+            self._write_chunk(buf[start:start+bufsize])
+        rest = buf[end:]
+        if rest:
+            self._wbuf = [rest]
         else:
-            start = 0
-        saved = line[start:]
-        self._wbuf.write(saved)
-        self._buflen += len(saved)
+            self._wbuf = []
+        self._buflen = len(rest)
 
     def flush(self):
         """Flush all data from the buffer."""
-        data = self._wbuf.getvalue()
-        if data:
-            self._write(data)
-        self._len = 0
-        self._wbuf = StringIO()
+        if self._buflen:
+            self._write_chunk(''.join(self._wbuf))
+        self._wbuf = []
+        self._buflen = 0
+
+
+class BufferedPktLineWriter(BufferedWriter):
+    """Writer that wraps its data in pkt-lines and has an independent buffer.
+
+    Consecutive calls to write() wrap the data in a pkt-line and then buffers it
+    until enough lines have been written such that their total length (including
+    length prefix) reach the buffer size.
+    """
+
+    def __init__(self, write, bufsize=65515):
+        """Initialize the BufferedPktLineWriter.
+
+        :param write: A write callback for the underlying writer.
+        :param bufsize: The internal buffer size, including length prefixes.
+        """
+        super(BufferedPktLineWriter, self).__init__(write, bufsize=bufsize)
+
+    def write(self, data):
+        """Write data, wrapping it in a pkt-line."""
+        super(BufferedPktLineWriter, self).write(pkt_line(data))
 
 
 class PktLineParser(object):
@@ -439,3 +606,84 @@ class PktLineParser(object):
     def get_tail(self):
         """Read back any unused data."""
         return self._readahead.getvalue()
+
+
+class SideBandReader(object):
+    """Reads the data on channel 1 of a side-band-64k stream.
+
+    Packets on other channels are handed off to callbacks as they are read,
+    so the data (usually a pack) can be read as a stream while progress
+    messages are still reported.
+    """
+
+    def __init__(self, proto, channel_callbacks):
+        """Create a new SideBandReader.
+
+        :param proto: Protocol object to read the pkt-lines from
+        :param channel_callbacks: Dictionary mapping channels other than 1
+            to packet handlers. None for a callback discards channel data.
+        """
+        self._proto = proto
+        self._channel_callbacks = channel_callbacks
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read packets up to the next one with data on channel 1.
+
+        :return: False if the end of the stream was reached first
+        """
+        while not self._eof:
+            pkt = self._proto.read_pkt_line()
+            if pkt is None:
+                self._eof = True
+                break
+            channel = ord(pkt[0])
+            if channel == 1:
+                self._buf = pkt
+                self._pos = 1
+                return True
+            try:
+                cb = self._channel_callbacks[channel]
+            except KeyError:
+                raise AssertionError('Invalid sideband channel %d' % channel)
+            else:
+                if cb is not None:
+                    cb(pkt[1:])
+        return False
+
+    def read_some(self, size):
+        """Read up to size bytes, blocking until at least one is available.
+
+        :return: The data read, or an empty string at the end of the stream
+        """
+        if self._pos >= len(self._buf) and not self._fill():
+            return ''
+        start = self._pos
+        self._pos = min(start + size, len(self._buf))
+        return self._buf[start:self._pos]
+
+    def read(self, size):
+        """Read size bytes, or less if the end of the stream is reached."""
+        chunks = []
+        while size > 0:
+            data = self.read_some(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def read_all_data(self):
+        """Read up to the end of the stream.
+
+        :return: The remaining data on channel 1
+        """
+        chunks = [self._buf[self._pos:]]
+        self._buf = ''
+        self._pos = 0
+        while self._fill():
+            chunks.append(self._buf[1:])
+            self._buf = ''
+        return ''.join(chunks)
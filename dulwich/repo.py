@@ -398,6 +398,8 @@ class DiskRefsContainer(RefsContainer):
         self.path = path
         self._packed_refs = None
         self._peeled_refs = None
+        # Inode, size and mtime of the packed-refs file that was read
+        self._packed_refs_stat = None
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
@@ -440,42 +442,59 @@ class DiskRefsContainer(RefsContainer):
             name = name.replace("/", os.path.sep)
         return os.path.join(self.path, name)
 
+    def _stat_packed_refs(self):
+        try:
+            st = os.stat(os.path.join(self.path, 'packed-refs'))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_ino, st.st_size, st.st_mtime)
+
     def get_packed_refs(self):
         """Get contents of the packed-refs file.
 
+        The contents are cached, and read again once the file has changed,
+        e.g. because git pack-refs was run.
+
         :return: Dictionary mapping ref names to SHA1s
 
         :note: Will return an empty dictionary when no packed-refs file is
             present.
         """
-        # TODO: invalidate the cache on repacking
-        if self._packed_refs is None:
-            # set both to empty because we want _peeled_refs to be
-            # None if and only if _packed_refs is also None.
-            self._packed_refs = {}
-            self._peeled_refs = {}
-            path = os.path.join(self.path, 'packed-refs')
-            try:
-                f = GitFile(path, 'rb')
-            except IOError, e:
-                if e.errno == errno.ENOENT:
-                    return {}
+        stat = self._stat_packed_refs()
+        if self._packed_refs is not None and stat == self._packed_refs_stat:
+            return self._packed_refs
+        # Read into new dictionaries, so that other threads never see
+        # partially read refs.
+        packed_refs = {}
+        peeled_refs = {}
+        path = os.path.join(self.path, 'packed-refs')
+        try:
+            f = GitFile(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
                 raise
+        else:
             try:
                 first_line = iter(f).next().rstrip()
                 if (first_line.startswith("# pack-refs") and " peeled" in
                         first_line):
                     for sha, name, peeled in read_packed_refs_with_peeled(f):
-                        self._packed_refs[name] = sha
+                        packed_refs[name] = sha
                         if peeled:
-                            self._peeled_refs[name] = peeled
+                            peeled_refs[name] = peeled
                 else:
                     f.seek(0)
                     for sha, name in read_packed_refs(f):
-                        self._packed_refs[name] = sha
+                        packed_refs[name] = sha
             finally:
                 f.close()
-        return self._packed_refs
+        # _peeled_refs is None if and only if _packed_refs is also None.
+        self._peeled_refs = peeled_refs
+        self._packed_refs = packed_refs
+        self._packed_refs_stat = stat
+        return packed_refs
 
     def get_peeled(self, name):
         """Return the cached peeled value of a ref, if available.
@@ -888,7 +907,18 @@ class BaseRepo(object):
     def get_config(self):
         import ConfigParser
         p = ConfigParser.RawConfigParser()
-        p.read(os.path.join(self._controldir, 'config'))
+        try:
+            f = open(os.path.join(self._controldir, 'config'), 'rb')
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            try:
+                # git indents options, which ConfigParser would take for
+                # continuation lines.
+                p.readfp(StringIO(''.join(l.lstrip() for l in f)))
+            finally:
+                f.close()
         return dict((section, dict(p.items(section)))
                     for section in p.sections())
 
@@ -1077,6 +1107,24 @@ class BaseRepo(object):
         return c.id
 
 
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
+def parse_config_size(value):
+    """Parse a size from a git config file, e.g. "96m".
+
+    :param value: Number with an optional k, m or g suffix
+    :return: The size in bytes
+    :raise ValueError: if the value is not a valid size
+    """
+    value = value.strip().lower()
+    factor = 1
+    if value and value[-1] in _SIZE_SUFFIXES:
+        factor = _SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+    return int(value) * factor
+
+
 class Repo(BaseRepo):
     """A git repository backed by local disk."""
 
@@ -1095,6 +1143,22 @@ class Repo(BaseRepo):
                                                     OBJECTDIR))
         refs = DiskRefsContainer(self.controldir())
         BaseRepo.__init__(self, object_store, refs)
+        self._apply_config()
+
+    def _apply_config(self):
+        """Apply the settings from the repository config that we support."""
+        import ConfigParser
+        try:
+            config = self.get_config()
+        except ConfigParser.Error:
+            return
+        limit = config.get('core', {}).get('deltabasecachelimit')
+        if limit is not None:
+            try:
+                limit = parse_config_size(limit)
+            except ValueError:
+                return
+            self.object_store.delta_base_cache.resize(limit)
 
     def controldir(self):
         """Return the path of the control directory."""
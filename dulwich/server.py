@@ -27,9 +27,16 @@ Documentation/technical directory in the cgit distribution, and in particular:
 
 
 import collections
+import errno
+import optparse
+import os
+import Queue
+import signal
 import socket
 import SocketServer
 import sys
+import threading
+import time
 import zlib
 
 from dulwich.errors import (
@@ -40,18 +47,29 @@ from dulwich.errors import (
     ObjectFormatException,
     )
 from dulwich import log_utils
+from dulwich.lru_cache import (
+    LRUCache,
+    )
 from dulwich.objects import (
     hex_to_sha,
     )
+from dulwich.object_store import (
+    PackHandleCache,
+    )
 from dulwich.pack import (
-    write_pack_objects,
+    DEFAULT_DELTA_BASE_CACHE_LIMIT,
+    DeltaBaseCache,
+    generate_pack_records,
+    write_pack_data,
     )
 from dulwich.protocol import (
     BufferedPktLineWriter,
+    BufferedWriter,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     Protocol,
     ProtocolFile,
+    ProtocolStats,
     ReceivableProtocol,
     SINGLE_ACK,
     TCP_GIT_PORT,
@@ -59,6 +77,7 @@ from dulwich.protocol import (
     ack_type,
     extract_capabilities,
     extract_want_line_capabilities,
+    report_reads,
     )
 from dulwich.repo import (
     Repo,
@@ -137,6 +156,75 @@ class FileSystemBackend(Backend):
         return Repo(path)
 
 
+class CachingBackend(FileSystemBackend):
+    """Backend that keeps repositories open between requests.
+
+    Opening a repository for every request means its packs have to be found
+    and their indexes loaded again each time, and that the caches of the
+    packs start out empty. This backend keeps the most recently used
+    repositories open instead. The packs of all of them share a
+    PackHandleCache, which limits the number of packs with open files and
+    the total size of their mapped indexes, and a DeltaBaseCache, which
+    limits the memory used for resolved objects.
+
+    The repositories are shared by all requests, so they must not be changed
+    other than through the object store and refs. Refs are read from disk
+    for each request, so changes made by other processes are seen.
+    """
+
+    def __init__(self, max_repos=100, max_open_packs=256,
+                 max_mapped_size=512*1024*1024,
+                 delta_base_cache_limit=DEFAULT_DELTA_BASE_CACHE_LIMIT):
+        """Create a new CachingBackend.
+
+        :param max_repos: Maximum number of repositories to keep open
+        :param max_open_packs: Maximum number of packs with open files
+        :param max_mapped_size: Maximum number of bytes in mapped pack
+            indexes and pack data
+        :param delta_base_cache_limit: Maximum number of bytes of resolved
+            objects to cache for all repositories together. This takes the
+            place of core.deltaBaseCacheLimit in the repositories.
+        """
+        self._lock = threading.Lock()
+        self._repos = LRUCache(max_repos)
+        self.pack_handle_cache = PackHandleCache(
+            max_open_packs=max_open_packs, max_mapped_size=max_mapped_size)
+        self.delta_base_cache = DeltaBaseCache(delta_base_cache_limit)
+
+    def _close_repository(self, path, repo):
+        repo.object_store.close()
+
+    def open_repository(self, path):
+        self._lock.acquire()
+        try:
+            repo = self._repos.get(path)
+            if repo is not None and os.path.isdir(repo.controldir()):
+                return repo
+            repo = FileSystemBackend.open_repository(self, path)
+            repo.object_store.pack_handle_cache = self.pack_handle_cache
+            repo.object_store.delta_base_cache = self.delta_base_cache
+            self._repos.add(path, repo, cleanup=self._close_repository)
+            return repo
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close all cached repositories."""
+        self._lock.acquire()
+        try:
+            self._repos.clear()
+        finally:
+            self._lock.release()
+
+
+def _chain_report_activity(*callbacks):
+    """Combine activity callbacks, as taken by Protocol, into one."""
+    def report_activity(nbytes, direction):
+        for callback in callbacks:
+            callback(nbytes, direction)
+    return report_activity
+
+
 class Handler(object):
     """Smart protocol command handler base class."""
 
@@ -145,6 +233,15 @@ class Handler(object):
         self.proto = proto
         self.http_req = http_req
         self._client_capabilities = None
+        # Statistics for this request, which servers can log once it has been
+        # handled.
+        self.stats = ProtocolStats()
+        report_activity = getattr(proto, 'report_activity', False)
+        if report_activity is None:
+            proto.report_activity = self.stats.report_activity
+        elif report_activity is not False:
+            proto.report_activity = _chain_report_activity(
+                report_activity, self.stats.report_activity)
 
     @classmethod
     def capability_line(cls):
@@ -187,12 +284,19 @@ class Handler(object):
 class UploadPackHandler(Handler):
     """Protocol handler for uploading a pack to the server."""
 
+    # Number of bytes of pack data to collect before sending it; the default
+    # fills a side-band-64k frame.
+    pack_bufsize = 65515
+
     def __init__(self, backend, args, proto, http_req=None,
                  advertise_refs=False):
         Handler.__init__(self, backend, proto, http_req=http_req)
         self.repo = backend.open_repository(args[0])
         self._graph_walker = None
         self.advertise_refs = advertise_refs
+        # BufferedWriter used for the pack data, which keeps track of the
+        # number of bytes and frames sent.
+        self.pack_writer = None
 
     @classmethod
     def capabilities(cls):
@@ -238,25 +342,46 @@ class UploadPackHandler(Handler):
         return tagged
 
     def handle(self):
-        write = lambda x: self.proto.write_sideband(1, x)
-
         graph_walker = ProtocolGraphWalker(self, self.repo.object_store,
             self.repo.get_peeled)
         objects_iter = self.repo.fetch_objects(
           graph_walker.determine_wants, graph_walker, self.progress,
           get_tagged=self.get_tagged)
+        # Started by the graph walker once the refs have been advertised.
+        self.stats.end_phase('negotiate')
 
         # Did the process short-circuit (e.g. in a stateless RPC call)? Note
         # that the client still expects a 0-object pack in most cases.
         if objects_iter is None:
             return
+        self.send_pack(objects_iter)
+
+    def send_pack(self, objects_iter):
+        """Send a pack to the client once the negotiation is done.
 
+        :param objects_iter: Iterator over the objects to send, with
+            __len__ implemented
+        """
+        write = lambda x: self.proto.write_sideband(1, x)
+        self.pack_writer = BufferedWriter(write, bufsize=self.pack_bufsize)
         self.progress("dul-daemon says what\n")
-        self.progress("counting objects: %d, done.\n" % len(objects_iter))
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
+        self.stats.start_phase('counting')
+        num_objects = len(objects_iter)
+        self.stats.end_phase('counting')
+        self.stats.add_count('objects', num_objects)
+        self.progress("counting objects: %d, done.\n" % num_objects)
+        # Time spent on searching for deltas is counted as compressing, the
+        # rest as writing.
+        self.stats.start_phase('writing')
+        records = self.stats.timed_iter('compressing', generate_pack_records(
+            objects_iter, thin=self.has_capability("thin-pack")))
+        write_pack_data(ProtocolFile(None, self.pack_writer.write),
+                        num_objects, records)
+        self.pack_writer.flush()
+        self.stats.end_phase('writing')
         self.progress("how was that, then?\n")
         # we are done
-        self.proto.write("0000")
+        self.proto.write_pkt_line(None)
 
 
 def _split_proto_line(line, allowed):
@@ -335,24 +460,52 @@ class ProtocolGraphWalker(object):
             # The repo is empty, so short-circuit the whole process.
             self.proto.write_pkt_line(None)
             return None
-        values = set(heads.itervalues())
         if self.advertise_refs or not self.http_req:
-            for i, (ref, sha) in enumerate(sorted(heads.iteritems())):
-                line = "%s %s" % (sha, ref)
-                if not i:
-                    line = "%s\x00%s" % (line, self.handler.capability_line())
-                self.proto.write_pkt_line("%s\n" % line)
-                peeled_sha = self.get_peeled(ref)
-                if peeled_sha != sha:
-                    self.proto.write_pkt_line('%s %s^{}\n' %
-                                              (peeled_sha, ref))
-
-            # i'm done..
-            self.proto.write_pkt_line(None)
-
+            self.send_refs(heads)
             if self.advertise_refs:
                 return None
 
+        self.handler.stats.start_phase('negotiate')
+        want_revs = self.read_wants(heads)
+
+        if self.http_req and self.proto.eof():
+            # The client may close the socket at this point, expecting a
+            # flush-pkt from the server. We might be ready to send a packfile at
+            # this point, so we need to explicitly short-circuit in this case.
+            return None
+
+        return want_revs
+
+    def send_refs(self, heads):
+        """Advertise a set of heads to the client.
+
+        :param heads: a dict of refname->SHA1 to advertise
+        """
+        stats = self.handler.stats
+        stats.start_phase('advertise')
+        for i, (ref, sha) in enumerate(sorted(heads.iteritems())):
+            line = "%s %s" % (sha, ref)
+            if not i:
+                line = "%s\x00%s" % (line, self.handler.capability_line())
+            self.proto.write_pkt_line("%s\n" % line)
+            peeled_sha = self.get_peeled(ref)
+            if peeled_sha != sha:
+                self.proto.write_pkt_line('%s %s^{}\n' % (peeled_sha, ref))
+
+        # i'm done..
+        self.proto.write_pkt_line(None)
+        stats.end_phase('advertise')
+
+    def read_wants(self, heads):
+        """Read the want lines of the client, up to the flush-pkt.
+
+        The first want line also sets the client capabilities and the ack
+        type.
+
+        :param heads: a dict of refname->SHA1 that were advertised
+        :return: a list of SHA1s requested by the client
+        """
+        values = set(heads.itervalues())
         # Now client will sending want want want commands
         want = self.proto.read_pkt_line()
         if not want:
@@ -372,13 +525,7 @@ class ProtocolGraphWalker(object):
             command, sha = self.read_proto_line(allowed)
 
         self.set_wants(want_revs)
-
-        if self.http_req and self.proto.eof():
-            # The client may close the socket at this point, expecting a
-            # flush-pkt from the server. We might be ready to send a packfile at
-            # this point, so we need to explicitly short-circuit in this case.
-            return None
-
+        self.handler.stats.add_count('wants', len(want_revs))
         return want_revs
 
     def ack(self, have_ref):
@@ -392,12 +539,32 @@ class ProtocolGraphWalker(object):
         if not self._cached:
             if not self._impl and self.http_req:
                 return None
-            return self._impl.next()
+            have = self._impl.next()
+            if have is not None:
+                self.handler.stats.add_count('haves')
+            return have
         self._cache_index += 1
         if self._cache_index > len(self._cache):
             return None
         return self._cache[self._cache_index]
 
+    def handle_line(self, line):
+        """Handle a line the client sent after its wants.
+
+        Unlike next(), this doesn't read from the wire, so it can be used by
+        servers that read the lines of the client themselves.
+
+        :param line: The line, or None for a flush-pkt
+        :return: A tuple of (done, have): done is True once the negotiation
+            is finished, have is the SHA1 the client has if the line was a
+            have line and None otherwise.
+        """
+        command, sha = _split_proto_line(line, _GRAPH_WALKER_COMMANDS)
+        done, have = self._impl.handle_line(command, sha)
+        if have is not None:
+            self.handler.stats.add_count('haves')
+        return done, have
+
     def read_proto_line(self, allowed):
         """Read a line from the wire.
 
@@ -430,20 +597,20 @@ class ProtocolGraphWalker(object):
             terminated, presumably because we're searching too far down the
             wrong branch.
         """
-        o = self.store[want]
-        pending = collections.deque([o])
+        if want in haves:
+            return True
+        if self.store[want].type_name != "commit":
+            # non-commit wants have no ancestors to search for haves
+            return False
+        pending = collections.deque([want])
         while pending:
-            commit = pending.popleft()
-            if commit.id in haves:
+            commit_id = pending.popleft()
+            if commit_id in haves:
                 return True
-            if commit.type_name != "commit":
-                # non-commit wants are assumed to be satisfied
-                continue
-            for parent in commit.parents:
-                parent_obj = self.store[parent]
+            for parent in self.store.get_parents(commit_id):
                 # TODO: handle parents with later commit times than children
-                if parent_obj.commit_time >= earliest:
-                    pending.append(parent_obj)
+                if self.store.get_commit_time(parent) >= earliest:
+                    pending.append(parent)
         return False
 
     def all_wants_satisfied(self, haves):
@@ -454,7 +621,7 @@ class ProtocolGraphWalker(object):
             in the current interface they are determined outside this class.
         """
         haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
+        earliest = min([self.store.get_commit_time(h) for h in haves])
         for want in self._wants:
             if not self._is_satisfied(haves, want, earliest):
                 return False
@@ -472,7 +639,31 @@ class ProtocolGraphWalker(object):
 _GRAPH_WALKER_COMMANDS = ('have', 'done', None)
 
 
-class SingleAckGraphWalkerImpl(object):
+class GraphWalkerImpl(object):
+    """Base class for graph walker implementations of an ack protocol.
+
+    Subclasses implement handle_line, which decides how to answer a single
+    line of the client.
+    """
+
+    def handle_line(self, command, sha):
+        """Handle a line of the client.
+
+        :param command: 'have', 'done' or None for a flush-pkt
+        :param sha: SHA1 of a have line, or None
+        :return: A tuple of (done, have); see ProtocolGraphWalker.handle_line
+        """
+        raise NotImplementedError(self.handle_line)
+
+    def next(self):
+        while True:
+            command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
+            done, have = self.handle_line(command, sha)
+            if done or have is not None:
+                return have
+
+
+class SingleAckGraphWalkerImpl(GraphWalkerImpl):
     """Graph walker implementation that speaks the single-ack protocol."""
 
     def __init__(self, walker):
@@ -484,17 +675,16 @@ class SingleAckGraphWalkerImpl(object):
             self.walker.send_ack(have_ref)
             self._sent_ack = True
 
-    def next(self):
-        command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
+    def handle_line(self, command, sha):
         if command in (None, 'done'):
             if not self._sent_ack:
                 self.walker.send_nak()
-            return None
+            return True, None
         elif command == 'have':
-            return sha
+            return False, sha
 
 
-class MultiAckGraphWalkerImpl(object):
+class MultiAckGraphWalkerImpl(GraphWalkerImpl):
     """Graph walker implementation that speaks the multi-ack protocol."""
 
     def __init__(self, walker):
@@ -510,30 +700,28 @@ class MultiAckGraphWalkerImpl(object):
                 self._found_base = True
         # else we blind ack within next
 
-    def next(self):
-        while True:
-            command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
-            if command is None:
+    def handle_line(self, command, sha):
+        if command is None:
+            self.walker.send_nak()
+            # in multi-ack mode, a flush-pkt indicates the client wants to
+            # flush but more have lines are still coming
+            return False, None
+        elif command == 'done':
+            # don't nak unless no common commits were found, even if not
+            # everything is satisfied
+            if self._common:
+                self.walker.send_ack(self._common[-1])
+            else:
                 self.walker.send_nak()
-                # in multi-ack mode, a flush-pkt indicates the client wants to
-                # flush but more have lines are still coming
-                continue
-            elif command == 'done':
-                # don't nak unless no common commits were found, even if not
-                # everything is satisfied
-                if self._common:
-                    self.walker.send_ack(self._common[-1])
-                else:
-                    self.walker.send_nak()
-                return None
-            elif command == 'have':
-                if self._found_base:
-                    # blind ack
-                    self.walker.send_ack(sha, 'continue')
-                return sha
+            return True, None
+        elif command == 'have':
+            if self._found_base:
+                # blind ack
+                self.walker.send_ack(sha, 'continue')
+            return False, sha
 
 
-class MultiAckDetailedGraphWalkerImpl(object):
+class MultiAckDetailedGraphWalkerImpl(GraphWalkerImpl):
     """Graph walker implementation speaking the multi-ack-detailed protocol."""
 
     def __init__(self, walker):
@@ -550,28 +738,24 @@ class MultiAckDetailedGraphWalkerImpl(object):
                 self.walker.send_ack(have_ref, 'ready')
         # else we blind ack within next
 
-    def next(self):
-        while True:
-            command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
-            if command is None:
+    def handle_line(self, command, sha):
+        if command is None:
+            self.walker.send_nak()
+            return bool(self.walker.http_req), None
+        elif command == 'done':
+            # don't nak unless no common commits were found, even if not
+            # everything is satisfied
+            if self._common:
+                self.walker.send_ack(self._common[-1])
+            else:
                 self.walker.send_nak()
-                if self.walker.http_req:
-                    return None
-                continue
-            elif command == 'done':
-                # don't nak unless no common commits were found, even if not
-                # everything is satisfied
-                if self._common:
-                    self.walker.send_ack(self._common[-1])
-                else:
-                    self.walker.send_nak()
-                return None
-            elif command == 'have':
-                if self._found_base:
-                    # blind ack; can happen if the client has more requests
-                    # inflight
-                    self.walker.send_ack(sha, 'ready')
-                return sha
+            return True, None
+        elif command == 'have':
+            if self._found_base:
+                # blind ack; can happen if the client has more requests
+                # inflight
+                self.walker.send_ack(sha, 'ready')
+            return False, sha
 
 
 class ReceivePackHandler(Handler):
@@ -593,14 +777,20 @@ class ReceivePackHandler(Handler):
                           ObjectFormatException)
         status = []
         # TODO: more informative error messages than just the exception string
+        self.stats.start_phase('indexing')
         try:
-            p = self.repo.object_store.add_thin_pack(self.proto.read,
-                                                     self.proto.recv)
+            report_activity = self.proto.report_activity
+            p = self.repo.object_store.add_thin_pack(
+                report_reads(self.proto.read, report_activity),
+                report_reads(self.proto.recv, report_activity))
             status.append(('unpack', 'ok'))
+            if p is not None:
+                self.stats.add_count('objects', len(p))
         except all_exceptions, e:
             status.append(('unpack', str(e).replace('\n', '')))
             # The pack may still have been moved in, but it may contain broken
             # objects. We trust a later GC to clean it up.
+        self.stats.end_phase('indexing')
 
         for oldsha, sha, ref in refs:
             ref_status = 'ok'
@@ -652,6 +842,7 @@ class ReceivePackHandler(Handler):
         refs = sorted(self.repo.get_refs().iteritems())
 
         if self.advertise_refs or not self.http_req:
+            self.stats.start_phase('advertise')
             if refs:
                 self.proto.write_pkt_line(
                   "%s %s\x00%s\n" % (refs[0][1], refs[0][0],
@@ -663,7 +854,8 @@ class ReceivePackHandler(Handler):
                 self.proto.write_pkt_line("%s capabilities^{}\0%s" % (
                   ZERO_SHA, self.capability_line()))
 
-            self.proto.write("0000")
+            self.proto.write_pkt_line(None)
+            self.stats.end_phase('advertise')
             if self.advertise_refs:
                 return
 
@@ -704,6 +896,10 @@ class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
         self.handlers = handlers
         SocketServer.StreamRequestHandler.__init__(self, *args, **kwargs)
 
+    def setup(self):
+        self.timeout = self.server.connection_timeout
+        SocketServer.StreamRequestHandler.setup(self)
+
     def handle(self):
         proto = ReceivableProtocol(self.connection.recv, self.wfile.write)
         command, args = proto.read_cmd()
@@ -714,9 +910,15 @@ class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
             raise GitProtocolError('Invalid service %s' % command)
         h = cls(self.server.backend, args, proto)
         h.handle()
+        stats = getattr(h, 'stats', None)
+        if stats is not None:
+            logger.info('Handled %s request: %s', command, stats)
 
 
 class TCPGitServer(SocketServer.TCPServer):
+    """Git server for the git:// protocol that handles one connection at a
+    time.
+    """
 
     allow_reuse_address = True
     serve = SocketServer.TCPServer.serve_forever
@@ -724,11 +926,23 @@ class TCPGitServer(SocketServer.TCPServer):
     def _make_handler(self, *args, **kwargs):
         return TCPGitRequestHandler(self.handlers, *args, **kwargs)
 
-    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None):
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 connection_timeout=None):
+        """Create a new TCPGitServer.
+
+        :param backend: Backend to serve repositories from
+        :param listen_addr: Address to listen on
+        :param port: Port to listen on
+        :param handlers: Optional dict of command names to handler classes,
+            in addition to the default handlers
+        :param connection_timeout: Optional timeout in seconds for socket
+            operations on connections
+        """
         self.handlers = dict(DEFAULT_HANDLERS)
         if handlers is not None:
             self.handlers.update(handlers)
         self.backend = backend
+        self.connection_timeout = connection_timeout
         logger.info('Listening for TCP connections on %s:%d', listen_addr, port)
         SocketServer.TCPServer.__init__(self, (listen_addr, port),
                                         self._make_handler)
@@ -741,17 +955,225 @@ class TCPGitServer(SocketServer.TCPServer):
         logger.exception('Exception happened during processing of request '
                          'from %s', client_address)
 
+    def _handle_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        if getattr(self, 'shutdown_request', None) is not None:
+            self.shutdown_request(request)
+        else:
+            self.close_request(request)
+
+
+class ThreadedTCPGitServer(TCPGitServer):
+    """TCPGitServer that handles connections in a pool of worker threads.
+
+    At most as many connections as there are workers are handled at the same
+    time. Accepted connections wait in a queue until a worker is available;
+    once max_queued connections are waiting, no new connections are accepted
+    until a worker becomes available.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 connection_timeout=None, workers=10, max_queued=None):
+        """Create a new ThreadedTCPGitServer.
+
+        :param workers: Number of worker threads
+        :param max_queued: Maximum number of accepted connections waiting for
+            a worker; defaults to the number of workers
+        :see: TCPGitServer.__init__ for the other parameters
+        """
+        TCPGitServer.__init__(self, backend, listen_addr, port=port,
+                              handlers=handlers,
+                              connection_timeout=connection_timeout)
+        if max_queued is None:
+            max_queued = workers
+        self._requests = Queue.Queue(max_queued)
+        self._workers = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._workers.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            self._handle_connection(*item)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        TCPGitServer.server_close(self)
+        for thread in self._workers:
+            self._requests.put(None)
+        self._workers = []
+
+
+class PreforkingTCPGitServer(TCPGitServer):
+    """TCPGitServer that handles connections in pre-forked worker processes.
+
+    Each worker process accepts connections on the shared listening socket
+    and handles them one at a time, so at most as many connections as there
+    are workers are handled at the same time. Other connections wait in the
+    listen backlog. Workers that exit are replaced.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 connection_timeout=None, workers=4):
+        """Create a new PreforkingTCPGitServer.
+
+        :param workers: Number of worker processes
+        :see: TCPGitServer.__init__ for the other parameters
+        """
+        TCPGitServer.__init__(self, backend, listen_addr, port=port,
+                              handlers=handlers,
+                              connection_timeout=connection_timeout)
+        self.workers = workers
+        self._pids = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def _spawn_worker(self, poll_interval):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                try:
+                    TCPGitServer.serve_forever(self, poll_interval)
+                except:
+                    logger.exception('Worker process failed')
+            finally:
+                os._exit(1)
+        self._pids.add(pid)
+
+    def start_workers(self, poll_interval=0.5):
+        """Start worker processes until there are enough of them.
+
+        This is called by serve_forever, but can be called before to start
+        the initial workers before any other threads or child processes are
+        started, so that the workers do not inherit their state.
+
+        :param poll_interval: Interval in seconds at which workers check for
+            shutdown
+        """
+        self._lock.acquire()
+        try:
+            if self._stopping:
+                return
+            while len(self._pids) < self.workers:
+                self._spawn_worker(poll_interval)
+        finally:
+            self._lock.release()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the worker processes and replace them when they exit.
+
+        This returns once shutdown has been called.
+
+        :param poll_interval: Interval in seconds at which to check whether
+            worker processes have exited
+        """
+        self._stopped.clear()
+        try:
+            while not self._stopping:
+                self.start_workers(poll_interval)
+                self._reap_workers(os.WNOHANG)
+                time.sleep(poll_interval)
+            self._reap_workers(0)
+        finally:
+            self._stopped.set()
+
+    def _reap_workers(self, options):
+        # Only wait for the worker processes, so that other child processes
+        # of this process are left alone.
+        for pid in list(self._pids):
+            try:
+                reaped, status = os.waitpid(pid, options)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                reaped = pid
+            if reaped == pid:
+                self._pids.discard(pid)
+
+    serve = serve_forever
+
+    def shutdown(self):
+        """Stop the worker processes and the serve_forever loop.
+
+        Blocks until all worker processes have exited.
+        """
+        self._lock.acquire()
+        try:
+            self._stopping = True
+            for pid in self._pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        raise
+        finally:
+            self._lock.release()
+        self._stopped.wait()
+        self._reap_workers(0)
+
 
 def main(argv=sys.argv):
     """Entry point for starting a TCP git server."""
-    if len(argv) > 1:
-        gitdir = argv[1]
+    parser = optparse.OptionParser(usage='usage: %prog [options] [GITDIR]')
+    parser.add_option('-l', '--listen-address', dest='listen_address',
+                      default='localhost', help='Address to listen on')
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      default=TCP_GIT_PORT, help='Port to listen on')
+    parser.add_option('--mode', dest='mode', default='single',
+                      type='choice',
+                      choices=['single', 'threaded', 'fork', 'async'],
+                      help='How to handle connections concurrently: single, '
+                           'threaded, fork (pre-forked processes) or async '
+                           '(event loop)')
+    parser.add_option('--workers', dest='workers', type='int', default=4,
+                      help='Number of worker threads or processes, and thus '
+                           'the maximum number of concurrent connections; '
+                           'in async mode, the maximum number of packs '
+                           'sent at the same time')
+    parser.add_option('--max-queued', dest='max_queued', type='int',
+                      default=None, help='Maximum number of accepted '
+                      'connections waiting for a worker thread')
+    parser.add_option('--timeout', dest='timeout', type='float',
+                      default=None, help='Timeout in seconds for socket '
+                      'operations on connections')
+    options, args = parser.parse_args(argv[1:])
+    if args:
+        gitdir = args[0]
     else:
         gitdir = '.'
 
     log_utils.default_logging_config()
     backend = DictBackend({'/': Repo(gitdir)})
-    server = TCPGitServer(backend, 'localhost')
+    kwargs = {'connection_timeout': options.timeout}
+    if options.mode == 'threaded':
+        server_cls = ThreadedTCPGitServer
+        kwargs['workers'] = options.workers
+        kwargs['max_queued'] = options.max_queued
+    elif options.mode == 'fork':
+        server_cls = PreforkingTCPGitServer
+        kwargs['workers'] = options.workers
+    elif options.mode == 'async':
+        from dulwich.async_transport import AsyncTCPGitServer
+        server_cls = AsyncTCPGitServer
+        kwargs['workers'] = options.workers
+    else:
+        server_cls = TCPGitServer
+    server = server_cls(backend, options.listen_address, options.port,
+                        **kwargs)
     server.serve_forever()
 
 
@@ -73,11 +73,15 @@ class BlackboxTestCase(TestCase):
 
 def self_test_suite():
     names = [
+        'async_transport',
+        'bitmap',
         'blackbox',
         'client',
+        'commit_graph',
         'diff_tree',
         'fastexport',
         'file',
+        'graph',
         'index',
         'lru_cache',
         'objects',
@@ -23,7 +23,9 @@ import unittest
 
 def test_suite():
     names = [
+        'bitmap',
         'client',
+        'commit_graph',
         'pack',
         'repository',
         'server',
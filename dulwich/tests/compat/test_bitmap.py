@@ -0,0 +1,73 @@
+# test_bitmap.py -- Compatibility tests for pack bitmap indexes
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for pack bitmap indexes."""
+
+import os
+import shutil
+
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.compat.utils import (
+    import_repo_to_dir,
+    require_git_version,
+    run_git_or_fail,
+    )
+
+
+class PackBitmapTests(TestCase):
+    """Compatibility tests for reading and writing pack bitmap indexes."""
+
+    def setUp(self):
+        require_git_version((1, 8, 4))
+        TestCase.setUp(self)
+        self._repo_dir = import_repo_to_dir('server_new.export')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self._repo_dir))
+
+    def repack(self, *args):
+        run_git_or_fail(['repack', '-a', '-d', '-q'] + list(args),
+                        cwd=self._repo_dir)
+        return Repo(self._repo_dir)
+
+    def test_git_reads_dulwich_bitmap(self):
+        repo = self.repack()
+        pack, = repo.object_store.packs
+        heads = repo.refs.as_dict('refs/heads').values()
+        repo.object_store.write_pack_bitmap(pack, heads)
+        output = run_git_or_fail(['rev-list', '--test-bitmap', 'master'],
+                                 cwd=self._repo_dir)
+        self.assertTrue('OK!' in output)
+
+    def test_dulwich_reads_git_bitmap(self):
+        repo = self.repack('-b')
+        store = repo.object_store
+        bitmap = store._get_pack_bitmap()
+        self.assertTrue(bitmap is not None)
+        bitmap.check()
+        head = repo.head()
+        parent = store[head].parents[0]
+        missing = set(sha for sha, path in
+                      store.find_missing_objects([parent], [head]))
+        output = run_git_or_fail(['rev-list', '--objects', head, '^' + parent],
+                                 cwd=self._repo_dir)
+        self.assertEqual(set(line[:40] for line in output.splitlines()),
+                         missing)
@@ -40,6 +40,10 @@ from dulwich import (
     objects,
     repo,
     )
+from dulwich.async_transport import (
+    AsyncTCPGitClient,
+    EventLoop,
+    )
 from dulwich.tests import (
     SkipTest,
     )
@@ -231,6 +235,19 @@ class DulwichTCPClientTest(CompatTestCase, DulwichClientTestBase):
         return path
 
 
+class DulwichAsyncTCPClientTest(DulwichTCPClientTest):
+
+    def _client(self):
+        return AsyncTCPGitClient('localhost', loop=self._loop)
+
+    def setUp(self):
+        DulwichTCPClientTest.setUp(self)
+        self._loop = EventLoop()
+        loop_thread = self._loop.start()
+        self.addCleanup(loop_thread.join)
+        self.addCleanup(self._loop.stop)
+
+
 class TestSSHVendor(object):
     @staticmethod
     def connect_ssh(host, command, username=None, port=None):
@@ -0,0 +1,66 @@
+# test_commit_graph.py -- Compatibility tests for commit graph files
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for commit graph files."""
+
+import os
+import shutil
+
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.compat.utils import (
+    import_repo_to_dir,
+    require_git_version,
+    run_git_or_fail,
+    )
+
+
+class CommitGraphTests(TestCase):
+    """Compatibility tests for reading and writing commit graph files."""
+
+    def setUp(self):
+        require_git_version((2, 18, 0))
+        TestCase.setUp(self)
+        self._repo_dir = import_repo_to_dir('server_new.export')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self._repo_dir))
+        self._repo = Repo(self._repo_dir)
+        self._heads = self._repo.refs.as_dict('refs/heads').values()
+
+    def test_git_reads_dulwich_commit_graph(self):
+        self._repo.object_store.write_commit_graph(self._heads)
+        run_git_or_fail(['commit-graph', 'verify'], cwd=self._repo_dir)
+
+    def test_dulwich_reads_git_commit_graph(self):
+        run_git_or_fail(['commit-graph', 'write', '--reachable'],
+                        cwd=self._repo_dir)
+        store = self._repo.object_store
+        graph = store._get_commit_graph()
+        graph.check()
+        output = run_git_or_fail(['rev-list', '--all'], cwd=self._repo_dir)
+        commit_ids = output.split()
+        self.assertEqual(sorted(commit_ids), list(graph))
+        for commit_id in commit_ids:
+            commit = store[commit_id]
+            self.assertEqual(commit.parents, graph.get_parents(commit_id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit_id))
+            self.assertEqual(commit.tree, graph.get_tree(commit_id))
@@ -25,6 +25,12 @@ import os
 import shutil
 import tempfile
 
+from dulwich.object_store import (
+    DiskObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    )
 from dulwich.pack import (
     write_pack,
     )
@@ -32,6 +38,9 @@ from dulwich.tests.test_pack import (
     pack1_sha,
     PackTests,
     )
+from dulwich.tests import (
+    TestCase,
+    )
 from dulwich.tests.compat.utils import (
     require_git_version,
     run_git_or_fail,
@@ -67,3 +76,45 @@ class TestPack(PackTests):
             pack_shas.add(sha)
         orig_shas = set(o.id for o in origpack.iterobjects())
         self.assertEquals(orig_shas, pack_shas)
+
+    def test_deltas(self):
+        text = ''.join(['line %d\n' % i for i in range(100)])
+        blobs = [Blob.from_string(text + 'x' * i) for i in range(10)]
+        pack_path = os.path.join(self._tempdir, "Elch")
+        write_pack(pack_path, [(b, None) for b in blobs])
+        output = run_git_or_fail(['verify-pack', '-v', pack_path])
+        self.assertTrue('chain length = 1: ' in output)
+        pack_shas = set(line[:40] for line in output.splitlines()
+                        if line[41:45] == 'blob')
+        self.assertEquals(set(b.id for b in blobs), pack_shas)
+
+
+class TestMultiPackIndex(TestCase):
+    """Compatibility tests for multi-pack-index files."""
+
+    def setUp(self):
+        require_git_version((2, 21, 0))
+        TestCase.setUp(self)
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        run_git_or_fail(['init', '--quiet', '--bare', self._tempdir])
+        self.store = DiskObjectStore(os.path.join(self._tempdir, 'objects'))
+        self.blobs = []
+        for i in range(3):
+            blobs = [Blob.from_string('blob %d-%d' % (i, j))
+                     for j in range(5)]
+            self.store.add_objects([(b, None) for b in blobs])
+            self.blobs.extend(blobs)
+
+    def test_verify(self):
+        self.store.write_multi_pack_index()
+        run_git_or_fail(['multi-pack-index', 'verify'], cwd=self._tempdir)
+
+    def test_read_git_written(self):
+        run_git_or_fail(['multi-pack-index', 'write'], cwd=self._tempdir)
+        store = DiskObjectStore(self.store.path)
+        self.assertEqual(3, len(store.packs))
+        self.assertEqual(len(self.blobs), len(store._midx))
+        self.assertEqual([], list(store._iter_uncovered_packs()))
+        for blob in self.blobs:
+            self.assertEqual(blob, store[blob.id])
@@ -26,9 +26,14 @@ Warning: these tests should be fairly stable, but when writing/debugging new
 
 import threading
 
+from dulwich.async_transport import (
+    AsyncTCPGitServer,
+    )
 from dulwich.server import (
     DictBackend,
+    PreforkingTCPGitServer,
     TCPGitServer,
+    ThreadedTCPGitServer,
     )
 from dulwich.tests.compat.server_utils import (
     ServerTests,
@@ -70,10 +75,14 @@ class GitServerTestCase(ServerTests, CompatTestCase):
         caps = receive_pack_handler_cls.capabilities()
         self.assertFalse('side-band-64k' in caps)
 
+    server_cls = TCPGitServer
+    server_kwargs = {}
+
     def _start_server(self, repo):
         backend = DictBackend({'/': repo})
-        dul_server = TCPGitServer(backend, 'localhost', 0,
-                                  handlers=self._handlers())
+        dul_server = self.server_cls(backend, 'localhost', 0,
+                                     handlers=self._handlers(),
+                                     **self.server_kwargs)
         self._check_server(dul_server)
         self.addCleanup(dul_server.shutdown)
         threading.Thread(target=dul_server.serve).start()
@@ -95,3 +104,31 @@ class GitServerSideBand64kTestCase(GitServerTestCase):
         receive_pack_handler_cls = server.handlers['git-receive-pack']
         caps = receive_pack_handler_cls.capabilities()
         self.assertTrue('side-band-64k' in caps)
+
+
+class ThreadedGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with a threaded server."""
+
+    server_cls = ThreadedTCPGitServer
+    server_kwargs = {'workers': 2, 'connection_timeout': 30}
+
+
+class PreforkingGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with a pre-forking server."""
+
+    server_cls = PreforkingTCPGitServer
+    server_kwargs = {'workers': 2, 'connection_timeout': 30}
+
+    def _check_server(self, server):
+        GitServerSideBand64kTestCase._check_server(self, server)
+        # Fork before the git subprocesses are started, so that the workers
+        # don't hold on to their pipes.
+        server.start_workers()
+
+
+
+class AsyncGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with an event loop server."""
+
+    server_cls = AsyncTCPGitServer
+    server_kwargs = {'connection_timeout': 30}
@@ -0,0 +1,385 @@
+# test_async_transport.py -- Tests for the event loop based transports
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the event loop based transports."""
+
+import shutil
+import socket
+import tempfile
+import thread
+import threading
+import time
+
+from dulwich.async_transport import (
+    AsyncChannel,
+    AsyncTCPGitClient,
+    AsyncTCPGitServer,
+    EventLoop,
+    WorkerPool,
+    )
+from dulwich.client import (
+    TCPGitClient,
+    )
+from dulwich.protocol import (
+    Protocol,
+    pkt_line,
+    )
+from dulwich.repo import (
+    MemoryRepo,
+    Repo,
+    )
+from dulwich.server import (
+    DictBackend,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+
+class EventLoopTests(TestCase):
+
+    def start_loop(self):
+        loop = EventLoop(poll_interval=0.05)
+        loop_thread = loop.start()
+        self.addCleanup(loop_thread.join)
+        self.addCleanup(loop.stop)
+        return loop
+
+    def test_call_not_running(self):
+        loop = EventLoop()
+        self.assertEqual(thread.get_ident(), loop.call(thread.get_ident))
+
+    def test_call(self):
+        loop = self.start_loop()
+        ident = loop.call(thread.get_ident)
+        self.assertNotEqual(thread.get_ident(), ident)
+        self.assertEqual(ident, loop.call(thread.get_ident))
+
+    def test_call_exception(self):
+        loop = self.start_loop()
+        def fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, loop.call, fail)
+
+    def test_call_soon(self):
+        loop = self.start_loop()
+        called = threading.Event()
+        loop.call_soon(called.set)
+        called.wait(5)
+        self.assertTrue(called.isSet())
+
+
+class AsyncChannelTests(TestCase):
+
+    def setUp(self):
+        super(AsyncChannelTests, self).setUp()
+        self.loop = EventLoop(poll_interval=0.05)
+        loop_thread = self.loop.start()
+        self.addCleanup(loop_thread.join)
+        self.addCleanup(self.loop.stop)
+
+    def make_channel(self, timeout=None):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        theirs.settimeout(5)
+        channel = self.loop.call(AsyncChannel, self.loop, ours,
+                                 timeout)
+        return channel, theirs
+
+    def test_read(self):
+        channel, sock = self.make_channel()
+        self.assertFalse(channel.has_input())
+        sock.sendall('foo')
+        sock.sendall('bar')
+        self.assertEqual('foob', channel.read(4))
+        self.assertTrue(channel.has_input())
+        self.assertEqual('ar', channel.read_some(10))
+
+    def test_read_eof(self):
+        channel, sock = self.make_channel()
+        sock.sendall('foo')
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual('foo', channel.read(10))
+        self.assertTrue(channel.has_input())
+        self.assertEqual('', channel.read_some(10))
+
+    def test_read_all(self):
+        channel, sock = self.make_channel()
+        sock.sendall('foo')
+        sock.sendall('bar')
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual('foobar', channel.read())
+
+    def test_read_paused(self):
+        channel, sock = self.make_channel()
+        channel.max_buffer_size = 10
+        data = 'x' * 1000
+        sock.sendall(data)
+        self.assertEqual(data, channel.read(len(data)))
+
+    def test_write(self):
+        channel, sock = self.make_channel()
+        channel.write('foo')
+        channel.write('bar')
+        channel.close_when_done()
+        received = []
+        while True:
+            data = sock.recv(100)
+            if not data:
+                break
+            received.append(data)
+        self.assertEqual('foobar', ''.join(received))
+
+    def test_write_closed(self):
+        channel, sock = self.make_channel()
+        sock.close()
+        self.assertEqual('', channel.read_some(10))
+        self.assertRaises(socket.error, channel.write, 'foo')
+
+    def test_timeout(self):
+        channel, sock = self.make_channel(timeout=0.05)
+        # Idle connections that nobody waits for input on are kept open.
+        time.sleep(0.2)
+        self.assertFalse(channel.has_input())
+        self.assertEqual('', channel.read_some(10))
+        self.assertEqual('', sock.recv(1))
+
+
+class WorkerPoolTests(TestCase):
+
+    def test_submit(self):
+        pool = WorkerPool(2)
+        self.addCleanup(pool.close)
+        results = []
+        done = threading.Event()
+        def task(value):
+            results.append(value)
+            if len(results) == 3:
+                done.set()
+        for i in range(3):
+            pool.submit(task, i)
+        done.wait(5)
+        self.assertEqual([0, 1, 2], sorted(results))
+
+    def test_bounded(self):
+        pool = WorkerPool(1)
+        self.addCleanup(pool.close)
+        release = threading.Event()
+        started = []
+        pool.submit(release.wait)
+        pool.submit(started.append, True)
+        time.sleep(0.05)
+        # The second task waits for the only worker.
+        self.assertEqual([], started)
+        release.set()
+
+    def test_close(self):
+        pool = WorkerPool(2)
+        threads = list(pool._threads)
+        pool.close()
+        for worker in threads:
+            worker.join(5)
+            self.assertFalse(worker.isAlive())
+
+
+class _EchoHandler(object):
+    """Handler that echoes pkt-lines along with the name of its thread."""
+
+    def __init__(self, backend, args, proto):
+        self.proto = proto
+
+    def handle(self):
+        while True:
+            pkt = self.proto.read_pkt_line()
+            if pkt is None:
+                break
+            self.proto.write_pkt_line('%s %s' % (
+                threading.currentThread().getName(), pkt))
+        self.proto.write_pkt_line(None)
+
+
+class AsyncTCPGitServerTests(TestCase):
+
+    def start_server(self, backend=None, **kwargs):
+        if backend is None:
+            backend = DictBackend({})
+        server = AsyncTCPGitServer(backend, 'localhost', 0,
+                                   handlers={'git-echo': _EchoHandler},
+                                   loop=EventLoop(poll_interval=0.05),
+                                   **kwargs)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def connect(self, server):
+        sock = socket.create_connection(server.server_address, 5)
+        self.addCleanup(sock.close)
+        return sock, Protocol(sock.makefile('rb').read, sock.sendall)
+
+    def test_timeout(self):
+        server = self.start_server(connection_timeout=0.05)
+        sock, proto = self.connect(server)
+        self.assertEqual('', sock.recv(1))
+
+    def make_repo(self):
+        repo = MemoryRepo()
+        c1, c2 = build_commit_graph(repo.object_store, [[1], [2, 1]])
+        repo.refs['refs/heads/master'] = c2.id
+        return repo, c1, c2
+
+    def test_idle_connections(self):
+        repo, c1, c2 = self.make_repo()
+        server = self.start_server(DictBackend({'/': repo}), workers=2)
+        threads = threading.activeCount()
+        for i in range(10):
+            self.connect(server)
+        # Connections that are negotiating don't use a thread either.
+        for i in range(10):
+            sock, proto = self.connect(server)
+            proto.send_cmd('git-upload-pack', '/')
+            while proto.read_pkt_line() is not None:
+                pass
+            proto.write_pkt_line('want %s\n' % c2.id)
+            proto.write_pkt_line(None)
+        # Make sure the server accepted the connections.
+        sock, proto = self.connect(server)
+        proto.send_cmd('git-echo', '/')
+        proto.write_pkt_line('foo')
+        proto.read_pkt_line()
+        self.assertEqual(threads, threading.activeCount())
+
+    def test_fetch(self):
+        repo, c1, c2 = self.make_repo()
+        server = self.start_server(DictBackend({'/': repo}))
+        client = TCPGitClient('localhost', server.server_address[1])
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = Repo.init(target_dir)
+        target.object_store.add_object(repo[c1.tree])
+        target.object_store.add_object(c1)
+        target.refs['refs/heads/master'] = c1.id
+        refs = client.fetch('/', target)
+        self.assertEqual(c2.id, refs['refs/heads/master'])
+        self.assertEqual(c2, target[c2.id])
+
+    def test_fetch_repository_access(self):
+        repo, c1, c2 = self.make_repo()
+        in_loop = []
+        class RecordingBackend(DictBackend):
+            def open_repository(backend, path):
+                in_loop.append(server.loop.in_loop())
+                return DictBackend.open_repository(backend, path)
+        get_refs = repo.get_refs
+        def recording_get_refs():
+            in_loop.append(server.loop.in_loop())
+            return get_refs()
+        repo.get_refs = recording_get_refs
+        server = self.start_server(RecordingBackend({'/': repo}))
+        client = TCPGitClient('localhost', server.server_address[1])
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = Repo.init(target_dir)
+        target.object_store.add_object(repo[c1.tree])
+        target.object_store.add_object(c1)
+        target.refs['refs/heads/master'] = c1.id
+        self.assertEqual(c2.id, client.fetch('/', target)['refs/heads/master'])
+        self.assertTrue(in_loop)
+        self.assertEqual([False] * len(in_loop), in_loop)
+
+    def test_pipelined_rounds(self):
+        repo, c1, c2 = self.make_repo()
+        server = self.start_server(DictBackend({'/': repo}))
+        sock, proto = self.connect(server)
+        proto.send_cmd('git-upload-pack', '/')
+        while proto.read_pkt_line() is not None:
+            pass
+        # The haves arrive while the wants are still being processed.
+        sock.sendall(pkt_line('want %s side-band-64k thin-pack ofs-delta\n'
+                              % c2.id) +
+                     pkt_line(None) + pkt_line('done\n'))
+        self.assertEqual('NAK\n', proto.read_pkt_line())
+
+    def test_fetch_empty(self):
+        server = self.start_server(DictBackend({'/': MemoryRepo()}))
+        client = TCPGitClient('localhost', server.server_address[1])
+        self.assertEqual({}, client.fetch('/', MemoryRepo()))
+
+    def test_request(self):
+        server = self.start_server()
+        sock1, proto1 = self.connect(server)
+        sock2, proto2 = self.connect(server)
+        proto1.send_cmd('git-echo', '/')
+        proto2.send_cmd('git-echo', '/')
+        proto1.write_pkt_line('foo')
+        proto2.write_pkt_line('bar')
+        name1, data1 = proto1.read_pkt_line().split(' ')
+        name2, data2 = proto2.read_pkt_line().split(' ')
+        self.assertEqual(('foo', 'bar'), (data1, data2))
+        self.assertNotEqual(name1, name2)
+        proto1.write_pkt_line(None)
+        self.assertEqual(None, proto1.read_pkt_line())
+        proto2.write_pkt_line(None)
+        self.assertEqual(None, proto2.read_pkt_line())
+        # Connections are closed once their handler is done.
+        self.assertEqual('', sock1.recv(1))
+
+
+class AsyncTCPGitClientTests(TestCase):
+
+    def test_connect(self):
+        loop = EventLoop(poll_interval=0.05)
+        server = AsyncTCPGitServer(DictBackend({}), 'localhost', 0,
+                                   handlers={'git-echo': _EchoHandler},
+                                   loop=loop)
+        loop_thread = loop.start()
+        self.addCleanup(loop_thread.join)
+        self.addCleanup(loop.stop)
+        client = AsyncTCPGitClient('localhost', server.server_address[1],
+                                   loop=loop)
+        proto, can_read = client._connect('echo', '/')
+        proto.write_pkt_line('foo')
+        self.assertTrue(proto.read_pkt_line().endswith(' foo'))
+        proto.write_pkt_line(None)
+        self.assertEqual(None, proto.read_pkt_line())
+        # The server closes the connection once the handler is done.
+        self.assertEqual('', proto.read(1))
+        self.assertTrue(can_read())
+
+    def test_close(self):
+        client = AsyncTCPGitClient('localhost')
+        loop_thread = client._loop_thread
+        self.assertTrue(loop_thread.isAlive())
+        client.close()
+        self.assertFalse(loop_thread.isAlive())
+        # Closing again does nothing.
+        client.close()
+
+    def test_close_shared_loop(self):
+        loop = EventLoop(poll_interval=0.05)
+        loop_thread = loop.start()
+        self.addCleanup(loop_thread.join)
+        self.addCleanup(loop.stop)
+        client = AsyncTCPGitClient('localhost', loop=loop)
+        client.close()
+        # A loop that was passed in is left running.
+        self.assertTrue(loop_thread.isAlive())
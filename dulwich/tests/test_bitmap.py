@@ -0,0 +1,246 @@
+# test_bitmap.py -- Tests for pack bitmap indexes
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for pack bitmap indexes."""
+
+from cStringIO import StringIO
+import shutil
+import tempfile
+
+from dulwich.bitmap import (
+    PackBitmapIndex,
+    bits_to_bytes,
+    bytes_to_bits,
+    iter_bit_positions,
+    read_ewah,
+    write_ewah,
+    write_pack_bitmap,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    Commit,
+    Tag,
+    Tree,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class BitsTests(TestCase):
+
+    def test_bits_to_bytes(self):
+        self.assertEqual('', bits_to_bytes(0))
+        self.assertEqual('\0\0', bits_to_bytes(0, 2))
+        self.assertEqual('\x01\x01', bits_to_bytes(0x101))
+        self.assertEqual('\x01\x01\0', bits_to_bytes(0x101, 3))
+
+    def test_bytes_to_bits(self):
+        self.assertEqual(0, bytes_to_bits(''))
+        self.assertEqual(0, bytes_to_bits('\0\0'))
+        self.assertEqual(0x101, bytes_to_bits('\x01\x01\0'))
+
+    def test_iter_bit_positions(self):
+        self.assertEqual([], list(iter_bit_positions(0)))
+        self.assertEqual([0, 8, 65],
+                         list(iter_bit_positions((1 << 65) | 0x101)))
+
+
+class EWAHTests(TestCase):
+
+    def assertRoundtrips(self, bits):
+        data = write_ewah(bits)
+        self.assertEqual((bits, len(data)), read_ewah(data))
+
+    def test_empty(self):
+        self.assertEqual('\0\0\0\0\0\0\0\x01' + '\0' * 8 + '\0\0\0\0',
+                         write_ewah(0))
+        self.assertRoundtrips(0)
+
+    def test_literal(self):
+        self.assertEqual(
+            '\0\0\0\x02\0\0\0\x02'
+            '\0\0\0\x02\0\0\0\0'
+            '\0\0\0\0\0\0\0\x03'
+            '\0\0\0\0',
+            write_ewah(3))
+        self.assertRoundtrips(3)
+
+    def test_runs(self):
+        bits = ((1 << 640) - 1) << 640
+        data = write_ewah(bits)
+        # A single running length word for the zeros and one for the ones.
+        self.assertEqual(8 + 2 * 8 + 4, len(data))
+        self.assertRoundtrips(bits)
+
+    def test_mixed(self):
+        self.assertRoundtrips((1 << 1000) | (((1 << 300) - 1) << 64) | 0x55)
+
+    def test_offset(self):
+        data = 'xx' + write_ewah(0x55) + 'yy'
+        self.assertEqual((0x55, len(data) - 2), read_ewah(data, 2))
+
+
+class PackBitmapTests(TestCase):
+
+    def setUp(self):
+        super(PackBitmapTests, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = DiskObjectStore.init(self.store_dir)
+        blob_a = make_object(Blob, data='a')
+        blob_b = make_object(Blob, data='b')
+        blob_c = make_object(Blob, data='c')
+        self.c1, self.c2, self.c3, self.c4 = build_commit_graph(self.store,
+          [[1], [2, 1], [3, 1], [4, 2, 3]],
+          trees={1: [('a', blob_a)],
+                 2: [('a', blob_a), ('b', blob_b)],
+                 3: [('a', blob_a), ('dir/c', blob_c)],
+                 4: [('a', blob_a), ('b', blob_b), ('dir/c', blob_c)]})
+        self.tag = make_object(Tag, name='v1', tagger='Foo <foo@example.com>',
+                               tag_time=0, tag_timezone=0, message='v1',
+                               object=(Commit, self.c2.id))
+        self.store.add_object(self.tag)
+        self.store.pack_loose_objects()
+        self.pack, = self.store.packs
+
+    def reachable(self, shas):
+        todo = list(shas)
+        seen = set()
+        while todo:
+            sha = todo.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            obj = self.store[sha]
+            if isinstance(obj, Commit):
+                todo.append(obj.tree)
+                todo.extend(obj.parents)
+            elif isinstance(obj, Tree):
+                todo.extend(sha for (name, mode, sha) in obj.iteritems())
+            elif isinstance(obj, Tag):
+                todo.append(obj.object[1])
+        return seen
+
+    def write_bitmap(self, commits):
+        f = StringIO()
+        sha = write_pack_bitmap(f, self.pack, commits)
+        bitmap = PackBitmapIndex('test.bitmap', self.pack.index,
+                                 f.getvalue())
+        bitmap.check()
+        self.assertEqual(sha, bitmap.get_stored_checksum())
+        return bitmap
+
+    def test_write(self):
+        bitmap = self.write_bitmap([self.c4.id, self.c2.id])
+        self.assertEqual(2, len(bitmap))
+        self.assertTrue(self.c2.id in bitmap)
+        self.assertFalse(self.c3.id in bitmap)
+        self.assertEqual(self.pack.index.get_pack_checksum(),
+                         bitmap.pack_checksum)
+        for commit in (self.c2, self.c4):
+            self.assertEqual(self.reachable([commit.id]),
+              set(bitmap.iter_shas(bitmap.get_commit_bitmap(commit.id))))
+        self.assertRaises(KeyError, bitmap.get_commit_bitmap, self.c3.id)
+
+    def test_type_bitmaps(self):
+        bitmap = self.write_bitmap([])
+        self.assertEqual(0, len(bitmap))
+        commits = set(bitmap.iter_shas(bitmap.type_bitmap(Commit.type_num)))
+        self.assertEqual(set([self.c1.id, self.c2.id, self.c3.id, self.c4.id]),
+                         commits)
+        tags = set(bitmap.iter_shas(bitmap.type_bitmap(Tag.type_num)))
+        self.assertEqual(set([self.tag.id]), tags)
+        self.assertEqual(3, len(list(
+            bitmap.iter_shas(bitmap.type_bitmap(Blob.type_num)))))
+
+    def test_reachable(self):
+        bitmap = self.write_bitmap([self.c2.id])
+        for shas in ([self.c4.id], [self.c3.id, self.c2.id], [self.tag.id],
+                     [self.c4.tree]):
+            self.assertEqual(self.reachable(shas), set(bitmap.iter_shas(
+                bitmap.reachable(shas, self.store.__getitem__))))
+
+    def test_reachable_not_in_pack(self):
+        bitmap = self.write_bitmap([self.c2.id])
+        c5 = make_object(Commit, tree=self.c4.tree, parents=[self.c4.id],
+                         author='Foo <foo@example.com>',
+                         committer='Foo <foo@example.com>',
+                         author_time=0, author_timezone=0,
+                         commit_time=0, commit_timezone=0, message='c5')
+        self.store.add_object(c5)
+        self.assertRaises(KeyError, bitmap.reachable, [c5.id],
+                          self.store.__getitem__)
+
+    def test_checksum_mismatch(self):
+        f = StringIO()
+        write_pack_bitmap(f, self.pack, [self.c2.id])
+        bitmap = PackBitmapIndex('test.bitmap', self.pack.index,
+                                 f.getvalue()[:-1] + 'x')
+        self.assertRaises(ChecksumMismatch, bitmap.check)
+
+    def test_find_missing_objects(self):
+        self.store.write_pack_bitmap(self.pack, [self.c4.id])
+        self.assertTrue(self.store._get_pack_bitmap() is not None)
+        missing = list(self.store.find_missing_objects(
+            [self.c2.id], [self.c4.id],
+            get_tagged=lambda: {self.c2.id: self.tag.id,
+                                self.c1.id: 'f' * 40}))
+        self.assertEqual(
+            self.reachable([self.c4.id]) - self.reachable([self.c2.id]),
+            set(sha for sha, path in missing))
+        self.assertEqual(len(missing), len(set(missing)))
+
+    def test_find_missing_objects_tagged(self):
+        self.store.write_pack_bitmap(self.pack, [self.c4.id])
+        missing = list(self.store.find_missing_objects(
+            [self.c1.id], [self.c4.id],
+            get_tagged=lambda: {self.c2.id: self.tag.id}))
+        self.assertEqual(
+            self.reachable([self.c4.id, self.tag.id]) -
+            self.reachable([self.c1.id]),
+            set(sha for sha, path in missing))
+
+    def test_find_missing_objects_fallback(self):
+        self.store.write_pack_bitmap(self.pack, [self.c4.id])
+        blob = make_object(Blob, data='loose')
+        self.store.add_object(blob)
+        self.assertEqual([(blob.id, None)],
+                         list(self.store.find_missing_objects([], [blob.id])))
+
+    def test_stale_bitmap(self):
+        f = StringIO()
+        write_pack_bitmap(f, self.pack, [self.c4.id])
+        data = f.getvalue()
+        bitmap_file = open(self.pack._basename + '.bitmap', 'wb')
+        try:
+            bitmap_file.write(data[:12] + '\0' * 20 + data[32:])
+        finally:
+            bitmap_file.close()
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(None, store._get_pack_bitmap())
@@ -17,23 +17,69 @@
 # MA  02110-1301, USA.
 
 from cStringIO import StringIO
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib2
 
 from dulwich.client import (
+    _ChunkedRequest,
+    HttpConnectionPool,
+    HttpGitClient,
     TraditionalGitClient,
     TCPGitClient,
     SubprocessGitClient,
     SSHGitClient,
+    SubprocessWrapper,
     ReportStatusParser,
     SendPackError,
     UpdateRefsError,
+    fetch_many,
     get_transport_and_path,
     )
+from dulwich.errors import (
+    FetchTimeout,
+    )
+from dulwich.objects import (
+    Blob,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    REF_DELTA,
+    write_pack_objects,
+    )
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.server import (
+    DictBackend,
+    TCPGitServer,
+    )
 from dulwich.tests import (
+    SkipTest,
     TestCase,
     )
 from dulwich.protocol import (
     TCP_GIT_PORT,
     Protocol,
+    pkt_line,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    build_pack,
+    make_object,
+    )
+from dulwich.web import (
+    HTTPGitRequestHandler,
+    KeepAliveHTTPGitRequestHandler,
+    ThreadingWSGIServer,
+    make_server,
+    make_wsgi_chain,
     )
 
 
@@ -49,6 +95,15 @@ class DummyClient(TraditionalGitClient):
         return Protocol(self.read, self.write), self.can_read
 
 
+class DummyGraphWalker(object):
+
+    def next(self):
+        return None
+
+    def ack(self, sha):
+        pass
+
+
 # TODO(durin42): add unit-level tests of GitClient
 class GitClientTests(TestCase):
 
@@ -76,6 +131,67 @@ class GitClientTests(TestCase):
         self.client.fetch_pack('bla', lambda heads: [], None, None, None)
         self.assertEquals(self.rout.getvalue(), '0000')
 
+    def write_pack_response(self, objects):
+        pack = StringIO()
+        write_pack_objects(pack, [(o, None) for o in objects])
+        return self.write_raw_pack_response(objects[0].id, pack.getvalue())
+
+    def write_raw_pack_response(self, head, pack):
+        self.rin.write(pkt_line(
+            '%s HEAD\x00side-band-64k ofs-delta\n' % head))
+        self.rin.write('0000')
+        self.rin.write(pkt_line('NAK\n'))
+        for i in range(0, len(pack), 10):
+            self.rin.write(pkt_line('\x01' + pack[i:i+10]))
+            self.rin.write(pkt_line('\x02progress\n'))
+        self.rin.write('0000')
+        self.rin.seek(0)
+        return pack
+
+    def test_fetch_pack(self):
+        blob = Blob.from_string('blob')
+        pack = self.write_pack_response([blob])
+        received = []
+        progress = []
+        self.client.fetch_pack('bla', lambda refs: refs.values(),
+                               DummyGraphWalker(), received.append,
+                               progress.append)
+        self.assertEquals(pack, ''.join(received))
+        self.assertEquals(len(pack) / 10 + 1, len(progress))
+
+    def test_fetch(self):
+        blob = Blob.from_string('blob')
+        self.write_pack_response([blob])
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        target = Repo.init(repo_dir)
+        refs = self.client.fetch('bla', target)
+        self.assertEquals({'HEAD': blob.id}, refs)
+        self.assertEquals('blob', target[blob.id].data)
+        self.assertEquals(1, len(target.object_store.packs))
+        # The pack was indexed while it was received.
+        objects_dir = target.object_store.path
+        self.assertFalse([n for n in os.listdir(objects_dir)
+                          if n.startswith('tmp_pack_')])
+
+    def test_fetch_thin_pack(self):
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        target = Repo.init(repo_dir)
+        base = make_object(Blob, data='blob')
+        target.object_store.add_object(base)
+        f = StringIO()
+        entries = build_pack(f, [(REF_DELTA, (base.id, 'blob1'))],
+                             store=target.object_store)
+        sha = sha_to_hex(entries[0][3])
+        self.write_raw_pack_response(sha, f.getvalue())
+        self.client.fetch('bla', target)
+        self.assertEquals('blob1', target[sha].data)
+        # The pack was completed with the base.
+        pack = target.object_store.packs[0]
+        self.assertEquals(2, len(pack))
+        self.assertTrue(base.id in pack)
+
     def test_get_transport_and_path_tcp(self):
         client, path = get_transport_and_path('git://foo.com/bar/baz')
         self.assertTrue(isinstance(client, TCPGitClient))
@@ -89,6 +205,12 @@ class GitClientTests(TestCase):
         self.assertEquals(1234, client._port)
         self.assertEqual('/bar/baz', path)
 
+    def test_get_transport_and_path_http(self):
+        client, path = get_transport_and_path('https://foo.com:1234/bar/baz')
+        self.assertTrue(isinstance(client, HttpGitClient))
+        self.assertEquals('https://foo.com:1234/', client.base_url)
+        self.assertEqual('/bar/baz', path)
+
     def test_get_transport_and_path_ssh_explicit(self):
         client, path = get_transport_and_path('git+ssh://foo.com/bar/baz')
         self.assertTrue(isinstance(client, SSHGitClient))
@@ -155,6 +277,383 @@ class SSHGitClientTests(TestCase):
             self.client._get_cmd_path('upload-pack'))
 
 
+class DummyHttpResponse(object):
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+
+    def getcode(self):
+        return 200
+
+    def info(self):
+        return self
+
+    def gettype(self):
+        return self.content_type
+
+
+class DummyHttpClient(HttpGitClient):
+
+    def __init__(self, *args, **kwargs):
+        HttpGitClient.__init__(self, 'http://example.com/', *args, **kwargs)
+        self.requests = []
+
+    def _perform(self, req):
+        self.requests.append((req.get_full_url(), dict(req.header_items()),
+                              [req.get_data()]))
+        return DummyHttpResponse(req.get_header('Content-type').replace(
+            '-request', '-result'))
+
+    def _perform_chunked(self, url, headers, chunks):
+        # Capitalize header names like urllib2.Request does.
+        headers = dict((k.capitalize(), v) for (k, v) in headers.iteritems())
+        self.requests.append((url, headers, list(chunks)))
+        return DummyHttpResponse(headers['Content-type'].replace(
+            '-request', '-result'))
+
+
+class HttpGitClientTests(TestCase):
+
+    def request(self, client, data):
+        client._smart_request('git-receive-pack', 'http://example.com/foo/',
+                              data)
+        self.assertEqual(1, len(client.requests))
+        url, headers, chunks = client.requests[0]
+        self.assertEqual('http://example.com/foo/git-receive-pack', url)
+        self.assertEqual('application/x-git-receive-pack-request',
+                         headers['Content-type'])
+        return headers, chunks
+
+    def test_small_request(self):
+        client = DummyHttpClient(post_buffer=10)
+        headers, chunks = self.request(client, iter(['foo', 'bar']))
+        self.assertEqual(['foobar'], chunks)
+
+    def test_large_request(self):
+        client = DummyHttpClient(post_buffer=10)
+        data = ['x' * 70000, 'y' * 10, 'z' * 10]
+        headers, chunks = self.request(client, iter(data))
+        # The body is sent in chunks, small ones being joined together.
+        self.assertEqual(['x' * 70000, 'y' * 10 + 'z' * 10], chunks)
+
+    def test_compress_requests(self):
+        client = DummyHttpClient(compress_requests=True)
+        headers, chunks = self.request(client, 'foobar')
+        self.assertEqual('gzip', headers['Content-encoding'])
+        f = gzip.GzipFile(fileobj=StringIO(''.join(chunks)))
+        self.assertEqual('foobar', f.read())
+
+
+class HttpChunkedPushTests(TestCase):
+
+    def setUp(self):
+        super(HttpChunkedPushTests, self).setUp()
+        self.remote = self.make_repo()
+        self.proxied = []
+        app = make_wsgi_chain(DictBackend({'/': self.remote}))
+        server = make_server('localhost', 0, self.proxy_app(app),
+            handler_class=HTTPGitRequestHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://localhost:%d/' % server.server_port
+
+    def proxy_app(self, app):
+        """Let the server act as a HTTP proxy for itself."""
+        def proxy(environ, start_response):
+            path = environ['PATH_INFO']
+            if path.startswith('http://'):
+                self.proxied.append(path)
+                environ['PATH_INFO'] = '/' + path.split('/', 3)[3]
+            return app(environ, start_response)
+        return proxy
+
+    def make_repo(self):
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        return Repo.init(repo_dir)
+
+    def set_environ(self, name, value):
+        old_value = os.environ.get(name)
+        def restore():
+            if old_value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = old_value
+        self.addCleanup(restore)
+        os.environ[name] = value
+
+    def push(self, **kwargs):
+        local = self.make_repo()
+        blob = make_object(Blob, data=os.urandom(8192))
+        c1, = build_commit_graph(local.object_store, [[1]],
+                                 trees={1: [('a', blob)]})
+        client = HttpGitClient(self.url, post_buffer=1024, **kwargs)
+        chunked = []
+        perform_chunked = client._perform_chunked
+        def counting_perform_chunked(*args):
+            chunked.append(args[0])
+            return perform_chunked(*args)
+        client._perform_chunked = counting_perform_chunked
+        client.send_pack('/', lambda refs: {'refs/heads/master': c1.id},
+                         local.object_store.generate_pack_contents)
+        self.assertEquals([self.url + 'git-receive-pack'], chunked)
+        self.assertEquals(c1.id, self.remote.refs['refs/heads/master'])
+        self.assertEquals(blob, self.remote[blob.id])
+
+    def test_send_pack_chunked(self):
+        self.push()
+
+    def test_send_pack_chunked_compressed(self):
+        self.push(compress_requests=True)
+
+    def test_send_pack_failure_ends_phase(self):
+        local = self.make_repo()
+        c1, = build_commit_graph(local.object_store, [[1]])
+        client = HttpGitClient(self.url, post_buffer=1)
+        def failing_perform_chunked(*args):
+            raise urllib2.URLError('failed')
+        client._perform_chunked = failing_perform_chunked
+        self.assertRaises(urllib2.URLError, client.send_pack, '/',
+                          lambda refs: {'refs/heads/master': c1.id},
+                          local.object_store.generate_pack_contents)
+        self.assertTrue('writing' in client.stats.timings)
+        self.assertEquals([], client.stats._running)
+
+    def test_chunked_request_sent_once(self):
+        req = _ChunkedRequest(self.url, iter(['foo']))
+        self.assertEquals('POST', req.get_method())
+        self.assertEquals(['foo'], list(req.take_chunks()))
+        self.assertRaises(urllib2.URLError, req.take_chunks)
+
+    def test_chunked_request_other_opener(self):
+        req = _ChunkedRequest(self.url, iter(['foo']))
+        self.assertRaises(urllib2.URLError, urllib2.build_opener().open, req)
+
+    def test_send_pack_chunked_proxy(self):
+        self.set_environ('http_proxy', self.url)
+        self.set_environ('no_proxy', '')
+        self.url = 'http://git.example.com/'
+        self.push()
+        self.assertEquals(self.url + 'git-receive-pack', self.proxied[-1])
+
+
+class CountingWSGIServer(ThreadingWSGIServer):
+
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadingWSGIServer.process_request(self, request, client_address)
+
+
+class HttpConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        super(HttpConnectionPoolTests, self).setUp()
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        self.repo = Repo.init(repo_dir)
+        c1, = build_commit_graph(self.repo.object_store, [[1]])
+        self.repo.refs['HEAD'] = c1.id
+        self.commit = c1
+        self.handler_class = KeepAliveHTTPGitRequestHandler
+
+    def start_server(self):
+        server = make_server('localhost', 0,
+            make_wsgi_chain(DictBackend({'/': self.repo})),
+            server_class=CountingWSGIServer, handler_class=self.handler_class)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def fetch(self, client):
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = Repo.init(target_dir)
+        refs = client.fetch('/', target)
+        self.assertEquals(self.commit.id, refs['HEAD'])
+        self.assertEquals(self.commit, target[self.commit.id])
+
+    def test_reuse(self):
+        server = self.start_server()
+        client = HttpGitClient('http://localhost:%d/' % server.server_port)
+        self.addCleanup(client.close)
+        self.fetch(client)
+        self.fetch(client)
+        self.assertEquals(1, server.connections)
+
+    def test_shared_pool(self):
+        server = self.start_server()
+        pool = HttpConnectionPool()
+        self.addCleanup(pool.close)
+        url = 'http://localhost:%d/' % server.server_port
+        self.fetch(HttpGitClient(url, pool=pool))
+        self.fetch(HttpGitClient(url, pool=pool))
+        self.assertEquals(1, server.connections)
+
+    def test_closed_by_server(self):
+        class ShortTimeoutHandler(KeepAliveHTTPGitRequestHandler):
+            timeout = 0.05
+        self.handler_class = ShortTimeoutHandler
+        server = self.start_server()
+        client = HttpGitClient('http://localhost:%d/' % server.server_port)
+        self.addCleanup(client.close)
+        self.fetch(client)
+        time.sleep(0.2)
+        # The idle connection was closed, so the request is retried.
+        self.fetch(client)
+        self.assertEquals(2, server.connections)
+
+    def test_max_connections_per_host(self):
+        server = self.start_server()
+        host = 'localhost:%d' % server.server_port
+        pool = HttpConnectionPool(max_connections_per_host=1)
+        self.addCleanup(pool.close)
+        resp1 = pool.request('http', host, 'GET', '/HEAD', {})
+        responses = []
+        def request():
+            responses.append(pool.request('http', host, 'GET', '/HEAD', {}))
+        waiting = threading.Thread(target=request)
+        waiting.start()
+        waiting.join(0.1)
+        self.assertEquals([], responses)
+        self.assertEquals('ref: refs/heads/master\n', resp1.read())
+        waiting.join()
+        self.assertEquals('ref: refs/heads/master\n', responses[0].read())
+        self.assertEquals(1, server.connections)
+
+
+class FetchManyTests(TestCase):
+
+    def setUp(self):
+        super(FetchManyTests, self).setUp()
+        repos = {}
+        self.commits = {}
+        for name in ('/a', '/b', '/c'):
+            repo = self.make_repo()
+            commit_spec = [[1], [2, 1]]
+            attrs = {1: {'message': name}}
+            c1, c2 = build_commit_graph(repo.object_store, commit_spec,
+                                        attrs=attrs)
+            repo.refs['refs/heads/master'] = c2.id
+            repos[name] = repo
+            self.commits[name] = c2
+        server = TCPGitServer(DictBackend(repos), 'localhost', 0)
+        server_thread = threading.Thread(target=server.serve)
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(server.shutdown)
+        self.port = server.server_address[1]
+        self.url = 'git://localhost:%d' % self.port
+
+    def make_repo(self):
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        return Repo.init(repo_dir)
+
+    def test_fetch_many(self):
+        specs = [(self.url + name, self.make_repo())
+                 for name in ('/a', '/b', '/c')]
+        progress = []
+        results = fetch_many(specs, concurrency=2,
+                             progress=lambda *args: progress.append(args))
+        self.assertEquals(3, len(results))
+        for (url, target), result, name in zip(specs, results,
+                                               ('/a', '/b', '/c')):
+            commit = self.commits[name]
+            self.assertEquals(url, result.url)
+            self.assertTrue(target is result.target)
+            self.assertEquals(None, result.error)
+            self.assertEquals(1, result.attempts)
+            self.assertEquals(commit.id, result.refs['refs/heads/master'])
+            self.assertEquals(commit, target[commit.id])
+            # Two commits with the same empty tree
+            self.assertEquals(3, result.num_objects)
+            self.assertTrue(result.bytes_received > 0)
+            self.assertEquals(
+                ["%s\t\t'HEAD' of %s\n" % (commit.id, url),
+                 "%s\t\t'refs/heads/master' of %s\n" % (commit.id, url)],
+                list(open(os.path.join(target.controldir(), 'FETCH_HEAD'))))
+        self.assertEquals(set(url for url, target in specs),
+                          set(url for url, data in progress))
+
+    def test_client_stats(self):
+        target = self.make_repo()
+        client = TCPGitClient('localhost', self.port)
+        client.fetch('/a', target)
+        stats = client.stats
+        self.assertTrue(stats.bytes_read > 0)
+        self.assertTrue(stats.bytes_written > 0)
+        self.assertEquals(3, stats.counts['objects'])
+        # HEAD and refs/heads/master
+        self.assertEquals(2, stats.counts['wants'])
+        self.assertEquals(['advertise', 'negotiate', 'receiving'],
+                          sorted(stats.timings))
+
+    def test_error(self):
+        target = self.make_repo()
+        results = fetch_many([(self.url + '/d', target)], retries=2)
+        self.assertEquals(None, results[0].refs)
+        self.assertTrue(results[0].error is not None)
+        self.assertEquals(3, results[0].attempts)
+        # The lock was released.
+        self.assertEquals([], [n for n in os.listdir(target.controldir())
+                               if n.startswith('FETCH_HEAD')])
+
+    def test_locked(self):
+        target = self.make_repo()
+        open(os.path.join(target.controldir(), 'FETCH_HEAD.lock'), 'w').close()
+        results = fetch_many([(self.url + '/a', target)])
+        self.assertTrue(isinstance(results[0].error, OSError))
+        self.assertFalse(self.commits['/a'].id in target)
+
+    def test_timeout(self):
+        def get_transport(url):
+            time.sleep(0.1)
+            return get_transport_and_path(url)
+        results = fetch_many([(self.url + '/a', self.make_repo())],
+                             timeout=0.05, get_transport=get_transport)
+        self.assertTrue(isinstance(results[0].error, FetchTimeout))
+
+    def silent_server(self):
+        """Start a server that accepts connections but never answers."""
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('localhost', 0))
+        sock.listen(5)
+        return sock.getsockname()[1]
+
+    def assertFetchTimesOut(self, url):
+        results = fetch_many([(url, self.make_repo())], timeout=0.1)
+        self.assertTrue(isinstance(results[0].error, FetchTimeout))
+        self.assertTrue(results[0].elapsed < 5)
+
+    def test_timeout_no_answer(self):
+        self.assertFetchTimesOut('git://localhost:%d/a' % self.silent_server())
+
+    def test_timeout_no_answer_http(self):
+        self.assertFetchTimesOut('http://localhost:%d/a' % self.silent_server())
+
+
+class SubprocessWrapperTests(TestCase):
+
+    def test_read_timeout(self):
+        if subprocess.mswindows:
+            raise SkipTest('read timeouts are not supported on Windows')
+        proc = subprocess.Popen(['sh', '-c', 'echo foo; exec sleep 10'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        wrapper = SubprocessWrapper(proc, timeout=0.1)
+        self.assertEquals('foo\n', wrapper.read(4))
+        self.assertRaises(socket.timeout, wrapper.read, 1)
+        # The subprocess was killed.
+        self.assertNotEquals(None, proc.wait())
+
+
 class ReportStatusParserTests(TestCase):
 
     def test_invalid_pack(self):
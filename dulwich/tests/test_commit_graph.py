@@ -0,0 +1,136 @@
+# test_commit_graph.py -- Tests for commit graph files
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for commit graph files."""
+
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+
+from dulwich.commit_graph import (
+    CommitGraph,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+from dulwich.walk import (
+    Walker,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.commits = build_commit_graph(self.store,
+          [[1], [2, 1], [3, 1], [4, 1], [5, 2, 3, 4], [6, 5, 1]],
+          attrs={6: {'commit_time': 1 << 33}})
+
+    def write_graph(self, commit_ids):
+        f = StringIO()
+        sha = write_commit_graph(f, self.store.__getitem__, commit_ids)
+        graph = CommitGraph('commit-graph', file=StringIO(),
+                            contents=f.getvalue(), size=len(f.getvalue()))
+        graph.check()
+        self.assertEqual(sha, graph.get_stored_checksum())
+        return graph
+
+    def test_empty(self):
+        graph = self.write_graph([])
+        self.assertEqual(0, len(graph))
+        self.assertFalse(self.commits[0].id in graph)
+        self.assertRaises(KeyError, graph.get_parents, self.commits[0].id)
+
+    def test_ancestors_included(self):
+        graph = self.write_graph([self.commits[1].id])
+        self.assertEqual(sorted([self.commits[0].id, self.commits[1].id]),
+                         list(graph))
+
+    def test_commit_data(self):
+        graph = self.write_graph([self.commits[-1].id])
+        self.assertEqual(len(self.commits), len(graph))
+        for commit in self.commits:
+            self.assertTrue(commit.id in graph)
+            self.assertEqual(commit.parents, graph.get_parents(commit.id))
+            self.assertEqual(commit.tree, graph.get_tree(commit.id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit.id))
+        self.assertEqual(1 << 33, graph.get_commit_time(self.commits[5].id))
+
+    def test_generation(self):
+        graph = self.write_graph([self.commits[-1].id])
+        self.assertEqual([1, 2, 2, 2, 3, 4],
+                         [graph.get_generation(c.id) for c in self.commits])
+
+    def test_checksum_mismatch(self):
+        f = StringIO()
+        write_commit_graph(f, self.store.__getitem__, [self.commits[0].id])
+        contents = f.getvalue()[:-1] + 'x'
+        graph = CommitGraph('commit-graph', file=StringIO(),
+                            contents=contents, size=len(contents))
+        self.assertRaises(ChecksumMismatch, graph.check)
+
+
+class DiskObjectStoreCommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(DiskObjectStoreCommitGraphTests, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = DiskObjectStore.init(self.store_dir)
+        self.c1, self.c2, self.c3 = build_commit_graph(self.store,
+          [[1], [2, 1], [3, 1, 2]])
+
+    def test_no_commit_graph(self):
+        self.assertEqual(None, self.store._get_commit_graph())
+        self.assertEqual([self.c1.id, self.c2.id],
+                         self.store.get_parents(self.c3.id))
+
+    def test_uses_commit_graph(self):
+        self.store.write_commit_graph([self.c2.id])
+        self.assertEqual(2, len(self.store._get_commit_graph()))
+        # Commits in the graph are no longer read from the store.
+        os.remove(self.store._get_shafile_path(self.c2.id))
+        self.assertEqual([self.c1.id], self.store.get_parents(self.c2.id))
+        self.assertEqual(self.c2.commit_time,
+                         self.store.get_commit_time(self.c2.id))
+        # Commits not in the graph are.
+        self.assertEqual([self.c1.id, self.c2.id],
+                         self.store.get_parents(self.c3.id))
+        self.assertEqual(self.c3.commit_time,
+                         self.store.get_commit_time(self.c3.id))
+
+    def test_walker_excluded(self):
+        self.store.write_commit_graph([self.c3.id])
+        os.remove(self.store._get_shafile_path(self.c1.id))
+        os.remove(self.store._get_shafile_path(self.c2.id))
+        walker = Walker(self.store, [self.c3.id], exclude=[self.c2.id])
+        self.assertEqual([self.c3], [e.commit for e in walker])
@@ -0,0 +1,117 @@
+# test_graph.py -- Tests for ancestry queries on the commit graph
+# Copyright (C) 2011 Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for ancestry queries on the commit graph."""
+
+import shutil
+import tempfile
+
+from dulwich.graph import (
+    find_merge_base,
+    is_ancestor,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+
+class GraphTests(TestCase):
+
+    def setUp(self):
+        super(GraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+
+    def make_commits(self, commit_spec, **kwargs):
+        return build_commit_graph(self.store, commit_spec, **kwargs)
+
+    def assertMergeBase(self, expected, a, b):
+        self.assertEqual(sorted(c.id for c in expected),
+                         sorted(find_merge_base(self.store, a.id, b.id)))
+        self.assertEqual(sorted(c.id for c in expected),
+                         sorted(find_merge_base(self.store, b.id, a.id)))
+
+    def test_merge_base_same(self):
+        c1, = self.make_commits([[1]])
+        self.assertEqual([c1.id], find_merge_base(self.store, c1.id, c1.id))
+
+    def test_merge_base_linear(self):
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 2]])
+        self.assertMergeBase([c1], c1, c3)
+        self.assertMergeBase([c2], c2, c3)
+
+    def test_merge_base_branch(self):
+        c1, c2, c3, c4, c5 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 2], [5, 4]])
+        self.assertMergeBase([c2], c3, c5)
+
+    def test_merge_base_merged(self):
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 1], [4, 2, 3]])
+        self.assertMergeBase([c3], c3, c4)
+        self.assertMergeBase([c1], c2, c3)
+
+    def test_merge_base_criss_cross(self):
+        # c1--c2--c4--c6
+        #   \    X
+        #    c3--c5
+        c1, c2, c3, c4, c5, c6 = self.make_commits(
+          [[1], [2, 1], [3, 1], [4, 2, 3], [5, 3, 2], [6, 4]])
+        self.assertMergeBase([c2, c3], c5, c6)
+
+    def test_merge_base_redundant(self):
+        # The old commit c2 is reached late through the long branch, after
+        # c1 has already been found as a candidate.
+        c1, c2, c3, c4, c5, c6 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 3], [5, 1, 4], [6, 2]],
+          attrs=dict((i + 1, {'commit_time': t}) for (i, t) in
+                     enumerate([1, 2, 30, 40, 50, 3])))
+        self.assertMergeBase([c2], c5, c6)
+
+    def test_merge_base_unrelated(self):
+        c1, c2 = self.make_commits([[1], [2]])
+        self.assertMergeBase([], c1, c2)
+
+    def test_is_ancestor(self):
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 1], [4, 2]])
+        self.assertTrue(is_ancestor(self.store, c1.id, c4.id))
+        self.assertTrue(is_ancestor(self.store, c2.id, c4.id))
+        self.assertTrue(is_ancestor(self.store, c4.id, c4.id))
+        self.assertFalse(is_ancestor(self.store, c3.id, c4.id))
+        self.assertFalse(is_ancestor(self.store, c4.id, c1.id))
+
+
+class CommitGraphGraphTests(GraphTests):
+    """Ancestry queries using generation numbers from a commit graph."""
+
+    def setUp(self):
+        super(CommitGraphGraphTests, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def make_commits(self, commit_spec, **kwargs):
+        commits = build_commit_graph(self.store, commit_spec, **kwargs)
+        self.store.write_commit_graph([c.id for c in commits])
+        self.assertEqual(1, self.store.get_generation(commits[0].id))
+        return commits
@@ -42,10 +42,15 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
+    PackHandleCache,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    OFS_DELTA,
     REF_DELTA,
+    PackStreamReader,
+    UnpackedObject,
+    create_delta,
     write_pack_objects,
     )
 from dulwich.tests import (
@@ -188,6 +193,12 @@ class ObjectStoreTests(object):
         self.assertEqual((Blob.type_num, 'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_get_object_info(self):
+        self.store.add_object(testobject)
+        self.assertEqual((Blob.type_num, 10),
+                         self.store.get_object_info(testobject.id))
+        self.assertRaises(KeyError, self.store.get_object_info, 'a' * 40)
+
 
 class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
 
@@ -195,6 +206,22 @@ class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
         TestCase.setUp(self)
         self.store = MemoryObjectStore()
 
+    def test_iter_tree_contents_does_not_keep_entries(self):
+        blob_a = make_object(Blob, data='a')
+        blob_b = make_object(Blob, data='b')
+        self.store.add_objects([(blob_a, None), (blob_b, None)])
+        tree_id = commit_tree(self.store, [('a', blob_a.id, 0100644),
+                                           ('ad/b', blob_b.id, 0100644)])
+        # Replace the trees with parsed copies, as read from disk.
+        tree_ids = [tree_id, self.store[tree_id]['ad'][1]]
+        for sha in tree_ids:
+            raw = self.store[sha].as_raw_string()
+            self.store.add_object(Tree.from_raw_string(Tree.type_num, raw))
+        self.assertEqual(['a', 'ad/b'], [e.path for e in
+                         self.store.iter_tree_contents(tree_id)])
+        for sha in tree_ids:
+            self.assertEqual(None, self.store[sha]._entries)
+
 
 class PackBasedObjectStoreTests(ObjectStoreTests):
 
@@ -215,6 +242,15 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
         self.assertNotEquals([], self.store.packs)
         self.assertEquals(0, self.store.pack_loose_objects())
 
+    def test_get_object_info_packed(self):
+        blob = make_object(Blob, data='blob' * 100)
+        blob2 = make_object(Blob, data='blob' * 100 + 'more')
+        self.store.add_objects([(blob, None), (blob2, None)])
+        self.assertEqual((Blob.type_num, 400),
+                         self.store.get_object_info(blob.id))
+        self.assertEqual((Blob.type_num, 404),
+                         self.store.get_object_info(blob2.sha().digest()))
+
 
 class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
 
@@ -279,6 +315,283 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertEqual((Blob.type_num, 'more yummy data'),
                          o.get_raw(packed_blob_sha))
 
+    def test_add_thin_pack_spilled(self):
+        o = DiskObjectStore(self.store_dir)
+        blob = make_object(Blob, data='yummy data')
+        o.add_object(blob)
+        f = StringIO()
+        build_pack(f, [
+          (Blob.type_num, 'other data'),
+          (OFS_DELTA, (0, 'other data and more')),
+          (REF_DELTA, (blob.id, 'more yummy data')),
+          ], store=o)
+        pack = o.add_thin_pack(f.read, None)
+        index_data = open(pack._basename + '.idx', 'rb').read()
+
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+        o2 = DiskObjectStore.init(spill_dir)
+        o2.pack_indexer_spill_threshold = 0
+        o2.add_object(blob)
+        f.seek(0)
+        pack2 = o2.add_thin_pack(f.read, None)
+        self.assertEqual(index_data,
+                         open(pack2._basename + '.idx', 'rb').read())
+
+    def _iter_pack_records(self, *args, **kwargs):
+        for record in self.store.iter_pack_records(*args, **kwargs):
+            if isinstance(record, UnpackedObject):
+                record = (record.pack_type_num, record.sha(),
+                          record.delta_base, ''.join(record.decomp_chunks))
+            yield record
+
+    def _add_pack(self, objects_spec):
+        f = StringIO()
+        entries = build_pack(f, objects_spec, store=self.store)
+        self.store.add_thin_pack(f.read, None)
+        return [(sha_to_hex(e[3]), e[3], e[2]) for e in entries]
+
+    def test_iter_pack_records_reuse_delta(self):
+        (sha1, bin1, data1), (sha2, bin2, data2) = self._add_pack([
+          (Blob.type_num, 'yummy data\n' * 10),
+          (OFS_DELTA, (0, 'yummy data\n' * 10 + 'more\n')),
+          ])
+        self.assertEqual([
+          (Blob.type_num, bin1, None, data1),
+          (REF_DELTA, bin2, bin1, create_delta(data1, data2)),
+          ], list(self._iter_pack_records([(sha2, None), (sha1, None)],
+                                          window=0)))
+
+    def test_iter_pack_records_thin(self):
+        (sha1, bin1, data1), (sha2, bin2, data2) = self._add_pack([
+          (Blob.type_num, 'yummy data\n' * 10),
+          (OFS_DELTA, (0, 'yummy data\n' * 10 + 'more\n')),
+          ])
+        self.assertEqual([(Blob.type_num, bin2, None, data2)],
+          list(self._iter_pack_records([(sha2, None)], window=0)))
+        self.assertEqual([(REF_DELTA, bin2, bin1, create_delta(data1, data2))],
+          list(self._iter_pack_records([(sha2, None)], window=0,
+                                       thin_bases=[sha1])))
+
+    def test_iter_pack_records_depth(self):
+        data = 'yummy data\n' * 10
+        objects = self._add_pack([
+          (Blob.type_num, data),
+          (OFS_DELTA, (0, data + 'more\n')),
+          (OFS_DELTA, (1, data + 'more\nand more\n')),
+          ])
+        records = list(self._iter_pack_records(
+          [(sha, None) for sha, _, _ in objects], window=0, depth=1))
+        self.assertEqual(set([objects[0][1], objects[2][1]]),
+          set([r[1] for r in records if r[2] is None]))
+        self.assertEqual([(objects[1][1], objects[0][1])],
+          [(r[1], r[2]) for r in records if r[2] is not None])
+
+    def test_write_pack_objects_reuse(self):
+        (sha1, bin1, data1), (sha2, bin2, data2) = self._add_pack([
+          (Blob.type_num, 'yummy data\n' * 10),
+          (OFS_DELTA, (0, 'yummy data\n' * 10 + 'more\n')),
+          ])
+        f = StringIO()
+        write_pack_objects(f, self.store.iter_shas([(sha1, None),
+                                                    (sha2, None)]))
+        f.seek(0)
+        unpacked = list(PackStreamReader(f.read).read_objects())
+        self.assertEqual([Blob.type_num, OFS_DELTA],
+                         [u.pack_type_num for u in unpacked])
+        self.assertEqual(create_delta(data1, data2),
+                         ''.join(unpacked[1].decomp_chunks))
+
+    def test_packs_most_recently_hit_first(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        store = DiskObjectStore(self.store_dir)
+        packs = list(store.packs)
+        pack1 = [p for p in packs if sha1 in p][0]
+        pack2 = [p for p in packs if sha2 in p][0]
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertTrue(store.packs[0] is pack1)
+        self.assertTrue(store.contains_packed(sha2))
+        self.assertEqual([pack2, pack1], store.packs)
+
+    def test_packed_miss_cache(self):
+        blob = make_object(Blob, data='yummy data')
+        self.assertFalse(self.store.contains_packed(blob.id))
+        self.assertTrue(blob.sha().digest() in self.store._packed_misses)
+        self.store.add_objects([(blob, None)])
+        self.assertEqual(0, len(self.store._packed_misses))
+        self.assertTrue(self.store.contains_packed(blob.id))
+        self.assertEqual((Blob.type_num, 'yummy data'),
+                         self.store.get_raw(blob.id))
+
+    def test_packed_miss_cache_race(self):
+        blob = make_object(Blob, data='yummy data')
+        find_packed = self.store._find_packed
+        def find_packed_while_adding(sha):
+            # The pack appears after the scan has missed it.
+            entry = find_packed(sha)
+            self.store.add_objects([(blob, None)])
+            return entry
+        self.store._find_packed = find_packed_while_adding
+        self.assertFalse(self.store.contains_packed(blob.id))
+        del self.store._find_packed
+        self.assertEqual(0, len(self.store._packed_misses))
+        self.assertTrue(self.store.contains_packed(blob.id))
+
+    def test_reload_keeps_packs(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        store = DiskObjectStore(self.store_dir)
+        pack1, = store.packs
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        store._pack_cache_time = 0
+        packs = store.packs
+        self.assertEqual(2, len(packs))
+        self.assertTrue([p for p in packs if p is pack1])
+        self.assertTrue(pack1.is_open())
+
+    def test_reload_removed_pack(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        cache = PackHandleCache()
+        store = DiskObjectStore(self.store_dir)
+        store.pack_handle_cache = cache
+        pack1, = store.packs
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertTrue(pack1 in cache)
+        os.remove(pack1._data_path)
+        os.remove(pack1._idx_path)
+        store._pack_cache_time = 0
+        self.assertEqual([], store.packs)
+        self.assertFalse(pack1.is_open())
+        self.assertEqual(0, len(cache))
+
+    def test_pack_handle_cache(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        cache = PackHandleCache(max_open_packs=1)
+        store = DiskObjectStore(self.store_dir)
+        store.pack_handle_cache = cache
+        packs = list(store.packs)
+        pack1 = [p for p in packs if sha1 in p][0]
+        pack2 = [p for p in packs if sha2 in p][0]
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        data_file = pack1._data._file
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+        self.assertEqual(1, len(cache))
+        self.assertTrue(pack2.is_open())
+        self.assertFalse(pack1.is_open())
+        self.assertTrue(cache.evictions > 0)
+        # The files of evicted packs are closed straight away.
+        self.assertTrue(data_file.closed)
+        # Released packs are loaded again when they are used.
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertTrue(pack1.is_open())
+        self.assertFalse(pack2.is_open())
+
+    def test_pack_handle_cache_mapped_size(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        cache = PackHandleCache(max_mapped_size=1)
+        store = DiskObjectStore(self.store_dir)
+        store.pack_handle_cache = cache
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+        # The pack that was used last is always kept.
+        self.assertEqual(1, len(cache))
+        self.assertTrue(cache.mapped_size() > 1)
+
+    def test_pack_handle_cache_touch(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        (sha3, _, data3), = self._add_pack([(Blob.type_num, 'much data')])
+        cache = PackHandleCache(max_open_packs=2)
+        store = DiskObjectStore(self.store_dir)
+        store.pack_handle_cache = cache
+        pack1 = [p for p in store.packs if sha1 in p][0]
+        store.get_raw(sha1)
+        store.get_raw(sha2)
+        store.get_raw(sha1)
+        store.get_raw(sha3)
+        # The least recently used pack is released.
+        self.assertTrue(pack1.is_open())
+        self.assertEqual(2, len(cache))
+
+    def test_delta_base_cache(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+        for pack in store.packs:
+            self.assertTrue(pack.data.delta_base_cache is
+                            store.delta_base_cache)
+
+    def test_close(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        store = DiskObjectStore(self.store_dir)
+        pack1, = store.packs
+        store.get_raw(sha1)
+        store.close()
+        self.assertFalse(pack1.is_open())
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+
+    def test_write_multi_pack_index(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        self.store.write_multi_pack_index()
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(2, len(store.packs))
+        self.assertEqual(2, len(store._midx))
+        self.assertEqual(2, len(store._midx_packs))
+        self.assertEqual([], list(store._iter_uncovered_packs()))
+        self.assertTrue(store.contains_packed(sha1))
+        self.assertTrue(store.contains_packed(sha2))
+        self.assertFalse(store.contains_packed('1' * 40))
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+
+    def test_multi_pack_index_uncovered_pack(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        self.store.write_multi_pack_index()
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(2, len(store.packs))
+        self.assertEqual(1, len(list(store._iter_uncovered_packs())))
+        self.assertTrue(store.contains_packed(sha2))
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+
+    def test_multi_pack_index_missing_pack(self):
+        (sha1, _, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        self.store.write_multi_pack_index()
+        pack, = self.store.packs
+        pack.close()
+        os.remove(pack._data_path)
+        os.remove(pack._idx_path)
+        (sha2, _, data2), = self._add_pack([(Blob.type_num, 'more data')])
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual({}, store._midx_packs)
+        self.assertFalse(store.contains_packed(sha1))
+        self.assertRaises(KeyError, store.get_raw, sha1)
+        self.assertEqual((Blob.type_num, data2), store.get_raw(sha2))
+
+    def test_multi_pack_index_missing_preferred_pack(self):
+        (sha1, bin1, data1), = self._add_pack([(Blob.type_num, 'yummy data')])
+        self._add_pack([(Blob.type_num, 'yummy data'),
+                        (Blob.type_num, 'more data')])
+        self.store.write_multi_pack_index()
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(2, len(store.packs))
+        preferred, _ = store._lookup_multi_pack_index(bin1)
+        preferred.close()
+        os.remove(preferred._data_path)
+        os.remove(preferred._idx_path)
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(1, len(store.packs))
+        self.assertEqual([], list(store._iter_uncovered_packs()))
+        self.assertTrue(store.contains_packed(sha1))
+        self.assertEqual((Blob.type_num, data1), store.get_raw(sha1))
+
 
 class TreeLookupPathTests(TestCase):
 
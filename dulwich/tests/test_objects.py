@@ -27,6 +27,7 @@ import datetime
 import os
 import stat
 import warnings
+import zlib
 
 from dulwich.errors import (
     ObjectFormatException,
@@ -49,6 +50,7 @@ from dulwich.objects import (
     TreeEntry,
     parse_tree,
     _parse_tree_py,
+    read_loose_object_info,
     sorted_tree_items,
     _sorted_tree_items_py,
     )
@@ -120,6 +122,27 @@ class BlobReadTests(TestCase):
         self.assertEqual(b.data, string)
         self.assertEqual(b.sha().hexdigest(), b_sha)
 
+    def test_from_raw_string_lazy(self):
+        c = make_commit()
+        raw = c.as_raw_string()
+        c2 = Commit.from_raw_string(Commit.type_num, raw)
+        self.assertTrue(c2._needs_parsing)
+        self.assertEqual(c.id, c2.id)
+        self.assertEqual(raw, c2.as_raw_string())
+        self.assertTrue(c2._needs_parsing)
+        self.assertEqual(c.parents, c2.parents)
+        self.assertFalse(c2._needs_parsing)
+
+    def test_from_raw_chunks_not_copied(self):
+        chunks = ['te', 'st']
+        b = Blob.from_raw_chunks(Blob.type_num, chunks)
+        self.assertTrue(b.as_raw_chunks() is chunks)
+        self.assertEqual('test', b.data)
+
+    def test_from_raw_string_type(self):
+        self.assertRaises(TypeError, Blob.from_raw_string, Blob.type_num,
+                          u'test')
+
     def test_legacy_from_file(self):
         b1 = Blob.from_string("foo")
         b_raw = b1.as_legacy_object()
@@ -214,6 +237,39 @@ class BlobReadTests(TestCase):
         self.assertNotEqual(sha, c._make_sha())
 
 
+class ReadLooseObjectInfoTests(TestCase):
+
+    def test_legacy(self):
+        b = Blob.from_string('x' * 1000)
+        self.assertEqual((Blob.type_num, 1000), read_loose_object_info(
+            StringIO(b.as_legacy_object())))
+
+    def test_legacy_file(self):
+        path = hex_to_filename(os.path.join(os.path.dirname(__file__), 'data',
+                                            'blobs'), c_sha)
+        f = open(path, 'rb')
+        try:
+            self.assertEqual((Blob.type_num, 7), read_loose_object_info(f))
+        finally:
+            f.close()
+
+    def test_new_style(self):
+        self.assertEqual((Blob.type_num, 3), read_loose_object_info(
+            StringIO('\x33' + zlib.compress('foo'))))
+        self.assertEqual((Tree.type_num, 100), read_loose_object_info(
+            StringIO('\xa4\x06' + zlib.compress('x' * 100))))
+
+    def test_invalid(self):
+        self.assertRaises(ObjectFormatException, read_loose_object_info,
+                          StringIO(''))
+        self.assertRaises(ObjectFormatException, read_loose_object_info,
+                          StringIO(zlib.compress('blob 3')))
+        self.assertRaises(ObjectFormatException, read_loose_object_info,
+                          StringIO(zlib.compress('bogus 3\0foo')))
+        self.assertRaises(ObjectFormatException, read_loose_object_info,
+                          StringIO('\xb4'))
+
+
 class ShaFileCheckTests(TestCase):
 
     def assertCheckFails(self, cls, data):
@@ -451,6 +507,34 @@ class TreeTests(ShaFileCheckTests):
             x[name] = item
         self.assertEquals(_SORTED_TREE_ITEMS, x.items())
 
+    def test_iteritems_not_kept(self):
+        x = Tree()
+        for name, item in _TREE_ITEMS.iteritems():
+            x[name] = item
+        y = Tree.from_raw_string(Tree.type_num, x.as_raw_string())
+        self.assertEqual(_SORTED_TREE_ITEMS, list(y.iteritems()))
+        self.assertEqual(sorted(_SORTED_TREE_ITEMS),
+                         list(y.iteritems(name_order=True)))
+        # Iterating parses the entries from the text every time.
+        self.assertEqual(None, y._entries)
+        self.assertEqual(_TREE_ITEMS['a.c'], y['a.c'])
+        self.assertEqual(3, len(y))
+        self.assertEqual(x.as_raw_string(), y.as_raw_string())
+
+    def test_change_parsed(self):
+        x = Tree()
+        x['a'] = (0100644, a_sha)
+        y = Tree.from_raw_string(Tree.type_num, x.as_raw_string())
+        y['b'] = (0100644, b_sha)
+        del y['a']
+        self.assertEqual([('b', 0100644, b_sha)], y.items())
+        self.assertEqual('100644 b\0' + hex_to_sha(b_sha), y.as_raw_string())
+
+    def test_tree_entry_slots(self):
+        entry = TreeEntry('a', 0100644, a_sha)
+        self.assertRaises(AttributeError, setattr, entry, 'foo', 1)
+        self.assertRaises(AttributeError, setattr, Tree(), 'foo', 1)
+
     def _do_test_parse_tree(self, parse_tree):
         dir = os.path.join(os.path.dirname(__file__), 'data', 'trees')
         o = Tree.from_path(hex_to_filename(dir, tree_sha))
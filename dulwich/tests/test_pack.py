@@ -23,7 +23,9 @@
 from cStringIO import StringIO
 import os
 import shutil
+import sys
 import tempfile
+import threading
 import zlib
 
 from dulwich._compat import (
@@ -50,32 +52,47 @@ from dulwich.pack import (
     OFS_DELTA,
     REF_DELTA,
     DELTA_TYPES,
+    DeltaBaseCache,
+    DeltaChainStats,
+    DeltaIndex,
     MemoryPackIndex,
+    MultiPackIndex,
     Pack,
     PackData,
     apply_delta,
     create_delta,
+    deltify_pack_entries,
     deltify_pack_objects,
+    load_multi_pack_index,
     load_pack_index,
     UnpackedObject,
     read_zlib_chunks,
     write_pack_header,
     write_pack_index_v1,
     write_pack_index_v2,
+    write_multi_pack_index,
     SHA1Writer,
+    ShaBloomFilter,
     write_pack_object,
+    write_pack_data,
+    generate_pack_chunks,
+    write_pack_objects,
     write_pack,
     unpack_object,
     compute_file_sha,
     PackStreamReader,
     DeltaChainIterator,
+    _DeltaIndex_py,
+    _RecordTable,
     )
 from dulwich.tests import (
+    SkipTest,
     TestCase,
     )
 from utils import (
     make_object,
     build_pack,
+    functest_builder,
     )
 
 pack1_sha = 'bc63ddad95e7321ee734ea11a7a62d314e0d7481'
@@ -180,6 +197,83 @@ class TestPackDeltas(TestCase):
         self._test_roundtrip(self.test_string_empty, self.test_string_big)
 
 
+class DeltaIndexTests(TestCase):
+
+    base = ''.join(['line %d of the base\n' % i for i in range(200)])
+
+    def _do_test_roundtrip(self, delta_index_cls):
+        target = self.base[:1000] + 'inserted\n' + self.base[1200:]
+        index = delta_index_cls(self.base)
+        self.assertEquals(len(self.base), len(index))
+        delta = index.delta_against(target)
+        self.assertTrue(len(delta) < 100)
+        self.assertEquals(target, ''.join(apply_delta(self.base, delta)))
+
+    def _do_test_reuse(self, delta_index_cls):
+        index = delta_index_cls(self.base)
+        for target in (self.base, self.base[::-1], '', self.base * 2):
+            self.assertEquals(target,
+                ''.join(apply_delta(self.base, index.delta_against(target))))
+
+    def _do_test_chunks(self, delta_index_cls):
+        index = delta_index_cls([self.base[:100], self.base[100:]])
+        delta = index.delta_against([self.base[:50], self.base[50:]])
+        self.assertEquals(self.base, ''.join(apply_delta(self.base, delta)))
+
+    def _do_test_large_copy(self, delta_index_cls):
+        base = ''.join(['%d\n' % i for i in range(40000)])
+        target = 'x' + base
+        delta = delta_index_cls(base).delta_against(target)
+        self.assertTrue(len(delta) < 100)
+        self.assertEquals(target, ''.join(apply_delta(base, delta)))
+
+    def _do_test_empty(self, delta_index_cls):
+        self.assertEquals('\x00\x03\x03abc',
+                          delta_index_cls('').delta_against('abc'))
+        self.assertEquals('\x03\x00',
+                          delta_index_cls('abc').delta_against(''))
+
+    test_roundtrip = functest_builder(_do_test_roundtrip, _DeltaIndex_py)
+    test_reuse = functest_builder(_do_test_reuse, _DeltaIndex_py)
+    test_chunks = functest_builder(_do_test_chunks, _DeltaIndex_py)
+    test_large_copy = functest_builder(_do_test_large_copy, _DeltaIndex_py)
+    test_empty = functest_builder(_do_test_empty, _DeltaIndex_py)
+
+    def _require_extension(self):
+        if DeltaIndex is _DeltaIndex_py:
+            raise SkipTest('DeltaIndex extension not found')
+
+    def test_roundtrip_extension(self):
+        self._require_extension()
+        self._do_test_roundtrip(DeltaIndex)
+
+    def test_reuse_extension(self):
+        self._require_extension()
+        self._do_test_reuse(DeltaIndex)
+
+    def test_chunks_extension(self):
+        self._require_extension()
+        self._do_test_chunks(DeltaIndex)
+
+    def test_large_copy_extension(self):
+        self._require_extension()
+        self._do_test_large_copy(DeltaIndex)
+
+    def test_empty_extension(self):
+        self._require_extension()
+        self._do_test_empty(DeltaIndex)
+
+    def test_extension_matches_python(self):
+        self._require_extension()
+        targets = [self.base[::-1], self.base[500:] + self.base[:500],
+                   'a' * 3000, self.base.replace('1', '2')]
+        for base in (self.base, 'a' * 2000):
+            for target in targets:
+                self.assertEquals(
+                    _DeltaIndex_py(base).delta_against(target),
+                    DeltaIndex(base).delta_against(target))
+
+
 class TestPackData(PackTests):
     """Tests getting the data from the packfile."""
 
@@ -194,6 +288,26 @@ class TestPackData(PackTests):
         p = self.get_pack_data(pack1_sha)
         self.assertEquals(3, len(p))
 
+    def test_get_object_at_mmap(self):
+        p = self.get_pack_data(pack1_sha)
+        self.addCleanup(p.close)
+        if not p.use_mmap:
+            self.skipTest('mmap not available')
+        self.assertNotEqual(None, p._contents)
+        offset = self.get_pack_index(pack1_sha).object_index(commit_sha)
+        mapped = p.get_object_at(offset)
+        p._contents = None
+        self.assertEqual(p.get_object_at(offset), mapped)
+        self.assertEqual(Commit.type_num, mapped[0])
+
+    def test_no_mmap(self):
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        f = StringIO(open(path, 'rb').read())
+        p = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual(None, p._contents)
+        offset = self.get_pack_index(pack1_sha).object_index(a_sha)
+        self.assertEqual(Blob.type_num, p.get_object_at(offset)[0])
+
     def test_index_check(self):
         p = self.get_pack_data(pack1_sha)
         self.assertSucceeds(p.check)
@@ -227,6 +341,29 @@ class TestPackData(PackTests):
           ('f18faa16531ac570a3fdc8c7ca16682548dafd12', 12, 3775879613L),
           ]), entries)
 
+    def test_get_unpacked_object_at_threads(self):
+        p = self.get_pack_data(pack1_sha)
+        expected = {}
+        for offset in (12, 138, 178):
+            expected[offset] = ''.join(
+                p.get_unpacked_object_at(offset).decomp_chunks)
+        errors = []
+        def read():
+            try:
+                for i in range(200):
+                    for offset, data in expected.iteritems():
+                        unpacked = p.get_unpacked_object_at(offset)
+                        self.assertEqual(data,
+                                         ''.join(unpacked.decomp_chunks))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
     def test_create_index_v1(self):
         p = self.get_pack_data(pack1_sha)
         filename = os.path.join(self.tempdir, 'v1test.idx')
@@ -268,6 +405,45 @@ class TestPack(PackTests):
         p = self.get_pack(pack1_sha)
         self.assertTrue(tree_sha in p)
 
+    def test_mapped_size(self):
+        p = self.get_pack(pack1_sha)
+        self.assertEquals(0, p.mapped_size())
+        index_size = p.index._size
+        self.assertEquals(index_size, p.mapped_size())
+        if p.data._contents is None:
+            raise SkipTest('pack data is not mmapped')
+        self.assertEquals(index_size + len(p.data._contents), p.mapped_size())
+
+    def test_release(self):
+        p = self.get_pack(pack1_sha)
+        data_file = p.data._file
+        index_file = p.index._file
+        p.release()
+        self.assertFalse(p.is_open())
+        self.assertTrue(data_file.closed)
+        self.assertTrue(index_file.closed)
+        # The pack is loaded again when it is used.
+        self.assertEquals(type(p[tree_sha]), Tree)
+
+    def test_release_in_use(self):
+        p = self.get_pack(pack1_sha)
+        p.begin_use()
+        data = p.data
+        p.release()
+        self.assertFalse(data._file.closed)
+        self.assertEquals(3, len(list(data.iterentries())))
+        p.end_use()
+        self.assertTrue(data._file.closed)
+
+    def test_release_while_iterating(self):
+        p = self.get_pack(pack1_sha)
+        objects = p.iterobjects()
+        objects.next()
+        data_file = p._data._file
+        p.release()
+        self.assertEquals(2, len(list(objects)))
+        self.assertTrue(data_file.closed)
+
     def test_get(self):
         p = self.get_pack(pack1_sha)
         self.assertEquals(type(p[tree_sha]), Tree)
@@ -302,6 +478,81 @@ class TestPack(PackTests):
         self.assertEqual(obj.type_name, 'commit')
         self.assertEqual(obj.sha().hexdigest(), commit_sha)
 
+    def test_get_unpacked_object(self):
+        p = self.get_pack(pack1_sha)
+        unpacked = p.get_unpacked_object(a_sha)
+        self.assertEqual(Blob.type_num, unpacked.pack_type_num)
+        self.assertEqual(None, unpacked.delta_base)
+        self.assertEqual(p[a_sha].as_raw_string(),
+                         ''.join(unpacked.decomp_chunks))
+        self.assertRaises(KeyError, p.get_unpacked_object, '1' * 40)
+
+    def test_get_unpacked_object_ofs_delta(self):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          ])
+        data = PackData('test.pack', file=f)
+        index = MemoryPackIndex(sorted((e[3], e[0], e[4]) for e in entries),
+                                data.get_stored_checksum())
+        p = Pack.from_objects(data, index)
+        unpacked = p.get_unpacked_object(entries[1][3])
+        self.assertEqual(REF_DELTA, unpacked.pack_type_num)
+        self.assertEqual(entries[0][3], unpacked.delta_base)
+        self.assertEqual(create_delta('blob', 'blob1'),
+                         ''.join(unpacked.decomp_chunks))
+
+    def _make_delta_pack(self, crc32_offset=0):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          ])
+        data = PackData('test.pack', file=f)
+        index = MemoryPackIndex(
+            sorted((e[3], e[0], e[4] + crc32_offset) for e in entries),
+            data.get_stored_checksum())
+        return entries, Pack.from_objects(data, index)
+
+    def test_get_raw_unresolved(self):
+        entries, p = self._make_delta_pack()
+        unpacked = p.get_raw_unresolved(entries[1][3])
+        self.assertEqual(REF_DELTA, unpacked.pack_type_num)
+        self.assertEqual(entries[0][3], unpacked.delta_base)
+        self.assertEqual(entries[1][4], unpacked.crc32)
+        self.assertEqual(entries[1][3], unpacked.sha())
+        self.assertEqual(create_delta('blob', 'blob1'),
+                         zlib.decompress(''.join(unpacked.comp_chunks)))
+
+    def test_get_raw_unresolved_crc32_mismatch(self):
+        entries, p = self._make_delta_pack(crc32_offset=1)
+        self.assertRaises(ChecksumMismatch, p.get_raw_unresolved,
+                          entries[0][3])
+
+    def test_iter_raw_entries(self):
+        entries, p = self._make_delta_pack()
+        self.assertEqual(
+            [(Blob.type_num, entries[0][3], None),
+             (REF_DELTA, entries[1][3], entries[0][3])],
+            [(u.pack_type_num, u.sha(), u.delta_base)
+             for u in p.iter_raw_entries()])
+
+    def test_write_raw_entries(self):
+        entries, p = self._make_delta_pack()
+        f = StringIO()
+        written, sha = write_pack_data(f, 2, p.iter_raw_entries())
+        self.assertEqual(
+            dict((e[3], (e[0], e[4])) for e in entries), written)
+        f.seek(0)
+        self.assertEqual(p.data._file.getvalue(), f.getvalue())
+
+    def test_object_sha1(self):
+        p = self.get_pack(pack1_sha)
+        offset = p.index.object_index(tree_sha)
+        self.assertEqual(hex_to_sha(tree_sha), p.index.object_sha1(offset))
+        self.assertRaises(KeyError, p.index.object_sha1, 1)
+
     def test_copy(self):
         origpack = self.get_pack(pack1_sha)
 
@@ -414,6 +665,226 @@ class TestPack(PackTests):
         self.assertTrue(isinstance(objs[tree_sha], Tree))
         self.assertTrue(isinstance(objs[commit_sha], Commit))
 
+    def test_bloom_filter(self):
+        p = self.get_pack(pack1_sha)
+        for sha in p.index._itersha():
+            self.assertTrue(sha in p.bloom_filter)
+        self.assertTrue(p.bloom_filter is p.bloom_filter)
+
+    def test_find_offset(self):
+        p = self.get_pack(pack1_sha)
+        self.assertEqual(p.index.object_index(hex_to_sha(a_sha)),
+                         p.find_offset(hex_to_sha(a_sha)))
+        self.assertEqual(None, p.find_offset('1' * 20))
+
+    def test_find_offset_builds_bloom_filter(self):
+        p = self.get_pack(pack1_sha)
+        p.bloom_filter_threshold = 3
+        for i in range(2):
+            self.assertEqual(None, p.find_offset(str(i) * 20))
+        # Cold packs are looked up in the index only.
+        self.assertEqual(None, p._bloom_filter)
+        self.assertEqual(None, p.find_offset('2' * 20))
+        self.assertNotEqual(None, p._bloom_filter)
+        self.assertEqual(None, p.find_offset('3' * 20))
+        self.assertEqual(p.index.object_index(hex_to_sha(tree_sha)),
+                         p.find_offset(hex_to_sha(tree_sha)))
+
+
+class DeltaBaseCacheTests(TestCase):
+
+    def test_hits_misses(self):
+        cache = DeltaBaseCache()
+        self.assertEqual(None, cache.get('pack', 12))
+        cache.add('pack', 12, Blob.type_num, ['foo'])
+        self.assertEqual((Blob.type_num, ['foo']), cache.get('pack', 12))
+        self.assertEqual(None, cache.get('other', 12))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_max_size(self):
+        cache = DeltaBaseCache(max_size=10)
+        cache.add('pack', 12, Blob.type_num, ['abcd'])
+        cache.add('pack', 20, Blob.type_num, ['efgh'])
+        self.assertEqual(8, cache.size())
+        cache.add('pack', 30, Blob.type_num, ['ijkl'])
+        self.assertTrue(cache.size() <= 10)
+        self.assertEqual(None, cache.get('pack', 12))
+        self.assertEqual((Blob.type_num, ['ijkl']), cache.get('pack', 30))
+
+    def test_too_big(self):
+        cache = DeltaBaseCache(max_size=10)
+        cache.add('pack', 12, Blob.type_num, ['x' * 10])
+        self.assertEqual(0, len(cache))
+
+    def test_resize(self):
+        cache = DeltaBaseCache(max_size=10)
+        cache.add('pack', 12, Blob.type_num, ['abcd'])
+        cache.add('pack', 20, Blob.type_num, ['efgh'])
+        cache.resize(5)
+        self.assertEqual(5, cache.max_size)
+        self.assertTrue(cache.size() <= 5)
+
+    def test_pack_data(self):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          ])
+        cache = DeltaBaseCache()
+        data = PackData('test.pack', file=f, delta_base_cache=cache)
+        offset = entries[1][0]
+        type_num, obj = data.get_object_at(offset)
+        self.assertEqual((Blob.type_num, ['blob1']),
+                         data.resolve_object(offset, type_num, obj))
+        self.assertEqual(1, len(cache))
+        # The resolved object is found in the cache.
+        self.assertEqual((Blob.type_num, ['blob1']),
+                         data.get_object_at(offset))
+        self.assertEqual(1, cache.hits)
+
+    def test_shared_by_packs(self):
+        path = os.path.join(tempfile.mkdtemp(), 'pack-test')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        f = open(path + '.pack', 'wb')
+        try:
+            entries = build_pack(f, [
+              (Blob.type_num, 'blob'),
+              (OFS_DELTA, (0, 'blob1')),
+              ])
+        finally:
+            f.close()
+        PackData(path + '.pack').create_index_v2(path + '.idx')
+        cache = DeltaBaseCache()
+        pack1 = Pack(path)
+        pack1.delta_base_cache = cache
+        self.assertEqual((Blob.type_num, 'blob1'),
+                         pack1.get_raw(entries[1][3]))
+        self.assertTrue(pack1.data.delta_base_cache is cache)
+        hits = cache.hits
+        # Another handle of the same pack file uses the cached objects.
+        pack2 = Pack(path)
+        pack2.delta_base_cache = cache
+        self.assertEqual((Blob.type_num, 'blob1'),
+                         pack2.get_raw(entries[1][3]))
+        self.assertEqual(hits + 1, cache.hits)
+        pack1.close()
+        pack2.close()
+
+
+class DeltaChainTestCase(TestCase):
+
+    def make_chain(self, length, delta_type=OFS_DELTA):
+        spec = [(Blob.type_num, 'blob 0')]
+        for i in xrange(1, length):
+            spec.append((delta_type, (i - 1, 'blob %d' % i)))
+        f = StringIO()
+        entries = build_pack(f, spec)
+        data = PackData('test.pack', file=f)
+        index = MemoryPackIndex(sorted((e[3], e[0], e[4]) for e in entries),
+                                data.get_stored_checksum())
+        # Loading the data sets data.pack, which REF_DELTA bases are looked
+        # up in.
+        Pack.from_objects(data, index).data
+        return entries, data
+
+
+class ResolveObjectTests(DeltaChainTestCase):
+
+    def resolve(self, data, offset, stats=None):
+        type_num, obj = data.get_object_at(offset)
+        type_num, chunks = data.resolve_object(offset, type_num, obj,
+                                               stats=stats)
+        return type_num, ''.join(chunks)
+
+    def test_not_delta(self):
+        entries, data = self.make_chain(1)
+        stats = DeltaChainStats()
+        self.assertEqual((Blob.type_num, 'blob 0'),
+                         self.resolve(data, entries[0][0], stats))
+        self.assertEqual(0, stats.depth)
+
+    def test_long_chain(self):
+        # Deeper than the recursion limit
+        length = sys.getrecursionlimit() + 100
+        entries, data = self.make_chain(length)
+        stats = DeltaChainStats()
+        self.assertEqual((Blob.type_num, 'blob %d' % (length - 1)),
+                         self.resolve(data, entries[-1][0], stats))
+        self.assertEqual(length - 1, stats.depth)
+        self.assertFalse(stats.base_cached)
+
+    def test_cached_intermediates(self):
+        entries, data = self.make_chain(20)
+        stats = DeltaChainStats()
+        self.resolve(data, entries[19][0], stats)
+        self.assertEqual(19, stats.depth)
+        # The object itself and every eighth base are cached.
+        self.assertEqual(3, stats.cached)
+        self.assertEqual((Blob.type_num, 'blob 18'),
+                         self.resolve(data, entries[18][0], stats))
+        self.assertEqual(7, stats.depth)
+        self.assertTrue(stats.base_cached)
+
+    def test_ref_delta_chain(self):
+        entries, data = self.make_chain(10, delta_type=REF_DELTA)
+        stats = DeltaChainStats()
+        self.assertEqual((Blob.type_num, 'blob 9'),
+                         self.resolve(data, entries[9][0], stats))
+        self.assertEqual(9, stats.depth)
+
+    def test_ref_delta_get_ref(self):
+        base = make_object(Blob, data='blob')
+        store = MemoryObjectStore()
+        store.add_object(base)
+        f = StringIO()
+        entries = build_pack(f, [(REF_DELTA, (base.id, 'blob1'))],
+                             store=store)
+        data = PackData('test.pack', file=f)
+        type_num, obj = data.get_object_at(entries[0][0])
+        get_ref = lambda sha: (None, Blob.type_num, ['blob'])
+        self.assertEqual((Blob.type_num, ['blob1']),
+                         data.resolve_object(entries[0][0], type_num, obj,
+                                             get_ref=get_ref))
+
+
+class GetObjectInfoTests(DeltaChainTestCase):
+
+    def test_not_delta(self):
+        entries, data = self.make_chain(1)
+        self.assertEqual((Blob.type_num, 6),
+                         data.get_object_info_at(entries[0][0]))
+
+    def test_ofs_delta_chain(self):
+        entries, data = self.make_chain(12)
+        self.assertEqual((Blob.type_num, 7),
+                         data.get_object_info_at(entries[11][0]))
+
+    def test_ref_delta_chain(self):
+        entries, data = self.make_chain(3, delta_type=REF_DELTA)
+        self.assertEqual((Blob.type_num, 6),
+                         data.get_object_info_at(entries[2][0]))
+        self.assertEqual((Blob.type_num, 6),
+                         data.pack.get_object_info(entries[2][3]))
+
+    def test_object_header(self):
+        entries, data = self.make_chain(2)
+        self.assertEqual((Blob.type_num, None),
+                         data.get_object_header_at(entries[0][0]))
+        self.assertEqual((OFS_DELTA, entries[1][0] - entries[0][0]),
+                         data.get_object_header_at(entries[1][0]))
+        self.assertEqual((REF_DELTA, entries[0][3]),
+                         data.pack.get_object_header(entries[1][3]))
+        self.assertEqual(0, len(data.delta_base_cache))
+
+    def test_large_delta(self):
+        f = StringIO()
+        entries = build_pack(f, [(Blob.type_num, 'x' * 100000),
+                                 (OFS_DELTA, (0, 'y' + 'x' * 200000))])
+        data = PackData('test.pack', file=f)
+        self.assertEqual((Blob.type_num, 200001),
+                         data.get_object_info_at(entries[1][0]))
+        self.assertEqual(0, len(data.delta_base_cache))
+
 
 class WritePackTests(TestCase):
 
@@ -451,6 +922,47 @@ class WritePackTests(TestCase):
         sha_b.update(f.getvalue()[offset:])
         self.assertEqual(sha_a.digest(), sha_b.digest())
 
+    def test_write_pack_objects_deltas(self):
+        f = StringIO()
+        text = "".join(["line %d\n" % i for i in range(50)])
+        blobs = [Blob.from_string(text + "x" * i) for i in range(5)]
+        entries, sha = write_pack_objects(f, [(b, None) for b in blobs])
+        f.seek(0)
+        objects = list(PackStreamReader(f.read).read_objects())
+        self.assertEqual(5, len(objects))
+        self.assertEqual(1, len([o for o in objects
+                                 if o.pack_type_num == Blob.type_num]))
+        self.assertEqual(4, len([o for o in objects
+                                 if o.pack_type_num == OFS_DELTA]))
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        index = MemoryPackIndex(
+            sorted((s, o, c) for (s, (o, c)) in entries.iteritems()),
+            sha)
+        pack = Pack.from_objects(data, index)
+        for b in blobs:
+            self.assertEqual(b, pack[b.id])
+
+    def test_write_pack_objects_no_window(self):
+        f = StringIO()
+        blobs = [Blob.from_string("a" * (200 - i)) for i in range(3)]
+        write_pack_objects(f, [(b, None) for b in blobs], window=0)
+        f.seek(0)
+        self.assertEqual([Blob.type_num] * 3,
+            [o.pack_type_num
+             for o in PackStreamReader(f.read).read_objects()])
+
+    def test_generate_pack_chunks(self):
+        text = "".join(["line %d\n" % i for i in range(50)])
+        objects = [(Blob.from_string(text + "x" * i), None) for i in range(5)]
+        f = StringIO()
+        write_pack_objects(f, objects)
+        chunks = list(generate_pack_chunks(objects))
+        # One chunk per object, the first including the header, and the
+        # trailer
+        self.assertEqual(6, len(chunks))
+        self.assertEqual(f.getvalue(), ''.join(chunks))
+
 
 pack_checksum = hex_to_sha('721980e866af9a5f93ad674144e1459b8ba3e7b7')
 
@@ -556,6 +1068,91 @@ class TestPackIndexWritingv2(TestCase, BaseTestFilePackIndexWriting):
         BaseTestFilePackIndexWriting.tearDown(self)
 
 
+class ShaBloomFilterTests(TestCase):
+
+    def test_empty(self):
+        bloom = ShaBloomFilter(0)
+        self.assertFalse('1' * 20 in bloom)
+
+    def test_contains(self):
+        shas = [make_sha(str(i)).digest() for i in range(100)]
+        bloom = ShaBloomFilter.from_shas(len(shas), shas)
+        for sha in shas:
+            self.assertTrue(sha in bloom)
+        others = [make_sha('x%d' % i).digest() for i in range(100)]
+        self.assertTrue(len([sha for sha in others if sha in bloom]) < 10)
+
+
+class MultiPackIndexTests(TestCase):
+
+    def setUp(self):
+        super(MultiPackIndexTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write_and_load(self, packs):
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = GitFile(path, 'wb')
+        try:
+            sha = write_multi_pack_index(f, packs)
+        finally:
+            f.close()
+        midx = load_multi_pack_index(path)
+        self.addCleanup(midx.close)
+        midx.check()
+        self.assertEqual(sha, midx.get_stored_checksum())
+        return midx
+
+    def test_empty(self):
+        midx = self.write_and_load([])
+        self.assertEqual(0, len(midx))
+        self.assertEqual([], midx.pack_names)
+        self.assertFalse('1' * 40 in midx)
+
+    def test_lookup(self):
+        sha1 = hex_to_sha('6f670c0fb53f9463760b7295fbb814e965fb20c8')
+        sha2 = hex_to_sha('06f670c0fb53f9463760b7295fbb814e965fb20c')
+        sha3 = hex_to_sha('f6f670c0fb53f9463760b7295fbb814e965fb20c')
+        midx = self.write_and_load([
+          ('pack-b.idx', MemoryPackIndex([(sha1, 12, 0), (sha2, 50, 0)])),
+          ('pack-a.idx', MemoryPackIndex([(sha1, 30, 0), (sha3, 12, 0)])),
+          ])
+        self.assertEqual(1, midx.version)
+        self.assertEqual(['pack-a.idx', 'pack-b.idx'], midx.pack_names)
+        self.assertEqual(3, len(midx))
+        self.assertEqual(('pack-b.idx', 12), midx.object_entry(sha1))
+        self.assertEqual(('pack-b.idx', 50),
+                         midx.object_entry(sha_to_hex(sha2)))
+        self.assertEqual(('pack-a.idx', 12), midx.object_entry(sha3))
+        self.assertRaises(KeyError, midx.object_entry, '1' * 20)
+        self.assertEqual([
+          (sha2, 'pack-b.idx', 50),
+          (sha1, 'pack-b.idx', 12),
+          (sha3, 'pack-a.idx', 12),
+          ], list(midx.iterentries()))
+
+    def test_large_offset(self):
+        sha1 = hex_to_sha('6f670c0fb53f9463760b7295fbb814e965fb20c8')
+        sha2 = hex_to_sha('06f670c0fb53f9463760b7295fbb814e965fb20c')
+        midx = self.write_and_load([
+          ('pack-a.idx', MemoryPackIndex([(sha1, 0x80000000 + 3, 0),
+                                          (sha2, 12, 0)])),
+          ])
+        self.assertEqual(('pack-a.idx', 0x80000000 + 3),
+                         midx.object_entry(sha1))
+        self.assertEqual(('pack-a.idx', 12), midx.object_entry(sha2))
+
+    def test_checksum_mismatch(self):
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = StringIO()
+        write_multi_pack_index(f, [])
+        contents = f.getvalue()
+        midx = MultiPackIndex(path, file=StringIO(),
+                              contents=contents[:-1] + 'x',
+                              size=len(contents))
+        self.assertRaises(ChecksumMismatch, midx.check)
+
+
 class ReadZlibTests(TestCase):
 
     decomp = (
@@ -658,6 +1255,80 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, ""), (b2, "")])))
 
+    def test_different_types(self):
+        b = Blob.from_string("a" * 101)
+        t = Tree()
+        t.add("a" * 100, 0100644, b.id)
+        self.assertEquals([None, None],
+            [e[2] for e in deltify_pack_objects([(b, ""), (t, "")])])
+
+    def test_not_worthwhile(self):
+        b1 = Blob.from_string("abc" * 100)
+        b2 = Blob.from_string("xyz" * 100)
+        self.assertEquals([None, None],
+            [e[2] for e in deltify_pack_objects([(b1, ""), (b2, "")])])
+
+    def test_window(self):
+        blobs = [Blob.from_string("a" * (200 - i)) for i in range(3)]
+        result = list(deltify_pack_objects([(b, "") for b in blobs],
+                                           window=1))
+        self.assertEquals(
+            [None, blobs[0].sha().digest(), blobs[1].sha().digest()],
+            [e[2] for e in result])
+
+    def test_depth(self):
+        blobs = [Blob.from_string("a" * (200 - i)) for i in range(4)]
+        result = list(deltify_pack_objects([(b, "") for b in blobs],
+                                           window=1, depth=2))
+        self.assertEquals(
+            [None, blobs[0].sha().digest(), blobs[1].sha().digest(), None],
+            [e[2] for e in result])
+
+
+class DeltifyEntriesTests(TestCase):
+
+    def setUp(self):
+        super(DeltifyEntriesTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.fetched = []
+
+    def get_raw(self, sha):
+        self.fetched.append(sha)
+        return self.store.get_raw(sha)
+
+    def add_objects(self, objects):
+        for obj in objects:
+            self.store.add_object(obj)
+        return [(obj, "") for obj in objects]
+
+    def test_empty(self):
+        self.assertEquals([], list(deltify_pack_entries(self.get_raw, [])))
+
+    def test_same_as_objects(self):
+        b = Blob.from_string("a" * 101)
+        t = Tree()
+        t.add("a" * 100, 0100644, b.id)
+        objects = self.add_objects(
+            [Blob.from_string("a" * (200 - i)) for i in range(4)] + [b, t])
+        for window in (0, 1, 10):
+            self.assertEquals(
+                list(deltify_pack_objects(objects, window=window, depth=2)),
+                list(deltify_pack_entries(self.get_raw,
+                    [(o.id, path) for (o, path) in objects], window=window,
+                    depth=2)))
+
+    def test_fetched_twice(self):
+        objects = self.add_objects(
+            [Blob.from_string("a" * (200 - i)) for i in range(3)])
+        result = deltify_pack_entries(self.get_raw,
+            [(o.id, path) for (o, path) in objects])
+        result.next()
+        # All objects are retrieved once to sort them, then again one at a
+        # time.
+        self.assertEquals(4, len(self.fetched))
+        self.assertEquals(2, len(list(result)))
+        self.assertEquals(6, len(self.fetched))
+
 
 class TestPackStreamReader(TestCase):
 
@@ -709,6 +1380,42 @@ class TestPackStreamReader(TestCase):
         self.assertEqual([], list(reader.read_objects()))
 
 
+class RecordTableTests(TestCase):
+
+    def make_table(self, values, **kwargs):
+        table = _RecordTable('>ll', **kwargs)
+        self.addCleanup(table.close)
+        for i, value in enumerate(values):
+            table.append(value, i)
+        return table
+
+    def test_sort(self):
+        table = self.make_table([3, 1, 2])
+        table.sort()
+        self.assertEqual([(1, 1), (2, 2), (3, 0)], list(table))
+
+    def test_sort_spilled(self):
+        values = [(i * 7) % 23 for i in xrange(23)]
+        table = self.make_table(values, sort_run_size=40)
+        table.spill()
+        table.sort()
+        self.assertTrue(table.is_spilled())
+        self.assertEqual(sorted((v, i) for i, v in enumerate(values)),
+                         list(table))
+        self.assertEqual(5, table.bisect_left(5))
+
+    def test_iter_spilled_blocks(self):
+        table = self.make_table(range(20000))
+        table.spill()
+        self.assertEqual([(i, i) for i in xrange(20000)], list(table))
+
+    def test_empty(self):
+        table = self.make_table([])
+        table.spill()
+        table.sort()
+        self.assertEqual([], list(table))
+
+
 class TestPackIterator(DeltaChainIterator):
 
     _compute_crc32 = True
@@ -922,3 +1629,30 @@ class DeltaChainIteratorTests(TestCase):
             self.fail()
         except KeyError, e:
             self.assertEqual((sorted([b2.id, b3.id]),), e.args)
+
+
+class SpillingDeltaChainIteratorTests(DeltaChainIteratorTests):
+    """Delta chain iterator tests with all records in temporary files."""
+
+    def make_pack_iter(self, f, thin=None):
+        if thin is None:
+            thin = bool(list(self.store))
+        resolve_ext_ref = thin and self.get_raw_no_repeat or None
+        data = PackData('test.pack', file=f)
+        pack_iter = TestPackIterator.for_pack_data(
+          data, resolve_ext_ref=resolve_ext_ref, spill_threshold=0)
+        self.addCleanup(pack_iter.close)
+        self.assertTrue(pack_iter.is_spilled())
+        self.assertEqual(0, pack_iter.memory_usage())
+        return pack_iter
+
+    def test_memory_usage(self):
+        f = StringIO()
+        build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          ])
+        data = PackData('test.pack', file=f)
+        pack_iter = TestPackIterator.for_pack_data(data)
+        self.assertFalse(pack_iter.is_spilled())
+        self.assertTrue(pack_iter.memory_usage() > 0)
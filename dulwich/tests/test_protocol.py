@@ -21,12 +21,14 @@
 
 from StringIO import StringIO
 
+from dulwich import protocol
 from dulwich.errors import (
     HangupException,
     )
 from dulwich.protocol import (
     PktLineParser,
     Protocol,
+    ProtocolStats,
     ReceivableProtocol,
     extract_capabilities,
     extract_want_line_capabilities,
@@ -35,6 +37,10 @@ from dulwich.protocol import (
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     BufferedPktLineWriter,
+    BufferedWriter,
+    SideBandReader,
+    pkt_line,
+    report_reads,
     )
 from dulwich.tests import TestCase
 
@@ -282,6 +288,72 @@ class BufferedPktLineWriterTests(TestCase):
         self._writer.flush()
         self.assertOutputEquals('0005z')
 
+    def test_write_after_flush(self):
+        self._writer.write('foo')
+        self._writer.write('barbaz')
+        self._writer.flush()
+        self._truncate()
+        self._writer.write('foo')
+        self.assertOutputEquals('')
+        self._writer.flush()
+        self.assertOutputEquals('0007foo')
+
+
+class BufferedWriterTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._chunks = []
+        self._writer = BufferedWriter(self._chunks.append, bufsize=4)
+
+    def test_write(self):
+        self._writer.write('foo')
+        self.assertEqual([], self._chunks)
+        self._writer.flush()
+        self.assertEqual(['foo'], self._chunks)
+
+    def test_flush_empty(self):
+        self._writer.flush()
+        self.assertEqual([], self._chunks)
+
+    def test_coalesce(self):
+        for c in 'abcdefghij':
+            self._writer.write(c)
+        self.assertEqual(['abcd', 'efgh'], self._chunks)
+        self._writer.flush()
+        self.assertEqual(['abcd', 'efgh', 'ij'], self._chunks)
+
+    def test_large_write(self):
+        self._writer.write('a')
+        self._writer.write('bcdefghijkl')
+        self.assertEqual(['abcd', 'efgh', 'ijkl'], self._chunks)
+        self._writer.flush()
+        self.assertEqual(['abcd', 'efgh', 'ijkl'], self._chunks)
+
+    def test_stats(self):
+        self._writer.write('abcdef')
+        self._writer.flush()
+        self.assertEqual(6, self._writer.bytes_written)
+        self.assertEqual(2, self._writer.chunks_written)
+
+    def test_sideband(self):
+        output = StringIO()
+        proto = Protocol(None, output.write)
+        writer = BufferedWriter(lambda d: proto.write_sideband(1, d))
+        for i in xrange(10000):
+            writer.write('0123456789')
+        writer.flush()
+        proto.write_pkt_line(None)
+        self.assertEqual(2, writer.chunks_written)
+        self.assertEqual(100000, writer.bytes_written)
+        output.seek(0)
+        proto = Protocol(output.read, None)
+        pkts = list(proto.read_pkt_seq())
+        self.assertEqual([65516, 100000 - 65515 + 1], map(len, pkts))
+        self.assertEqual(['\x01', '\x01'], [p[0] for p in pkts])
+        self.assertEqual('0123456789' * 10000,
+                         ''.join(p[1:] for p in pkts))
+
 
 class PktLineParserTests(TestCase):
 
@@ -307,3 +379,144 @@ class PktLineParserTests(TestCase):
         parser.parse("0005z0006aba")
         self.assertEquals(pktlines, ["z", "ab"])
         self.assertEquals("a", parser.get_tail())
+
+
+class SideBandReaderTests(TestCase):
+
+    def make_reader(self, *pkts):
+        self.progress = []
+        data = ''.join(pkt_line(pkt) for pkt in pkts) + '0000'
+        proto = Protocol(StringIO(data).read, None)
+        return SideBandReader(proto, {2: self.progress.append, 3: None})
+
+    def test_read(self):
+        reader = self.make_reader('\x01abc', '\x02progress', '\x01defgh')
+        self.assertEquals('abcd', reader.read(4))
+        self.assertEquals(['progress'], self.progress)
+        self.assertEquals('ef', reader.read_some(2))
+        self.assertEquals('gh', reader.read_some(10))
+        self.assertEquals('', reader.read_some(10))
+        self.assertEquals('', reader.read(10))
+
+    def test_read_short(self):
+        reader = self.make_reader('\x01abc', '\x03ignored')
+        self.assertEquals('abc', reader.read(10))
+
+    def test_read_all_data(self):
+        reader = self.make_reader('\x01abc', '\x01def', '\x02done')
+        self.assertEquals('a', reader.read(1))
+        self.assertEquals('bcdef', reader.read_all_data())
+        self.assertEquals(['done'], self.progress)
+
+    def test_invalid_channel(self):
+        reader = self.make_reader('\x05abc')
+        self.assertRaises(AssertionError, reader.read, 1)
+
+
+class ProtocolStatsTests(TestCase):
+
+    def setUp(self):
+        super(ProtocolStatsTests, self).setUp()
+        self.ended = []
+        self.stats = ProtocolStats(
+            phase_callback=lambda *args: self.ended.append(args))
+        self.now = 0.0
+        self.stats_time = protocol.time.time
+        protocol.time.time = lambda: self.now
+        self.addCleanup(setattr, protocol.time, 'time', self.stats_time)
+
+    def test_report_activity(self):
+        self.stats.report_activity(3, 'read')
+        self.stats.report_activity(4, 'write')
+        self.stats.report_activity(5, 'read')
+        self.assertEqual(8, self.stats.bytes_read)
+        self.assertEqual(4, self.stats.bytes_written)
+
+    def test_add_count(self):
+        self.stats.add_count('objects', 3)
+        self.stats.add_count('haves')
+        self.stats.add_count('haves')
+        self.assertEqual({'objects': 3, 'haves': 2}, self.stats.counts)
+
+    def test_phase(self):
+        self.stats.start_phase('negotiate')
+        self.now = 2.0
+        self.stats.end_phase('negotiate')
+        self.assertEqual({'negotiate': 2.0}, self.stats.timings)
+        self.assertEqual([('negotiate', 2.0)], self.ended)
+
+    def test_nested_phase(self):
+        self.stats.start_phase('writing')
+        self.now = 1.0
+        self.stats.start_phase('compressing')
+        self.now = 4.0
+        self.stats.end_phase('compressing')
+        self.now = 5.0
+        self.stats.end_phase('writing')
+        # Time spent in the inner phase is not counted for the outer one.
+        self.assertEqual({'writing': 2.0, 'compressing': 3.0},
+                         self.stats.timings)
+
+    def test_end_phase_not_running(self):
+        self.stats.end_phase('writing')
+        self.assertEqual({}, self.stats.timings)
+        self.assertEqual([], self.ended)
+
+    def test_end_phase_unended_inner(self):
+        self.stats.start_phase('writing')
+        self.stats.start_phase('compressing')
+        self.now = 1.0
+        self.stats.end_phase('writing')
+        self.assertEqual({'writing': 1.0}, self.stats.timings)
+        self.stats.end_phase('compressing')
+        self.assertEqual({'writing': 1.0}, self.stats.timings)
+
+    def test_timed_iter(self):
+        def gen():
+            self.now += 1.0
+            yield 'a'
+            self.now += 2.0
+            yield 'b'
+        self.stats.start_phase('writing')
+        for item in self.stats.timed_iter('compressing', gen()):
+            self.now += 10.0
+        self.stats.end_phase('writing')
+        self.assertEqual({'writing': 20.0, 'compressing': 3.0},
+                         self.stats.timings)
+
+    def test_str(self):
+        self.stats.report_activity(10, 'read')
+        self.stats.report_activity(20, 'write')
+        self.stats.start_phase('counting')
+        self.now = 0.5
+        self.stats.end_phase('counting')
+        self.stats.add_count('objects', 3)
+        self.assertEqual(
+            'read 10 bytes, wrote 20 bytes, counting 0.500s, 3 objects',
+            str(self.stats))
+
+
+class ReportReadsTests(TestCase):
+
+    def test_report_reads(self):
+        stats = ProtocolStats()
+        read = report_reads(StringIO('foobar').read, stats.report_activity)
+        self.assertEqual('foo', read(3))
+        self.assertEqual('bar', read(10))
+        self.assertEqual('', read(10))
+        self.assertEqual(6, stats.bytes_read)
+
+    def test_no_report_activity(self):
+        read = StringIO('foobar').read
+        self.assertTrue(read is report_reads(read, None))
+
+    def test_write_file(self):
+        stats = ProtocolStats()
+        out = StringIO()
+        proto = Protocol(None, out.write,
+                         report_activity=stats.report_activity)
+        f = proto.write_file()
+        f.write('foo')
+        f.write('barbaz')
+        self.assertEqual('foobarbaz', out.getvalue())
+        self.assertEqual(9, stats.bytes_written)
@@ -33,11 +33,15 @@ from dulwich.object_store import (
     tree_lookup_path,
     )
 from dulwich import objects
+from dulwich.pack import (
+    DEFAULT_DELTA_BASE_CACHE_LIMIT,
+    )
 from dulwich.repo import (
     check_ref_format,
     DictRefsContainer,
     Repo,
     MemoryRepo,
+    parse_config_size,
     read_packed_refs,
     read_packed_refs_with_peeled,
     write_packed_refs,
@@ -93,6 +97,42 @@ class CreateRepositoryTests(TestCase):
         self._check_repo_contents(repo, True)
 
 
+class RepositoryConfigTests(TestCase):
+
+    def make_repo(self, config):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        Repo.init_bare(tmp_dir)
+        f = open(os.path.join(tmp_dir, 'config'), 'wb')
+        try:
+            f.write(config)
+        finally:
+            f.close()
+        return Repo(tmp_dir)
+
+    def test_get_config_indented(self):
+        repo = self.make_repo('[core]\n\tbare = true\n\tfilemode = true\n')
+        self.assertEqual({'core': {'bare': 'true', 'filemode': 'true'}},
+                         repo.get_config())
+
+    def test_delta_base_cache_limit(self):
+        repo = self.make_repo('[core]\n\tdeltaBaseCacheLimit = 10m\n')
+        self.assertEqual(10 * 1024 * 1024,
+                         repo.object_store.delta_base_cache.max_size)
+
+    def test_invalid_delta_base_cache_limit(self):
+        repo = self.make_repo('[core]\n\tdeltaBaseCacheLimit = lots\n')
+        self.assertEqual(DEFAULT_DELTA_BASE_CACHE_LIMIT,
+                         repo.object_store.delta_base_cache.max_size)
+
+    def test_parse_config_size(self):
+        self.assertEqual(100, parse_config_size('100'))
+        self.assertEqual(2048, parse_config_size('2k'))
+        self.assertEqual(3 * 1024 * 1024, parse_config_size('3M'))
+        self.assertEqual(1024 * 1024 * 1024, parse_config_size('1g'))
+        self.assertRaises(ValueError, parse_config_size, 'lots')
+
+
 class RepositoryTests(TestCase):
 
     def setUp(self):
@@ -733,6 +773,19 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'refs/tags/refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
           }, self._refs.get_packed_refs())
 
+    def test_get_packed_refs_changed(self):
+        self.assertEqual(2, len(self._refs.get_packed_refs()))
+        # Another process packs the refs.
+        f = open(os.path.join(self._refs.path, 'packed-refs'), 'wb')
+        try:
+            f.write('%s refs/heads/other\n' % ('1' * 40))
+        finally:
+            f.close()
+        self.assertEqual({'refs/heads/other': '1' * 40},
+                         self._refs.get_packed_refs())
+        os.remove(os.path.join(self._refs.path, 'packed-refs'))
+        self.assertEqual({}, self._refs.get_packed_refs())
+
     def test_get_peeled_not_packed(self):
         # not packed
         self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.2'))
@@ -20,24 +20,38 @@
 
 from cStringIO import StringIO
 import os
+import shutil
+import socket
 import tempfile
+import threading
 
 from dulwich.errors import (
     GitProtocolError,
     NotGitRepository,
     UnexpectedCommandError,
     )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.protocol import (
+    Protocol,
+    pkt_line,
+    )
 from dulwich.repo import (
     MemoryRepo,
     Repo,
     )
 from dulwich.server import (
     Backend,
+    CachingBackend,
     DictBackend,
     FileSystemBackend,
     Handler,
     MultiAckGraphWalkerImpl,
     MultiAckDetailedGraphWalkerImpl,
+    PreforkingTCPGitServer,
+    TCPGitServer,
+    ThreadedTCPGitServer,
     _split_proto_line,
     serve_command,
     ProtocolGraphWalker,
@@ -47,7 +61,9 @@ from dulwich.server import (
     )
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_commit,
+    make_object,
     )
 
 
@@ -194,6 +210,49 @@ class UploadPackHandlerTestCase(TestCase):
         self.assertEquals({}, self._handler.get_tagged(refs, repo=self._repo))
 
 
+class UploadPackHandlerStatsTestCase(TestCase):
+
+    def test_stats(self):
+        repo = MemoryRepo.init_bare([], {})
+        c1, c2 = build_commit_graph(repo.object_store, [[1], [2, 1]])
+        repo.refs['refs/heads/master'] = c2.id
+        request = (pkt_line('want %s side-band-64k thin-pack ofs-delta\n' %
+                            c2.id) +
+                   pkt_line(None) + pkt_line('done\n'))
+        response = StringIO()
+        proto = Protocol(StringIO(request).read, response.write)
+        handler = UploadPackHandler(DictBackend({'/': repo}), ['/'], proto)
+        handler.handle()
+        stats = handler.stats
+        self.assertEqual(len(request), stats.bytes_read)
+        self.assertEqual(len(response.getvalue()), stats.bytes_written)
+        # Two commits with the same empty tree
+        self.assertEqual({'wants': 1, 'objects': 3}, stats.counts)
+        self.assertEqual(
+            ['advertise', 'compressing', 'counting', 'negotiate', 'writing'],
+            sorted(stats.timings))
+
+    def test_stats_existing_callback(self):
+        repo = MemoryRepo.init_bare([], {})
+        c1, = build_commit_graph(repo.object_store, [[1]])
+        repo.refs['refs/heads/master'] = c1.id
+        request = (pkt_line('want %s side-band-64k thin-pack ofs-delta\n' %
+                            c1.id) +
+                   pkt_line(None) + pkt_line('done\n'))
+        response = StringIO()
+        activity = {'read': 0, 'write': 0}
+        def report_activity(nbytes, direction):
+            activity[direction] += nbytes
+        proto = Protocol(StringIO(request).read, response.write,
+                         report_activity=report_activity)
+        handler = UploadPackHandler(DictBackend({'/': repo}), ['/'], proto)
+        handler.handle()
+        self.assertEqual(len(request), activity['read'])
+        self.assertEqual(len(response.getvalue()), activity['write'])
+        self.assertEqual(len(request), handler.stats.bytes_read)
+        self.assertEqual(len(response.getvalue()), handler.stats.bytes_written)
+
+
 class TestUploadPackHandler(UploadPackHandler):
     @classmethod
     def required_capabilities(self):
@@ -666,6 +725,110 @@ class FileSystemBackendTests(TestCase):
             self.backend.open_repository, os.path.join(self.path, "foo"))
 
 
+class CachingBackendTests(TestCase):
+    """Tests for CachingBackend."""
+
+    def make_repo(self, data):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        repo = Repo.init(path)
+        blob = make_object(Blob, data=data)
+        repo.object_store.add_objects([(blob, None)])
+        return path, blob
+
+    def test_nonexistant(self):
+        backend = CachingBackend()
+        self.assertRaises(NotGitRepository,
+            backend.open_repository, "/does/not/exist/unless/foo")
+
+    def test_cached(self):
+        path, blob = self.make_repo('yummy data')
+        backend = CachingBackend()
+        repo = backend.open_repository(path)
+        self.assertEqual('yummy data', repo[blob.id].data)
+        self.assertTrue(repo is backend.open_repository(path))
+        self.assertTrue(repo.object_store.pack_handle_cache is
+                        backend.pack_handle_cache)
+        self.assertTrue(repo.object_store.delta_base_cache is
+                        backend.delta_base_cache)
+        self.assertEqual(1, len(backend.pack_handle_cache))
+
+    def test_packed_refs(self):
+        path, blob = self.make_repo('yummy data')
+        backend = CachingBackend()
+        repo = backend.open_repository(path)
+        repo.refs['refs/heads/master'] = blob.id
+        self.assertEqual({'master': blob.id}, repo.refs.as_dict('refs/heads'))
+        # Pack the refs behind the back of the backend, like git pack-refs.
+        f = open(os.path.join(path, '.git', 'packed-refs'), 'wb')
+        try:
+            f.write('%s refs/heads/master\n%s refs/heads/b1\n' %
+                    (blob.id, blob.id))
+        finally:
+            f.close()
+        os.remove(os.path.join(path, '.git', 'refs', 'heads', 'master'))
+        repo = backend.open_repository(path)
+        self.assertEqual({'master': blob.id, 'b1': blob.id},
+                         repo.refs.as_dict('refs/heads'))
+
+    def test_max_repos(self):
+        path1, blob1 = self.make_repo('yummy data')
+        path2, blob2 = self.make_repo('more data')
+        backend = CachingBackend(max_repos=1)
+        repo1 = backend.open_repository(path1)
+        self.assertEqual('yummy data', repo1[blob1.id].data)
+        pack1, = repo1.object_store.packs
+        repo2 = backend.open_repository(path2)
+        self.assertEqual('more data', repo2[blob2.id].data)
+        # The packs of evicted repositories are released.
+        self.assertFalse(pack1.is_open())
+        self.assertEqual(1, len(backend.pack_handle_cache))
+        self.assertFalse(repo1 is backend.open_repository(path1))
+
+    def test_max_open_packs(self):
+        path1, blob1 = self.make_repo('yummy data')
+        path2, blob2 = self.make_repo('more data')
+        backend = CachingBackend(max_open_packs=1)
+        repo1 = backend.open_repository(path1)
+        repo2 = backend.open_repository(path2)
+        self.assertEqual('yummy data', repo1[blob1.id].data)
+        self.assertEqual('more data', repo2[blob2.id].data)
+        self.assertEqual(1, len(backend.pack_handle_cache))
+        self.assertEqual('yummy data', repo1[blob1.id].data)
+
+    def test_removed(self):
+        path, blob = self.make_repo('yummy data')
+        backend = CachingBackend()
+        backend.open_repository(path)
+        shutil.rmtree(path)
+        self.assertRaises(NotGitRepository, backend.open_repository, path)
+
+    def test_close(self):
+        path, blob = self.make_repo('yummy data')
+        backend = CachingBackend()
+        repo = backend.open_repository(path)
+        self.assertEqual('yummy data', repo[blob.id].data)
+        backend.close()
+        self.assertEqual(0, len(backend.pack_handle_cache))
+        self.assertFalse(repo is backend.open_repository(path))
+
+    def test_threads(self):
+        path, blob = self.make_repo('yummy data')
+        backend = CachingBackend(max_open_packs=1)
+        results = []
+        def read():
+            for i in range(50):
+                repo = backend.open_repository(path)
+                repo.object_store.close()
+                results.append(repo.object_store.get_raw(blob.id))
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([(Blob.type_num, 'yummy data')] * 200, results)
+
+
 class ServeCommandTests(TestCase):
     """Tests for serve_command."""
 
@@ -689,3 +852,104 @@ class ServeCommandTests(TestCase):
             outlines[0][4:].split("\x00")[0])
         self.assertEquals("0000", outlines[-1])
         self.assertEquals(0, exitcode)
+
+
+class _PidHandler(object):
+    """Handler that sends its process id and waits for a flush-pkt."""
+
+    started = []
+
+    def __init__(self, backend, args, proto):
+        self.proto = proto
+
+    def handle(self):
+        self.started.append(os.getpid())
+        self.proto.write_pkt_line(str(os.getpid()))
+        self.proto.read_pkt_line()
+        self.proto.write_pkt_line('done')
+
+
+class TCPGitServerTests(TestCase):
+
+    server_cls = TCPGitServer
+    server_kwargs = {}
+
+    def setUp(self):
+        super(TCPGitServerTests, self).setUp()
+        _PidHandler.started[:] = []
+
+    def start_server(self, **kwargs):
+        kwargs.update(self.server_kwargs)
+        server = self.server_cls(DictBackend({}), 'localhost', 0,
+                                 handlers={'git-pid': _PidHandler}, **kwargs)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def connect(self, server):
+        sock = socket.create_connection(server.server_address, 5)
+        self.addCleanup(sock.close)
+        proto = Protocol(sock.makefile('rb').read, sock.sendall)
+        proto.send_cmd('git-pid', '/')
+        return proto
+
+    def test_timeout(self):
+        server = self.start_server(connection_timeout=0.05)
+        sock = socket.create_connection(server.server_address, 5)
+        self.addCleanup(sock.close)
+        # The server closes the connection once the command doesn't arrive in
+        # time.
+        self.assertEqual('', sock.recv(1))
+
+    def test_request(self):
+        server = self.start_server()
+        proto = self.connect(server)
+        proto.read_pkt_line()
+        proto.write_pkt_line(None)
+        self.assertEqual('done', proto.read_pkt_line())
+
+
+class ThreadedTCPGitServerTests(TCPGitServerTests):
+
+    server_cls = ThreadedTCPGitServer
+    server_kwargs = {'workers': 2}
+
+    def test_concurrent(self):
+        server = self.start_server()
+        proto1 = self.connect(server)
+        proto2 = self.connect(server)
+        # Both connections are handled at the same time.
+        self.assertEqual(str(os.getpid()), proto1.read_pkt_line())
+        self.assertEqual(str(os.getpid()), proto2.read_pkt_line())
+        proto3 = self.connect(server)
+        self.assertEqual(2, len(_PidHandler.started))
+        proto1.write_pkt_line(None)
+        self.assertEqual('done', proto1.read_pkt_line())
+        # The queued connection is handled once a worker is available.
+        self.assertEqual(str(os.getpid()), proto3.read_pkt_line())
+        for proto in (proto2, proto3):
+            proto.write_pkt_line(None)
+            self.assertEqual('done', proto.read_pkt_line())
+
+
+class PreforkingTCPGitServerTests(TCPGitServerTests):
+
+    server_cls = PreforkingTCPGitServer
+    server_kwargs = {'workers': 2}
+
+    def test_concurrent(self):
+        server = self.start_server()
+        proto1 = self.connect(server)
+        proto2 = self.connect(server)
+        pid1 = int(proto1.read_pkt_line())
+        pid2 = int(proto2.read_pkt_line())
+        self.assertNotEqual(pid1, pid2)
+        self.assertNotEqual(os.getpid(), pid1)
+        for proto in (proto1, proto2):
+            proto.write_pkt_line(None)
+            self.assertEqual('done', proto.read_pkt_line())
+
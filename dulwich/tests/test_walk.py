@@ -409,3 +409,48 @@ class WalkerTest(TestCase):
         # Ensure that c1..y4 get excluded even though they're popped from the
         # priority queue long before y5.
         self.assertWalkYields([m6, x2], [m6.id], exclude=[y5.id])
+
+
+class GenerationObjectStore(MemoryObjectStore):
+    """Object store that knows the generation numbers of its commits."""
+
+    def get_generation(self, sha):
+        generations = {}
+        todo = [sha]
+        while todo:
+            current = todo[-1]
+            if current in generations:
+                todo.pop()
+                continue
+            try:
+                parents = self.get_parents(current)
+            except KeyError:
+                return None
+            missing = [p for p in parents if p not in generations]
+            if missing:
+                todo.extend(missing)
+                continue
+            generations[current] = 1 + max([0] + [generations[p]
+                                                  for p in parents])
+            todo.pop()
+        return generations[sha]
+
+
+class GenerationWalkerTest(WalkerTest):
+
+    def setUp(self):
+        self.store = GenerationObjectStore()
+
+    def test_skew_beyond_extra_commits(self):
+        # Create the following graph:
+        # b1--...--b8--y9--m11
+        #               \
+        #                e10
+        # Due to skew, e10 is the oldest commit, so all other commits are
+        # popped from the queue before it.
+        commit_spec = [[1]] + [[i, i - 1] for i in range(2, 10)]
+        commit_spec.extend([[10, 9], [11, 9]])
+        cs = self.make_commits(commit_spec, times=range(10, 19) + [0, 19])
+        self.assertWalkYields([cs[10]], [cs[10].id], exclude=[cs[9].id])
+        self.assertWalkYields(reversed(cs[:9]), [cs[8].id])
+
@@ -20,13 +20,18 @@
 
 from cStringIO import StringIO
 import gzip
+import httplib
 import os
 import re
 import shutil
+import threading
 
 from dulwich.tests.compat.utils import (
     import_repo_to_dir,
     )
+from dulwich.gzip import (
+    GzipConsumer,
+    )
 from dulwich.log_utils import (
     getLogger
     )
@@ -61,11 +66,15 @@ from dulwich.web import (
     get_info_refs,
     get_info_packs,
     handle_service_request,
+    _ChunkedFile,
     _LengthLimitedFile,
     GunzipFilter,
+    KeepAliveHTTPGitRequestHandler,
     LimitedInputFilter,
     HTTPGitRequest,
     HTTPGitApplication,
+    ThreadingWSGIServer,
+    make_server,
     )
 from dulwich.web.paster import (
     make_app,
@@ -390,6 +399,75 @@ class LengthLimitedFileTestCase(TestCase):
         self.assertEquals('', f.read())
 
 
+class ChunkedFileTestCase(TestCase):
+
+    def test_read(self):
+        f = _ChunkedFile(StringIO('3\r\nfoo\r\n3;x=y\r\nbar\r\n0\r\n\r\nnext'))
+        self.assertEquals('foobar', f.read())
+        self.assertEquals('', f.read())
+
+    def test_multiple_reads(self):
+        input = StringIO('3\r\nfoo\r\n3\r\nbar\r\n0\r\nX-Foo: bar\r\n\r\nnext')
+        f = _ChunkedFile(input)
+        self.assertEquals('fo', f.read(2))
+        self.assertEquals('oba', f.read(3))
+        self.assertEquals('r', f.read(5))
+        self.assertEquals('', f.read(5))
+        # Nothing after the body was read.
+        self.assertEquals('next', input.read())
+
+
+class KeepAliveHTTPGitRequestHandlerTests(TestCase):
+
+    def setUp(self):
+        super(KeepAliveHTTPGitRequestHandlerTests, self).setUp()
+        self._server = make_server('localhost', 0, self._app,
+            server_class=ThreadingWSGIServer,
+            handler_class=KeepAliveHTTPGitRequestHandler)
+        server_thread = threading.Thread(target=self._server.serve_forever)
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(self._server.shutdown)
+        self._conn = httplib.HTTPConnection('localhost',
+                                            self._server.server_port)
+        self.addCleanup(self._conn.close)
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        body = environ['wsgi.input'].read(3)
+        return iter([environ['PATH_INFO'], ' ', body])
+
+    def request(self, path, body=None):
+        self._conn.request('POST', path, body)
+        resp = self._conn.getresponse()
+        return resp, resp.read()
+
+    def test_keep_alive(self):
+        resp, body = self.request('/foo', 'abcdef')
+        self.assertEquals('/foo abc', body)
+        self.assertFalse(resp.will_close)
+        sock = self._conn.sock
+        resp, body = self.request('/bar', 'ghi')
+        self.assertEquals('/bar ghi', body)
+        self.assertTrue(sock is self._conn.sock)
+
+    def test_chunked_request(self):
+        self._conn.putrequest('POST', '/foo')
+        self._conn.putheader('Transfer-Encoding', 'chunked')
+        self._conn.endheaders()
+        self._conn.send('2\r\nab\r\n4\r\ncdef\r\n0\r\n\r\n')
+        resp = self._conn.getresponse()
+        self.assertEquals('/foo abc', resp.read())
+        self.assertEquals('/bar ghi', self.request('/bar', 'ghi')[1])
+
+    def test_http_1_0(self):
+        self._conn._http_vsn = 10
+        self._conn._http_vsn_str = 'HTTP/1.0'
+        resp, body = self.request('/foo', 'abc')
+        self.assertEquals('/foo abc', body)
+        self.assertTrue(resp.will_close)
+
+
 class HTTPGitRequestTestCase(WebTestCase):
 
     # This class tests the contents of the actual cache headers
@@ -495,6 +573,23 @@ class GunzipTestCase(HTTPGitApplicationTestCase):
         self.assertLess(zlength, int(self._environ['CONTENT_LENGTH']))
         self.assertNotIn('HTTP_CONTENT_ENCODING', self._environ)
 
+    def test_call_no_content_length(self):
+        self._add_handler(self._app.app)
+        orig = self.__class__.__doc__ * 10000
+        zstream = self._get_zstream(orig)
+        zstream.seek(0)
+        self._environ['wsgi.input'] = zstream
+        self._app(self._environ, None)
+        self.assertEquals(orig, self._environ['wsgi.input'].read())
+        self.assertEquals(len(orig), int(self._environ['CONTENT_LENGTH']))
+
+    def test_consumer_split_header(self):
+        data = self._get_zstream('foo').getvalue()
+        consumer = GzipConsumer()
+        consumer.feed(data[:5])
+        consumer.feed(data[5:])
+        self.assertEquals('foo', consumer.close().getvalue())
+
 class PasterFactoryTests(TestCase):
     """Tests for the Paster factory and filter functions."""
 
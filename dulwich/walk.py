@@ -89,7 +89,18 @@ class WalkEntry(object):
 
 
 class _CommitTimeQueue(object):
-    """Priority queue of WalkEntry objects by commit time."""
+    """Priority queue of WalkEntry objects by commit time.
+
+    The queue only uses the get_parents and get_commit_time methods of the
+    store, which may be able to answer without parsing the commits. Commits
+    are only retrieved for the entries that are returned.
+
+    If the store knows the generation numbers of the commits, commits are held
+    back until it is certain that they are not excluded, and walking stops
+    as soon as only excluded commits are left. Otherwise, the queue walks a
+    number of extra commits past that point and relies on the Walker to
+    drop commits that turn out to be excluded.
+    """
 
     def __init__(self, walker):
         self._walker = walker
@@ -100,60 +111,116 @@ class _CommitTimeQueue(object):
         self._seen = set()
         self._done = set()
         self._min_time = walker.since
-        self._last = None
+        self._last_time = None
         self._extra_commits_left = _MAX_EXTRA_COMMITS
         self._is_finished = False
+        self._generations = {}
+        # Number of queued commits per generation number, and a heap of the
+        # negated generation numbers that may still be queued.
+        self._queued_generations = {}
+        self._generation_heap = []
+        self._use_generations = bool(self._excluded)
+        self._held = collections.deque()
 
         for commit_id in itertools.chain(walker.include, walker.excluded):
             self._push(commit_id)
 
     def _push(self, commit_id):
         try:
-            commit = self._store[commit_id]
+            commit_time = self._store.get_commit_time(commit_id)
         except KeyError:
             raise MissingCommitError(commit_id)
         if commit_id not in self._pq_set and commit_id not in self._done:
-            heapq.heappush(self._pq, (-commit.commit_time, commit))
+            if self._use_generations:
+                generation = self._store.get_generation(commit_id)
+                if generation is None:
+                    self._use_generations = False
+                else:
+                    self._generations[commit_id] = generation
+                    count = self._queued_generations.get(generation, 0)
+                    if not count:
+                        heapq.heappush(self._generation_heap, -generation)
+                    self._queued_generations[generation] = count + 1
+            heapq.heappush(self._pq, (-commit_time, commit_id))
             self._pq_set.add(commit_id)
             self._seen.add(commit_id)
 
-    def _exclude_parents(self, commit):
+    def _pop(self):
+        neg_time, sha = heapq.heappop(self._pq)
+        self._pq_set.remove(sha)
+        generation = self._generations.get(sha)
+        if generation is not None:
+            self._queued_generations[generation] -= 1
+        return -neg_time, sha
+
+    def _max_queued_generation(self):
+        heap = self._generation_heap
+        while not self._queued_generations[-heap[0]]:
+            heapq.heappop(heap)
+        return -heap[0]
+
+    def _next_held(self, final=False):
+        """Return the next held back commit that is known not to be excluded.
+
+        A commit can only be excluded through an excluded descendant, which
+        has a higher generation number. So once no commit in the queue has a
+        higher generation number than a held commit, it is final.
+
+        :param final: If True, return held commits regardless of the queue
+        :return: A WalkEntry, or None
+        """
+        held = self._held
+        while held:
+            sha = held[0]
+            if sha in self._excluded:
+                held.popleft()
+                continue
+            if not final and self._use_generations and self._pq:
+                generation = self._generations[sha]
+                if self._max_queued_generation() > generation:
+                    return None
+            held.popleft()
+            return WalkEntry(self._walker, self._store[sha])
+        return None
+
+    def _exclude_parents(self, commit_id):
         excluded = self._excluded
         seen = self._seen
-        todo = [commit]
+        todo = [commit_id]
         while todo:
-            commit = todo.pop()
-            for parent in commit.parents:
+            commit_id = todo.pop()
+            for parent in self._store.get_parents(commit_id):
                 if parent not in excluded and parent in seen:
-                    # TODO: This is inefficient unless the object store does
-                    # some caching (which DiskObjectStore currently does not).
-                    # We could either add caching in this class or pass around
-                    # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+                    todo.append(parent)
                 excluded.add(parent)
 
     def next(self):
         if self._is_finished:
-            return None
+            return self._next_held(final=True)
         while self._pq:
-            _, commit = heapq.heappop(self._pq)
-            sha = commit.id
-            self._pq_set.remove(sha)
+            entry = self._next_held()
+            if entry is not None:
+                return entry
+            commit_time, sha = self._pop()
             if sha in self._done:
                 continue
-            self._done.add(commit.id)
+            self._done.add(sha)
 
-            for parent_id in commit.parents:
+            for parent_id in self._store.get_parents(sha):
                 self._push(parent_id)
 
             reset_extra_commits = True
             is_excluded = sha in self._excluded
             if is_excluded:
-                self._exclude_parents(commit)
-                if self._pq and all(c.id in self._excluded
+                self._exclude_parents(sha)
+                if self._pq and all(c in self._excluded
                                     for _, c in self._pq):
-                    _, n = self._pq[0]
-                    if n.commit_time >= self._last.commit_time:
+                    if self._use_generations:
+                        if not self._held:
+                            # Only excluded commits and their ancestors are
+                            # left, so there is nothing more to return.
+                            break
+                    elif -self._pq[0][0] >= self._last_time:
                         # If the next commit is newer than the last one, we need
                         # to keep walking in case its parents (which we may not
                         # have seen yet) are excluded. This gives the excluded
@@ -164,7 +231,7 @@ class _CommitTimeQueue(object):
                         reset_extra_commits = False
 
             if (self._min_time is not None and
-                commit.commit_time < self._min_time):
+                commit_time < self._min_time):
                 # We want to stop walking at min_time, but commits at the
                 # boundary may be out of order with respect to their parents. So
                 # we walk _MAX_EXTRA_COMMITS more commits once we hit this
@@ -180,10 +247,13 @@ class _CommitTimeQueue(object):
                     break
 
             if not is_excluded:
-                self._last = commit
-                return WalkEntry(self._walker, commit)
+                self._last_time = commit_time
+                if self._use_generations:
+                    self._held.append(sha)
+                    continue
+                return WalkEntry(self._walker, self._store[sha])
         self._is_finished = True
-        return None
+        return self._next_held(final=True)
 
 
 class Walker(object):
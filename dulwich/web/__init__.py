@@ -228,6 +228,50 @@ class _LengthLimitedFile(object):
     # TODO: support more methods as necessary
 
 
+class _ChunkedFile(object):
+    """Wrapper class to read a body sent with chunked transfer encoding.
+
+    EOF is read once the last chunk has been read.
+    """
+
+    def __init__(self, input):
+        self._input = input
+        self._chunk_left = 0
+        self._done = False
+
+    def _next_chunk(self):
+        line = self._input.readline()
+        self._chunk_left = int(line.split(';', 1)[0], 16)
+        if not self._chunk_left:
+            # Skip the trailer
+            while self._input.readline() not in ('\r\n', '\n', ''):
+                pass
+            self._done = True
+
+    def read(self, size=-1):
+        ret = []
+        while not self._done and size != 0:
+            if not self._chunk_left:
+                self._next_chunk()
+                continue
+            if size < 0 or size > self._chunk_left:
+                data = self._input.read(self._chunk_left)
+            else:
+                data = self._input.read(size)
+            if not data:
+                self._done = True
+                break
+            ret.append(data)
+            self._chunk_left -= len(data)
+            if size > 0:
+                size -= len(data)
+            if not self._chunk_left:
+                self._input.readline()
+        return ''.join(ret)
+
+    # TODO: support more methods as necessary
+
+
 def handle_service_request(req, backend, mat):
     service = mat.group().lstrip('/')
     logger.info('Handling service request for %s', service)
@@ -240,6 +284,9 @@ def handle_service_request(req, backend, mat):
     proto = ReceivableProtocol(req.environ['wsgi.input'].read, write)
     handler = handler_cls(backend, [url_prefix(mat)], proto, http_req=req)
     handler.handle()
+    stats = getattr(handler, 'stats', None)
+    if stats is not None:
+        logger.info('Handled service request for %s: %s', service, stats)
 
 
 class HTTPGitRequest(object):
@@ -355,6 +402,10 @@ class HTTPGitApplication(object):
         return handler(req, self.backend, mat)
 
 
+# Size of the blocks GunzipFilter reads compressed request bodies in.
+_GUNZIP_BUFSIZE = 65536
+
+
 class GunzipFilter(object):
     """WSGI middleware that unzips gzip-encoded requests before
     passing on to the underlying application.
@@ -369,9 +420,18 @@ class GunzipFilter(object):
             # so that anything further in the chain sees
             # a regular stream, and all relevant HTTP headers
             # are updated
-            zlength = int(environ.get('CONTENT_LENGTH', '0'))
+            input = environ['wsgi.input']
+            content_length = environ.get('CONTENT_LENGTH', '')
+            if content_length:
+                input = _LengthLimitedFile(input, int(content_length))
+            # Without a Content-Length (e.g. for requests sent with chunked
+            # transfer encoding), the body extends to the end of the input.
             consumer = GzipConsumer()
-            consumer.feed(environ['wsgi.input'].read(zlength))
+            while True:
+                data = input.read(_GUNZIP_BUFSIZE)
+                if not data:
+                    break
+                consumer.feed(data)
             buf = consumer.close()
             environ.pop('HTTP_CONTENT_ENCODING')
 
@@ -393,8 +453,8 @@ class LimitedInputFilter(object):
     def __call__(self, environ, start_response):
         # This is not necessary if this app is run from a conforming WSGI
         # server. Unfortunately, there's no way to tell that at this point.
-        # TODO: git may used HTTP/1.1 chunked encoding instead of specifying
-        # content-length
+        # Bodies sent with chunked encoding have no content-length; the
+        # server has to decode them and provide EOF at their end.
         content_length = environ.get('CONTENT_LENGTH', '')
         if content_length:
             input = environ['wsgi.input']
@@ -417,13 +477,33 @@ def make_wsgi_chain(backend, dumb=False, handlers=None):
 # distributed with python 2.4. If wsgiref is not present, users will not be able
 # to use the HTTP server without a little extra work.
 try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    import socket
+    from SocketServer import ThreadingMixIn
     from wsgiref.simple_server import (
+        ServerHandler,
         WSGIRequestHandler,
+        WSGIServer,
         make_server,
         )
 
     class HTTPGitRequestHandler(WSGIRequestHandler):
-        """Handler that uses dulwich's logger for logging exceptions."""
+        """Handler that uses dulwich's logger for logging exceptions.
+
+        Request bodies sent with chunked transfer encoding are decoded.
+        """
+
+        def handle(self):
+            self.raw_requestline = self.rfile.readline(65537)
+            if not self.parse_request():
+                return
+            input = self.rfile
+            if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                input = _ChunkedFile(self.rfile)
+            handler = ServerHandler(
+                input, self.wfile, self.get_stderr(), self.get_environ())
+            handler.request_handler = self
+            handler.run(self.server.get_app())
 
         def log_exception(self, exc_info):
             logger.exception('Exception happened during processing of request',
@@ -436,6 +516,93 @@ try:
             logger.error(*args)
 
 
+    class _KeepAliveServerHandler(ServerHandler):
+        """Server handler that keeps the connection open after a response.
+
+        Responses without a Content-Length are sent with chunked transfer
+        encoding to HTTP/1.1 clients.
+        """
+
+        http_version = '1.1'
+        chunked = False
+        keep_alive = False
+        completed = False
+
+        def cleanup_headers(self):
+            ServerHandler.cleanup_headers(self)
+            if 'Content-Length' in self.headers:
+                self.keep_alive = True
+            elif self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = self.keep_alive = True
+            else:
+                self.headers['Connection'] = 'close'
+
+        def write(self, data):
+            if self.status and not self.headers_sent:
+                self.send_headers()
+            if self.chunked and data:
+                data = '%x\r\n%s\r\n' % (len(data), data)
+            ServerHandler.write(self, data)
+
+        def finish_content(self):
+            ServerHandler.finish_content(self)
+            if self.chunked:
+                self._write('0\r\n\r\n')
+                self._flush()
+            self.completed = True
+
+
+    class KeepAliveHTTPGitRequestHandler(HTTPGitRequestHandler):
+        """Handler that serves multiple requests over the same connection.
+
+        This should be used with a server that handles each connection in a
+        separate thread, such as ThreadingWSGIServer, as the connection stays
+        open between requests.
+        """
+
+        protocol_version = 'HTTP/1.1'
+
+        # Idle connections are closed after this many seconds.
+        timeout = 60
+
+        def handle(self):
+            # WSGIRequestHandler.handle only handles a single request.
+            BaseHTTPRequestHandler.handle(self)
+
+        def handle_one_request(self):
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            except socket.timeout:
+                self.raw_requestline = ''
+            if not self.raw_requestline:
+                self.close_connection = 1
+                return
+            if not self.parse_request():
+                return
+            # The body has to be read up to its end to find the next request.
+            if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                input = _ChunkedFile(self.rfile)
+            else:
+                input = _LengthLimitedFile(self.rfile,
+                    int(self.headers.get('content-length') or 0))
+            handler = _KeepAliveServerHandler(
+                input, self.wfile, self.get_stderr(), self.get_environ())
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+            if not (handler.completed and handler.keep_alive):
+                self.close_connection = 1
+                return
+            while input.read(65536):
+                pass
+
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        """WSGI server that handles each connection in a separate thread."""
+
+        daemon_threads = True
+
+
     def main(argv=sys.argv):
         """Entry point for starting an HTTP git server."""
         if len(argv) > 1:
@@ -451,7 +618,8 @@ try:
         backend = DictBackend({'/': Repo(gitdir)})
         app = make_wsgi_chain(backend)
         server = make_server(listen_addr, port, app,
-                             handler_class=HTTPGitRequestHandler)
+                             server_class=ThreadingWSGIServer,
+                             handler_class=KeepAliveHTTPGitRequestHandler)
         logger.info('Listening for HTTP connections on %s:%d', listen_addr,
                     port)
         server.serve_forever()